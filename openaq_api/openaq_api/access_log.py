@@ -0,0 +1,145 @@
+import atexit
+import logging
+import threading
+from collections import deque
+from typing import NamedTuple
+
+import orjson
+
+from openaq_api.models.logging import LogType, WarnLog
+from openaq_api.settings import settings
+
+
+class AccessLogRecord(NamedTuple):
+    """The raw fields of an HTTPLog, captured on the request path"""
+
+    type: LogType
+    http_code: int | None
+    timing: float
+    rate_limiter: str | None
+    counter: int | None
+    ip: str | None
+    api_key: str | None
+    user_agent: str | None
+    path: str
+    params: str
+    server_timing: dict[str, float] | None = None
+
+
+def http_log_json(record: AccessLogRecord) -> str:
+    """Serializes a record the way HTTPLog.model_dump_json does"""
+    params_obj = dict(x.split("=", 1) for x in record.params.split("&") if "=" in x)
+    return orjson.dumps(
+        {
+            "type": record.type.value,
+            "detail": None,
+            "httpCode": record.http_code,
+            "timing": record.timing,
+            "rateLimiter": record.rate_limiter,
+            "counter": record.counter,
+            "serverTiming": record.server_timing,
+            "ip": record.ip,
+            "apiKey": record.api_key,
+            "userAgent": record.user_agent,
+            "path": record.path,
+            "params": record.params,
+            "paramsObj": params_obj,
+            "paramsKeys": list(params_obj.keys()),
+        }
+    ).decode()
+
+
+class AccessLog:
+    """Bounded buffer of access log records emitted by a background thread
+
+    Requests only append the raw record, serialization and the logging
+    handlers run in the thread, which drains the buffer in batches of
+    `batch_size` or every `flush_interval` seconds. Records are dropped and
+    counted when the buffer is full. A frozen Lambda environment does not
+    run the thread, so the buffer is also flushed at application shutdown.
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        max_size: int = 10000,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+    ) -> None:
+        self.logger = logger
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer: deque[AccessLogRecord] = deque()
+        self.dropped = 0
+        self.emitted = 0
+        self._reported_dropped = 0
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._closed = False
+
+    def put(self, record: AccessLogRecord) -> bool:
+        """Adds a record to the buffer, False if it was dropped"""
+        if len(self.buffer) >= self.max_size:
+            self.dropped += 1
+            return False
+        self.buffer.append(record)
+        if self._thread is None and not self._closed:
+            self._start()
+        if len(self.buffer) >= self.batch_size:
+            self._wake.set()
+        return True
+
+    def _start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run, name="access-log", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """Emits every buffered record, returns the number emitted"""
+        emitted = 0
+        with self._lock:
+            while self.buffer:
+                batch = [
+                    self.buffer.popleft()
+                    for _ in range(min(self.batch_size, len(self.buffer)))
+                ]
+                for record in batch:
+                    self.logger.info(http_log_json(record))
+                emitted += len(batch)
+            self.emitted += emitted
+            dropped = self.dropped - self._reported_dropped
+            if dropped:
+                self._reported_dropped += dropped
+                self.logger.warning(
+                    WarnLog(
+                        detail=f"access log buffer full, dropped {dropped} records"
+                    ).model_dump_json()
+                )
+        return emitted
+
+    def close(self) -> None:
+        """Stops the thread and emits the remaining records"""
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+
+
+access_log = AccessLog(
+    logging.getLogger("middleware"),
+    max_size=settings.LOG_BUFFER_SIZE,
+    batch_size=settings.LOG_BATCH_SIZE,
+    flush_interval=settings.LOG_FLUSH_INTERVAL,
+)
+atexit.register(access_log.close)
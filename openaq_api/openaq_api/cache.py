@@ -0,0 +1,809 @@
+import asyncio
+import hashlib
+import logging
+import math
+import random
+import re
+import sys
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from functools import lru_cache
+
+import msgpack
+import orjson
+from aiocache.base import BaseCache
+from aiocache.serializers import NullSerializer
+from pydantic import BaseModel
+from starlette.requests import Request
+
+from openaq_api.models.logging import InfrastructureErrorLog
+from openaq_api.settings import settings
+
+logger = logging.getLogger("cache")
+
+# rough per object overhead used when estimating the resident size of a
+# result set, covers the Record/tuple header and the hash table slot
+RECORD_OVERHEAD = 64
+# number of rows sampled from a result set to estimate the average row size
+SIZE_SAMPLE_ROWS = 10
+
+
+class CachePolicy(BaseModel):
+    """How the query cache treats the results of a route
+
+    Attributes:
+        ttl: seconds a result is fresh.
+        stale_ttl: seconds past `ttl` that a stale result is still served
+            while it is refreshed in the background, 0 disables
+            stale-while-revalidate.
+        early_refresh: XFetch beta, when > 0 a fresh result is refreshed
+            in the background with a probability that rises as it nears
+            expiry, scaled by how long the query took. 1 is the usual value.
+    """
+
+    ttl: int
+    stale_ttl: int = 0
+    early_refresh: float = 0
+
+
+# default cache policies by route path. Routes not listed here use
+# settings.API_CACHE_TIMEOUT. Values can be overridden with the
+# API_CACHE_TIMEOUTS, API_CACHE_STALE_TIMEOUTS and API_CACHE_EARLY_REFRESH
+# settings e.g. API_CACHE_TIMEOUTS='{"/v3/parameters": 60}'
+ROUTE_CACHE_POLICIES = {
+    "/v2/parameters": CachePolicy(ttl=3600),
+    "/v1/parameters": CachePolicy(ttl=3600),
+    "/v2/manufacturers": CachePolicy(ttl=3600),
+    "/v2/models": CachePolicy(ttl=3600),
+    "/v3/parameters": CachePolicy(ttl=3600),
+    "/v3/parameters/{parameters_id}": CachePolicy(ttl=3600),
+    "/v3/countries": CachePolicy(ttl=3600),
+    "/v3/countries/{countries_id}": CachePolicy(ttl=3600),
+    "/v3/providers": CachePolicy(ttl=3600),
+    "/v3/providers/{providers_id}": CachePolicy(ttl=3600),
+    "/v3/manufacturers": CachePolicy(ttl=3600),
+    "/v3/owners": CachePolicy(ttl=3600),
+    # percentile aggregations that can take seconds to compute
+    "/v3/sensors/{sensors_id}": CachePolicy(ttl=900, stale_ttl=3600, early_refresh=1),
+    "/v3/locations/{locations_id}/trends/{measurands_id}": CachePolicy(
+        ttl=900, stale_ttl=3600, early_refresh=1
+    ),
+}
+
+
+def route_path(request: Request | None) -> str | None:
+    """Returns the path template of the route handling the request
+
+    e.g. `/v3/locations/{locations_id}` rather than `/v3/locations/2178` so
+    that all requests to the same route share a cache policy.
+    """
+    if request is None:
+        return None
+    route = request.scope.get("route")
+    if route is not None and hasattr(route, "path"):
+        return route.path
+    return request.url.path
+
+
+def route_policy(request: Request | None) -> CachePolicy:
+    """Resolves the cache policy for the route handling the request.
+
+    Args:
+        request: the current request, may be None outside of a request cycle
+
+    Returns:
+        the route's CachePolicy with any settings overrides applied
+    """
+    path = route_path(request)
+    policy = ROUTE_CACHE_POLICIES.get(path)
+    if policy is None:
+        policy = CachePolicy(ttl=settings.API_CACHE_TIMEOUT)
+    overrides = {}
+    if path in settings.API_CACHE_TIMEOUTS:
+        overrides["ttl"] = settings.API_CACHE_TIMEOUTS[path]
+    if path in settings.API_CACHE_STALE_TIMEOUTS:
+        overrides["stale_ttl"] = settings.API_CACHE_STALE_TIMEOUTS[path]
+    if path in settings.API_CACHE_EARLY_REFRESH:
+        overrides["early_refresh"] = settings.API_CACHE_EARLY_REFRESH[path]
+    if overrides:
+        policy = policy.model_copy(update=overrides)
+    return policy
+
+
+# single/double quoted literals are kept as is, runs of whitespace and
+# comments are collapsed
+SQL_TOKENS = re.compile(
+    r"""('(?:[^']|'')*'|"(?:[^"]|"")*")|((?:\s|--[^\n]*|/\*.*?\*/)+)""",
+    re.S,
+)
+SQL_PUNCTUATION = ",()"
+
+
+def _normalize_sql_token(match: re.Match) -> str:
+    if match.group(1):
+        return match.group(1)
+    before = match.string[match.start() - 1] if match.start() > 0 else ","
+    after = match.string[match.end()] if match.end() < len(match.string) else ","
+    if before in SQL_PUNCTUATION or after in SQL_PUNCTUATION:
+        return ""
+    return " "
+
+
+@lru_cache(maxsize=1024)
+def normalize_sql(query: str) -> str:
+    """Normalizes SQL text for use in a cache key.
+
+    Strips comments and collapses whitespace outside of quoted literals so
+    that queries which only differ in formatting share a key. The normalized
+    text is only used for keys, the original SQL is what gets executed.
+
+    Args:
+        query: SQL text
+
+    Returns:
+        normalized SQL text
+    """
+    return SQL_TOKENS.sub(_normalize_sql_token, query).strip()
+
+
+def _params_default(obj):
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=str)
+    return str(obj)
+
+
+def query_key(query: str, params: dict) -> str:
+    """Builds a stable cache key from a query and its parameters.
+
+    Uses a BLAKE2 digest of the normalized SQL and the parameters serialized
+    with sorted keys, unlike the builtin `hash` it is the same across
+    processes and is wide enough that collisions are not a concern.
+
+    Args:
+        query: SQL text with buildpg style `:name` placeholders
+        params: query parameters
+
+    Returns:
+        hex digest
+    """
+    h = hashlib.blake2b(digest_size=20)
+    h.update(normalize_sql(query).encode())
+    h.update(b"\x00")
+    h.update(
+        orjson.dumps(
+            params,
+            option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS,
+            default=_params_default,
+        )
+    )
+    return h.hexdigest()
+
+
+class CacheEntry:
+    """A cached value with the timestamps needed for stale-while-revalidate
+
+    Attributes:
+        value: the cached query result.
+        stale_at: unix timestamp after which the value is stale.
+        expires_at: unix timestamp after which the value can not be served.
+        delta: seconds it took to compute the value.
+    """
+
+    __slots__ = ("value", "stale_at", "expires_at", "delta")
+
+    def __init__(self, value, stale_at: float, expires_at: float, delta: float = 0):
+        self.value = value
+        self.stale_at = stale_at
+        self.expires_at = expires_at
+        self.delta = delta
+
+
+def _value_size(value) -> int:
+    """Shallow recursive size estimate of a single column value"""
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            _value_size(k) + _value_size(v) for k, v in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_value_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+def estimate_size(value) -> int:
+    """Estimates the memory used by a cached query result.
+
+    Result sets are sized by sampling the first rows and multiplying the
+    average row size by the row count, walking every row of a large result
+    set would cost more than the query cache saves.
+
+    Args:
+        value: a list of asyncpg Records or any other python object
+
+    Returns:
+        estimated size in bytes
+    """
+    if isinstance(value, CacheEntry):
+        return RECORD_OVERHEAD + estimate_size(value.value)
+    if isinstance(value, list):
+        if len(value) == 0:
+            return sys.getsizeof(value)
+        sample = value[:SIZE_SAMPLE_ROWS]
+        row_size = sum(
+            RECORD_OVERHEAD + sum(_value_size(v) for v in row) for row in sample
+        ) / len(sample)
+        return sys.getsizeof(value) + int(row_size * len(value))
+    if isinstance(value, (bytes, str)):
+        return sys.getsizeof(value)
+    return RECORD_OVERHEAD + _value_size(value)
+
+
+class LRUMemoryBackend:
+    """In process LRU cache with a memory budget.
+
+    Entries are evicted least recently used first once either the estimated
+    resident size goes over `max_bytes` or the number of entries goes over
+    `max_entries`. Expired entries are dropped lazily when they are read or
+    when they reach the end of the LRU list. A `ttl` of None never expires,
+    a `ttl` of 0 or less has already expired.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 128 * 1024 * 1024,
+        max_entries: int | None = None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        # key -> (value, expires_at, size)
+        self._cache = OrderedDict()
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expired(self, expires_at: float | None) -> bool:
+        return expires_at is not None and expires_at <= time.monotonic()
+
+    def _pop(self, key):
+        value, _, size = self._cache.pop(key)
+        self.resident_bytes -= size
+        return value
+
+    def _evict(self):
+        while self._cache and (
+            self.resident_bytes > self.max_bytes
+            or (self.max_entries is not None and len(self._cache) > self.max_entries)
+        ):
+            key, (_, expires_at, size) = self._cache.popitem(last=False)
+            self.resident_bytes -= size
+            if self._expired(expires_at):
+                self.expirations += 1
+            else:
+                self.evictions += 1
+
+    async def _get(self, key, encoding="utf-8", _conn=None):
+        entry = self._cache.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at, _ = entry
+        if self._expired(expires_at):
+            self._pop(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return value
+
+    async def _gets(self, key, encoding="utf-8", _conn=None):
+        return await self._get(key, encoding=encoding, _conn=_conn)
+
+    async def _multi_get(self, keys, encoding="utf-8", _conn=None):
+        return [await self._get(key, encoding=encoding) for key in keys]
+
+    async def _set(self, key, value, ttl=None, _cas_token=None, _conn=None):
+        if _cas_token is not None:
+            current = self._cache.get(key)
+            if current is None or current[0] != _cas_token:
+                return 0
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            logger.debug(f"not caching {key}, {size} bytes is over the cache budget")
+            return False
+        if key in self._cache:
+            self._pop(key)
+        if ttl is not None and ttl <= 0:
+            return True
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._cache[key] = (value, expires_at, size)
+        self.resident_bytes += size
+        self._evict()
+        return True
+
+    async def _multi_set(self, pairs, ttl=None, _conn=None):
+        for key, value in pairs:
+            await self._set(key, value, ttl=ttl)
+        return True
+
+    async def _add(self, key, value, ttl=None, _conn=None):
+        if await self._exists(key):
+            raise ValueError(f"Key {key} already exists, use .set to update the value")
+        await self._set(key, value, ttl=ttl)
+        return True
+
+    async def _exists(self, key, _conn=None):
+        entry = self._cache.get(key)
+        return entry is not None and not self._expired(entry[1])
+
+    async def _increment(self, key, delta, _conn=None):
+        entry = self._cache.get(key)
+        if entry is None or self._expired(entry[1]):
+            await self._set(key, delta)
+            return delta
+        value, expires_at, size = entry
+        try:
+            value = int(value) + delta
+        except ValueError:
+            raise TypeError("Value is not an integer") from None
+        self._cache[key] = (value, expires_at, size)
+        return value
+
+    async def _expire(self, key, ttl, _conn=None):
+        entry = self._cache.get(key)
+        if entry is None:
+            return False
+        if ttl is not None and ttl <= 0:
+            self._pop(key)
+            return True
+        value, _, size = entry
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._cache[key] = (value, expires_at, size)
+        return True
+
+    async def _delete(self, key, _conn=None):
+        if key in self._cache:
+            self._pop(key)
+            return 1
+        return 0
+
+    async def _clear(self, namespace=None, _conn=None):
+        if namespace:
+            for key in [k for k in self._cache if str(k).startswith(namespace)]:
+                self._pop(key)
+        else:
+            self._cache.clear()
+            self.resident_bytes = 0
+        return True
+
+    async def _raw(self, command, *args, encoding="utf-8", _conn=None, **kwargs):
+        return getattr(self._cache, command)(*args, **kwargs)
+
+    @property
+    def stats(self) -> dict:
+        """Counters describing the state of the cache"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "entries": len(self._cache),
+            "resident_bytes": self.resident_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class LRUMemoryCache(LRUMemoryBackend, BaseCache):
+    """
+    Bounded memory cache implementation with the following components as defaults:
+        - serializer: :class:`aiocache.serializers.NullSerializer`
+        - plugins: None
+
+    Config options are:
+
+    :param max_bytes: estimated memory budget in bytes.
+    :param max_entries: optional maximum number of entries.
+    :param serializer: obj derived from :class:`aiocache.serializers.BaseSerializer`.
+    :param plugins: list of :class:`aiocache.plugins.BasePlugin` derived classes.
+    :param namespace: string to use as default prefix for the key used in all operations of
+        the backend. Default is None.
+    :param timeout: int or float in seconds specifying maximum timeout for the operations to last.
+        By default its 5.
+    """
+
+    NAME = "lru_memory"
+
+    def __init__(self, serializer=None, **kwargs):
+        super().__init__(**kwargs)
+        self.serializer = serializer or NullSerializer()
+
+    @classmethod
+    def parse_uri_path(cls, path):
+        return {}
+
+
+class CachedRecord:
+    """Read only stand in for an asyncpg Record loaded from the shared cache.
+
+    Supports the parts of the Record interface used by the routers, access
+    by index or column name, `keys()` and conversion with `dict()`.
+    """
+
+    __slots__ = ("_values", "_index")
+
+    def __init__(self, values: tuple, index: dict[str, int]):
+        self._values = values
+        self._index = index
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self._values[self._index[key]]
+        return self._values[key]
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __eq__(self, other):
+        return tuple(self) == tuple(other) and list(self.keys()) == list(other.keys())
+
+    def __repr__(self):
+        items = " ".join(f"{k}={v!r}" for k, v in self.items())
+        return f"<CachedRecord {items}>"
+
+    def get(self, key, default=None):
+        if key in self._index:
+            return self[key]
+        return default
+
+    def keys(self):
+        return iter(self._index)
+
+    def values(self):
+        return iter(self._values)
+
+    def items(self):
+        return zip(self._index, self._values)
+
+
+EXT_DATETIME = 1
+EXT_DATE = 2
+EXT_DECIMAL = 3
+EXT_TIMEDELTA = 4
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, datetime):
+        return msgpack.ExtType(EXT_DATETIME, obj.isoformat().encode())
+    if isinstance(obj, date):
+        return msgpack.ExtType(EXT_DATE, obj.isoformat().encode())
+    if isinstance(obj, Decimal):
+        return msgpack.ExtType(EXT_DECIMAL, str(obj).encode())
+    if isinstance(obj, timedelta):
+        return msgpack.ExtType(
+            EXT_TIMEDELTA, msgpack.packb([obj.days, obj.seconds, obj.microseconds])
+        )
+    # stored as a string the value would not load as the same type
+    raise TypeError(f"cannot store {type(obj).__name__} in the shared cache")
+
+
+def _msgpack_ext_hook(code: int, data: bytes):
+    if code == EXT_DATETIME:
+        return datetime.fromisoformat(data.decode())
+    if code == EXT_DATE:
+        return date.fromisoformat(data.decode())
+    if code == EXT_DECIMAL:
+        return Decimal(data.decode())
+    if code == EXT_TIMEDELTA:
+        days, seconds, microseconds = msgpack.unpackb(data)
+        return timedelta(days=days, seconds=seconds, microseconds=microseconds)
+    return msgpack.ExtType(code, data)
+
+
+def dumps_entry(entry: CacheEntry) -> bytes:
+    """Serializes a cached query result for the shared cache.
+
+    Rows are stored as msgpack arrays with the column names stored once
+    rather than once per row.
+
+    Args:
+        entry: CacheEntry with a list of asyncpg Records as value
+
+    Returns:
+        msgpack bytes
+    """
+    records = entry.value
+    columns = list(records[0].keys()) if len(records) > 0 else []
+    return msgpack.packb(
+        {
+            "c": columns,
+            "r": [tuple(r) for r in records],
+            "s": entry.stale_at,
+            "e": entry.expires_at,
+            "d": entry.delta,
+        },
+        default=_msgpack_default,
+    )
+
+
+def loads_entry(data: bytes) -> CacheEntry:
+    """Loads a cached query result serialized with `dumps_entry`"""
+    payload = msgpack.unpackb(data, ext_hook=_msgpack_ext_hook, strict_map_key=False)
+    index = {c: i for i, c in enumerate(payload["c"])}
+    records = [CachedRecord(tuple(r), index) for r in payload["r"]]
+    return CacheEntry(records, payload["s"], payload["e"], payload["d"])
+
+
+class RedisQueryCache:
+    """Query cache shared between instances through redis.
+
+    Any redis error marks the cache as unavailable for `retry_after`
+    seconds, during which every operation is skipped so that a redis outage
+    only costs the first request a timeout.
+    """
+
+    def __init__(
+        self,
+        client,
+        namespace: str = "openaq-api:query:v1:",
+        retry_after: int = 30,
+    ):
+        self.client = client
+        self.namespace = namespace
+        self.retry_after = retry_after
+        self.unavailable_until = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.skipped = 0
+
+    @property
+    def available(self) -> bool:
+        return self.unavailable_until <= time.monotonic()
+
+    def _error(self, e: Exception):
+        self.errors += 1
+        self.unavailable_until = time.monotonic() + self.retry_after
+        logger.warning(
+            InfrastructureErrorLog(
+                detail=f"query cache redis unavailable, using local cache only: {e}"
+            ).model_dump_json()
+        )
+
+    async def get(self, key: str) -> CacheEntry | None:
+        if not self.available:
+            self.skipped += 1
+            return None
+        try:
+            data = await self.client.get(f"{self.namespace}{key}")
+        except Exception as e:
+            self._error(e)
+            return None
+        if data is None:
+            self.misses += 1
+            return None
+        try:
+            entry = loads_entry(data)
+        except Exception as e:
+            # e.g. written by a version that stored rows differently
+            logger.warning(f"dropping unreadable shared cache entry {key}: {e}")
+            self.misses += 1
+            await self.delete(key)
+            return None
+        self.hits += 1
+        return entry
+
+    async def delete(self, key: str):
+        try:
+            await self.client.delete(f"{self.namespace}{key}")
+        except Exception as e:
+            self._error(e)
+
+    async def set(self, key: str, entry: CacheEntry):
+        ttl = math.ceil(entry.expires_at - time.time())
+        if not self.available or not isinstance(entry.value, list) or ttl <= 0:
+            return
+        try:
+            data = dumps_entry(entry)
+        except TypeError as e:
+            # kept in the local cache only
+            logger.debug(f"not sharing {key}: {e}")
+            return
+        try:
+            await self.client.set(f"{self.namespace}{key}", data, ex=ttl)
+        except Exception as e:
+            self._error(e)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "available": self.available,
+        }
+
+
+class SingleFlight:
+    """Deduplicates concurrent calls for the same key.
+
+    The first caller for a key starts the call as a task and every caller
+    that arrives while it is running awaits the same task. Callers await
+    the task through `asyncio.shield`, so a cancelled caller, e.g. a client
+    that disconnected, does not cancel the call for the others. Exceptions
+    are raised to every caller.
+    """
+
+    def __init__(self):
+        self._calls: dict[str, asyncio.Task] = {}
+        self.calls = 0
+        self.shared = 0
+
+    def running(self, key: str) -> bool:
+        return key in self._calls
+
+    def _done(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # retrieve the exception so a call that every caller gave up on does
+        # not log "Task exception was never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: str, fn):
+        """Runs `fn()` or joins the call already running for `key`
+
+        Args:
+            key: key identifying identical calls
+            fn: callable returning an awaitable
+
+        Returns:
+            the result of `fn()`
+        """
+        task = self._calls.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+
+class QueryCache:
+    """Two tier query cache, process local L1 in front of an optional
+    shared L2.
+
+    L2 hits are copied into L1 for the remainder of their timeout. Writes
+    to L2 happen in the background so a slow redis never delays a response.
+
+    Routes with a `stale_ttl` keep serving a result for that long after it
+    goes stale while a single background task refreshes it. Routes with
+    `early_refresh` refresh hot results before they go stale using XFetch
+    (Vattani et al., "Optimal Probabilistic Cache Stampede Prevention").
+    """
+
+    def __init__(self, l1: BaseCache, l2: RedisQueryCache | None = None):
+        self.l1 = l1
+        self.l2 = l2
+        self.flights = SingleFlight()
+        self.stale_served = 0
+        self.early_refreshes = 0
+        self.background_refreshes = 0
+        self.background_errors = 0
+        self._refreshing = set()
+        self._tasks = set()
+
+    async def fetch(self, key: str, loader, policy: CachePolicy):
+        """Returns the cached value for key, calling `loader` on a miss.
+
+        Concurrent misses for the same key share a single call to `loader`
+        so that an expired popular entry only costs one query.
+
+        Args:
+            key: cache key
+            loader: callable returning an awaitable of the value to cache
+            policy: the CachePolicy of the route
+        """
+        entry = await self.get_entry(key)
+        now = time.time()
+        if entry is None or now >= entry.expires_at:
+            return await self.flights.do(key, lambda: self._load(key, loader, policy))
+        if now >= entry.stale_at:
+            self.stale_served += 1
+            self._refresh(key, loader, policy)
+        elif policy.early_refresh > 0 and (
+            now - entry.delta * policy.early_refresh * math.log(random.random())
+            >= entry.stale_at
+        ):
+            self.early_refreshes += 1
+            self._refresh(key, loader, policy)
+        return entry.value
+
+    async def _load(self, key: str, loader, policy: CachePolicy):
+        start = time.time()
+        value = await loader()
+        now = time.time()
+        entry = CacheEntry(
+            value,
+            stale_at=now + policy.ttl,
+            expires_at=now + policy.ttl + policy.stale_ttl,
+            delta=now - start,
+        )
+        await self.set_entry(key, entry)
+        return value
+
+    def _refresh(self, key: str, loader, policy: CachePolicy):
+        """Reloads the value for key in the background"""
+        if key in self._refreshing or self.flights.running(key):
+            return
+        self.background_refreshes += 1
+        self._refreshing.add(key)
+        task = asyncio.ensure_future(
+            self.flights.do(key, lambda: self._load(key, loader, policy))
+        )
+        self._tasks.add(task)
+        task.add_done_callback(lambda t: self._refreshed(key, t))
+
+    def _refreshed(self, key: str, task: asyncio.Task):
+        self._refreshing.discard(key)
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.background_errors += 1
+            logger.warning(f"background cache refresh failed: {task.exception()}")
+
+    async def get(self, key: str):
+        entry = await self.get_entry(key)
+        return entry.value if entry is not None else None
+
+    async def get_entry(self, key: str) -> CacheEntry | None:
+        entry = await self.l1.get(key)
+        if entry is not None or self.l2 is None:
+            return entry
+        entry = await self.l2.get(key)
+        if entry is None:
+            return None
+        ttl = entry.expires_at - time.time()
+        if ttl > 0:
+            await self.l1.set(key, entry, ttl=ttl)
+        return entry
+
+    async def set(self, key: str, value, ttl: int):
+        now = time.time()
+        await self.set_entry(key, CacheEntry(value, now + ttl, now + ttl))
+
+    async def set_entry(self, key: str, entry: CacheEntry):
+        await self.l1.set(key, entry, ttl=entry.expires_at - time.time())
+        if self.l2 is not None:
+            task = asyncio.create_task(self.l2.set(key, entry))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "l1": self.l1.stats,
+            "l2": self.l2.stats if self.l2 is not None else None,
+            "single_flight": {
+                "calls": self.flights.calls,
+                "shared": self.flights.shared,
+                "in_flight": self.flights.in_flight,
+            },
+            "stale_served": self.stale_served,
+            "early_refreshes": self.early_refreshes,
+            "background_refreshes": self.background_refreshes,
+            "background_errors": self.background_errors,
+        }
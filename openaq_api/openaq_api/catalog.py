@@ -0,0 +1,358 @@
+import asyncio
+import logging
+import math
+import struct
+import time
+from array import array
+from decimal import Decimal
+
+from pydantic import BaseModel
+
+from openaq_api.models.logging import WarnLog
+from openaq_api.models.responses import Meta
+from openaq_api.spatial import GridIndex, distance
+from openaq_api.v3.models.responses import aliased_jsonb
+
+logger = logging.getLogger("catalog")
+
+# query fields the catalog answers, any other field set on a query sends it
+# to the database
+CATALOG_FIELDS = frozenset(
+    {
+        "locations_id",
+        "providers_id",
+        "owner_contacts_id",
+        "countries_id",
+        "iso",
+        "mobile",
+        "monitor",
+        "bbox",
+        "coordinates",
+        "radius",
+        "limit",
+        "page",
+    }
+)
+
+# set bit positions of every byte value
+_BITS = tuple(tuple(i for i in range(8) if b >> i & 1) for b in range(256))
+_FLOAT = struct.Struct("<f")
+_UINT = struct.Struct("<I")
+# the distance entry of every row, null as the database returns it without
+# a radius and filled in for radius searches
+_DISTANCE = b'"distance": null'
+
+
+def _float32(value: float) -> float:
+    return _FLOAT.unpack(_FLOAT.pack(value))[0]
+
+
+def _next_float32(value: float, up: bool) -> float:
+    if value == 0:
+        return _FLOAT.unpack(_UINT.pack(0x00000001 if up else 0x80000001))[0]
+    bits = _UINT.unpack(_FLOAT.pack(value))[0]
+    bits += 1 if (value > 0) == up else -1
+    return _FLOAT.unpack(_UINT.pack(bits))[0]
+
+
+def float_down(value: float) -> float:
+    """The largest float4 not above value, as PostGIS rounds box minimums"""
+    f = _float32(value)
+    return f if f <= value else _next_float32(f, up=False)
+
+
+def float_up(value: float) -> float:
+    """The smallest float4 not below value, as PostGIS rounds box maximums"""
+    f = _float32(value)
+    return f if f >= value else _next_float32(f, up=True)
+
+
+def jsonb_float(value: float) -> bytes:
+    """A float8 as `to_jsonb` prints it, the shortest exact digits without
+    an exponent"""
+    text = repr(value)
+    if text.endswith(".0"):
+        text = text[:-2]
+    return format(Decimal(text), "f").encode()
+
+
+def bitmask(positions) -> int:
+    """An int with the bits of the given row positions set"""
+    bits = bytearray()
+    for position in positions:
+        byte = position >> 3
+        if byte >= len(bits):
+            bits.extend(bytes(byte + 1 - len(bits)))
+        bits[byte] |= 1 << (position & 7)
+    return int.from_bytes(bits, "little")
+
+
+def mask_positions(mask: int, offset: int, limit: int) -> list[int]:
+    """Row positions of the set bits of mask, skipping the first `offset`"""
+    positions = []
+    data = mask.to_bytes((mask.bit_length() + 7) // 8, "little")
+    for index, byte in enumerate(data):
+        if not byte:
+            continue
+        bits = _BITS[byte]
+        if offset >= len(bits):
+            offset -= len(bits)
+            continue
+        for bit in bits[offset:]:
+            positions.append(index * 8 + bit)
+            if len(positions) == limit:
+                return positions
+        offset = 0
+    return positions
+
+
+class CatalogSnapshot:
+    """The locations of locations_view_cached at one point in time
+
+    Rows are kept in id order with the JSON text the database builds for
+    each row of the locations response, so pages are assembled without
+    re-serializing. Every filter value maps to an int bitmask of the rows
+    that match it, filters are combined with bitwise operations on whole
+    masks. Points are bucketed in a grid index for bbox and radius searches.
+    Bounding boxes are matched against float4 boxes rounded outward the way
+    PostGIS `&&` compares them, radius searches against geodesic distances
+    on the WGS 84 spheroid as `ST_DWithin` on geography.
+    """
+
+    def __init__(self, rows) -> None:
+        self.loaded_at = time.time()
+        self.ids = array("q")
+        self.json: list[bytes] = []
+        # where the distance entry goes in the JSON of each row
+        self.distance_at = array("q")
+        self.index: dict[int, int] = {}
+        providers: dict[int, list[int]] = {}
+        owners: dict[int, list[int]] = {}
+        countries: dict[int, list[int]] = {}
+        isos: dict[str, list[int]] = {}
+        mobile: dict[bool, list[int]] = {}
+        monitor: dict[bool, list[int]] = {}
+        # point of each row, NaN without a point so that no comparison
+        # matches
+        self.xs = array("d")
+        self.ys = array("d")
+        # float4 box of each row as xmin, ymin, xmax, ymax
+        self.boxes = array("d")
+        for position, row in enumerate(rows):
+            self.ids.append(row["id"])
+            text = row["json"].encode()
+            at = text.find(_DISTANCE)
+            if at < 0 or not text[at + len(_DISTANCE) :].startswith(b", "):
+                at = -1
+            self.json.append(text)
+            self.distance_at.append(at)
+            self.index[row["id"]] = position
+            for values, key in (
+                (providers, row["providers_id"]),
+                (owners, row["owner_contacts_id"]),
+                (countries, row["countries_id"]),
+                (isos, row["iso"]),
+                (mobile, row["is_mobile"]),
+                (monitor, row["is_monitor"]),
+            ):
+                if key is not None:
+                    values.setdefault(key, []).append(position)
+            x, y = row["x"], row["y"]
+            if x is None or y is None:
+                self.xs.append(math.nan)
+                self.ys.append(math.nan)
+                self.boxes.extend((math.nan,) * 4)
+                continue
+            self.xs.append(x)
+            self.ys.append(y)
+            self.boxes.extend((float_down(x), float_down(y), float_up(x), float_up(y)))
+        self.all = (1 << len(self.ids)) - 1
+        self.providers = {k: bitmask(v) for k, v in providers.items()}
+        self.owners = {k: bitmask(v) for k, v in owners.items()}
+        self.countries = {k: bitmask(v) for k, v in countries.items()}
+        self.isos = {k: bitmask(v) for k, v in isos.items()}
+        self.mobile = {k: bitmask(v) for k, v in mobile.items()}
+        self.monitor = {k: bitmask(v) for k, v in monitor.items()}
+        self.grid = GridIndex(self.xs, self.ys)
+        # radius pages need every row to take a distance
+        self.distances = all(at >= 0 for at in self.distance_at)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def supports(self, query) -> bool:
+        """Whether every filter set on the query is answered by the catalog"""
+        if query.has("radius") and query.radius and not self.distances:
+            return False
+        return all(
+            name in CATALOG_FIELDS or not query.has(name)
+            for name in type(query).model_fields
+        )
+
+    @staticmethod
+    def _any(masks: dict, values) -> int:
+        mask = 0
+        for value in values:
+            mask |= masks.get(value, 0)
+        return mask
+
+    def _bbox(self, minx: float, miny: float, maxx: float, maxy: float) -> int:
+        xmin, ymin = float_down(minx), float_down(miny)
+        xmax, ymax = float_up(maxx), float_up(maxy)
+        boxes = self.boxes
+        matches = []
+        # the float4 box of a point is at most a float4 step from the point
+        for position in self.grid.bbox(xmin - 1e-3, ymin - 1e-3, xmax, ymax):
+            i = position * 4
+            if (
+                boxes[i] <= xmax
+                and boxes[i + 2] >= xmin
+                and boxes[i + 1] <= ymax
+                and boxes[i + 3] >= ymin
+            ):
+                matches.append(position)
+        return bitmask(matches)
+
+    def within(self, lon: float, lat: float, radius: float) -> list[int]:
+        """Ids, in ascending order, of the locations within `radius` meters
+        of lon, lat"""
+        return [self.ids[p] for p in self.grid.within(lon, lat, radius)]
+
+    def mask(self, query) -> int:
+        """Bitmask of the rows matching the filters of the query"""
+        mask = self.all
+        if query.has("locations_id"):
+            position = self.index.get(query.locations_id)
+            mask = 0 if position is None else 1 << position
+        if query.has("providers_id"):
+            mask &= self._any(self.providers, query.providers_id)
+        if query.has("owner_contacts_id"):
+            mask &= self._any(self.owners, query.owner_contacts_id)
+        if query.has("countries_id"):
+            mask &= self._any(self.countries, query.countries_id)
+        if query.has("iso"):
+            mask &= self.isos.get(query.iso, 0)
+        if query.has("mobile"):
+            mask &= self.mobile.get(query.mobile, 0)
+        if query.has("monitor"):
+            mask &= self.monitor.get(query.monitor, 0)
+        if query.has("bbox") and query.bbox:
+            mask &= self._bbox(query.minx, query.miny, query.maxx, query.maxy)
+        if query.has("radius") and query.radius:
+            positions = self.grid.within(query.lon, query.lat, query.radius)
+            mask &= bitmask(positions)
+        return mask
+
+    def _with_distance(self, position: int, lon: float, lat: float) -> bytes:
+        at = self.distance_at[position]
+        text = self.json[position]
+        value = distance(lon, lat, self.xs[position], self.ys[position])
+        return b"".join(
+            (text[:at], _DISTANCE[:-4], jsonb_float(value), text[at + len(_DISTANCE) :])
+        )
+
+    def page(self, query, kwargs: dict) -> tuple[Meta, bytes]:
+        """A page of results as `DB.fetchRawPage` returns it
+
+        Args:
+            query: the locations query
+            kwargs: the query parameters, as passed to `fetchRawPage`
+        """
+        limit = kwargs.get("limit", 1000)
+        kwargs["offset"] = abs((kwargs.get("page", 1) - 1) * limit)
+        mask = self.mask(query)
+        positions = mask_positions(mask, kwargs["offset"], limit)
+        # as fetchRawPage, the count is only known from a non empty page
+        kwargs["found"] = mask.bit_count() if positions else 0
+        if query.has("radius") and query.radius:
+            rows = (self._with_distance(p, query.lon, query.lat) for p in positions)
+        else:
+            rows = (self.json[p] for p in positions)
+        return Meta.model_validate(kwargs), b"[" + b", ".join(rows) + b"]"
+
+
+class LocationCatalog:
+    """In process copy of locations_view_cached for the locations routes
+
+    The catalog is loaded with `load` and reloaded in the background once it
+    is older than `refresh_interval` seconds. Until the first load succeeds
+    the routes query the database.
+
+    Args:
+        fields: the select list of the locations response
+        model: the response model of a location, each row is stored as the
+            JSON the database builds of it from `fields`
+        refresh_interval: seconds between reloads
+    """
+
+    def __init__(
+        self, fields: str, model: type[BaseModel], refresh_interval: float = 3600
+    ) -> None:
+        self.fields = fields
+        self.model = model
+        self.refresh_interval = refresh_interval
+        self.snapshot: CatalogSnapshot | None = None
+        self.loads = 0
+        self.errors = 0
+        self._task: asyncio.Task | None = None
+
+    def query(self) -> str:
+        return f"""
+        WITH page AS (
+        SELECT {self.fields}
+        , geom
+        FROM locations_view_cached
+        )
+        SELECT id
+        , (provider->'id')::int as providers_id
+        , (owner->'id')::int as owner_contacts_id
+        , (country->'id')::int as countries_id
+        , country->>'code' as iso
+        , is_mobile
+        , is_monitor
+        , ST_X(geom) as x
+        , ST_Y(geom) as y
+        , {aliased_jsonb(self.model, "j")}::text as json
+        FROM page, to_jsonb(page) as j
+        ORDER BY id
+        """
+
+    async def load(self, pool) -> CatalogSnapshot | None:
+        """Loads the catalog, keeping the previous snapshot on failure"""
+        start = time.time()
+        try:
+            async with pool.acquire() as con:
+                rows = await con.fetch(self.query())
+            # building the masks takes a while for large views
+            snapshot = await asyncio.to_thread(CatalogSnapshot, rows)
+        except Exception as e:
+            self.errors += 1
+            logger.warning(
+                WarnLog(
+                    detail=f"could not load location catalog: {e}"
+                ).model_dump_json()
+            )
+            return self.snapshot
+        self.snapshot = snapshot
+        self.loads += 1
+        logger.debug(
+            "loaded %s locations into the catalog in %.2fs",
+            len(snapshot),
+            time.time() - start,
+        )
+        return snapshot
+
+    async def get(self, db) -> CatalogSnapshot | None:
+        """The current snapshot, scheduling a reload when it is due
+
+        Args:
+            db: the request's DB, reloads run on its analytical pool
+        """
+        snapshot = self.snapshot
+        due = snapshot is None or time.time() - snapshot.loaded_at >= (
+            self.refresh_interval
+        )
+        if due and (self._task is None or self._task.done()):
+            pool = await db.pool("analytical")
+            self._task = asyncio.ensure_future(self.load(pool))
+        return snapshot
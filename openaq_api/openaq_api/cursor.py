@@ -0,0 +1,54 @@
+import base64
+import binascii
+import logging
+from datetime import datetime
+
+import orjson
+
+logger = logging.getLogger("cursor")
+
+# value of the `cursor` query parameter that starts cursor pagination
+CURSOR_START = "*"
+
+# columns a paged query selects to build the cursor of the next page
+CURSOR_FIELDS = ("cursor_datetime", "cursor_id")
+
+
+def encode_cursor(dt: datetime, id: int) -> str:
+    """Builds an opaque cursor token from the ordering key of a row
+
+    Args:
+        dt: datetime of the last row of a page
+        id: id breaking ties between rows with the same datetime
+
+    Returns:
+        url safe token
+    """
+    data = orjson.dumps([dt.isoformat(), id])
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def decode_cursor(token: str) -> tuple[datetime, int]:
+    """Loads the ordering key from a cursor token built with `encode_cursor`
+
+    Raises:
+        ValueError: if the token is not a valid cursor
+    """
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        dt, id = orjson.loads(data)
+        return datetime.fromisoformat(dt), int(id)
+    except (binascii.Error, orjson.JSONDecodeError, TypeError, ValueError) as e:
+        logger.debug(f"invalid cursor {token}: {e}")
+        raise ValueError("cursor is not valid, use the cursor from meta.next")
+
+
+def cursor_params(token: str | None) -> dict:
+    """Query parameters for the ordering key of a cursor token
+
+    Returns an empty dict for the first page of results.
+    """
+    if token is None or token == CURSOR_START:
+        return {}
+    dt, id = decode_cursor(token)
+    return {"cursor_datetime": dt, "cursor_id": id}
@@ -1,49 +1,146 @@
+import asyncio
 import logging
 import time
 import os
+from contextlib import asynccontextmanager
 
 import asyncpg
 from .models.auth import User
 import orjson
-from aiocache import SimpleMemoryCache, cached
 from aiocache.plugins import HitMissRatioPlugin, TimingPlugin
 from buildpg import render
 from fastapi import HTTPException, Request
 from asyncio.exceptions import TimeoutError
+from pydantic import BaseModel
 
+from openaq_api import metrics, timing
+from openaq_api.cache import (
+    LRUMemoryCache,
+    QueryCache,
+    query_key,
+    route_path,
+    route_policy,
+)
+from openaq_api.cursor import CURSOR_FIELDS, cursor_params, encode_cursor
 from openaq_api.settings import settings
+from openaq_api.slow_queries import slow_queries
+from openaq_api.statements import StatementConnection, statements
 
 from .models.responses import Meta, OpenAQResult
+from .v3.models.responses import aliased_jsonb
 
 logger = logging.getLogger("db")
 
 
-def default(obj):
-    return str(obj)
+def dbkey(query, args):
+    return query_key(query, args)
 
 
-def dbkey(m, f, query, args):
-    j = orjson.dumps(
-        args, option=orjson.OPT_OMIT_MICROSECONDS, default=default
-    ).decode()
-    dbkey = f"{query}{j}"
-    h = hash(dbkey)
-    # logger.debug(f"dbkey: {dbkey} h: {h}")
-    return h
+# in memory operations do not need the aiocache timeout wrapper
+# the shared redis tier is attached on startup when API_CACHE_REDIS is set
+query_cache = QueryCache(
+    LRUMemoryCache(
+        max_bytes=settings.API_CACHE_MAX_BYTES,
+        max_entries=settings.API_CACHE_MAX_ENTRIES,
+        timeout=None,
+        plugins=[
+            HitMissRatioPlugin(),
+            TimingPlugin(),
+        ],
+    )
+)
 
 
-cache_config = {
-    "key_builder": dbkey,
-    "cache": SimpleMemoryCache,
-    "noself": True,
-    "plugins": [
-        HitMissRatioPlugin(),
-        TimingPlugin(),
-    ],
-}
+# latency sensitive lookups and expensive aggregations use separate pools so
+# that slow queries cannot hold every connection
+POOLS = ("interactive", "analytical")
 
 
-async def db_pool(pool):
+def pool_options(name: str) -> dict:
+    """Connection options of a named pool from the settings
+
+    `DATABASE_{NAME}_URL` optionally points a pool at a read replica,
+    otherwise pools connect to DATABASE_READ_URL
+    """
+    if name not in POOLS:
+        raise ValueError(f"unknown database pool {name}, use one of {POOLS}")
+    prefix = f"DATABASE_{name.upper()}"
+    return {
+        "dsn": getattr(settings, f"{prefix}_URL") or settings.DATABASE_READ_URL,
+        "command_timeout": getattr(settings, f"{prefix}_TIMEOUT"),
+        "max_size": getattr(settings, f"{prefix}_POOL_SIZE"),
+    }
+
+
+def pool_attribute(name: str) -> str:
+    """app.state attribute of a named pool, the interactive pool is `pool`"""
+    return "pool" if name == "interactive" else f"{name}_pool"
+
+
+@metrics.registry.collector
+def collect_pool_metrics(state) -> None:
+    """Connections of the pools open on app.state"""
+    for name in POOLS:
+        pool = getattr(state, pool_attribute(name), None)
+        if pool is None or not hasattr(pool, "get_size"):
+            continue
+        size, idle = pool.get_size(), pool.get_idle_size()
+        metrics.db_pool_connections.set(size - idle, (name, "in_use"))
+        metrics.db_pool_connections.set(idle, (name, "idle"))
+        metrics.db_pool_max_connections.set(pool.get_max_size(), (name,))
+
+
+query_cache_requests = metrics.registry.counter(
+    "openaq_query_cache_requests_total",
+    "Query cache lookups",
+    ("tier", "result"),
+)
+query_cache_hit_ratio = metrics.registry.gauge(
+    "openaq_query_cache_hit_ratio", "Ratio of in process query cache gets that hit"
+)
+query_cache_operation_seconds = metrics.registry.gauge(
+    "openaq_query_cache_operation_seconds",
+    "Duration of in process query cache operations",
+    ("operation", "stat"),
+)
+query_cache_entries = metrics.registry.gauge(
+    "openaq_query_cache_entries", "Results in the in process query cache"
+)
+query_cache_bytes = metrics.registry.gauge(
+    "openaq_query_cache_bytes", "Estimated size of the in process query cache"
+)
+query_cache_refreshes = metrics.registry.counter(
+    "openaq_query_cache_refreshes_total",
+    "Results refreshed in the background",
+    ("reason",),
+)
+
+
+@metrics.registry.collector
+def collect_cache_metrics(state) -> None:
+    """Counters of the query cache and of its aiocache plugins"""
+    l1 = query_cache.l1
+    stats = l1.stats
+    query_cache_requests.set(stats["hits"], ("memory", "hit"))
+    query_cache_requests.set(stats["misses"], ("memory", "miss"))
+    query_cache_entries.set(stats["entries"])
+    query_cache_bytes.set(stats["resident_bytes"])
+    if query_cache.l2 is not None:
+        query_cache_requests.set(query_cache.l2.hits, ("redis", "hit"))
+        query_cache_requests.set(query_cache.l2.misses, ("redis", "miss"))
+    # set by HitMissRatioPlugin and TimingPlugin on first use
+    ratio = getattr(l1, "hit_miss_ratio", None)
+    if ratio:
+        query_cache_hit_ratio.set(ratio["hit_ratio"])
+    for key, value in getattr(l1, "profiling", {}).items():
+        operation, stat = key.rsplit("_", 1)
+        if stat in ("avg", "min", "max"):
+            query_cache_operation_seconds.set(value, (operation, stat))
+    query_cache_refreshes.set(query_cache.stale_served, ("stale",))
+    query_cache_refreshes.set(query_cache.early_refreshes, ("early",))
+
+
+async def db_pool(pool, name: str = "interactive"):
     # each time we create a connect make sure it can
     # properly convert json/jsonb fields
     async def init(con):
@@ -56,18 +153,61 @@ async def db_pool(pool):
 
     logger.debug(f"Checking for existing pool: {pool}")
     if pool is None:
-        logger.debug("Creating a new pool")
+        logger.debug(f"Creating a new {name} pool")
+        options = pool_options(name)
         pool = await asyncpg.create_pool(
-            settings.DATABASE_READ_URL,
-            command_timeout=6,
+            options["dsn"],
+            command_timeout=options["command_timeout"],
             max_inactive_connection_lifetime=15,
             min_size=1,
-            max_size=10,
+            max_size=options["max_size"],
             init=init,
+            connection_class=StatementConnection,
         )
     return pool
 
 
+def query_error(e: Exception, rquery: str, kwargs: dict) -> Exception:
+    """Maps a database error to the exception returned to the client"""
+    if isinstance(e, asyncpg.exceptions.UndefinedColumnError):
+        logger.error(f"Undefined Column Error: {e}\n{rquery}\n{kwargs}")
+        return ValueError(f"{e}")
+    if isinstance(e, asyncpg.exceptions.CharacterNotInRepertoireError):
+        return ValueError(f"{e}")
+    if isinstance(e, asyncpg.exceptions.DataError):
+        logger.error(f"Data Error: {e}\n{rquery}\n{kwargs}")
+        return ValueError(f"{e}")
+    if isinstance(e, (TimeoutError, asyncpg.exceptions.QueryCanceledError)):
+        return HTTPException(
+            status_code=408,
+            detail="Connection timed out",
+        )
+    if isinstance(e, HTTPException):
+        return e
+    logger.error(f"Unknown database error: {e}\n{rquery}\n{kwargs}")
+    if str(e).startswith("ST_TileEnvelope"):
+        return HTTPException(status_code=422, detail=f"{e}")
+    return HTTPException(status_code=500, detail=f"{e}")
+
+
+_stream_slots: asyncio.Semaphore | None = None
+
+
+def stream_slots() -> asyncio.Semaphore:
+    """The streams that may run at a time in this process"""
+    global _stream_slots
+    if _stream_slots is None:
+        _stream_slots = asyncio.Semaphore(settings.API_STREAM_CONCURRENCY)
+    return _stream_slots
+
+
+def streams_busy() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Too many exports are running, try again later",
+    )
+
+
 class DB:
     def __init__(self, request: Request):
         self.request = request
@@ -77,39 +217,126 @@ class DB:
         pool = await self.pool()
         return pool
 
-    async def pool(self):
-        self.request.app.state.pool = await db_pool(
-            getattr(self.request.app.state, "pool", None)
+    async def pool(self, name: str = "interactive"):
+        state = self.request.app.state
+        attribute = pool_attribute(name)
+        pool = await db_pool(getattr(state, attribute, None), name)
+        setattr(state, attribute, pool)
+        return pool
+
+    @asynccontextmanager
+    async def acquire_timed(self, pool, labels: tuple, timeout: float | None = None):
+        """Acquires a connection, recording the time waited for it
+
+        Args:
+            pool: the connection pool
+            labels: the pool name, route and query name of the metrics
+            timeout: seconds to wait for a connection, None waits until one
+                is released
+        """
+        waiting = labels[:1]
+        metrics.db_pool_waiting.inc(waiting)
+        start = time.perf_counter()
+        acquired = False
+        try:
+            async with pool.acquire(timeout=timeout) as con:
+                acquired = True
+                waited = time.perf_counter() - start
+                metrics.db_pool_waiting.dec(waiting)
+                metrics.db_pool_acquire_seconds.observe(waited, labels)
+                timing.record("acquire", waited)
+                yield con
+        finally:
+            if not acquired:
+                metrics.db_pool_waiting.dec(waiting)
+
+    async def fetch(
+        self,
+        query,
+        kwargs,
+        statement: str | None = None,
+        pool: str = "interactive",
+        cached: bool = True,
+    ):
+        """Runs the query, serving repeated queries from the query cache.
+
+        Identical queries that miss the cache at the same time share one
+        database call. The cache policy is set per route, see
+        `openaq_api.cache.route_policy`
+
+        Args:
+            query: SQL query with :named parameters
+            kwargs: query parameters
+            statement: name of a hot query, the query is then run as a
+                statement prepared once per connection, see
+                `openaq_api.statements`
+            pool: name of the connection pool the query runs on, one of
+                `POOLS`, expensive aggregations use "analytical"
+            cached: False for results cached by the caller, e.g. tiles in
+                the tile cache
+        """
+        if not cached:
+            return await self._fetch(query, kwargs, statement, pool)
+        request_timing = timing.current_timing.get()
+        if request_timing is None:
+            return await query_cache.fetch(
+                dbkey(query, kwargs),
+                lambda: self._fetch(query, kwargs, statement, pool),
+                route_policy(self.request),
+            )
+        # the cache phase is the time not spent on a connection, including
+        # waiting on the same query run for another request
+        phases = request_timing.phases
+        start = time.perf_counter()
+        before = phases.get("acquire", 0) + phases.get("sql", 0)
+        r = await query_cache.fetch(
+            dbkey(query, kwargs),
+            lambda: self._fetch(query, kwargs, statement, pool),
+            route_policy(self.request),
         )
-        return self.request.app.state.pool
+        database = phases.get("acquire", 0) + phases.get("sql", 0) - before
+        request_timing.add("cache", time.perf_counter() - start - database)
+        return r
 
-    @cached(settings.API_CACHE_TIMEOUT, **cache_config)
-    async def fetch(self, query, kwargs):
-        pool = await self.pool()
+    async def _fetch(
+        self,
+        query,
+        kwargs,
+        statement: str | None = None,
+        pool: str = "interactive",
+    ):
+        name = pool
+        pool = await self.pool(name)
         start = time.time()
         logger.debug("Start time: %s\nQuery: %s \nArgs:%s\n", start, query, kwargs)
-        rquery, args = render(query, **kwargs)
-        async with pool.acquire() as con:
+        prepared = statements.get(statement, query) if statement else None
+        if prepared is not None:
+            rquery, args = prepared.sql, prepared.args(kwargs)
+        else:
+            rquery, args = render(query, **kwargs)
+        labels = (name, route_path(self.request), statement or "other")
+        async with self.acquire_timed(pool, labels) as con:
+            query_start = time.perf_counter()
             try:
-                r = await con.fetch(rquery, *args)
-            except asyncpg.exceptions.UndefinedColumnError as e:
-                logger.error(f"Undefined Column Error: {e}\n{rquery}\n{kwargs}")
-                raise ValueError(f"{e}") from e
-            except asyncpg.exceptions.CharacterNotInRepertoireError as e:
-                raise ValueError(f"{e}") from e
-            except asyncpg.exceptions.DataError as e:
-                logger.error(f"Data Error: {e}\n{rquery}\n{kwargs}")
-                raise ValueError(f"{e}") from e
-            except TimeoutError:
-                raise HTTPException(
-                    status_code=408,
-                    detail="Connection timed out",
-                )
+                if prepared is not None:
+                    r = await con.fetch_statement(prepared, args)
+                else:
+                    r = await con.fetch(rquery, *args)
             except Exception as e:
-                logger.error(f"Unknown database error: {e}\n{rquery}\n{kwargs}")
-                if str(e).startswith("ST_TileEnvelope"):
-                    raise HTTPException(status_code=422, detail=f"{e}")
-                raise HTTPException(status_code=500, detail=f"{e}")
+                raise query_error(e, rquery, kwargs) from e
+            finally:
+                took = time.perf_counter() - query_start
+                metrics.db_query_seconds.observe(took, labels)
+                timing.record("sql", took)
+                slow_queries.observe(
+                    rquery,
+                    args,
+                    took,
+                    labels[1],
+                    name,
+                    statement,
+                    lambda: self.pool("analytical"),
+                )
         logger.debug(
             "query took: %s and returned:%s\n -- results_firstrow: %s",
             time.time() - start,
@@ -118,24 +345,133 @@ class DB:
         )
         return r
 
-    async def fetchrow(self, query, kwargs):
-        r = await self.fetch(query, kwargs)
+    async def stream(self, query, kwargs, pool: str = "interactive"):
+        """Streams the results of a query in chunks of rows
+
+        Rows are read through a server side cursor inside a read only
+        transaction so only one chunk is held in memory at a time. Results
+        are not cached. The number of rows is capped at
+        settings.API_STREAM_MAX_ROWS and the query is cancelled after
+        settings.API_STREAM_TIMEOUT seconds.
+
+        Behind the Lambda handler Mangum buffers the whole response body, so
+        the row cap has to keep an export within a Lambda response. At most
+        settings.API_STREAM_CONCURRENCY streams run at a time so that they
+        leave connections to the other queries of the pool, a stream that
+        waits longer than settings.API_STREAM_ACQUIRE_TIMEOUT for its turn or
+        a connection is answered with a 503.
+
+        Args:
+            query: SQL query with :named parameters
+            kwargs: query parameters, paged with `page`/`limit` or `cursor`
+                as in `fetchPage`
+            pool: name of the connection pool, as for `fetch`
+
+        Yields:
+            lists of asyncpg Records
+        """
+        limit = min(kwargs.get("limit", 1000), settings.API_STREAM_MAX_ROWS)
+        kwargs["limit"] = limit
+        cursor = kwargs.get("cursor")
+        if cursor is not None:
+            kwargs["offset"] = 0
+            kwargs.update(cursor_params(cursor))
+        else:
+            kwargs["offset"] = abs((kwargs.get("page", 1) - 1) * limit)
+
+        labels = (pool, route_path(self.request), "stream")
+        pool = await self.pool(pool)
+        rquery, args = render(query, **kwargs)
+        slots = stream_slots()
+        try:
+            await asyncio.wait_for(slots.acquire(), settings.API_STREAM_ACQUIRE_TIMEOUT)
+        except TimeoutError:
+            raise streams_busy()
+        deadline = time.monotonic() + settings.API_STREAM_TIMEOUT
+        rows = 0
+        try:
+            async with self.acquire_timed(
+                pool, labels, timeout=settings.API_STREAM_ACQUIRE_TIMEOUT
+            ) as con:
+                try:
+                    async with con.transaction(readonly=True):
+                        await con.execute(
+                            "SET LOCAL statement_timeout = "
+                            f"{int(settings.API_STREAM_TIMEOUT * 1000)}"
+                        )
+                        cur = await con.cursor(
+                            rquery, *args, timeout=settings.API_STREAM_TIMEOUT
+                        )
+                        while rows < limit:
+                            chunk = await cur.fetch(
+                                min(settings.API_STREAM_CHUNK_SIZE, limit - rows),
+                                timeout=max(deadline - time.monotonic(), 0.001),
+                            )
+                            if len(chunk) == 0:
+                                break
+                            rows += len(chunk)
+                            yield chunk
+                except Exception as e:
+                    raise query_error(e, rquery, kwargs) from e
+        except TimeoutError:
+            # the query errors are mapped above, this is waiting for a connection
+            raise streams_busy()
+        finally:
+            slots.release()
+        logger.debug("streamed %s rows", rows)
+
+    async def fetchrow(
+        self,
+        query,
+        kwargs,
+        statement: str | None = None,
+        pool: str = "interactive",
+        cached: bool = True,
+    ):
+        r = await self.fetch(query, kwargs, statement, pool, cached)
         if len(r) > 0:
             return r[0]
         return []
 
-    async def fetchval(self, query, kwargs):
-        r = await self.fetchrow(query, kwargs)
+    async def fetchval(
+        self,
+        query,
+        kwargs,
+        statement: str | None = None,
+        pool: str = "interactive",
+        cached: bool = True,
+    ):
+        r = await self.fetchrow(query, kwargs, statement, pool, cached)
         if len(r) > 0:
             return r[0]
         return None
 
-    async def fetchPage(self, query, kwargs) -> OpenAQResult:
+    async def fetchPage(
+        self,
+        query,
+        kwargs,
+        statement: str | None = None,
+        pool: str = "interactive",
+    ) -> OpenAQResult:
+        """Fetches a page of results
+
+        Pages are selected with `page` and `limit` unless a `cursor` is
+        given, in which case the query is expected to select the
+        `cursor_datetime` and `cursor_id` ordering key and filter on the
+        ordering key of the previous page. A link to the next page is added
+        to the meta when the page is full.
+        """
         page = kwargs.get("page", 1)
         limit = kwargs.get("limit", 1000)
-        kwargs["offset"] = abs((page - 1) * limit)
+        cursor = kwargs.get("cursor")
+        if cursor is not None:
+            kwargs["offset"] = 0
+            kwargs.update(cursor_params(cursor))
+        else:
+            kwargs["offset"] = abs((page - 1) * limit)
 
-        data = await self.fetch(query, kwargs)
+        data = await self.fetch(query, kwargs, statement, pool)
+        start = time.perf_counter()
         if len(data) > 0:
             if "found" in data[0].keys():
                 kwargs["found"] = data[0]["found"]
@@ -146,11 +482,79 @@ class DB:
         else:
             kwargs["found"] = 0
 
-        output = OpenAQResult(
-            meta=Meta.model_validate(kwargs), results=[dict(x) for x in data]
-        )
+        results = [dict(x) for x in data]
+        if cursor is not None:
+            if len(data) == limit:
+                token = encode_cursor(*(data[-1][f] for f in CURSOR_FIELDS))
+                kwargs["next"] = str(
+                    self.request.url.include_query_params(cursor=token)
+                )
+            for row in results:
+                for f in CURSOR_FIELDS:
+                    row.pop(f, None)
+
+        output = OpenAQResult(meta=Meta.model_validate(kwargs), results=results)
+        timing.record("rows", time.perf_counter() - start)
         return output
 
+    async def fetchRawPage(
+        self,
+        query,
+        kwargs,
+        model: type[BaseModel],
+        statement: str | None = None,
+        pool: str = "interactive",
+    ) -> tuple[Meta, bytes]:
+        """Fetches a page of results as one JSON array built by Postgres
+
+        The page query is wrapped so that Postgres aggregates the rows into
+        a single JSON text which is returned without being decoded, skipping
+        the json codec, response model validation and re-encoding. Each row
+        is built as `model` serializes it, with the fields of the model only
+        and their aliases as keys, fields the query does not select are null.
+
+        Args:
+            query: page query, as for `fetchPage`
+            kwargs: query parameters, as for `fetchPage` without a cursor
+            model: the response model of a result
+            statement: name of a hot query, as for `fetch`, the wrapped
+                query is registered as `{statement}_raw`
+            pool: name of the connection pool, as for `fetch`
+
+        Returns:
+            the page meta and the results as JSON array bytes
+        """
+        page = kwargs.get("page", 1)
+        limit = kwargs.get("limit", 1000)
+        kwargs["offset"] = abs((page - 1) * limit)
+        # rows are numbered as the page query produces them, aggregates are
+        # not ordered otherwise
+        sql = f"""
+        WITH page AS ({query}
+        ), rows AS (
+        SELECT to_jsonb(page) as row
+        , row_number() OVER () as n
+        FROM page
+        )
+        SELECT COALESCE(jsonb_agg({aliased_jsonb(model, "row")} ORDER BY n), '[]')::text as results
+        , COUNT(1) as returned
+        , MAX((row->>'found')::bigint) as found
+        FROM rows
+        """
+        # the wrapped query is a statement of its own
+        raw = f"{statement}_raw" if statement else None
+        data = await self.fetchrow(sql, kwargs, raw, pool)
+        start = time.perf_counter()
+        if data["found"] is not None:
+            kwargs["found"] = data["found"]
+        elif data["returned"] == limit:
+            kwargs["found"] = f">{limit}"
+        else:
+            kwargs["found"] = data["returned"]
+        meta, results = Meta.model_validate(kwargs), data["results"].encode()
+        timing.record("rows", time.perf_counter() - start)
+        return meta, results
+
     async def create_user(self, user: User) -> str:
         """
         calls the create_user plpgsql function to create a new user and entity records
@@ -7,18 +7,22 @@ from pathlib import Path
 from typing import Any
 
 import orjson
-from fastapi import FastAPI, Request
+from fastapi import Depends, FastAPI, Request
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
 from mangum import Mangum
 from pydantic import BaseModel, ValidationError
 from starlette.responses import JSONResponse, RedirectResponse
 
-from openaq_api.db import db_pool
+from openaq_api import metrics, timing
+from openaq_api.access_log import access_log
+from openaq_api.cache import RedisQueryCache
+from openaq_api.db import POOLS, db_pool, pool_attribute, query_cache
 from openaq_api.middleware import (
+    APIKeyCache,
     CacheControlMiddleware,
     LoggingMiddleware,
     RateLimiterMiddleWare,
@@ -29,6 +33,8 @@ from openaq_api.models.logging import (
     UnprocessableEntityLog,
     WarnLog,
 )
+from openaq_api.routers.admin import admin_key
+from openaq_api.routers.admin import router as admin_router
 from openaq_api.routers.auth import router as auth_router
 from openaq_api.routers.averages import router as averages_router
 from openaq_api.routers.cities import router as cities_router
@@ -42,6 +48,7 @@ from openaq_api.routers.projects import router as projects_router
 from openaq_api.routers.sources import router as sources_router
 from openaq_api.routers.summary import router as summary_router
 from openaq_api.settings import settings
+from openaq_api.tile_cache import RedisTileStore, tile_cache
 
 # V3 routers
 from openaq_api.v3.routers import (
@@ -107,17 +114,22 @@ redis_client = None  # initialize for generalize_schema.py
 
 if settings.RATE_LIMITING:
     logger.debug("Connecting to redis")
-    import redis
+    from redis.asyncio import RedisCluster
 
     try:
-        redis_client = redis.RedisCluster(
+        redis_client = RedisCluster(
             host=settings.REDIS_HOST,
             port=settings.REDIS_PORT,
             decode_responses=True,
-            skip_full_coverage_check=True,
             socket_timeout=5,
         )
         app.state.redis_client = redis_client
+        app.state.api_keys = APIKeyCache(
+            redis_client,
+            refresh_interval=settings.API_KEY_CACHE_REFRESH,
+            ttl=settings.API_KEY_CACHE_TTL,
+            negative_ttl=settings.API_KEY_CACHE_NEGATIVE_TTL,
+        )
     except Exception as e:
         logging.error(InfrastructureErrorLog(detail=f"failed to connect to redis: {e}"))
     logger.debug("Redis connected")
@@ -139,6 +151,9 @@ if settings.RATE_LIMITING is True:
             rate_amount=settings.RATE_AMOUNT,
             rate_amount_key=settings.RATE_AMOUNT_KEY,
             rate_time=datetime.timedelta(minutes=settings.RATE_TIME),
+            api_keys=app.state.api_keys,
+            local_batch=settings.RATE_LOCAL_BATCH,
+            local_overdraft=settings.RATE_LOCAL_OVERDRAFT,
         )
     else:
         logger.warning(
@@ -151,7 +166,7 @@ app.include_router(auth_router)
 
 
 app.add_middleware(CacheControlMiddleware, cachecontrol="public, max-age=900")
-app.add_middleware(LoggingMiddleware)
+app.add_middleware(LoggingMiddleware, server_timing=settings.API_SERVER_TIMING)
 
 
 class OpenAQValidationResponseDetail(BaseModel):
@@ -213,15 +228,68 @@ async def startup_event():
     else:
         app.state.counter = 0
 
+    if settings.API_LOCATION_CATALOG and locations.location_catalog.snapshot is None:
+        logger.debug("loading location catalog")
+        await locations.location_catalog.load(app.state.pool)
+
+    if settings.API_CACHE_REDIS and query_cache.l2 is None:
+        if settings.REDIS_HOST:
+            from redis.asyncio import RedisCluster
+
+            logger.debug("Connecting query cache to redis")
+            query_cache.l2 = RedisQueryCache(
+                RedisCluster(
+                    host=settings.REDIS_HOST,
+                    port=settings.REDIS_PORT,
+                    socket_timeout=settings.API_CACHE_REDIS_TIMEOUT,
+                    socket_connect_timeout=settings.API_CACHE_REDIS_TIMEOUT,
+                )
+            )
+        else:
+            logger.warning(
+                WarnLog(
+                    detail="REDIS_HOST not provided but API_CACHE_REDIS set to TRUE"
+                ).model_dump_json()
+            )
+
+    if settings.API_TILE_CACHE_REDIS and not isinstance(
+        tile_cache.store, RedisTileStore
+    ):
+        if settings.REDIS_HOST:
+            from redis.asyncio import RedisCluster
+
+            logger.debug("Connecting tile cache to redis")
+            tile_cache.store = RedisTileStore(
+                RedisCluster(
+                    host=settings.REDIS_HOST,
+                    port=settings.REDIS_PORT,
+                    socket_timeout=settings.API_CACHE_REDIS_TIMEOUT,
+                    socket_connect_timeout=settings.API_CACHE_REDIS_TIMEOUT,
+                )
+            )
+        else:
+            logger.warning(
+                WarnLog(
+                    detail="REDIS_HOST not provided but API_TILE_CACHE_REDIS set to TRUE"
+                ).model_dump_json()
+            )
+
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Application shutdown: de-register the database connection."""
-    if hasattr(app.state, "pool") and not settings.USE_SHARED_POOL:
-        logger.debug("Closing connection")
-        await app.state.pool.close()
-        delattr(app.state, "pool")
-        logger.debug("Connection closed")
+    # Lambda freezes the environment between invocations, emit the access
+    # logs of this invocation before it does
+    access_log.flush()
+    if settings.USE_SHARED_POOL:
+        return
+    for name in POOLS:
+        attribute = pool_attribute(name)
+        if hasattr(app.state, attribute):
+            logger.debug(f"Closing {name} connection")
+            await getattr(app.state, attribute).close()
+            delattr(app.state, attribute)
+            logger.debug(f"{name} connection closed")
 
 
 @app.get("/ping", include_in_schema=False)
@@ -235,6 +303,21 @@ def pong():
     return {"ping": "pong!"}
 
 
+@app.get("/metrics", include_in_schema=False, dependencies=[Depends(admin_key)])
+def metrics_get():
+    """
+    Metrics of this instance in the Prometheus text format:
+    pool connections, waits and query latency, query cache hit ratio,
+    requests in flight and rate limit rejections,
+    with the API_ADMIN_KEY in the X-Admin-Key header
+    """
+    return Response(
+        metrics.registry.render(app.state),
+        media_type=metrics.CONTENT_TYPE,
+        headers={"Cache-Control": "no-store"},
+    )
+
+
 @app.get("/favicon.ico", include_in_schema=False)
 def favico():
     return RedirectResponse("https://openaq.org/assets/graphics/meta/favicon.png")
@@ -249,6 +332,7 @@ app.include_router(trends.router)
 app.include_router(providers.router)
 app.include_router(sensors.router)
 
+app.include_router(admin_router)
 app.include_router(auth_router)
 app.include_router(averages_router)
 app.include_router(cities_router)
@@ -262,6 +346,9 @@ app.include_router(projects_router)
 app.include_router(sources_router)
 app.include_router(summary_router)
 
+if settings.API_SERVER_TIMING:
+    timing.time_endpoints(app.routes)
+
 
 static_dir = Path.joinpath(Path(__file__).resolve().parent, "static")
 
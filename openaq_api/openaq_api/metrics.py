@@ -0,0 +1,225 @@
+import math
+from bisect import bisect_left
+from typing import Callable
+
+# seconds, from a warm cache hit to the slowest analytical query
+BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    20.0,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    """A named metric with a fixed set of labels
+
+    Values are kept per combination of label values, in the order the
+    labels were declared.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+
+    def _key(self, labels: tuple) -> tuple:
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} has labels {self.labels}, got {labels}")
+        return labels
+
+    def set(self, value: float, labels: tuple = ()) -> None:
+        self.values[self._key(labels)] = value
+
+    def get(self, labels: tuple = ()) -> float:
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, self.labels, labels, value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, label_names, labels, value in self.samples():
+            lines.append(
+                f"{name}{_format_labels(label_names, labels)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, labels: tuple = (), amount: float = 1) -> None:
+        self.inc(labels, -amount)
+
+
+class Histogram(Metric):
+    """Counts observations into fixed buckets
+
+    Each label combination keeps a count per bucket, the last one for values
+    above the largest bound, and the sum of the observed values. Bucket
+    counts are only made cumulative when rendered.
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.counts: dict[tuple, list[int]] = {}
+        self.sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        key = self._key(labels)
+        counts = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+            self.sums[key] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    def count(self, labels: tuple = ()) -> int:
+        return sum(self.counts.get(labels, ()))
+
+    def samples(self):
+        bucket_labels = self.labels + ("le",)
+        for labels, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield (
+                    f"{self.name}_bucket",
+                    bucket_labels,
+                    labels + (_format_value(bound),),
+                    cumulative,
+                )
+            yield f"{self.name}_sum", self.labels, labels, self.sums[labels]
+            yield f"{self.name}_count", self.labels, labels, cumulative
+
+
+class MetricsRegistry:
+    """The metrics of the process in the Prometheus text format
+
+    Metrics that describe state kept elsewhere, e.g. the connections of a
+    pool, are updated by collectors when the metrics are rendered.
+    """
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+        self.collectors: list[Callable] = []
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def collector(self, fn: Callable) -> Callable:
+        """Registers `fn(state)` to run before the metrics are rendered"""
+        self.collectors.append(fn)
+        return fn
+
+    def render(self, state=None) -> str:
+        for collect in self.collectors:
+            collect(state)
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+http_requests_in_flight = registry.gauge(
+    "openaq_http_requests_in_flight", "Requests being handled"
+)
+rate_limit_rejections = registry.counter(
+    "openaq_rate_limit_rejections_total",
+    "Requests rejected by the rate limiter",
+    ("limiter",),
+)
+db_pool_acquire_seconds = registry.histogram(
+    "openaq_db_pool_acquire_seconds",
+    "Time waited for a pool connection",
+    ("pool", "route", "query"),
+)
+db_query_seconds = registry.histogram(
+    "openaq_db_query_seconds",
+    "Query execution time on the connection",
+    ("pool", "route", "query"),
+)
+db_pool_waiting = registry.gauge(
+    "openaq_db_pool_waiting", "Queries waiting for a pool connection", ("pool",)
+)
+db_pool_connections = registry.gauge(
+    "openaq_db_pool_connections", "Open pool connections", ("pool", "state")
+)
+db_pool_max_connections = registry.gauge(
+    "openaq_db_pool_max_connections", "Maximum size of the pool", ("pool",)
+)
@@ -1,17 +1,23 @@
+import asyncio
 import logging
+import math
 import time
+from collections import OrderedDict
 from datetime import timedelta
 from os import environ
+from typing import NamedTuple
 
-from fastapi import Response, status
+from fastapi import status
 from fastapi.responses import JSONResponse
-from redis import Redis
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
+from redis.asyncio import Redis
+from starlette.datastructures import Headers, MutableHeaders
 from starlette.requests import Request
-from starlette.types import ASGIApp
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
+from openaq_api import metrics, timing
+from openaq_api.access_log import AccessLog, AccessLogRecord, access_log
 from openaq_api.models.logging import (
-    HTTPLog,
+    InfrastructureErrorLog,
     LogType,
     TooManyRequestsLog,
     UnauthorizedLog,
@@ -22,84 +28,273 @@ from .settings import settings
 logger = logging.getLogger("middleware")
 
 
-class CacheControlMiddleware(BaseHTTPMiddleware):
+class CacheControlMiddleware:
     """MiddleWare to add CacheControl in response headers."""
 
     def __init__(self, app: ASGIApp, cachecontrol: str | None = None) -> None:
         """Init Middleware."""
-        super().__init__(app)
+        self.app = app
         self.cachecontrol = cachecontrol
 
-    async def dispatch(self, request: Request, call_next):
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
         """Add cache-control."""
-        response = await call_next(request)
-
         if (
-            not response.headers.get("Cache-Control")
-            and self.cachecontrol
-            and request.method in ["HEAD", "GET"]
-            and response.status_code < 500
+            scope["type"] != "http"
+            or not self.cachecontrol
+            or scope["method"] not in ["HEAD", "GET"]
         ):
-            response.headers["Cache-Control"] = self.cachecontrol
-        return response
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cache_control(message: Message) -> None:
+            if message["type"] == "http.response.start" and message["status"] < 500:
+                headers = MutableHeaders(scope=message)
+                if not headers.get("Cache-Control"):
+                    headers["Cache-Control"] = self.cachecontrol
+            await send(message)
+
+        await self.app(scope, receive, send_with_cache_control)
 
 
-class GetHostMiddleware(BaseHTTPMiddleware):
+class GetHostMiddleware:
     """MiddleWare to set servers url on App with current url."""
 
-    async def dispatch(self, request: Request, call_next):
-        environ["BASE_URL"] = str(request.base_url)
-        response = await call_next(request)
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
 
-        return response
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http":
+            environ["BASE_URL"] = str(Request(scope).base_url)
+        await self.app(scope, receive, send)
 
 
-class LoggingMiddleware(BaseHTTPMiddleware):
-    """MiddleWare to set servers url on App with current url."""
+class LoggingMiddleware:
+    """MiddleWare to log every HTTP request and its response status.
+
+    Only the raw fields are captured on the request path, the log is
+    serialized and emitted by the access log's background thread. Also
+    counts the requests in flight.
+
+    With `server_timing` the time spent per phase of the request is added
+    to the response as a Server-Timing header and to the log, see
+    `openaq_api.timing`.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        access_log: AccessLog = access_log,
+        server_timing: bool = False,
+    ) -> None:
+        self.app = app
+        self.access_log = access_log
+        self.server_timing = server_timing
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
 
-    async def dispatch(self, request: Request, call_next):
         start_time = time.time()
-        response = await call_next(request)
+        status_code = None
+        server_timing = None
+        request_timing = timing.ServerTiming() if self.server_timing else None
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status_code, server_timing
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if request_timing is not None:
+                    request_timing.response_started()
+                    server_timing = request_timing.milliseconds()
+                    headers = MutableHeaders(scope=message)
+                    headers.append(
+                        "Server-Timing", request_timing.header(server_timing)
+                    )
+            await send(message)
+
+        token = timing.current_timing.set(request_timing) if request_timing else None
+        metrics.http_requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.http_requests_in_flight.dec()
+            if token is not None:
+                timing.current_timing.reset(token)
         process_time = time.time() - start_time
-        timing = round(process_time * 1000, 2)
-        if hasattr(request.app.state, "rate_limiter"):
-            rate_limiter = request.app.state.rate_limiter
-        else:
-            rate_limiter = None
-
-        if hasattr(request.app.state, "counter"):
-            counter = request.app.state.counter
-        else:
-            counter = None
-        api_key = request.headers.get("x-api-key", None)
-        if response.status_code == 200:
-            logger.info(
-                HTTPLog(
-                    request=request,
-                    type=LogType.SUCCESS,
-                    http_code=response.status_code,
-                    timing=timing,
-                    rate_limiter=rate_limiter,
-                    counter=counter,
-                    api_key=api_key,
-                ).model_dump_json()
+        state = scope["app"].state
+        headers = Headers(scope=scope)
+        client = scope.get("client")
+        self.access_log.put(
+            AccessLogRecord(
+                type=LogType.SUCCESS if status_code == 200 else LogType.WARNING,
+                http_code=status_code,
+                timing=round(process_time * 1000, 2),
+                rate_limiter=getattr(state, "rate_limiter", None),
+                counter=getattr(state, "counter", None),
+                ip=client[0] if client else None,
+                api_key=headers.get("x-api-key"),
+                user_agent=headers.get("user-agent"),
+                path=scope.get("root_path", "") + scope["path"],
+                params=scope.get("query_string", b"").decode(),
+                server_timing=server_timing,
             )
-        else:
-            logger.info(
-                HTTPLog(
-                    request=request,
-                    type=LogType.WARNING,
-                    http_code=response.status_code,
-                    timing=timing,
-                    rate_limiter=rate_limiter,
-                    counter=counter,
-                    api_key=api_key,
+        )
+
+
+# generic cell rate algorithm (GCRA), a token bucket of ARGV[2] requests per
+# ARGV[1] milliseconds kept as the theoretical arrival time (TAT) of the next
+# request. Grants up to ARGV[3] requests and returns the requests granted,
+# the requests left, the milliseconds until the whole limit is available
+# again and the milliseconds until the next request is, in one round trip.
+# Unlike a fixed window, requests used up at the end of a window are not
+# available again right after it.
+RATE_LIMIT_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local window = tonumber(ARGV[1])
+local interval = window / tonumber(ARGV[2])
+local tat = math.max(tonumber(redis.call('GET', KEYS[1])) or now, now)
+local granted = math.min(
+    tonumber(ARGV[3]), math.floor((now + window - tat) / interval + 1e-9)
+)
+if granted > 0 then
+    tat = tat + granted * interval
+    redis.call('SET', KEYS[1], tat, 'PX', math.ceil(tat - now))
+else
+    granted = 0
+end
+return {
+    granted,
+    math.floor((now + window - tat) / interval + 1e-9),
+    math.ceil(tat - now),
+    math.max(math.ceil(tat + interval - now - window), 0)
+}
+"""
+
+
+class RateLimit(NamedTuple):
+    limit: int
+    remaining: int
+    reset: int  # seconds until the whole limit is available again
+    limited: bool
+    retry_after: int = 0  # seconds until the next request is available
+
+    def headers(self) -> dict[str, str]:
+        return {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+            "X-RateLimit-Reset": str(self.reset),
+        }
+
+
+class QuotaLease:
+    """Requests of a rate limit claimed from redis by this process
+
+    `tokens` goes negative by up to the overdraft while a claim is in
+    flight, the next claim pays the debt back.
+    """
+
+    __slots__ = ("tokens", "remaining", "reset_at", "retry_at", "claim")
+
+    def __init__(self) -> None:
+        self.tokens = 0
+        self.remaining = 0  # requests left in redis as of the last claim
+        self.reset_at = 0.0  # when the whole limit is available again
+        self.retry_at = 0.0  # when redis has requests again after running out
+        self.claim: asyncio.Task | None = None
+
+    def exhausted(self, now: float) -> bool:
+        return now < self.retry_at
+
+    def claimed(self, task: asyncio.Task) -> None:
+        self.claim = None
+
+
+class APIKeyCache:
+    """In process cache of the valid API keys in the redis `keys` set
+
+    Holds a snapshot of the whole set, refreshed in the background every
+    `refresh_interval` seconds, and the results of individual lookups for
+    keys missing from the snapshot, valid keys for `ttl` seconds and
+    invalid keys for `negative_ttl` seconds. When redis is unavailable the
+    last snapshot and lookups keep being served.
+    """
+
+    def __init__(
+        self,
+        redis_client: Redis,
+        refresh_interval: int = 300,
+        ttl: int = 300,
+        negative_ttl: int = 60,
+        max_entries: int = 100_000,
+        retry_after: int = 30,
+    ) -> None:
+        self.redis_client = redis_client
+        self.refresh_interval = refresh_interval
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.retry_after = retry_after
+        self.snapshot: frozenset[str] = frozenset()
+        self.entries: OrderedDict[str, tuple[bool, float]] = OrderedDict()
+        self._refresh_at = 0.0
+        self._refresh_task: asyncio.Task | None = None
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def get(self, key: str) -> bool | None:
+        """Whether the key is valid, None when it is not cached
+
+        Schedules a background refresh of the snapshot when one is due.
+        """
+        now = time.monotonic()
+        if now >= self._refresh_at and self._refresh_task is None:
+            self._refresh_at = now + self.retry_after
+            self._refresh_task = asyncio.create_task(self.refresh())
+            self._refresh_task.add_done_callback(self._refreshed)
+        if key in self.snapshot:
+            self.hits += 1
+            return True
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] > now:
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        return None
+
+    def set(self, key: str, valid: bool) -> None:
+        ttl = self.ttl if valid else self.negative_ttl
+        self.entries[key] = (valid, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def add(self, key: str) -> None:
+        """Marks a key this instance added to the redis set as valid"""
+        self.set(key, True)
+
+    async def refresh(self) -> None:
+        """Replaces the snapshot with the current members of the set"""
+        try:
+            keys = await self.redis_client.smembers("keys")
+        except Exception as e:
+            self.errors += 1
+            logger.error(
+                InfrastructureErrorLog(
+                    detail=f"api key cache refresh failed, retrying in {self.retry_after}s: {e}"
                 ).model_dump_json()
             )
-        return response
+            return
+        self.snapshot = frozenset(keys)
+        self._refresh_at = time.monotonic() + self.refresh_interval
+
+    def _refreshed(self, task: asyncio.Task) -> None:
+        self._refresh_task = None
 
 
-class RateLimiterMiddleWare(BaseHTTPMiddleware):
+class RateLimiterMiddleWare:
     def __init__(
         self,
         app: ASGIApp,
@@ -107,28 +302,163 @@ class RateLimiterMiddleWare(BaseHTTPMiddleware):
         rate_amount: int,  # number of requests allowed without api key
         rate_amount_key: int,  # number of requests allowed with api key
         rate_time: timedelta,  # timedelta of rate limit expiration
+        retry_after: int = 30,  # seconds to skip redis after an error
+        api_keys: APIKeyCache | None = None,
+        local_batch: float | None = None,
+        local_overdraft: float = 0,
     ) -> None:
-        """Init Middleware."""
-        super().__init__(app)
+        """Init Middleware.
+
+        Args:
+            redis_client: asyncio redis client
+            api_keys: cache of valid api keys, shared with the routes that
+                add keys
+            local_batch: fraction of a limit claimed from redis at a time and
+                counted down in process, None counts every request in redis
+            local_overdraft: fraction of a batch a process may admit while
+                its next claim is in flight, each process admits at most this
+                many requests over the limit per window
+        """
+        self.app = app
         self.redis_client = redis_client
         self.rate_amount = rate_amount
         self.rate_amount_key = rate_amount_key
         self.rate_time = rate_time
-        self.counter = 0
-
-    def request_is_limited(self, key: str, limit: int):
-        if self.redis_client.setnx(key, limit):
-            self.redis_client.expire(key, int(self.rate_time.total_seconds()))
-        count = self.redis_client.get(key)
-        if count and int(count) > 0:
-            self.counter = self.redis_client.decrby(key, 1)
+        self.retry_after = retry_after
+        self.api_keys = api_keys or APIKeyCache(redis_client, retry_after=retry_after)
+        self.local_batch = local_batch
+        self.local_overdraft = local_overdraft
+        self.leases: dict[str, QuotaLease] = {}
+        self.script = redis_client.register_script(RATE_LIMIT_SCRIPT)
+        self._retry_at = 0.0
+        self._swept_at = 0.0
+
+    def _available(self) -> bool:
+        return time.monotonic() >= self._retry_at
+
+    def _error(self, e: Exception):
+        self._retry_at = time.monotonic() + self.retry_after
+        logger.error(
+            InfrastructureErrorLog(
+                detail=f"rate limiter redis error, retrying in {self.retry_after}s: {e}"
+            ).model_dump_json()
+        )
+
+    async def request_is_limited(self, key: str, limit: int) -> RateLimit | None:
+        """Counts a request against the key's limit
+
+        Returns:
+            the key's rate limit or None when redis is unavailable in which
+            case the request is not limited
+        """
+        if self.local_batch:
+            return await self.local_request_is_limited(key, limit)
+        if not self._available():
+            return None
+        window = int(self.rate_time.total_seconds() * 1000)
+        try:
+            granted, remaining, reset, retry = await self.script(
+                keys=[f"ratelimit:{key}"], args=[window, limit, 1]
+            )
+        except Exception as e:
+            self._error(e)
+            return None
+        return RateLimit(
+            limit=limit,
+            remaining=int(remaining),
+            reset=math.ceil(int(reset) / 1000),
+            limited=int(granted) == 0,
+            retry_after=math.ceil(int(retry) / 1000),
+        )
+
+    async def claim(self, key: str, lease: QuotaLease, limit: int) -> bool:
+        """Claims a batch of the key's limit from redis for the lease
+
+        Returns:
+            False when redis is unavailable
+        """
+        if not self._available():
+            return False
+        batch = self._batch(limit)
+        window = int(self.rate_time.total_seconds() * 1000)
+        try:
+            granted, remaining, reset, retry = await self.script(
+                keys=[f"ratelimit:{key}"], args=[window, limit, batch]
+            )
+        except Exception as e:
+            self._error(e)
             return False
+        now = time.monotonic()
+        lease.tokens += int(granted)
+        lease.remaining = int(remaining)
+        lease.reset_at = now + int(reset) / 1000
+        # redis ran out, it is not called again until it has a request
+        lease.retry_at = now + int(retry) / 1000 if int(granted) < batch else 0.0
         return True
 
-    def check_valid_key(self, key: str):
-        if self.redis_client.sismember("keys", key):
-            return True
-        return False
+    def _batch(self, limit: int) -> int:
+        return max(math.ceil(limit * self.local_batch), 1)
+
+    def _lease(self, key: str) -> QuotaLease:
+        now = time.monotonic()
+        lease = self.leases.get(key)
+        if lease is None:
+            lease = self.leases[key] = QuotaLease()
+            if now - self._swept_at >= self.rate_time.total_seconds():
+                self._swept_at = now
+                # leases of keys whose limit is whole again
+                for k in [
+                    k
+                    for k, v in self.leases.items()
+                    if now >= v.reset_at and v.claim is None and v is not lease
+                ]:
+                    del self.leases[k]
+        return lease
+
+    async def local_request_is_limited(self, key: str, limit: int) -> RateLimit | None:
+        """Counts a request against the tokens this process claimed
+
+        Redis is only called when the claimed tokens run out. With an
+        overdraft requests are admitted while the next claim runs in the
+        background, otherwise they wait for it.
+        """
+        lease = self._lease(key)
+        overdraft = math.floor(self._batch(limit) * self.local_overdraft)
+        while lease.tokens <= 0 and not lease.exhausted(time.monotonic()):
+            if lease.claim is None or lease.claim.done():
+                lease.claim = asyncio.create_task(self.claim(key, lease, limit))
+                lease.claim.add_done_callback(lease.claimed)
+            if -lease.tokens < overdraft:
+                break
+            if not await asyncio.shield(lease.claim):
+                return None
+        now = time.monotonic()
+        limited = lease.tokens <= 0 and lease.exhausted(now)
+        if not limited:
+            lease.tokens -= 1
+        return RateLimit(
+            limit=limit,
+            remaining=lease.remaining + max(lease.tokens, 0),
+            reset=max(math.ceil(lease.reset_at - now), 0),
+            limited=limited,
+            retry_after=max(math.ceil(lease.retry_at - now), 0),
+        )
+
+    async def check_valid_key(self, key: str) -> bool | None:
+        """Whether the key is valid, None when it is not cached and redis is
+        unavailable"""
+        valid = self.api_keys.get(key)
+        if valid is not None:
+            return valid
+        if not self._available():
+            return None
+        try:
+            valid = bool(await self.redis_client.sismember("keys", key))
+        except Exception as e:
+            self._error(e)
+            return None
+        self.api_keys.set(key, valid)
+        return valid
 
     @staticmethod
     def limited_path(route: str) -> bool:
@@ -147,21 +477,30 @@ class RateLimiterMiddleWare(BaseHTTPMiddleware):
             return False
         return True
 
-    async def dispatch(
-        self, request: Request, call_next: RequestResponseEndpoint
-    ) -> Response:
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        request = Request(scope)
         route = request.url.path
         auth = request.headers.get("x-api-key", None)
         limit = self.rate_amount
         key = request.client.host
 
-        if auth:
-            if not self.check_valid_key(auth):
-                logging.info(UnauthorizedLog(request=request).model_dump_json())
-                return JSONResponse(
-                    status_code=status.HTTP_401_UNAUTHORIZED,
-                    content={"message": "invalid credentials"},
-                )
+        valid = await self.check_valid_key(auth) if auth else None
+        if valid is False:
+            logging.info(UnauthorizedLog(request=request).model_dump_json())
+            response = JSONResponse(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                content={"message": "invalid credentials"},
+            )
+            await response(scope, receive, send)
+            return
+        # a key that cannot be checked while redis is unavailable gets the
+        # limit of requests without a key
+        if valid:
             key = auth
             limit = self.rate_amount_key
         if (
@@ -169,19 +508,44 @@ class RateLimiterMiddleWare(BaseHTTPMiddleware):
             and request.headers.get("API-User-Agent", None) == settings.USER_AGENT
         ):
             limit = self.rate_amount_key
-        if self.limited_path(route) and self.request_is_limited(key, limit):
+        if not self.limited_path(route):
+            # not counted, so there is no remaining quota to log
+            request.app.state.rate_limiter = f"{key}/{limit}/None"
+            await self.app(scope, receive, send)
+            return
+
+        rate_limit = await self.request_is_limited(key, limit)
+        timing.record("ratelimit", time.perf_counter() - start)
+        remaining = rate_limit.remaining if rate_limit is not None else None
+        if rate_limit is not None and rate_limit.limited:
+            metrics.rate_limit_rejections.inc(("api_key" if valid else "ip",))
             logging.info(
                 TooManyRequestsLog(
                     request=request,
-                    rate_limiter=f"{key}/{limit}/{self.counter}",
+                    rate_limiter=f"{key}/{limit}/{remaining}",
                 ).model_dump_json()
             )
-            return JSONResponse(
+            response = JSONResponse(
                 status_code=status.HTTP_429_TOO_MANY_REQUESTS,
                 content={"message": "Too many requests"},
+                headers={
+                    **rate_limit.headers(),
+                    "Retry-After": str(rate_limit.retry_after),
+                },
             )
+            await response(scope, receive, send)
+            return
+
+        request.app.state.rate_limiter = f"{key}/{limit}/{remaining}"
+        if rate_limit is None:
+            await self.app(scope, receive, send)
+            return
 
-        request.app.state.rate_limiter = f"{key}/{limit}/{self.counter}"
-        response = await call_next(request)
+        async def send_with_rate_limit(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                for name, value in rate_limit.headers().items():
+                    headers[name] = value
+            await send(message)
 
-        return response
+        await self.app(scope, receive, send_with_rate_limit)
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+from typing import NamedTuple
+
+import asyncpg
+
+from openaq_api import rollups, sketches, trend_profiles
+from openaq_api.settings import settings
+
+logger = logging.getLogger("migrations")
+
+# the lock held while migrating so that one instance migrates at a time
+ADVISORY_LOCK = 7_416_521_000
+
+
+class Migration(NamedTuple):
+    """A change to the tables of the api, applied once by name
+
+    Args:
+        name: orders the migrations and records that it was applied
+        sql: the statements of the migration
+        transaction: False for statements that cannot run in a transaction,
+            e.g. `CREATE INDEX CONCURRENTLY`
+    """
+
+    name: str
+    sql: str
+    transaction: bool = True
+
+
+# the migrations in the order they are applied, applied migrations are never
+# edited, a change is a new migration
+MIGRATIONS = (
+    Migration("0001_rollups", rollups.SCHEMA),
+    # the refreshes select the hourly rows calculated since the previous one,
+    # built without blocking the writes to hourly_data
+    Migration(
+        "0002_hourly_data_calculated_on",
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS hourly_data_calculated_on_idx
+        ON hourly_data (calculated_on)
+        """,
+        transaction=False,
+    ),
+    Migration("0003_sensor_sketches", sketches.SCHEMA),
+    Migration("0004_trend_profiles", trend_profiles.SCHEMA),
+    # the position of a sketch refresh going through the sensors in batches
+    Migration(
+        "0005_sensor_sketches_refresh_batches",
+        """
+        ALTER TABLE sensor_sketches_refresh
+        ADD COLUMN IF NOT EXISTS pass_until timestamptz
+        , ADD COLUMN IF NOT EXISTS sensors_after int
+        """,
+    ),
+    # the position of a profile refresh going through the locations in batches
+    Migration(
+        "0006_trend_profiles_refresh_batches",
+        """
+        ALTER TABLE trend_profiles_refresh
+        ADD COLUMN IF NOT EXISTS pass_until timestamptz
+        , ADD COLUMN IF NOT EXISTS nodes_after int
+        """,
+    ),
+    # the position of a rollup refresh going through the locations in batches
+    Migration(
+        "0007_measurements_rollup_refresh_batches",
+        """
+        ALTER TABLE measurements_rollup_refresh
+        ADD COLUMN IF NOT EXISTS pass_until timestamptz
+        , ADD COLUMN IF NOT EXISTS nodes_after int
+        """,
+    ),
+)
+
+
+async def pending(con, migrations=MIGRATIONS) -> list[Migration]:
+    """The migrations that have not been applied on the connection"""
+    await con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS api_migrations (
+          name text PRIMARY KEY
+        , applied_on timestamptz NOT NULL DEFAULT current_timestamp
+        )
+        """
+    )
+    applied = {r["name"] for r in await con.fetch("SELECT name FROM api_migrations")}
+    return [m for m in migrations if m.name not in applied]
+
+
+async def migrate(con, migrations=MIGRATIONS) -> list[str]:
+    """Applies the pending migrations in order, returns their names
+
+    A migration that fails is not recorded and stops the later ones, a
+    migration outside of a transaction must then be safe to run again.
+    """
+    await con.execute("SELECT pg_advisory_lock($1)", ADVISORY_LOCK)
+    try:
+        applied = []
+        for migration in await pending(con, migrations):
+            logger.info("applying migration %s", migration.name)
+            if migration.transaction:
+                async with con.transaction():
+                    await con.execute(migration.sql)
+                    await record(con, migration)
+            else:
+                await con.execute(migration.sql)
+                await record(con, migration)
+            applied.append(migration.name)
+        return applied
+    finally:
+        await con.execute("SELECT pg_advisory_unlock($1)", ADVISORY_LOCK)
+
+
+async def record(con, migration: Migration) -> None:
+    await con.execute("INSERT INTO api_migrations (name) VALUES ($1)", migration.name)
+
+
+async def main() -> None:
+    con = await asyncpg.connect(settings.DATABASE_WRITE_URL)
+    try:
+        applied = await migrate(con)
+    finally:
+        await con.close()
+    logger.info("applied %s migrations", len(applied))
+
+
+if __name__ == "__main__":
+    # migrate the write database, e.g. before a deployment
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
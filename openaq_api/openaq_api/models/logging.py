@@ -57,6 +57,7 @@ class HTTPLog(BaseLog):
         timing:
         rate_limiter:
         counter:
+        server_timing: milliseconds per phase of the request
         ip:
         api_key:
         user-agent:
@@ -72,6 +73,7 @@ class HTTPLog(BaseLog):
     timing: float | None = None
     rate_limiter: str | None = None
     counter: int | None = None
+    server_timing: dict[str, float] | None = None
 
     @computed_field(return_type=str)
     @property
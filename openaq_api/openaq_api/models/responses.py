@@ -14,6 +14,7 @@ class Meta(BaseModel):
     page: int = 1
     limit: int = 100
     found: int | str | None = None
+    next: str | None = None
 
 
 class Date(BaseModel):
@@ -0,0 +1,488 @@
+import asyncio
+import logging
+import time
+from datetime import date, datetime
+
+import asyncpg
+from buildpg import render
+
+from openaq_api.models.logging import WarnLog
+from openaq_api.settings import settings
+from openaq_api.v3.models.queries import PeriodNames
+
+logger = logging.getLogger("rollups")
+
+# aggregation periods served from the rollup tables
+ROLLUP_PERIODS = ("day", "month")
+
+# more than the length of any period, with room for a timezone offset
+MARGINS = {"day": "2 days", "month": "1 month 2 days"}
+
+# hourly rows calculated within this long of a refresh starting are read
+# again by the next refresh, they may not have been visible to it
+REFRESH_OVERLAP = "15 minutes"
+
+# the lock held by each refresh transaction so that one instance refreshes
+# at a time
+ADVISORY_LOCK = 7_416_521_022
+
+# timezone offsets are within this long of UTC
+MAX_OFFSET = "14 hours"
+
+# an instance frozen or killed in a refresh transaction leaves it idle, it
+# is ended by the database after this long so that its lock is released
+IDLE_TIMEOUT = "5min"
+
+# the rollup tables, they live next to hourly_data and are created by
+# `openaq_api.migrations`
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS measurements_rollup (
+  period_name text NOT NULL
+, sensor_nodes_id int NOT NULL
+, measurands_id int NOT NULL
+, tzid text NOT NULL
+, datetime timestamptz NOT NULL
+, avg_seconds double precision
+, log_seconds double precision
+, last_period timestamptz NOT NULL
+, first_datetime timestamp
+, last_datetime timestamp
+, value_count bigint NOT NULL
+, value_avg double precision
+, value_sd double precision
+, value_min double precision
+, value_max double precision
+, value_p02 double precision
+, value_p25 double precision
+, value_p50 double precision
+, value_p75 double precision
+, value_p98 double precision
+, calculated_on timestamptz
+, PRIMARY KEY (period_name, sensor_nodes_id, measurands_id, datetime)
+);
+
+CREATE TABLE IF NOT EXISTS measurements_rollup_refresh (
+  period_name text PRIMARY KEY
+, refreshed_until timestamptz NOT NULL
+, calculated_until timestamptz NOT NULL
+, pass_until timestamptz
+, nodes_after int
+);
+"""
+
+# the columns of a period aggregate, in the order of measurements_rollup
+ROLLUP_COLUMNS = (
+    "sensor_nodes_id",
+    "measurands_id",
+    "tzid",
+    "datetime",
+    "avg_seconds",
+    "log_seconds",
+    "last_period",
+    "first_datetime",
+    "last_datetime",
+    "value_count",
+    "value_avg",
+    "value_sd",
+    "value_min",
+    "value_max",
+    "value_p02",
+    "value_p25",
+    "value_p50",
+    "value_p75",
+    "value_p98",
+    "calculated_on",
+)
+ROLLUP_KEY = ("sensor_nodes_id", "measurands_id", "datetime")
+
+
+# the select list aggregating hourly_data rows into the periods of
+# :period_name, grouped by its first four columns
+AGGREGATE_COLUMNS = """
+            sy.sensor_nodes_id
+            , s.measurands_id
+            , ts.tzid
+            , truncate_timestamp(datetime, :period_name, ts.tzid) as datetime
+            , AVG(s.data_averaging_period_seconds) as avg_seconds
+            , AVG(s.data_logging_period_seconds) as log_seconds
+            , MAX(truncate_timestamp(datetime, :period_name, ts.tzid, ('1' || :period_name)::interval)) as last_period
+            , MIN(timezone(ts.tzid, datetime - '1sec'::interval)) as first_datetime
+            , MAX(timezone(ts.tzid, datetime - '1sec'::interval)) as last_datetime
+            , COUNT(1) as value_count
+            , AVG(value_avg) as value_avg
+            , STDDEV(value_avg) as value_sd
+            , MIN(value_avg) as value_min
+            , MAX(value_avg) as value_max
+            , PERCENTILE_CONT(0.02) WITHIN GROUP(ORDER BY value_avg) as value_p02
+            , PERCENTILE_CONT(0.25) WITHIN GROUP(ORDER BY value_avg) as value_p25
+            , PERCENTILE_CONT(0.5) WITHIN GROUP(ORDER BY value_avg) as value_p50
+            , PERCENTILE_CONT(0.75) WITHIN GROUP(ORDER BY value_avg) as value_p75
+            , PERCENTILE_CONT(0.98) WITHIN GROUP(ORDER BY value_avg) as value_p98
+            , current_timestamp as calculated_on
+            FROM hourly_data m
+            JOIN sensors s ON (m.sensors_id = s.sensors_id)
+            JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
+            JOIN sensor_nodes sn ON (sy.sensor_nodes_id = sn.sensor_nodes_id)
+            JOIN timezones ts ON (sn.timezones_id = ts.gid)"""
+
+
+def date_bound(value: datetime | date | None, param: str, tz: str) -> str | None:
+    """The instant of a date_from/date_to parameter, as `DateFromQuery` and
+    `DateToQuery` compare it, with dates and naive datetimes in the
+    timezone of the location"""
+    if value is None:
+        return None
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return f":{param}"
+    return f"(:{param}::timestamp AT TIME ZONE {tz})"
+
+
+def covered(q, start: str, end: str, tz: str) -> str:
+    """SQL condition on a period starting at `start` and ending at `end` that
+    holds when the rollup of the period answers the query
+
+    A period is answered by its rollup when it ended before the last refresh
+    and the date filters of the query include all of it, any other period
+    is aggregated from hourly_data.
+    """
+    conditions = [f"{end} <= (SELECT until FROM refreshed)"]
+    date_from = date_bound(getattr(q, "date_from", None), "date_from", tz)
+    if date_from is not None:
+        conditions.append(f"{start} > {date_from}")
+    date_to = date_bound(getattr(q, "date_to", None), "date_to", tz)
+    if date_to is not None:
+        conditions.append(f"{end} <= {date_to}")
+    return " AND ".join(conditions)
+
+
+def aggregates_sql(q, where: str) -> str:
+    """The `meas` CTE rows of a day or month aggregate, from the rollups
+    for the periods they answer and from hourly_data for the rest
+
+    Args:
+        q: the measurements query
+        where: the WHERE clause of the query on hourly_data
+    """
+    period_name = PeriodNames(q.period_name).value
+    margin = MARGINS[period_name]
+    rollup_where = [
+        "r.period_name = :period_name",
+        "r.sensor_nodes_id = :locations_id",
+        covered(q, "r.datetime", "r.last_period", "r.tzid"),
+    ]
+    if q.has("parameters_id"):
+        rollup_where.append("r.measurands_id = ANY (:parameters_id)")
+    start = "truncate_timestamp(datetime, :period_name, ts.tzid)"
+    end = "truncate_timestamp(datetime, :period_name, ts.tzid, ('1' || :period_name)::interval)"
+    # a coarse bound on the hourly rows of the periods not answered by a
+    # rollup, so that only those rows are read from the index
+    recent = [f"m.datetime > (SELECT until FROM refreshed) - '{margin}'::interval"]
+    if q.has("date_from"):
+        recent.append(
+            f"m.datetime <= (:date_from::timestamp AT TIME ZONE 'UTC') + '{margin}'::interval"
+        )
+    if q.has("date_to"):
+        recent.append(
+            f"m.datetime > (:date_to::timestamp AT TIME ZONE 'UTC') - '{margin}'::interval"
+        )
+    return f"""
+            refreshed AS (
+            SELECT COALESCE(MAX(refreshed_until), '-infinity') as until
+            FROM measurements_rollup_refresh
+            WHERE period_name = :period_name
+            ), meas AS (
+            SELECT {", ".join(f"r.{c}" for c in ROLLUP_COLUMNS)}
+            FROM measurements_rollup r
+            WHERE {" AND ".join(rollup_where)}
+            UNION ALL
+            SELECT {AGGREGATE_COLUMNS}
+            {where or "WHERE TRUE"}
+            AND ({" OR ".join(recent)})
+            AND NOT ({covered(q, start, end, "ts.tzid")})
+            GROUP BY 1, 2, 3, 4)"""
+
+
+def changed_where(period_name: str) -> str:
+    """SQL condition on hourly_data rows of the periods to roll up again, the
+    rows calculated since the last refresh and the rows of the periods that
+    may have closed in some timezone since the last refresh"""
+    margin = MARGINS[period_name]
+    return f"""(m.calculated_on > :calculated_until
+    OR (m.datetime > :refreshed_until::timestamptz - '{margin}'::interval
+      AND date_trunc(:period_name, (:until::timestamptz AT TIME ZONE 'UTC') + '{MAX_OFFSET}'::interval)
+        > date_trunc(:period_name, (:refreshed_until::timestamptz AT TIME ZONE 'UTC') - '{MAX_OFFSET}'::interval)))"""
+
+
+# the next batch of locations of the first refresh, ($1 after, $2 batch)
+NODES_SQL = """
+SELECT sensor_nodes_id FROM sensor_nodes
+WHERE sensor_nodes_id > $1
+ORDER BY sensor_nodes_id
+LIMIT $2
+"""
+
+
+def nodes_sql(period_name: str) -> str:
+    """The next batch of locations with periods to roll up again"""
+    return f"""
+    SELECT DISTINCT sy.sensor_nodes_id
+    FROM hourly_data m
+    JOIN sensors s ON (m.sensors_id = s.sensors_id)
+    JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
+    WHERE sy.sensor_nodes_id > :after
+    AND {changed_where(period_name)}
+    ORDER BY sy.sensor_nodes_id
+    LIMIT :batch
+    """
+
+
+def refresh_sql(period_name: str) -> str:
+    """Upserts the rollups of a batch of locations, of the closed periods
+    with hourly rows calculated since the last refresh or that closed since
+    the last refresh"""
+    margin = MARGINS[period_name]
+    updates = "\n    , ".join(
+        f"{c} = EXCLUDED.{c}" for c in ROLLUP_COLUMNS if c not in ROLLUP_KEY
+    )
+    return f"""
+    WITH changed AS (
+    SELECT DISTINCT sy.sensor_nodes_id
+    , truncate_timestamp(m.datetime, :period_name, ts.tzid) as datetime
+    FROM hourly_data m
+    JOIN sensors s ON (m.sensors_id = s.sensors_id)
+    JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
+    JOIN sensor_nodes sn ON (sy.sensor_nodes_id = sn.sensor_nodes_id)
+    JOIN timezones ts ON (sn.timezones_id = ts.gid)
+    WHERE sy.sensor_nodes_id = ANY(:sensor_nodes_ids)
+    AND {changed_where(period_name)}
+    ), meas AS (
+    SELECT {AGGREGATE_COLUMNS}
+    WHERE sy.sensor_nodes_id = ANY(:sensor_nodes_ids)
+    AND (sy.sensor_nodes_id, truncate_timestamp(datetime, :period_name, ts.tzid))
+      IN (SELECT sensor_nodes_id, datetime FROM changed)
+    -- a range of hourly_data.datetime, so that only the changed periods
+    -- are read from the index
+    AND m.datetime >= (SELECT MIN(datetime) FROM changed) - '{margin}'::interval
+    AND m.datetime < (SELECT MAX(datetime) FROM changed) + '{margin}'::interval
+    AND truncate_timestamp(datetime, :period_name, ts.tzid, ('1' || :period_name)::interval) <= :until
+    GROUP BY 1, 2, 3, 4
+    )
+    INSERT INTO measurements_rollup (period_name, {", ".join(ROLLUP_COLUMNS)})
+    SELECT :period_name, meas.* FROM meas
+    ON CONFLICT (period_name, sensor_nodes_id, measurands_id, datetime) DO UPDATE
+    SET {updates}
+    """
+
+
+class RollupRefresher:
+    """Refreshes the rollup tables incrementally
+
+    Each refresh rolls up the periods that closed since the previous one and
+    the periods with hourly_data rows calculated since the previous one. A
+    refresh goes through the locations in batches in order of their id,
+    each batch in its own transaction that records the last location
+    refreshed, so that a refresh that fails is resumed from its last batch.
+    Refreshes write through `DATABASE_WRITE_URL` and each refresh
+    transaction holds an advisory lock, when another instance is refreshing
+    the refresh is skipped.
+
+    The first refresh rolls up all of hourly_data, it is a backfill run as a
+    job with `python -m openaq_api.rollups`, refreshes scheduled by requests
+    are skipped until it is complete.
+
+    Args:
+        interval: seconds between refreshes scheduled with `schedule`
+        nodes: the locations refreshed per transaction
+    """
+
+    name = "rollups"
+    module = "openaq_api.rollups"
+    lock = ADVISORY_LOCK
+    periods = ROLLUP_PERIODS
+    state_table = "measurements_rollup_refresh"
+
+    def __init__(self, interval: float | None = None, nodes: int = 100) -> None:
+        self.interval = interval
+        self.nodes = nodes
+        self.refreshed_at: float | None = None
+        self.refreshes = 0
+        self.errors = 0
+        self._task: asyncio.Task | None = None
+
+    async def locked(self, con) -> bool:
+        """Takes the advisory lock for the transaction on the connection,
+        False when another instance holds it"""
+        return await con.fetchval("SELECT pg_try_advisory_xact_lock($1)", self.lock)
+
+    async def backfilled(self, con) -> bool:
+        """Whether the first refresh of every period is complete"""
+        count = await con.fetchval(
+            f"""
+            SELECT COUNT(1) FROM {self.state_table}
+            WHERE calculated_until > '-infinity'
+            """
+        )
+        return count >= len(self.periods)
+
+    async def refresh(self, con, period_name: str) -> str | None:
+        """Refreshes one period on the connection, None when another
+        instance is refreshing"""
+        refreshed = 0
+        while True:
+            count = await self.refresh_batch(con, period_name)
+            if count is None:
+                return None
+            if count == 0:
+                return f"{refreshed} locations"
+            refreshed += count
+
+    async def refresh_batch(self, con, period_name: str) -> int | None:
+        """Refreshes the rollups of one period of the next batch of
+        locations on the connection, returns the number of locations, 0
+        when the refresh is complete and None when another instance is
+        refreshing"""
+        async with con.transaction():
+            if not await self.locked(con):
+                return None
+            state = await con.fetchrow(
+                """
+                SELECT COALESCE(r.refreshed_until, '-infinity') as refreshed_until
+                , COALESCE(r.calculated_until, '-infinity') as calculated_until
+                , COALESCE(r.refreshed_until, '-infinity') = '-infinity' as first
+                , COALESCE(r.pass_until, now()) as until
+                , COALESCE(r.pass_until, now()) - $2::interval as calculated
+                , COALESCE(r.nodes_after, 0) as nodes_after
+                FROM (SELECT 1) t
+                LEFT JOIN measurements_rollup_refresh r ON (r.period_name = $1)
+                """,
+                period_name,
+                REFRESH_OVERLAP,
+            )
+            params = {
+                "period_name": period_name,
+                "until": state["until"],
+                "refreshed_until": state["refreshed_until"],
+                "calculated_until": state["calculated_until"],
+            }
+            if state["first"]:
+                rows = await con.fetch(NODES_SQL, state["nodes_after"], self.nodes)
+            else:
+                sql, args = render(
+                    nodes_sql(period_name),
+                    **params,
+                    after=state["nodes_after"],
+                    batch=self.nodes,
+                )
+                rows = await con.fetch(sql, *args)
+            ids = [row["sensor_nodes_id"] for row in rows]
+            if ids:
+                sql, args = render(
+                    refresh_sql(period_name), **params, sensor_nodes_ids=ids
+                )
+                await con.execute(sql, *args)
+                # the pass continues after the last location of the batch
+                state = (
+                    state["refreshed_until"],
+                    state["calculated_until"],
+                    state["until"],
+                    ids[-1],
+                )
+            else:
+                # the pass is complete
+                state = (state["until"], state["calculated"], None, None)
+            await con.execute(
+                """
+                INSERT INTO measurements_rollup_refresh
+                (period_name, refreshed_until, calculated_until, pass_until, nodes_after)
+                VALUES ($1, $2, $3, $4, $5)
+                ON CONFLICT (period_name) DO UPDATE
+                SET refreshed_until = EXCLUDED.refreshed_until
+                , calculated_until = EXCLUDED.calculated_until
+                , pass_until = EXCLUDED.pass_until
+                , nodes_after = EXCLUDED.nodes_after
+                """,
+                period_name,
+                *state,
+            )
+        return len(ids)
+
+    async def refresh_all(self, con) -> bool:
+        """Refreshes every period on the connection, False when another
+        instance is refreshing"""
+        for period_name in self.periods:
+            start = time.time()
+            status = await self.refresh(con, period_name)
+            if status is None:
+                return False
+            logger.debug(
+                "refreshed %s %s in %.2fs: %s",
+                period_name,
+                self.name,
+                time.time() - start,
+                status,
+            )
+        return True
+
+    async def run(self, connect=None, backfill: bool = False) -> bool:
+        """Refreshes unless another instance is, returns whether it refreshed
+
+        Args:
+            connect: opens the connection to refresh on, defaults to the
+                write database
+            backfill: runs the first refresh when it is not complete,
+                otherwise the refresh is skipped
+        """
+        self.refreshed_at = time.time()
+        connect = connect or (lambda: asyncpg.connect(settings.DATABASE_WRITE_URL))
+        try:
+            con = await connect()
+        except Exception as e:
+            return self._failed(e)
+        try:
+            await con.execute(
+                f"SET idle_in_transaction_session_timeout = '{IDLE_TIMEOUT}'"
+            )
+            if not backfill and not await self.backfilled(con):
+                logger.warning(
+                    WarnLog(
+                        detail=f"{self.name} are not backfilled, "
+                        f"run python -m {self.module}"
+                    ).model_dump_json()
+                )
+                return False
+            if not await self.refresh_all(con):
+                logger.debug("%s are being refreshed by another instance", self.name)
+                return False
+        except Exception as e:
+            return self._failed(e)
+        finally:
+            await con.close()
+        self.refreshes += 1
+        return True
+
+    def _failed(self, e: Exception) -> bool:
+        self.errors += 1
+        logger.warning(
+            WarnLog(detail=f"could not refresh {self.name}: {e}").model_dump_json()
+        )
+        return False
+
+    def schedule(self) -> None:
+        """Starts a refresh in the background when one is due"""
+        if self.interval is None:
+            return
+        due = self.refreshed_at is None or (
+            time.time() - self.refreshed_at >= self.interval
+        )
+        if due and (self._task is None or self._task.done()):
+            self.refreshed_at = time.time()
+            self._task = asyncio.ensure_future(self.run())
+
+
+rollup_refresher = RollupRefresher(settings.API_ROLLUP_REFRESH)
+
+
+if __name__ == "__main__":
+    # refresh once, e.g. from a scheduled task, backfilling on the first run
+    logging.basicConfig(level=logging.DEBUG)
+    asyncio.run(RollupRefresher().run(backfill=True))
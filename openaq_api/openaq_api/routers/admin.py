@@ -0,0 +1,45 @@
+import hmac
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Response, status
+
+from ..settings import settings
+from ..slow_queries import slow_queries
+from ..tile_cache import TileLayer, tile_cache
+
+router = APIRouter(include_in_schema=False)
+
+
+def admin_key(x_admin_key: str | None = Header(None)) -> None:
+    """Allows requests with the API_ADMIN_KEY in the X-Admin-Key header
+
+    The admin routes do not exist when API_ADMIN_KEY is not set.
+    """
+    if settings.API_ADMIN_KEY is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    if x_admin_key is None or not hmac.compare_digest(
+        x_admin_key.encode(), settings.API_ADMIN_KEY.encode()
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+        )
+
+
+@router.get("/admin/slow-queries", dependencies=[Depends(admin_key)])
+async def slow_queries_get(response: Response):
+    """The latest queries slower than API_SLOW_QUERY_THRESHOLD with their
+    sampled plans"""
+    response.headers["Cache-Control"] = "no-store"
+    return slow_queries.report()
+
+
+@router.delete(
+    "/admin/tile-cache/{layer}",
+    status_code=status.HTTP_204_NO_CONTENT,
+    dependencies=[Depends(admin_key)],
+)
+async def tile_cache_delete(layer: TileLayer):
+    """Drops the cached tiles of a layer from this instance and from the
+    shared store, the other instances keep the tiles of their process local
+    cache until they expire"""
+    await tile_cache.invalidate(layer.value)
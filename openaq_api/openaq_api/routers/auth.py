@@ -155,7 +155,8 @@ async def verify(request: Request, verification_code: str, db: DB = Depends()):
         token = await db.get_user_token(row[0])
         if request.app.state.redis_client:
             redis_client = request.app.state.redis_client
-            redis_client.sadd("keys", token)
+            await redis_client.sadd("keys", token)
+            request.app.state.api_keys.add(token)
         send_api_key_email(token, row[3], row[4])
         return templates.TemplateResponse(
             "verify/index.html", {"request": request, "error": False, "verify": True}
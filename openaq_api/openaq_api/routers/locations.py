@@ -1,9 +1,12 @@
 import logging
+import time
 from enum import Enum
 from typing import Annotated
 
 from fastapi import APIRouter, Depends, Path, Query
+from pydantic import PrivateAttr
 
+from ..cache import route_policy
 from ..db import DB
 from ..models.queries import (
     APIBase,
@@ -23,6 +26,8 @@ from ..models.responses import (
     LocationsResponse,
     LocationsResponseV1,
 )
+from ..settings import settings
+from ..v3.routers.locations import location_catalog
 
 logger = logging.getLogger("locations")
 
@@ -93,6 +98,14 @@ class Locations(
         examples=["Ecotech"],
     )
     dumpRaw: bool | None = Query(False)
+    # ids of the locations within the radius, from the location catalog
+    _geo_ids: list[int] | None = PrivateAttr(None)
+
+    def params(self):
+        params = super().params()
+        if self._geo_ids is not None:
+            params["geo_ids"] = self._geo_ids
+        return params
 
     def order(self):
         stm = self.order_by
@@ -193,7 +206,10 @@ class Locations(
                                 )
                             """
                     )
-        wheres.append(self.where_geo())
+        if self._geo_ids is not None:
+            wheres.append(" l.id = ANY(:geo_ids) ")
+        else:
+            wheres.append(self.where_geo())
         if self.order_by == "random":
             wheres.append("\"lastUpdated\" > now() - '2 weeks'::interval")
         wheres = [w for w in wheres if w is not None]
@@ -202,6 +218,27 @@ class Locations(
         return " TRUE "
 
 
+async def catalog_geo(locations: Locations, db: DB) -> None:
+    """Resolves a radius search to the ids of the locations within it from
+    the location catalog, so the database looks them up by id instead of
+    searching its spatial index
+
+    A snapshot older than the cache TTL of the route would miss locations a
+    cached response of the route could have found, the database then
+    searches its spatial index.
+    """
+    if not settings.API_LOCATION_CATALOG or locations.lat is None:
+        return
+    snapshot = await location_catalog.get(db)
+    if (
+        snapshot is not None
+        and time.time() - snapshot.loaded_at <= route_policy(db.request).ttl
+    ):
+        locations._geo_ids = snapshot.within(
+            locations.lon, locations.lat, locations.radius
+        )
+
+
 class LocationQuery(LocationPath, APIBase):
     location_id: int = Path(..., description="The ID of the location")
 
@@ -251,7 +288,7 @@ async def get_v2_location_by_id(
     LIMIT :limit
     OFFSET :offset;
     """
-    output = await db.fetchPage(q, qparams)
+    output = await db.fetchPage(q, qparams, statement="v2_location")
     return output
 
 
@@ -266,6 +303,7 @@ async def locations_get(
     locations: Annotated[Locations, Depends(Locations.depends())],
     db: DB = Depends(),
 ):
+    await catalog_geo(locations, db)
     qparams = locations.params()
 
     hidejson = "rawData,"
@@ -302,7 +340,7 @@ async def locations_get(
     LIMIT :limit
     OFFSET :offset;
     """
-    output = await db.fetchPage(q, qparams)
+    output = await db.fetchPage(q, qparams, statement="v2_locations")
     return output
 
 
@@ -335,7 +373,7 @@ async def get_v2_latest_by_id(
     LIMIT :limit
     OFFSET :offset
     """
-    output = await db.fetchPage(q, qparams)
+    output = await db.fetchPage(q, qparams, statement="v2_latest_location")
     return output
 
 
@@ -350,6 +388,7 @@ async def latest_get(
     locations: Annotated[Locations, Depends(Locations)],
     db: DB = Depends(),
 ):
+    await catalog_geo(locations, db)
     qparams = locations.params()
 
     q = f"""
@@ -369,7 +408,7 @@ async def latest_get(
     LIMIT :limit
     OFFSET :offset
     """
-    output = await db.fetchPage(q, qparams)
+    output = await db.fetchPage(q, qparams, statement="v2_latest")
     return output
 
 
@@ -433,6 +472,7 @@ async def latest_v1_get(
     db: DB = Depends(),
 ):
     locations.entity = "government"
+    await catalog_geo(locations, db)
     qparams = locations.params()
 
     q = f"""
@@ -553,6 +593,7 @@ async def locationsv1_get(
     db: DB = Depends(),
 ):
     locations.entity = "government"
+    await catalog_geo(locations, db)
     qparams = locations.params()
 
     q = f"""
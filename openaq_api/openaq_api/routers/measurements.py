@@ -6,8 +6,10 @@ from typing import Annotated
 
 from dateutil.tz import UTC
 from fastapi import APIRouter, Depends, Query
+from pydantic import field_validator
 from starlette.responses import Response
 
+from ..cursor import CURSOR_FIELDS, CURSOR_START, cursor_params
 from ..db import DB
 from ..models.queries import (
     APIBase,
@@ -23,6 +25,7 @@ from ..models.queries import (
     Sort,
 )
 from ..models.responses import MeasurementsResponse, MeasurementsResponseV1
+from ..streaming import StreamFormat, csv_chunks, ndjson_chunks, stream_response
 
 logger = logging.getLogger("measurements")
 
@@ -31,9 +34,10 @@ router = APIRouter(
 )
 
 
-def meas_csv(rows, includefields):
-    output = io.StringIO()
-    writer = csv.writer(output)
+MEAS_CSV_INCLUDE_FIELDS = ["sourceName", "attribution", "averagingPeriod"]
+
+
+def meas_csv_header(includefields) -> list[str]:
     header = [
         "locationId",
         "location",
@@ -49,41 +53,54 @@ def meas_csv(rows, includefields):
     ]
     # include_fields in csv header
     if includefields is not None:
-        include_fields = includefields.split(",")
-        available_fields = ["sourceName", "attribution", "averagingPeriod"]
-        for f in include_fields:
-            if f in available_fields:
+        for f in includefields.split(","):
+            if f in MEAS_CSV_INCLUDE_FIELDS:
                 header.append(f)
-    writer.writerow(header)
+    return header
+
+
+def meas_csv_row(r, includefields) -> list:
+    row = [
+        r["locationId"],
+        r["location"],
+        r.get("city"),
+        r["country"],
+        r["date"]["utc"],
+        r["date"]["local"],
+        r["parameter"],
+        r["value"],
+        r["unit"],
+        r["coordinates"]["latitude"],
+        r["coordinates"]["longitude"],
+    ]
+    # include_fields in csv data
+    if includefields is not None:
+        for f in includefields.split(","):
+            if f in MEAS_CSV_INCLUDE_FIELDS:
+                row.append(r.get(f))
+    return row
+
+
+def meas_csv(rows, includefields):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(meas_csv_header(includefields))
     for r in rows:
         try:
-            row = [
-                r["locationId"],
-                r["location"],
-                r["city"],
-                r["country"],
-                r["date"]["utc"],
-                r["date"]["local"],
-                r["parameter"],
-                r["value"],
-                r["unit"],
-                r["coordinates"]["latitude"],
-                r["coordinates"]["longitude"],
-            ]
-            # include_fields in csv data
-            if includefields is not None:
-                include_fields = includefields.split(",")
-                available_fields = ["sourceName", "attribution", "averagingPeriod"]
-                for f in include_fields:
-                    if f in available_fields:
-                        row.append(r["{}".format(f)])
-            writer.writerow(row)
+            writer.writerow(meas_csv_row(r, includefields))
         except Exception as e:
             logger.debug(e)
 
     return output.getvalue()
 
 
+def measurement_dict(r) -> dict:
+    row = dict(r)
+    for f in CURSOR_FIELDS:
+        row.pop(f, None)
+    return row
+
+
 class MeasOrder(str, Enum):
     city = "city"
     country = "country"
@@ -118,6 +135,27 @@ class Measurements(
         description="Additional fields to include in response e.g. ?include_fields=sourceName",
         examples=["sourceName"],
     )
+    cursor: str | None = Query(
+        None,
+        description="Paginate through results with a cursor rather than a page number. Use ?cursor=* for the first page and follow meta.next for the following pages",
+        examples=["*"],
+    )
+
+    @field_validator("cursor")
+    def check_cursor(cls, v):
+        cursor_params(v)
+        return v
+
+    def cursor_fields(self) -> str:
+        if self.cursor is None:
+            return ""
+        return ", h.datetime as cursor_datetime, h.sensors_id as cursor_id"
+
+    def cursor_order(self) -> str:
+        if self.cursor is None:
+            return ""
+        direction = "ASC" if self.sort == "asc" else "DESC"
+        return f"ORDER BY h.datetime {direction}, h.sensors_id {direction}"
 
     def where(self):
         wheres = []
@@ -174,6 +212,11 @@ class Measurements(
                     wheres.append("h.datetime > :date_from")
                 elif f == "date_to":
                     wheres.append("h.datetime <= :date_to")
+                elif f == "cursor" and v != CURSOR_START:
+                    op = ">" if self.sort == "asc" else "<"
+                    wheres.append(
+                        f"(h.datetime, h.sensors_id) {op} (:cursor_datetime, :cursor_id)"
+                    )
 
         wheres = list(filter(None, wheres))
         # wheres.append(" sensor_nodes_id not in (61485,61505,61506) ")
@@ -192,7 +235,12 @@ class Measurements(
 async def measurements_get(
     m: Annotated[Measurements, Depends(Measurements.depends())],
     db: DB = Depends(),
-    format: str | None = Query(None),
+    format: str
+    | None = Query(
+        None,
+        description="Stream all results as a file, csv or ndjson (newline delimited JSON)",
+        examples=["csv"],
+    ),
 ):
     where = m.where()
     params = m.params()
@@ -217,6 +265,7 @@ async def measurements_get(
                ELSE 'low-cost sensor'
                END as "sensorType"
         , sn.is_analysis
+        {m.cursor_fields()}
         FROM hourly_data h
         JOIN sensors s USING (sensors_id)
         JOIN sensor_systems sy USING (sensor_systems_id)
@@ -224,19 +273,23 @@ async def measurements_get(
         JOIN locations_view_cached sn ON (sy.sensor_nodes_id = sn.id)
         JOIN measurands m ON (m.measurands_id = h.measurands_id)
         WHERE {where}
+        {m.cursor_order()}
         OFFSET :offset
         LIMIT :limit;
         """
 
-    response = await db.fetchPage(sql, params)
-
-    if format == "csv":
-        return Response(
-            content=meas_csv(response.results, includes),
-            media_type="text/csv",
-            headers={"Content-Disposition": "attachment;filename=measurements.csv"},
-        )
+    if format in [f.value for f in StreamFormat]:
+        format = StreamFormat(format)
+        rows = db.stream(sql, params, pool="analytical")
+        if format == StreamFormat.csv:
+            chunks = csv_chunks(
+                rows, meas_csv_header(includes), lambda r: meas_csv_row(r, includes)
+            )
+        else:
+            chunks = ndjson_chunks(rows, measurement_dict)
+        return await stream_response(chunks, format, "measurements")
 
+    response = await db.fetchPage(sql, params)
     return response
 
 
@@ -267,6 +320,7 @@ async def measurements_get_v1(
              'longitude', st_x(sn.geom)
         ) as coordinates
         , c.iso as country
+        {m.cursor_fields()}
         FROM hourly_data h
         JOIN sensors s USING (sensors_id)
         JOIN sensor_systems sy USING (sensor_systems_id)
@@ -275,6 +329,7 @@ async def measurements_get_v1(
         JOIN measurands m ON (m.measurands_id = h.measurands_id)
         JOIN countries c ON (c.countries_id = sn.countries_id)
         WHERE {where}
+        {m.cursor_order()}
         OFFSET :offset
         LIMIT :limit
         """
@@ -20,9 +20,53 @@ class Settings(BaseSettings):
     DATABASE_HOST: str
     DATABASE_PORT: int
     API_CACHE_TIMEOUT: int = 900
+    API_CACHE_TIMEOUTS: dict[str, int] = {}
+    API_CACHE_STALE_TIMEOUTS: dict[str, int] = {}
+    API_CACHE_EARLY_REFRESH: dict[str, float] = {}
+    API_CACHE_MAX_BYTES: int = 128 * 1024 * 1024
+    API_CACHE_MAX_ENTRIES: int | None = None
+    API_CACHE_REDIS: bool = False
+    API_CACHE_REDIS_TIMEOUT: float = 0.5
+    API_TILE_CACHE: bool = False
+    API_TILE_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    API_TILE_CACHE_TTLS: dict[int, int] = {5: 3600, 9: 1800, 12: 900}
+    API_TILE_CACHE_TTL: int = 300
+    API_TILE_CACHE_DIR: str | None = None
+    API_TILE_CACHE_DIR_MAX_BYTES: int = 1024 * 1024 * 1024
+    API_TILE_CACHE_REDIS: bool = False
+    API_STREAM_MAX_ROWS: int = 20_000
+    API_STREAM_CHUNK_SIZE: int = 1000
+    API_STREAM_TIMEOUT: int = 300
+    API_STREAM_CONCURRENCY: int = 2
+    API_STREAM_ACQUIRE_TIMEOUT: float = 5
+    API_SERVER_TIMING: bool = False
+    API_RAW_JSON: bool = False
+    API_LOCATION_CATALOG: bool = False
+    API_LOCATION_CATALOG_REFRESH: int = 3600
+    API_ROLLUPS: bool = False
+    API_ROLLUP_REFRESH: int | None = None
+    API_SENSOR_SKETCHES: bool = False
+    API_SENSOR_SKETCH_REFRESH: int | None = None
+    API_TREND_PROFILES: bool = False
+    API_TREND_PROFILE_REFRESH: int | None = None
+    API_SLOW_QUERY_THRESHOLD: float | None = 2.0
+    API_SLOW_QUERY_SAMPLE_RATE: float = 0
+    API_SLOW_QUERY_MAX_ENTRIES: int = 100
+    API_SLOW_QUERY_EXPLAIN_INTERVAL: int = 300
+    API_SLOW_QUERY_ANALYZE: bool = False
+    API_ADMIN_KEY: str | None = None
     USE_SHARED_POOL: bool = False
+    DATABASE_INTERACTIVE_URL: str | None = None
+    DATABASE_INTERACTIVE_POOL_SIZE: int = 10
+    DATABASE_INTERACTIVE_TIMEOUT: int = 6
+    DATABASE_ANALYTICAL_URL: str | None = None
+    DATABASE_ANALYTICAL_POOL_SIZE: int = 4
+    DATABASE_ANALYTICAL_TIMEOUT: int = 20
     LOG_LEVEL: str = "INFO"
     LOG_BUCKET: str | None = None
+    LOG_BUFFER_SIZE: int = 10000
+    LOG_BATCH_SIZE: int = 500
+    LOG_FLUSH_INTERVAL: float = 1.0
     DOMAIN_NAME: str | None = None
 
     REDIS_HOST: str | None = None
@@ -32,6 +76,11 @@ class Settings(BaseSettings):
     RATE_AMOUNT: int | None = None
     RATE_AMOUNT_KEY: int | None = None
     RATE_TIME: int | None = None
+    RATE_LOCAL_BATCH: float | None = None
+    RATE_LOCAL_OVERDRAFT: float = 0
+    API_KEY_CACHE_REFRESH: int = 300
+    API_KEY_CACHE_TTL: int = 300
+    API_KEY_CACHE_NEGATIVE_TTL: int = 60
     USER_AGENT: str | None = None
     ORIGIN: str | None = None
 
@@ -0,0 +1,494 @@
+import asyncio
+import logging
+import math
+import time
+from datetime import datetime
+from typing import Iterable
+
+import orjson
+
+from openaq_api.rollups import REFRESH_OVERLAP, RollupRefresher
+from openaq_api.settings import settings
+
+logger = logging.getLogger("sketches")
+
+# the relative error of the quantiles of a sketch
+RELATIVE_ACCURACY = 0.01
+
+# bins kept per sign, with 1% accuracy 2048 bins cover values over 17 orders
+# of magnitude before the smallest ones are folded together
+MAX_BINS = 2048
+
+# values closer to zero than this are counted as zero
+MIN_VALUE = 1e-9
+
+# the quantiles of the sensor summary
+SUMMARY_QUANTILES = {
+    "q02": 0.02,
+    "q25": 0.25,
+    "median": 0.5,
+    "q75": 0.75,
+    "q98": 0.98,
+}
+
+# the bucket of the row merging every bucket of a sensor, asyncpg encodes it
+# as '-infinity'
+TOTAL = datetime.min
+
+# the lock held by each refresh transaction so that one instance refreshes
+# at a time
+ADVISORY_LOCK = 7_416_521_023
+
+# the sketch tables, they live next to hourly_data and are created by
+# `openaq_api.migrations`
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sensor_sketches (
+  sensors_id int NOT NULL
+, bucket timestamp NOT NULL
+, datetime_first timestamptz
+, datetime_last timestamptz
+, value_count bigint NOT NULL
+, value_avg double precision
+, value_m2 double precision
+, value_min double precision
+, value_max double precision
+, sketch jsonb NOT NULL
+, calculated_on timestamptz
+, PRIMARY KEY (sensors_id, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS sensor_sketches_refresh (
+  sketch text PRIMARY KEY
+, calculated_until timestamptz NOT NULL
+, pass_until timestamptz
+, sensors_after int
+);
+"""
+
+
+class QuantileSketch:
+    """A mergeable sketch of the distribution of a stream of values
+
+    Values are counted in logarithmic bins (DDSketch) so that the value of a
+    bin is within `RELATIVE_ACCURACY` of every value counted in it. A
+    quantile is then within `RELATIVE_ACCURACY` of the exact quantile,
+    whatever the distribution and the number of values, relative to the
+    larger of the two values it is interpolated between when they differ in
+    sign. The minimum and maximum are exact. Merging adds the counts of the
+    bins, the merge of two sketches is the sketch of all their values.
+
+    Args:
+        alpha: the relative accuracy
+    """
+
+    def __init__(self, alpha: float = RELATIVE_ACCURACY) -> None:
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self.gamma)
+        self.positive: dict[int, int] = {}
+        self.negative: dict[int, int] = {}
+        self.zero = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _key(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, key: int) -> float:
+        # the value within alpha of both ends of the bin
+        return 2 * self.gamma**key / (self.gamma + 1)
+
+    def add(self, value: float) -> None:
+        if value > MIN_VALUE:
+            bins = self.positive
+            key = self._key(value)
+            bins[key] = bins.get(key, 0) + 1
+        elif value < -MIN_VALUE:
+            bins = self.negative
+            key = self._key(-value)
+            bins[key] = bins.get(key, 0) + 1
+        else:
+            self.zero += 1
+        self.count += 1
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def extend(self, values: Iterable[float | None]) -> "QuantileSketch":
+        for value in values:
+            if value is not None:
+                self.add(value)
+        self._collapse()
+        return self
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        if other.alpha != self.alpha:
+            raise ValueError("cannot merge sketches of a different accuracy")
+        for bins, others in (
+            (self.positive, other.positive),
+            (self.negative, other.negative),
+        ):
+            for key, count in others.items():
+                bins[key] = bins.get(key, 0) + count
+        self.zero += other.zero
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self._collapse()
+        return self
+
+    def _collapse(self) -> None:
+        # folds the bins of the smallest magnitudes into the smallest bin kept
+        for bins in (self.positive, self.negative):
+            if len(bins) > MAX_BINS:
+                keys = sorted(bins)
+                folded = sum(bins.pop(k) for k in keys[:-MAX_BINS])
+                bins[keys[-MAX_BINS]] += folded
+
+    def _rank(self, rank: int) -> float:
+        # the approximate value of the order statistic, ascending from 0,
+        # the extremes are known exactly
+        if rank <= 0:
+            return self.min
+        if rank >= self.count - 1:
+            return self.max
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self.max
+
+    def quantiles(self, qs: Iterable[float]) -> list[float | None]:
+        """Quantiles interpolated between order statistics like
+        `PERCENTILE_CONT`"""
+        if self.count == 0:
+            return [None for _ in qs]
+        values = []
+        for q in qs:
+            rank = q * (self.count - 1)
+            low = math.floor(rank)
+            value = self._rank(low)
+            if rank > low:
+                value += (rank - low) * (self._rank(low + 1) - value)
+            # the bins may overshoot the exact extremes
+            values.append(min(max(value, self.min), self.max))
+        return values
+
+    def quantile(self, q: float) -> float | None:
+        return self.quantiles([q])[0]
+
+    def to_dict(self) -> dict:
+        return {
+            "alpha": self.alpha,
+            "count": self.count,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "zero": self.zero,
+            "positive": [[k, c] for k, c in sorted(self.positive.items())],
+            "negative": [[k, c] for k, c in sorted(self.negative.items())],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "QuantileSketch":
+        sketch = cls(data["alpha"])
+        sketch.count = data["count"]
+        if sketch.count:
+            sketch.min = data["min"]
+            sketch.max = data["max"]
+        sketch.zero = data["zero"]
+        sketch.positive = {k: c for k, c in data["positive"]}
+        sketch.negative = {k: c for k, c in data["negative"]}
+        return sketch
+
+
+class Moments:
+    """Mergeable count, mean and sum of squared deviations of values
+
+    Merged with Chan's formula, which unlike a sum of squares keeps the
+    variance accurate when the values are large next to their spread.
+    """
+
+    def __init__(self, count: int = 0, mean: float = 0.0, m2: float = 0.0) -> None:
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def merge(self, other: "Moments") -> "Moments":
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        return self
+
+    @property
+    def sd(self) -> float | None:
+        """The sample standard deviation, as `STDDEV`"""
+        if self.count < 2:
+            return None
+        return math.sqrt(max(self.m2, 0.0) / (self.count - 1))
+
+
+def summary(sketch: dict, sd: float | None) -> dict:
+    """The summary of a sensor from its merged sketch"""
+    sketch = QuantileSketch.from_dict(sketch)
+    quantiles = sketch.quantiles(SUMMARY_QUANTILES.values())
+    return {
+        "sd": sd,
+        "min": sketch.min if sketch.count else None,
+        **dict(zip(SUMMARY_QUANTILES, quantiles)),
+        "max": sketch.max if sketch.count else None,
+    }
+
+
+# the next batch of sensors of the first refresh, ($1 after, $2 batch)
+SENSORS_SQL = """
+SELECT sensors_id FROM sensors
+WHERE sensors_id > $1
+ORDER BY sensors_id
+LIMIT $2
+"""
+
+# the next batch of sensors with hourly rows calculated since the last
+# refresh, ($1 calculated_until, $2 after, $3 batch)
+CHANGED_SENSORS_SQL = """
+SELECT DISTINCT sensors_id FROM hourly_data
+WHERE calculated_on > $1 AND sensors_id > $2
+ORDER BY sensors_id
+LIMIT $3
+"""
+
+# the months of the sensors with hourly rows calculated since the last
+# refresh and all the values of those months, months in UTC by the start of
+# the hour, ($1 calculated_until, $2 sensors_ids)
+BUCKETS_SQL = """
+WITH changed AS (
+SELECT DISTINCT sensors_id
+, date_trunc('month', (datetime - '1sec'::interval) AT TIME ZONE 'UTC') as bucket
+FROM hourly_data
+WHERE calculated_on > $1 AND sensors_id = ANY($2)
+)
+SELECT m.sensors_id
+, date_trunc('month', (m.datetime - '1sec'::interval) AT TIME ZONE 'UTC') as bucket
+, MIN(m.datetime - '1sec'::interval) as datetime_first
+, MAX(m.datetime - '1sec'::interval) as datetime_last
+, COUNT(1) as value_count
+, AVG(m.value_avg) as value_avg
+, COALESCE(VAR_POP(m.value_avg) * COUNT(m.value_avg), 0) as value_m2
+, MIN(m.value_avg) as value_min
+, MAX(m.value_avg) as value_max
+, array_agg(m.value_avg) as values
+FROM hourly_data m
+WHERE m.sensors_id = ANY($2)
+AND (m.sensors_id, date_trunc('month', (m.datetime - '1sec'::interval) AT TIME ZONE 'UTC'))
+  IN (SELECT sensors_id, bucket FROM changed)
+GROUP BY 1, 2
+"""
+
+UPSERT_SQL = """
+INSERT INTO sensor_sketches (sensors_id, bucket, datetime_first, datetime_last
+, value_count, value_avg, value_m2, value_min, value_max, sketch, calculated_on)
+VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10::jsonb, current_timestamp)
+ON CONFLICT (sensors_id, bucket) DO UPDATE
+SET datetime_first = EXCLUDED.datetime_first
+, datetime_last = EXCLUDED.datetime_last
+, value_count = EXCLUDED.value_count
+, value_avg = EXCLUDED.value_avg
+, value_m2 = EXCLUDED.value_m2
+, value_min = EXCLUDED.value_min
+, value_max = EXCLUDED.value_max
+, sketch = EXCLUDED.sketch
+, calculated_on = EXCLUDED.calculated_on
+"""
+
+
+def merge_buckets(rows: list) -> tuple:
+    """The total of a sensor from the rows of its buckets, as upsert
+    arguments"""
+    moments = Moments()
+    sketch = QuantileSketch()
+    for row in rows:
+        # hourly rows without a value are counted but not in the moments
+        moments.merge(
+            Moments(row["sketch"]["count"], row["value_avg"] or 0, row["value_m2"])
+        )
+        sketch.merge(QuantileSketch.from_dict(row["sketch"]))
+    return (
+        rows[0]["sensors_id"],
+        TOTAL,
+        min(r["datetime_first"] for r in rows),
+        max(r["datetime_last"] for r in rows),
+        sum(r["value_count"] for r in rows),
+        moments.mean if moments.count else None,
+        moments.m2,
+        sketch.min if sketch.count else None,
+        sketch.max if sketch.count else None,
+        orjson.dumps(sketch.to_dict()).decode(),
+    )
+
+
+class SketchRefresher(RollupRefresher):
+    """Refreshes the sensor sketches incrementally
+
+    Each refresh sketches again the months of the sensors with hourly_data
+    rows calculated since the previous refresh and merges the months of
+    those sensors into their totals. The first refresh sketches all of
+    hourly_data, as a backfill job like the first refresh of the rollups. A
+    refresh goes through the sensors in batches in order of
+    their id, each batch in its own transaction that records the last
+    sensor refreshed, so that a refresh that fails is resumed from its last
+    batch.
+
+    Args:
+        interval: seconds between refreshes scheduled with `schedule`
+        batch: the rows upserted at a time
+        sensors: the sensors refreshed per transaction
+    """
+
+    name = "sensor sketches"
+    module = "openaq_api.sketches"
+    lock = ADVISORY_LOCK
+    periods = ("sensor",)
+    state_table = "sensor_sketches_refresh"
+
+    def __init__(
+        self, interval: float | None = None, batch: int = 1000, sensors: int = 500
+    ) -> None:
+        super().__init__(interval)
+        self.batch = batch
+        self.sensors = sensors
+
+    async def refresh_all(self, con) -> bool:
+        start = time.time()
+        refreshed = 0
+        while True:
+            count = await self.refresh_batch(con)
+            if count is None:
+                return False
+            if count == 0:
+                break
+            refreshed += count
+        logger.debug(
+            "refreshed the sketches of %s sensors in %.2fs",
+            refreshed,
+            time.time() - start,
+        )
+        return True
+
+    async def refresh_batch(self, con) -> int | None:
+        """Refreshes the next batch of sensors on the connection, returns
+        the number of sensors, 0 when the refresh is complete and None when
+        another instance is refreshing"""
+        async with con.transaction():
+            if not await self.locked(con):
+                return None
+            state = await con.fetchrow(
+                """
+                SELECT COALESCE(r.calculated_until, '-infinity') as calculated_until
+                , COALESCE(r.calculated_until, '-infinity') = '-infinity' as first
+                , COALESCE(r.pass_until, now() - $1::interval) as pass_until
+                , COALESCE(r.sensors_after, 0) as sensors_after
+                FROM (SELECT 1) t
+                LEFT JOIN sensor_sketches_refresh r ON (r.sketch = 'sensor')
+                """,
+                REFRESH_OVERLAP,
+            )
+            calculated_until = state["calculated_until"]
+            if state["first"]:
+                rows = await con.fetch(
+                    SENSORS_SQL, state["sensors_after"], self.sensors
+                )
+            else:
+                rows = await con.fetch(
+                    CHANGED_SENSORS_SQL,
+                    calculated_until,
+                    state["sensors_after"],
+                    self.sensors,
+                )
+            ids = [row["sensors_id"] for row in rows]
+            if ids:
+                await self.sketch(con, calculated_until, ids)
+                await self.merge(con, ids)
+                # the pass continues after the last sensor of the batch
+                state = (calculated_until, state["pass_until"], ids[-1])
+            else:
+                # the pass is complete
+                state = (state["pass_until"], None, None)
+            await con.execute(
+                """
+                INSERT INTO sensor_sketches_refresh
+                (sketch, calculated_until, pass_until, sensors_after)
+                VALUES ('sensor', $1, $2, $3)
+                ON CONFLICT (sketch) DO UPDATE
+                SET calculated_until = EXCLUDED.calculated_until
+                , pass_until = EXCLUDED.pass_until
+                , sensors_after = EXCLUDED.sensors_after
+                """,
+                *state,
+            )
+        return len(ids)
+
+    async def sketch(self, con, calculated_until, sensors_ids: list[int]) -> None:
+        """Sketches the changed months of the sensors"""
+        upserts = []
+        async for row in con.cursor(BUCKETS_SQL, calculated_until, sensors_ids):
+            sketch = QuantileSketch().extend(row["values"])
+            upserts.append(
+                (
+                    row["sensors_id"],
+                    row["bucket"],
+                    row["datetime_first"],
+                    row["datetime_last"],
+                    row["value_count"],
+                    row["value_avg"],
+                    row["value_m2"],
+                    row["value_min"],
+                    row["value_max"],
+                    orjson.dumps(sketch.to_dict()).decode(),
+                )
+            )
+            if len(upserts) >= self.batch:
+                await con.executemany(UPSERT_SQL, upserts)
+                upserts = []
+        if upserts:
+            await con.executemany(UPSERT_SQL, upserts)
+
+    async def merge(self, con, sensors_ids: list[int]) -> None:
+        """Merges the buckets of the sensors into their totals"""
+        rows = await con.fetch(
+            """
+            SELECT sensors_id, datetime_first, datetime_last, value_count
+            , value_avg, value_m2, sketch::text
+            FROM sensor_sketches
+            WHERE sensors_id = ANY($1) AND bucket > '-infinity'
+            ORDER BY sensors_id, bucket
+            """,
+            sensors_ids,
+        )
+        buckets: dict[int, list] = {}
+        for row in rows:
+            row = dict(row)
+            row["sketch"] = orjson.loads(row["sketch"])
+            buckets.setdefault(row["sensors_id"], []).append(row)
+        await con.executemany(
+            UPSERT_SQL, [merge_buckets(rows) for rows in buckets.values()]
+        )
+
+
+sketch_refresher = SketchRefresher(settings.API_SENSOR_SKETCH_REFRESH)
+
+
+if __name__ == "__main__":
+    # refresh once, e.g. from a scheduled task, backfilling on the first run
+    logging.basicConfig(level=logging.DEBUG)
+    asyncio.run(SketchRefresher().run(backfill=True))
@@ -0,0 +1,242 @@
+import asyncio
+import hashlib
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable
+
+import asyncpg
+import orjson
+
+from openaq_api import metrics
+from openaq_api.cache import normalize_sql
+from openaq_api.models.logging import WarnLog
+from openaq_api.settings import settings
+
+logger = logging.getLogger("slow_queries")
+
+slow_queries_total = metrics.registry.counter(
+    "openaq_slow_queries_total",
+    "Queries slower than API_SLOW_QUERY_THRESHOLD",
+    ("pool", "route"),
+)
+
+
+def fingerprint(sql: str) -> str:
+    """Identifies the shape of a query, regardless of its parameters"""
+    return hashlib.blake2b(normalize_sql(sql).encode(), digest_size=8).hexdigest()
+
+
+class SlowQuery:
+    """A query that took longer than the threshold, with its plan once
+    explained"""
+
+    __slots__ = (
+        "fingerprint",
+        "sql",
+        "args",
+        "seconds",
+        "route",
+        "pool",
+        "statement",
+        "at",
+        "plan",
+        "explain_error",
+    )
+
+    def __init__(
+        self,
+        sql: str,
+        args: list,
+        seconds: float,
+        route: str | None,
+        pool: str,
+        statement: str | None,
+    ) -> None:
+        self.fingerprint = fingerprint(sql)
+        self.sql = sql
+        self.args = args
+        self.seconds = seconds
+        self.route = route
+        self.pool = pool
+        self.statement = statement
+        self.at = time.time()
+        self.plan = None
+        self.explain_error = None
+
+    def as_dict(self) -> dict:
+        return {
+            "fingerprint": self.fingerprint,
+            "seconds": round(self.seconds, 4),
+            "route": self.route,
+            "pool": self.pool,
+            "statement": self.statement,
+            "at": self.at,
+            "sql": self.sql,
+            # values are shown as text, arrays of ids can be long
+            "params": [repr(a)[:200] for a in self.args],
+            "plan": self.plan,
+            "explainError": self.explain_error,
+        }
+
+
+class SlowQueryLog:
+    """Bounded ring of the latest slow queries
+
+    Queries slower than `threshold` seconds are recorded with their rendered
+    SQL and parameters, and counted per fingerprint. A `sample_rate` share of
+    them, none by default, is explained in the background on a connection of
+    the pool the explain is given, at most once per fingerprint every
+    `explain_interval` seconds, so that a regressed plan does not get
+    explained on every request. With `analyze` the query is run again by
+    EXPLAIN (ANALYZE, BUFFERS) inside a read only transaction, which doubles
+    its cost.
+    """
+
+    def __init__(
+        self,
+        threshold: float | None,
+        sample_rate: float = 0,
+        max_entries: int = 100,
+        max_fingerprints: int = 1000,
+        explain_interval: float = 300,
+        explain_timeout: float = 30,
+        analyze: bool = False,
+    ) -> None:
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.entries: deque[SlowQuery] = deque(maxlen=max_entries)
+        self.max_fingerprints = max_fingerprints
+        self.fingerprints: OrderedDict[str, dict] = OrderedDict()
+        self.explain_interval = explain_interval
+        self.explain_timeout = explain_timeout
+        self.analyze = analyze
+        self.explains = 0
+        self.explain_errors = 0
+        self._tasks = set()
+
+    def observe(
+        self,
+        sql: str,
+        args: list,
+        seconds: float,
+        route: str | None,
+        pool: str,
+        statement: str | None,
+        explain_pool: Callable[[], Awaitable[asyncpg.Pool]],
+    ) -> SlowQuery | None:
+        """Records the query if it was slow
+
+        Args:
+            sql: the rendered query text
+            args: the positional query parameters
+            seconds: time the query ran
+            route: path of the route that ran the query
+            pool: name of the pool the query ran on
+            statement: name of the prepared statement, if any
+            explain_pool: the pool to explain the query on, e.g. the
+                analytical pool so that explains do not hold the connections
+                of requests
+        """
+        if self.threshold is None or seconds < self.threshold:
+            return None
+        entry = SlowQuery(sql, args, seconds, route, pool, statement)
+        self.entries.append(entry)
+        slow_queries_total.inc((pool, str(route)))
+        stats = self._stats(entry)
+        logger.warning(
+            WarnLog(
+                detail=f"slow query {entry.fingerprint} on {route} took {seconds:.3f}s"
+            ).model_dump_json()
+        )
+        now = time.monotonic()
+        if (
+            random.random() < self.sample_rate
+            and now - stats["explained_at"] >= self.explain_interval
+        ):
+            stats["explained_at"] = now
+            task = asyncio.ensure_future(self.explain(entry, explain_pool))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return entry
+
+    def _stats(self, entry: SlowQuery) -> dict:
+        stats = self.fingerprints.get(entry.fingerprint)
+        if stats is None:
+            if len(self.fingerprints) >= self.max_fingerprints:
+                self.fingerprints.popitem(last=False)
+            stats = self.fingerprints[entry.fingerprint] = {
+                "count": 0,
+                "total": 0.0,
+                "max": 0.0,
+                "explained_at": float("-inf"),
+                "sql": entry.sql,
+            }
+        else:
+            self.fingerprints.move_to_end(entry.fingerprint)
+        stats["count"] += 1
+        stats["total"] += entry.seconds
+        stats["max"] = max(stats["max"], entry.seconds)
+        return stats
+
+    async def explain(
+        self,
+        entry: SlowQuery,
+        explain_pool: Callable[[], Awaitable[asyncpg.Pool]],
+    ) -> None:
+        """Adds the plan of the query to the entry"""
+        options = "ANALYZE, BUFFERS, FORMAT JSON" if self.analyze else "FORMAT JSON"
+        try:
+            pool = await explain_pool()
+            async with pool.acquire() as con, con.transaction(readonly=True):
+                await con.execute(
+                    f"SET LOCAL statement_timeout = {int(self.explain_timeout * 1000)}"
+                )
+                plan = await con.fetchval(
+                    f"EXPLAIN ({options}) {entry.sql}", *entry.args
+                )
+            entry.plan = orjson.loads(plan) if isinstance(plan, str) else plan
+            self.explains += 1
+        except Exception as e:
+            entry.explain_error = str(e)
+            self.explain_errors += 1
+            logger.warning(
+                WarnLog(
+                    detail=f"could not explain slow query {entry.fingerprint}: {e}"
+                ).model_dump_json()
+            )
+
+    def report(self) -> dict:
+        """The recorded slow queries, newest first, and the fingerprints by
+        total time"""
+        fingerprints = sorted(
+            (
+                {
+                    "fingerprint": fp,
+                    "count": stats["count"],
+                    "totalSeconds": round(stats["total"], 4),
+                    "maxSeconds": round(stats["max"], 4),
+                    "sql": stats["sql"],
+                }
+                for fp, stats in self.fingerprints.items()
+            ),
+            key=lambda s: s["totalSeconds"],
+            reverse=True,
+        )
+        return {
+            "threshold": self.threshold,
+            "explains": self.explains,
+            "explainErrors": self.explain_errors,
+            "fingerprints": fingerprints,
+            "queries": [e.as_dict() for e in reversed(self.entries)],
+        }
+
+
+slow_queries = SlowQueryLog(
+    settings.API_SLOW_QUERY_THRESHOLD,
+    sample_rate=settings.API_SLOW_QUERY_SAMPLE_RATE,
+    max_entries=settings.API_SLOW_QUERY_MAX_ENTRIES,
+    explain_interval=settings.API_SLOW_QUERY_EXPLAIN_INTERVAL,
+    analyze=settings.API_SLOW_QUERY_ANALYZE,
+)
@@ -0,0 +1,185 @@
+import math
+from array import array
+
+# WGS 84, the spheroid PostGIS measures geography distances on
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+# the smallest radius of curvature of the spheroid, at the equator along a
+# meridian, so that no point of a radius search is further in degrees
+MIN_RADIUS = WGS84_A * (1 - WGS84_F * (2 - WGS84_F))
+# the sphere PostGIS falls back to
+MEAN_RADIUS = 6371008.7714
+
+
+def sphere_distance(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    """Great circle distance in meters on the mean sphere"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    h = (
+        math.sin(dphi / 2) ** 2
+        + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    )
+    return 2 * MEAN_RADIUS * math.asin(min(1.0, math.sqrt(h)))
+
+
+def distance(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    """Geodesic distance in meters on the WGS 84 spheroid
+
+    Vincenty's inverse formula, agreeing with `ST_Distance` on geography to
+    well under a millimeter. Nearly antipodal points, where the iteration
+    does not converge, are measured on the sphere.
+    """
+    if lon1 == lon2 and lat1 == lat2:
+        return 0.0
+    a, b, f = WGS84_A, WGS84_B, WGS84_F
+    L = math.radians(lon2 - lon1)
+    U1 = math.atan((1 - f) * math.tan(math.radians(lat1)))
+    U2 = math.atan((1 - f) * math.tan(math.radians(lat2)))
+    sinU1, cosU1 = math.sin(U1), math.cos(U1)
+    sinU2, cosU2 = math.sin(U2), math.cos(U2)
+    lam = L
+    for _ in range(200):
+        sinLam, cosLam = math.sin(lam), math.cos(lam)
+        sinSigma = math.hypot(cosU2 * sinLam, cosU1 * sinU2 - sinU1 * cosU2 * cosLam)
+        if sinSigma == 0:
+            return 0.0
+        cosSigma = sinU1 * sinU2 + cosU1 * cosU2 * cosLam
+        sigma = math.atan2(sinSigma, cosSigma)
+        sinAlpha = cosU1 * cosU2 * sinLam / sinSigma
+        cos2Alpha = 1 - sinAlpha**2
+        # on the equator cos2Alpha is 0
+        cos2SigmaM = cosSigma - 2 * sinU1 * sinU2 / cos2Alpha if cos2Alpha else 0.0
+        C = f / 16 * cos2Alpha * (4 + f * (4 - 3 * cos2Alpha))
+        previous = lam
+        lam = L + (1 - C) * f * sinAlpha * (
+            sigma
+            + C * sinSigma * (cos2SigmaM + C * cosSigma * (-1 + 2 * cos2SigmaM**2))
+        )
+        if abs(lam - previous) < 1e-12:
+            break
+    else:
+        return sphere_distance(lon1, lat1, lon2, lat2)
+    u2 = cos2Alpha * (a**2 - b**2) / b**2
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    deltaSigma = (
+        B
+        * sinSigma
+        * (
+            cos2SigmaM
+            + B
+            / 4
+            * (
+                cosSigma * (-1 + 2 * cos2SigmaM**2)
+                - B
+                / 6
+                * cos2SigmaM
+                * (-3 + 4 * sinSigma**2)
+                * (-3 + 4 * cos2SigmaM**2)
+            )
+        )
+    )
+    return b * A * (sigma - deltaSigma)
+
+
+def radius_boxes(
+    lon: float, lat: float, radius: float
+) -> list[tuple[float, float, float, float]]:
+    """Boxes of longitude and latitude holding every point within `radius`
+    meters of lon, lat
+
+    The boxes are a little larger than the circle and are split in two
+    where the circle crosses the antimeridian.
+    """
+    delta = math.degrees(radius / MIN_RADIUS) * 1.01 + 1e-9
+    miny, maxy = max(-90.0, lat - delta), min(90.0, lat + delta)
+    cos_lat = math.cos(math.radians(max(abs(miny), abs(maxy))))
+    sin_delta = math.sin(math.radians(delta))
+    if maxy >= 90 or miny <= -90 or sin_delta >= cos_lat:
+        return [(-180.0, miny, 180.0, maxy)]
+    dlon = math.degrees(math.asin(sin_delta / cos_lat)) * 1.01 + 1e-9
+    minx, maxx = lon - dlon, lon + dlon
+    if minx < -180:
+        return [(-180.0, miny, maxx, maxy), (minx + 360, miny, 180.0, maxy)]
+    if maxx > 180:
+        return [(minx, miny, 180.0, maxy), (-180.0, miny, maxx - 360, maxy)]
+    return [(minx, miny, maxx, maxy)]
+
+
+class GridIndex:
+    """Row positions of points bucketed into a grid of degree cells
+
+    Cells are `cell` degrees wide, radius searches up to a few tens of
+    kilometers read a handful of cells. Rows without a point (NaN) are not
+    indexed.
+
+    Args:
+        xs: longitude of each row
+        ys: latitude of each row
+        cell: the width and height of a cell in degrees
+    """
+
+    def __init__(self, xs: array, ys: array, cell: float = 0.25) -> None:
+        self.xs = xs
+        self.ys = ys
+        self.cell = cell
+        self.columns = math.ceil(360 / cell)
+        self.rows = math.ceil(180 / cell)
+        cells: dict[int, array] = {}
+        for position, (x, y) in enumerate(zip(xs, ys)):
+            if math.isnan(x) or math.isnan(y):
+                continue
+            cells.setdefault(self._key(x, y), array("q")).append(position)
+        self.cells = cells
+
+    def _column(self, x: float) -> int:
+        return min(max(int((x + 180) // self.cell), 0), self.columns - 1)
+
+    def _row(self, y: float) -> int:
+        return min(max(int((y + 90) // self.cell), 0), self.rows - 1)
+
+    def _key(self, x: float, y: float) -> int:
+        return self._row(y) * self.columns + self._column(x)
+
+    def bbox(self, minx: float, miny: float, maxx: float, maxy: float) -> list[int]:
+        """Positions of the rows in the cells overlapping the box, a superset
+        of the rows inside it"""
+        x0, x1 = self._column(minx), self._column(maxx)
+        y0, y1 = self._row(miny), self._row(maxy)
+        positions: list[int] = []
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+            # a large box, faster to filter the cells that hold points
+            for key, cell in self.cells.items():
+                row, column = divmod(key, self.columns)
+                if y0 <= row <= y1 and x0 <= column <= x1:
+                    positions.extend(cell)
+            return positions
+        cells = self.cells
+        for row in range(y0, y1 + 1):
+            offset = row * self.columns
+            for column in range(x0, x1 + 1):
+                cell = cells.get(offset + column)
+                if cell is not None:
+                    positions.extend(cell)
+        return positions
+
+    def within(self, lon: float, lat: float, radius: float) -> list[int]:
+        """Positions, in ascending order, of the rows within `radius` meters of
+        lon, lat as `ST_DWithin` on geography selects them"""
+        xs, ys = self.xs, self.ys
+        positions = []
+        for box in radius_boxes(lon, lat, radius):
+            minx, miny, maxx, maxy = box
+            for position in self.bbox(*box):
+                x, y = xs[position], ys[position]
+                if (
+                    minx <= x <= maxx
+                    and miny <= y <= maxy
+                    and distance(lon, lat, x, y) <= radius
+                ):
+                    positions.append(position)
+        # the boxes of a circle around a pole or the antimeridian may share
+        # cells
+        return sorted(set(positions))
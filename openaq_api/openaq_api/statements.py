@@ -0,0 +1,92 @@
+import logging
+
+import asyncpg
+from buildpg import render
+
+logger = logging.getLogger("statements")
+
+# query shapes registered per name, queries that build their WHERE clause
+# from the request have one shape per combination of filters
+MAX_SHAPES = 16
+
+
+class Statement:
+    """A named query, rendered once and prepared on the connections it runs on
+
+    Attributes:
+        name: name of the hot query
+        query: query text with :named parameters
+        sql: query text with positional parameters
+        params: parameter names in positional order
+    """
+
+    __slots__ = ("name", "query", "sql", "params")
+
+    def __init__(self, name: str, query: str) -> None:
+        self.name = name
+        self.query = query
+        names = {p: p for p in render.regex.findall(query)}
+        self.sql, params = render(query, **names)
+        self.params = tuple(params)
+
+    def args(self, kwargs: dict) -> list:
+        """Positional parameter values from the named parameters"""
+        return [kwargs[p] for p in self.params]
+
+
+class StatementRegistry:
+    """The query shapes of named hot queries
+
+    Each name is one query of the api, its shapes are the combinations of
+    filters of the request, values are bound as parameters. Shapes are
+    registered on first use and prepared on a connection the first time
+    they run on it. Each name keeps at most `max_shapes` shapes, further
+    shapes run as plain queries.
+    """
+
+    def __init__(self, max_shapes: int = MAX_SHAPES) -> None:
+        self.max_shapes = max_shapes
+        self.statements: dict[str, dict[str, Statement]] = {}
+
+    def get(self, name: str, query: str) -> Statement | None:
+        shapes = self.statements.setdefault(name, {})
+        statement = shapes.get(query)
+        if statement is None and len(shapes) < self.max_shapes:
+            statement = shapes[query] = Statement(name, query)
+            logger.debug("registered shape %s of statement %s", len(shapes), name)
+        return statement
+
+
+class StatementConnection(asyncpg.Connection):
+    """Connection that keeps the prepared statements of the registry
+
+    Unlike the asyncpg statement cache, prepared statements are not evicted
+    by other queries run on the connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: dict[str, asyncpg.prepared_stmt.PreparedStatement] = {}
+
+    async def prepare_statement(
+        self, statement: Statement
+    ) -> asyncpg.prepared_stmt.PreparedStatement:
+        prepared = await self.prepare(statement.sql)
+        self.prepared[statement.sql] = prepared
+        return prepared
+
+    async def fetch_statement(self, statement: Statement, args: list) -> list:
+        """Runs a registered statement, preparing it on first use"""
+        prepared = self.prepared.get(statement.sql)
+        if prepared is None:
+            prepared = await self.prepare_statement(statement)
+        try:
+            return await prepared.fetch(*args)
+        except asyncpg.exceptions.InvalidCachedStatementError:
+            # the schema of a queried relation changed since it was prepared
+            logger.debug("re-preparing statement %s", statement.name)
+            prepared = await self.prepare_statement(statement)
+            return await prepared.fetch(*args)
+
+
+statements = StatementRegistry()
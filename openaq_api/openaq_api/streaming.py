@@ -0,0 +1,106 @@
+import csv
+import io
+import logging
+from collections.abc import AsyncIterator, Callable, Iterable
+from decimal import Decimal
+from enum import Enum
+
+import orjson
+from starlette.responses import StreamingResponse
+
+logger = logging.getLogger("streaming")
+
+
+class StreamFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+MEDIA_TYPES = {
+    StreamFormat.ndjson: "application/x-ndjson",
+    StreamFormat.csv: "text/csv",
+}
+
+
+def _json_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError
+
+
+def ndjson_chunks(
+    chunks: AsyncIterator[list], transform: Callable | None = None
+) -> AsyncIterator[bytes]:
+    """Encodes chunks of rows as newline delimited JSON
+
+    Args:
+        chunks: async iterator of lists of rows
+        transform: optional function converting a row to a JSON serializable
+            object, rows are converted to dicts by default
+    """
+    transform = transform or dict
+
+    async def encode():
+        async for rows in chunks:
+            yield b"".join(
+                orjson.dumps(transform(r), default=_json_default) + b"\n" for r in rows
+            )
+
+    return encode()
+
+
+def csv_chunks(
+    chunks: AsyncIterator[list],
+    header: list[str],
+    transform: Callable[[dict], Iterable],
+) -> AsyncIterator[bytes]:
+    """Encodes chunks of rows as CSV, starting with the header row
+
+    Args:
+        chunks: async iterator of lists of rows
+        header: column names
+        transform: function converting a row to a list of values in the
+            order of `header`
+    """
+
+    async def encode():
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(header)
+        sent = False
+        async for rows in chunks:
+            for r in rows:
+                writer.writerow(transform(r))
+            yield output.getvalue().encode()
+            output.seek(0)
+            output.truncate(0)
+            sent = True
+        if not sent:
+            yield output.getvalue().encode()
+
+    return encode()
+
+
+async def stream_response(
+    chunks: AsyncIterator[bytes], format: StreamFormat, filename: str
+) -> StreamingResponse:
+    """Builds a StreamingResponse from encoded chunks
+
+    The first chunk is read before the response is returned so that query
+    errors are still returned as error responses rather than as a
+    truncated body.
+    """
+    first = await anext(chunks, None)
+
+    async def body():
+        if first is not None:
+            yield first
+        async for chunk in chunks:
+            yield chunk
+
+    extension = "csv" if format == StreamFormat.csv else "ndjson"
+    return StreamingResponse(
+        body(),
+        media_type=MEDIA_TYPES[format],
+        headers={"Content-Disposition": f"attachment;filename={filename}.{extension}"},
+    )
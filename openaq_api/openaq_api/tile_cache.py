@@ -0,0 +1,437 @@
+import asyncio
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import time
+from enum import Enum
+from typing import NamedTuple
+
+import msgpack
+import orjson
+from fastapi import Request, Response
+
+from openaq_api import metrics
+from openaq_api.cache import LRUMemoryCache, SingleFlight
+from openaq_api.models.logging import InfrastructureErrorLog
+from openaq_api.settings import settings
+
+logger = logging.getLogger("tile_cache")
+
+# path parameters of a tile, the other parameters of a tile query are its
+# filters
+TILE_FIELDS = ("z", "x", "y")
+
+MEDIA_TYPE = "application/x-protobuf"
+
+
+class TileLayer(str, Enum):
+    """The layers of the cached tiles"""
+
+    locations = "locations"
+    thresholds = "thresholds"
+
+
+tile_cache_requests = metrics.registry.counter(
+    "openaq_tile_cache_requests_total",
+    "Tile cache lookups",
+    ("tier", "result"),
+)
+tile_cache_bytes = metrics.registry.gauge(
+    "openaq_tile_cache_bytes", "Size of the in process tile cache"
+)
+
+
+class TileEntry(NamedTuple):
+    """A cached tile
+
+    Attributes:
+        etag: weak entity tag of the tile, the same for every encoding
+        data: the gzip compressed MVT, None when the tile has no data
+        expires_at: unix timestamp after which the tile is not served
+    """
+
+    etag: str
+    data: bytes | None
+    expires_at: float
+
+    @property
+    def ttl(self) -> int:
+        return max(0, int(self.expires_at - time.time()))
+
+
+def tile_ttl(z: int) -> int:
+    """Seconds a tile of zoom level `z` is cached
+
+    Low zoom tiles cover many locations, cost the most to build and change
+    the least, they are cached the longest.
+    """
+    for max_zoom, ttl in sorted(settings.API_TILE_CACHE_TTLS.items()):
+        if z <= max_zoom:
+            return ttl
+    return settings.API_TILE_CACHE_TTL
+
+
+def filters_digest(query) -> str:
+    """Identifies the filters of a tile query
+
+    Unset filters are left out and lists are sorted, so that filters that
+    select the same locations share tiles.
+    """
+    filters = {}
+    for name, value in query.model_dump(exclude=set(TILE_FIELDS)).items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            value = sorted(set(value))
+        filters[name] = value
+    data = orjson.dumps(filters, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def tile_prefix(layer: str, query=None) -> str:
+    """The key prefix of the tiles of a layer, or of the tiles of a layer
+    with the filters of `query`"""
+    if query is None:
+        return f"{layer}:"
+    return f"{layer}:{filters_digest(query)}:"
+
+
+def tile_key(layer: str, query) -> str:
+    return f"{tile_prefix(layer, query)}{query.z}/{query.x}/{query.y}"
+
+
+def dumps_tile(entry: TileEntry) -> bytes:
+    return msgpack.packb(tuple(entry))
+
+
+def loads_tile(data: bytes) -> TileEntry:
+    return TileEntry(*msgpack.unpackb(data))
+
+
+class DiskTileStore:
+    """Tiles shared between the processes of an instance through a
+    directory, one file per tile
+
+    The modification time of a tile file is its expiry. Every tenth of
+    `max_bytes` written the directory is swept in the background, expired
+    tiles are removed and then the tiles closest to expiring until the
+    directory is within `max_bytes`.
+
+    Args:
+        directory: the directory the tiles are written to
+        max_bytes: the size of the tiles kept in the directory
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 1024 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._sweep: asyncio.Task | None = None
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, *key.split(":")) + ".tile"
+
+    def _read(self, key: str) -> TileEntry | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = loads_tile(f.read())
+        except FileNotFoundError:
+            return None
+        if entry.expires_at <= time.time():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return None
+        return entry
+
+    def _write(self, key: str, entry: TileEntry) -> int:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written aside then renamed so that readers never see part of a tile
+        tmp = f"{path}.{os.getpid()}.tmp"
+        data = dumps_tile(entry)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.utime(tmp, (entry.expires_at, entry.expires_at))
+        os.replace(tmp, path)
+        return len(data)
+
+    def _sweep_files(self) -> None:
+        now = time.time()
+        tiles = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                    if name.endswith(".tile") and stat.st_mtime > now:
+                        tiles.append((stat.st_mtime, stat.st_size, path))
+                    # expired tiles and the leftovers of interrupted writes
+                    elif name.endswith(".tile") or (
+                        name.endswith(".tmp") and stat.st_ctime < now - 60
+                    ):
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+        size = sum(t[1] for t in tiles)
+        for _, tile_size, path in sorted(tiles):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= tile_size
+
+    def _remove(self, prefix: str) -> None:
+        shutil.rmtree(os.path.join(self.directory, *prefix.split(":")), True)
+
+    async def get(self, key: str) -> TileEntry | None:
+        try:
+            entry = await asyncio.to_thread(self._read, key)
+        except Exception as e:
+            self._error(e)
+            return None
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    async def set(self, key: str, entry: TileEntry) -> None:
+        try:
+            self.written += await asyncio.to_thread(self._write, key, entry)
+        except Exception as e:
+            self._error(e)
+            return
+        if self.written >= self.max_bytes // 10 and (
+            self._sweep is None or self._sweep.done()
+        ):
+            self.written = 0
+            self._sweep = asyncio.ensure_future(self.sweep())
+
+    async def sweep(self) -> None:
+        """Removes the expired tiles, then the tiles closest to expiring
+        until the directory is within `max_bytes`"""
+        try:
+            await asyncio.to_thread(self._sweep_files)
+        except Exception as e:
+            self._error(e)
+
+    async def invalidate(self, prefix: str) -> None:
+        await asyncio.to_thread(self._remove, prefix)
+
+    def _error(self, e: Exception) -> None:
+        self.errors += 1
+        logger.warning(
+            InfrastructureErrorLog(
+                detail=f"tile cache directory: {e}"
+            ).model_dump_json()
+        )
+
+
+class RedisTileStore:
+    """Tiles shared between instances through redis
+
+    Any redis error marks the store as unavailable for `retry_after`
+    seconds, as for the query cache.
+    """
+
+    def __init__(
+        self,
+        client,
+        namespace: str = "openaq-api:tiles:v1:",
+        retry_after: int = 30,
+    ) -> None:
+        self.client = client
+        self.namespace = namespace
+        self.retry_after = retry_after
+        self.unavailable_until = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @property
+    def available(self) -> bool:
+        return self.unavailable_until <= time.monotonic()
+
+    def _error(self, e: Exception) -> None:
+        self.errors += 1
+        self.unavailable_until = time.monotonic() + self.retry_after
+        logger.warning(
+            InfrastructureErrorLog(
+                detail=f"tile cache redis unavailable, using local cache only: {e}"
+            ).model_dump_json()
+        )
+
+    async def get(self, key: str) -> TileEntry | None:
+        if not self.available:
+            return None
+        try:
+            data = await self.client.get(f"{self.namespace}{key}")
+        except Exception as e:
+            self._error(e)
+            return None
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return loads_tile(data)
+
+    async def set(self, key: str, entry: TileEntry) -> None:
+        if not self.available or entry.ttl <= 0:
+            return
+        try:
+            await self.client.set(
+                f"{self.namespace}{key}", dumps_tile(entry), ex=entry.ttl
+            )
+        except Exception as e:
+            self._error(e)
+
+    async def invalidate(self, prefix: str) -> None:
+        try:
+            keys = [
+                k
+                async for k in self.client.scan_iter(match=f"{self.namespace}{prefix}*")
+            ]
+            if keys:
+                await self.client.delete(*keys)
+        except Exception as e:
+            self._error(e)
+
+
+class TileCache:
+    """Cache of MVT tiles by layer, filters and tile
+
+    Tiles are kept gzip compressed in a process local LRU in front of an
+    optional shared store, a `DiskTileStore` or a `RedisTileStore`.
+    Concurrent misses for a tile share one query, map pans request the same
+    tiles from many clients at once.
+
+    Args:
+        max_bytes: the memory budget of the process local cache
+        store: the shared tier
+    """
+
+    def __init__(self, max_bytes: int, store=None) -> None:
+        self.l1 = LRUMemoryCache(max_bytes=max_bytes, timeout=None)
+        self.store = store
+        self.flights = SingleFlight()
+        self._tasks = set()
+
+    async def fetch(self, layer: str, query, loader) -> TileEntry:
+        """Returns the cached tile of the query, calling `loader` for the MVT
+        bytes on a miss"""
+        key = tile_key(layer, query)
+        entry = await self.l1.get(key)
+        if entry is None and self.store is not None:
+            entry = await self.store.get(key)
+            if entry is not None and entry.ttl > 0:
+                await self.l1.set(key, entry, ttl=entry.ttl)
+        if entry is not None:
+            return entry
+        return await self.flights.do(key, lambda: self._load(key, query.z, loader))
+
+    async def _load(self, key: str, z: int, loader) -> TileEntry:
+        data = await loader()
+        ttl = tile_ttl(z)
+        entry = TileEntry(
+            etag=f'W/"{hashlib.blake2b(data or b"", digest_size=16).hexdigest()}"',
+            data=None if data is None else gzip.compress(data, mtime=0),
+            expires_at=time.time() + ttl,
+        )
+        await self.l1.set(key, entry, ttl=ttl)
+        if self.store is not None:
+            # the shared tier is written in the background
+            task = asyncio.ensure_future(self.store.set(key, entry))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return entry
+
+    async def invalidate(self, layer: str, query=None) -> None:
+        """Drops the tiles of a layer, or only the tiles of a layer with the
+        filters of `query`"""
+        prefix = tile_prefix(layer, query)
+        await self.l1.clear(namespace=prefix)
+        if self.store is not None:
+            await self.store.invalidate(prefix)
+
+
+def not_modified(request: Request, etag: str) -> bool:
+    """Whether the If-None-Match header of the request matches the tag,
+    compared weakly"""
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+def accepts_gzip(header: str) -> bool:
+    """Whether an Accept-Encoding header accepts gzip, by the q-value of
+    gzip, or of * when gzip is not listed"""
+    qvalues = {}
+    for coding in header.split(","):
+        name, *params = coding.split(";")
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[name.strip().lower()] = q
+    q = qvalues.get("gzip", qvalues.get("x-gzip", qvalues.get("*", 0.0)))
+    return q > 0
+
+
+def tile_response(request: Request, entry: TileEntry) -> Response:
+    """The response of a cached tile, 304 when the client has it, gzip
+    encoded when the client accepts it"""
+    headers = {
+        "ETag": entry.etag,
+        "Cache-Control": f"public, max-age={entry.ttl}",
+        "Vary": "Accept-Encoding",
+    }
+    if not_modified(request, entry.etag):
+        return Response(status_code=304, headers=headers)
+    if accepts_gzip(request.headers.get("accept-encoding", "")):
+        headers["Content-Encoding"] = "gzip"
+        content = entry.data
+    else:
+        content = gzip.decompress(entry.data)
+    return Response(content=content, headers=headers, media_type=MEDIA_TYPE)
+
+
+tile_cache = TileCache(
+    settings.API_TILE_CACHE_MAX_BYTES,
+    (
+        DiskTileStore(
+            settings.API_TILE_CACHE_DIR, settings.API_TILE_CACHE_DIR_MAX_BYTES
+        )
+        if settings.API_TILE_CACHE_DIR
+        else None
+    ),
+)
+
+
+@metrics.registry.collector
+def collect_tile_cache_metrics(state) -> None:
+    """Counters of the tile cache"""
+    stats = tile_cache.l1.stats
+    tile_cache_requests.set(stats["hits"], ("memory", "hit"))
+    tile_cache_requests.set(stats["misses"], ("memory", "miss"))
+    tile_cache_bytes.set(stats["resident_bytes"])
+    store = tile_cache.store
+    if store is not None:
+        tier = "redis" if isinstance(store, RedisTileStore) else "disk"
+        tile_cache_requests.set(store.hits, (tier, "hit"))
+        tile_cache_requests.set(store.misses, (tier, "miss"))
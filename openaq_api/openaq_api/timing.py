@@ -0,0 +1,135 @@
+import functools
+import inspect
+import time
+from contextvars import ContextVar
+
+from fastapi.routing import APIRoute
+
+# phases in the order they happen in a request
+PHASES = (
+    "ratelimit",
+    "validate",
+    "cache",
+    "acquire",
+    "sql",
+    "rows",
+    "handler",
+    "serialize",
+)
+
+# the timing of the current request, None when Server-Timing is off
+current_timing: ContextVar["ServerTiming | None"] = ContextVar(
+    "server_timing", default=None
+)
+
+
+class ServerTiming:
+    """Time spent per phase of a request, in seconds
+
+    Phases that run more than once in a request, e.g. one SQL query per
+    page and one for the count, are added up. The time between the request
+    reaching the application and the endpoint running, less the rate
+    limiter, is dependency resolution and parameter validation. The time
+    between the endpoint returning and the response starting is the
+    serialization of the response.
+    """
+
+    __slots__ = ("start", "phases", "endpoint_start", "endpoint_end")
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.phases: dict[str, float] = {}
+        self.endpoint_start: float | None = None
+        self.endpoint_end: float | None = None
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def endpoint_started(self) -> None:
+        self.endpoint_start = time.perf_counter()
+        self.add(
+            "validate",
+            self.endpoint_start - self.start - self.phases.get("ratelimit", 0),
+        )
+
+    def endpoint_returned(self) -> None:
+        self.endpoint_end = time.perf_counter()
+        if self.endpoint_start is None:
+            return
+        # the endpoint's own python time, outside of the database phases
+        database = sum(self.phases.get(p, 0) for p in ("cache", "acquire", "sql"))
+        self.add(
+            "handler",
+            self.endpoint_end
+            - self.endpoint_start
+            - database
+            - self.phases.get("rows", 0),
+        )
+
+    def response_started(self) -> None:
+        if self.endpoint_end is not None:
+            self.add("serialize", time.perf_counter() - self.endpoint_end)
+
+    def milliseconds(self) -> dict[str, float]:
+        """Phase durations in milliseconds, with the total as `total`"""
+        durations = {
+            phase: round(self.phases[phase] * 1000, 2)
+            for phase in PHASES
+            if phase in self.phases
+        }
+        durations["total"] = round((time.perf_counter() - self.start) * 1000, 2)
+        return durations
+
+    def header(self, durations: dict[str, float] | None = None) -> str:
+        """The Server-Timing header value"""
+        durations = durations or self.milliseconds()
+        return ", ".join(f"{phase};dur={ms}" for phase, ms in durations.items())
+
+
+def record(phase: str, seconds: float) -> None:
+    """Adds to a phase of the current request when Server-Timing is on"""
+    timing = current_timing.get()
+    if timing is not None:
+        timing.add(phase, seconds)
+
+
+def _timed_endpoint(call):
+    if inspect.iscoroutinefunction(call):
+
+        @functools.wraps(call)
+        async def timed(*args, **kwargs):
+            timing = current_timing.get()
+            if timing is None:
+                return await call(*args, **kwargs)
+            timing.endpoint_started()
+            try:
+                return await call(*args, **kwargs)
+            finally:
+                timing.endpoint_returned()
+
+    else:
+        # runs in the threadpool, which runs in a copy of the request context
+
+        @functools.wraps(call)
+        def timed(*args, **kwargs):
+            timing = current_timing.get()
+            if timing is None:
+                return call(*args, **kwargs)
+            timing.endpoint_started()
+            try:
+                return call(*args, **kwargs)
+            finally:
+                timing.endpoint_returned()
+
+    return timed
+
+
+def time_endpoints(routes) -> None:
+    """Marks when the endpoint of each API route starts and returns
+
+    FastAPI looks up the endpoint on the route's dependant when handling a
+    request, after resolving the dependencies and validating parameters.
+    """
+    for route in routes:
+        if isinstance(route, APIRoute):
+            route.dependant.call = _timed_endpoint(route.dependant.call)
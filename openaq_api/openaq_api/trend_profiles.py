@@ -0,0 +1,486 @@
+import asyncio
+import logging
+
+import orjson
+from buildpg import render
+
+from openaq_api.rollups import (
+    MARGINS,
+    NODES_SQL,
+    REFRESH_OVERLAP,
+    RollupRefresher,
+    date_bound,
+)
+from openaq_api.settings import settings
+from openaq_api.sketches import SUMMARY_QUANTILES, TOTAL, Moments, QuantileSketch
+from openaq_api.v3.models.queries import PeriodNames
+
+logger = logging.getLogger("trend_profiles")
+
+# the to_char format of the factor and its interval, by period name
+TREND_PERIODS = {
+    "hour": ("HH24", "01:00:00"),
+    "day": ("ID", "24:00:00"),
+    "month": ("MM", "1 month"),
+}
+
+# the lock held by each refresh transaction so that one instance refreshes
+# at a time
+ADVISORY_LOCK = 7_416_521_024
+
+# the profile tables, they live next to hourly_data and are created by
+# `openaq_api.migrations`
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trend_profiles (
+  period_name text NOT NULL
+, sensor_nodes_id int NOT NULL
+, measurands_id int NOT NULL
+, bucket timestamp NOT NULL
+, factor text NOT NULL
+, avg_seconds double precision
+, log_seconds double precision
+, datetime_from timestamptz
+, datetime_to timestamptz
+, value_count bigint NOT NULL
+, value_avg double precision
+, value_m2 double precision
+, value_min double precision
+, value_max double precision
+, sketch jsonb NOT NULL
+, calculated_on timestamptz
+, PRIMARY KEY (period_name, sensor_nodes_id, measurands_id, bucket, factor)
+);
+
+CREATE TABLE IF NOT EXISTS trend_profiles_refresh (
+  period_name text PRIMARY KEY
+, calculated_until timestamptz NOT NULL
+, pass_until timestamptz
+, nodes_after int
+);
+"""
+
+# the columns of a partial aggregate, in the order of trend_profiles
+PROFILE_COLUMNS = (
+    "period_name",
+    "sensor_nodes_id",
+    "measurands_id",
+    "bucket",
+    "factor",
+    "avg_seconds",
+    "log_seconds",
+    "datetime_from",
+    "datetime_to",
+    "value_count",
+    "value_avg",
+    "value_m2",
+    "value_min",
+    "value_max",
+    "sketch",
+)
+PROFILE_KEY = PROFILE_COLUMNS[:5]
+
+# the local month of an hourly row
+BUCKET = "date_trunc('month', timezone(sn.timezone, datetime - '1sec'::interval))"
+
+FROM_HOURLY = """
+            FROM hourly_data m
+            JOIN sensors s ON (m.sensors_id = s.sensors_id)
+            JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
+            JOIN locations_view_cached sn ON (sy.sensor_nodes_id = sn.id)"""
+
+
+def partial_columns(period_name: str) -> str:
+    """The select list aggregating hourly_data rows into the factors of each
+    month, grouped by its first four columns"""
+    fmt, _ = TREND_PERIODS[period_name]
+    return f"""
+            sy.sensor_nodes_id
+            , s.measurands_id
+            , {BUCKET} as bucket
+            , to_char(timezone(sn.timezone, datetime - '1sec'::interval), '{fmt}') as factor
+            , AVG(s.data_averaging_period_seconds) as avg_seconds
+            , AVG(s.data_logging_period_seconds) as log_seconds
+            , MIN(datetime - '1sec'::interval) as datetime_from
+            , MAX(datetime - '1sec'::interval) as datetime_to
+            , COUNT(1) as value_count
+            , AVG(value_avg) as value_avg
+            , COALESCE(VAR_POP(value_avg) * COUNT(value_avg), 0) as value_m2
+            , MIN(value_avg) as value_min
+            , MAX(value_avg) as value_max
+            , array_agg(value_avg::float8) as values"""
+
+
+def months_covered(q, bucket: str, tz: str) -> str:
+    """SQL condition on the local month starting at `bucket` that holds when
+    its profile answers the query
+
+    A month is answered by its profile when it ended before the last
+    refresh and the date filters of the query include all of it, any other
+    month is aggregated from hourly_data.
+    """
+    end = f"(({bucket} + '1 month'::interval) AT TIME ZONE {tz})"
+    conditions = [f"{end} <= (SELECT until FROM refreshed)"]
+    date_from = date_bound(q.date_from, "date_from", tz)
+    if date_from is not None:
+        conditions.append(f"({bucket} AT TIME ZONE {tz}) >= {date_from}")
+    date_to = date_bound(q.date_to, "date_to", tz)
+    if date_to is not None:
+        conditions.append(f"{end} <= {date_to}")
+    return " AND ".join(conditions)
+
+
+def profile_sql(q, where: str) -> str:
+    """The partial aggregates of a trends query
+
+    Without date filters these are the merged rows of the location and
+    parameter. With date filters they are the months the filters include
+    that were profiled by the last refresh, and the hourly rows of the
+    partial months at either end and of the months since the last refresh.
+    Only the stored rows have a sketch.
+
+    Args:
+        q: the trends query
+        where: the WHERE clause of the query on hourly_data
+    """
+    period_name = PeriodNames(q.period_name).value
+    columns = ", ".join(PROFILE_COLUMNS[1:-1])
+    stored = f"""
+            SELECT {columns}, NULL::float8[] as values, sketch
+            FROM trend_profiles
+            WHERE period_name = :period_name
+            AND sensor_nodes_id = :locations_id
+            AND measurands_id = :measurands_id"""
+    if not (q.has("date_from") or q.has("date_to")):
+        return f"{stored}\n            AND bucket = '-infinity'"
+    margin = MARGINS["month"]
+    # a coarse bound on the hourly rows of the months not answered by a
+    # profile, so that only those rows are read from the index
+    recent = [f"m.datetime > (SELECT until FROM refreshed) - '{margin}'::interval"]
+    if q.has("date_from"):
+        recent.append(
+            f"m.datetime <= (:date_from::timestamp AT TIME ZONE 'UTC') + '{margin}'::interval"
+        )
+    if q.has("date_to"):
+        recent.append(
+            f"m.datetime > (:date_to::timestamp AT TIME ZONE 'UTC') - '{margin}'::interval"
+        )
+    tz = "(SELECT timezone FROM locations_view_cached WHERE id = :locations_id)"
+    return f"""
+            WITH refreshed AS (
+            SELECT COALESCE(MAX(calculated_until), '-infinity') as until
+            FROM trend_profiles_refresh
+            WHERE period_name = :period_name
+            ){stored}
+            AND bucket > '-infinity'
+            AND {months_covered(q, "bucket", tz)}
+            UNION ALL
+            SELECT {partial_columns(period_name)}
+            , NULL::jsonb as sketch
+            {FROM_HOURLY}
+            {where}
+            AND ({" OR ".join(recent)})
+            AND NOT ({months_covered(q, BUCKET, "sn.timezone")})
+            GROUP BY 1, 2, 3, 4"""
+
+
+def merge_partials(rows) -> dict[str, dict]:
+    """Merges partial aggregates by factor
+
+    The rows either hold the sketch of their values or the values.
+    """
+    merged: dict[str, dict] = {}
+    for row in rows:
+        if row["sketch"] is not None:
+            sketch = QuantileSketch.from_dict(row["sketch"])
+        else:
+            sketch = QuantileSketch().extend(row["values"])
+        # hourly rows without a value are counted but not in the moments
+        moments = Moments(sketch.count, row["value_avg"] or 0, row["value_m2"])
+        total = merged.get(row["factor"])
+        if total is None:
+            merged[row["factor"]] = {
+                "factor": row["factor"],
+                "avg_seconds": row["avg_seconds"],
+                "log_seconds": row["log_seconds"],
+                "datetime_from": row["datetime_from"],
+                "datetime_to": row["datetime_to"],
+                "value_count": row["value_count"],
+                "moments": moments,
+                "sketch": sketch,
+            }
+            continue
+        count = total["value_count"] + row["value_count"]
+        for key in ("avg_seconds", "log_seconds"):
+            # the average over the hourly rows of both
+            if total[key] is None or row[key] is None:
+                total[key] = total[key] if row[key] is None else row[key]
+            else:
+                total[key] = (
+                    total[key] * total["value_count"] + row[key] * row["value_count"]
+                ) / count
+        total["datetime_from"] = min(total["datetime_from"], row["datetime_from"])
+        total["datetime_to"] = max(total["datetime_to"], row["datetime_to"])
+        total["value_count"] = count
+        total["moments"].merge(moments)
+        total["sketch"].merge(sketch)
+    return merged
+
+
+def trend_rows(rows) -> list[dict]:
+    """The rows of the trends CTE from partial aggregates, in factor order"""
+    trends = []
+    for factor, total in sorted(merge_partials(rows).items()):
+        moments, sketch = total.pop("moments"), total.pop("sketch")
+        quantiles = sketch.quantiles(SUMMARY_QUANTILES.values())
+        trends.append(
+            {
+                **total,
+                "value_avg": moments.mean if moments.count else None,
+                "value_sd": moments.sd,
+                "value_min": sketch.min if sketch.count else None,
+                "value_max": sketch.max if sketch.count else None,
+                **{
+                    f"value_p{round(q * 100):02}": value
+                    for q, value in zip(SUMMARY_QUANTILES.values(), quantiles)
+                },
+            }
+        )
+    return trends
+
+
+# the trends CTE from the rows of `trend_rows`
+TRENDS_CTE = """
+trends AS (
+SELECT sn.id
+ , :measurands_id::int as measurands_id
+ , sn.timezone
+ , t.*
+ FROM jsonb_to_recordset(:trends::text::jsonb) AS t(
+   factor text
+ , avg_seconds float8
+ , log_seconds float8
+ , datetime_from timestamptz
+ , datetime_to timestamptz
+ , value_count bigint
+ , value_avg float8
+ , value_sd float8
+ , value_min float8
+ , value_max float8
+ , value_p02 float8
+ , value_p25 float8
+ , value_p50 float8
+ , value_p75 float8
+ , value_p98 float8
+ )
+ JOIN locations_view_cached sn ON (sn.id = :locations_id))"""
+
+
+# the next batch of locations with hourly rows calculated since the last
+# refresh, ($1 calculated_until, $2 after, $3 batch)
+CHANGED_NODES_SQL = """
+SELECT DISTINCT sy.sensor_nodes_id
+FROM hourly_data m
+JOIN sensors s ON (m.sensors_id = s.sensors_id)
+JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
+WHERE m.calculated_on > $1 AND sy.sensor_nodes_id > $2
+ORDER BY sy.sensor_nodes_id
+LIMIT $3
+"""
+
+
+def refresh_sql(period_name: str) -> str:
+    """The partial aggregates of the months of a batch of locations with
+    hourly rows calculated since the last refresh"""
+    return f"""
+    WITH changed AS (
+    SELECT DISTINCT sy.sensor_nodes_id, s.measurands_id, {BUCKET} as bucket
+    {FROM_HOURLY}
+    WHERE m.calculated_on > :calculated_until
+    AND sy.sensor_nodes_id = ANY(:sensor_nodes_ids)
+    )
+    SELECT {partial_columns(period_name)}
+    {FROM_HOURLY}
+    WHERE sy.sensor_nodes_id = ANY(:sensor_nodes_ids)
+    AND (sy.sensor_nodes_id, s.measurands_id, {BUCKET})
+      IN (SELECT sensor_nodes_id, measurands_id, bucket FROM changed)
+    GROUP BY 1, 2, 3, 4
+    """
+
+
+UPSERT_SQL = f"""
+INSERT INTO trend_profiles ({", ".join(PROFILE_COLUMNS)}, calculated_on)
+VALUES ({", ".join(f"${i}" for i in range(1, len(PROFILE_COLUMNS)))}
+, ${len(PROFILE_COLUMNS)}::jsonb, current_timestamp)
+ON CONFLICT ({", ".join(PROFILE_KEY)}) DO UPDATE
+SET {", ".join(f"{c} = EXCLUDED.{c}" for c in PROFILE_COLUMNS[5:])}
+, calculated_on = EXCLUDED.calculated_on
+"""
+
+
+def upsert_args(period_name: str, key: tuple, partial: dict) -> tuple:
+    """The upsert arguments of a merged partial aggregate"""
+    moments, sketch = partial["moments"], partial["sketch"]
+    return (
+        period_name,
+        *key,
+        partial["factor"],
+        partial["avg_seconds"],
+        partial["log_seconds"],
+        partial["datetime_from"],
+        partial["datetime_to"],
+        partial["value_count"],
+        moments.mean if moments.count else None,
+        moments.m2,
+        sketch.min if sketch.count else None,
+        sketch.max if sketch.count else None,
+        orjson.dumps(sketch.to_dict()).decode(),
+    )
+
+
+class TrendRefresher(RollupRefresher):
+    """Refreshes the trend profiles incrementally
+
+    Each refresh aggregates again the factors of the months of the
+    locations and parameters with hourly_data rows calculated since the
+    previous refresh, then merges all the months of those locations and
+    parameters into their profile. The first refresh aggregates all of
+    hourly_data, as a backfill job like the first refresh of the rollups. A
+    refresh goes through the locations in batches in order
+    of their id, as the sensor sketches do.
+
+    Args:
+        interval: seconds between refreshes scheduled with `schedule`
+        batch: the rows upserted at a time
+        nodes: the locations refreshed per transaction
+    """
+
+    name = "trend profiles"
+    module = "openaq_api.trend_profiles"
+    lock = ADVISORY_LOCK
+    periods = tuple(TREND_PERIODS)
+    state_table = "trend_profiles_refresh"
+
+    def __init__(
+        self, interval: float | None = None, batch: int = 1000, nodes: int = 100
+    ) -> None:
+        super().__init__(interval, nodes)
+        self.batch = batch
+
+    async def refresh_batch(self, con, period_name: str) -> int | None:
+        """Refreshes the profiles of one period of the next batch of
+        locations on the connection, returns the number of locations, 0
+        when the refresh is complete and None when another instance is
+        refreshing"""
+        async with con.transaction():
+            if not await self.locked(con):
+                return None
+            state = await con.fetchrow(
+                """
+                SELECT COALESCE(r.calculated_until, '-infinity') as calculated_until
+                , COALESCE(r.calculated_until, '-infinity') = '-infinity' as first
+                , COALESCE(r.pass_until, now() - $2::interval) as pass_until
+                , COALESCE(r.nodes_after, 0) as nodes_after
+                FROM (SELECT 1) t
+                LEFT JOIN trend_profiles_refresh r ON (r.period_name = $1)
+                """,
+                period_name,
+                REFRESH_OVERLAP,
+            )
+            calculated_until = state["calculated_until"]
+            if state["first"]:
+                rows = await con.fetch(NODES_SQL, state["nodes_after"], self.nodes)
+            else:
+                rows = await con.fetch(
+                    CHANGED_NODES_SQL,
+                    calculated_until,
+                    state["nodes_after"],
+                    self.nodes,
+                )
+            ids = [row["sensor_nodes_id"] for row in rows]
+            if ids:
+                keys = await self.aggregate(con, period_name, calculated_until, ids)
+                for i in range(0, len(keys), self.batch):
+                    await self.merge(con, period_name, keys[i : i + self.batch])
+                # the pass continues after the last location of the batch
+                state = (calculated_until, state["pass_until"], ids[-1])
+            else:
+                # the pass is complete
+                state = (state["pass_until"], None, None)
+            await con.execute(
+                """
+                INSERT INTO trend_profiles_refresh
+                (period_name, calculated_until, pass_until, nodes_after)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT (period_name) DO UPDATE
+                SET calculated_until = EXCLUDED.calculated_until
+                , pass_until = EXCLUDED.pass_until
+                , nodes_after = EXCLUDED.nodes_after
+                """,
+                period_name,
+                *state,
+            )
+        return len(ids)
+
+    async def aggregate(
+        self, con, period_name: str, calculated_until, sensor_nodes_ids: list[int]
+    ) -> list[tuple]:
+        """Aggregates the changed months of the locations, returns the
+        locations and parameters aggregated"""
+        sql, args = render(
+            refresh_sql(period_name),
+            calculated_until=calculated_until,
+            sensor_nodes_ids=sensor_nodes_ids,
+        )
+        keys: set[tuple] = set()
+        upserts = []
+        async for row in con.cursor(sql, *args):
+            key = (row["sensor_nodes_id"], row["measurands_id"])
+            keys.add(key)
+            [partial] = merge_partials([{**row, "sketch": None}]).values()
+            upserts.append(upsert_args(period_name, (*key, row["bucket"]), partial))
+            if len(upserts) >= self.batch:
+                await con.executemany(UPSERT_SQL, upserts)
+                upserts = []
+        if upserts:
+            await con.executemany(UPSERT_SQL, upserts)
+        return sorted(keys)
+
+    async def merge(self, con, period_name: str, keys: list[tuple]) -> None:
+        """Merges the months of the locations and parameters into their
+        profiles"""
+        rows = await con.fetch(
+            f"""
+            SELECT {", ".join(PROFILE_COLUMNS[1:-1])}, sketch::text
+            FROM trend_profiles
+            WHERE period_name = $1
+            AND (sensor_nodes_id, measurands_id)
+              IN (SELECT * FROM unnest($2::int[], $3::int[]))
+            AND bucket > '-infinity'
+            """,
+            period_name,
+            [k[0] for k in keys],
+            [k[1] for k in keys],
+        )
+        months: dict[tuple, list] = {}
+        for row in rows:
+            key = (row["sensor_nodes_id"], row["measurands_id"])
+            months.setdefault(key, []).append(
+                {**row, "sketch": orjson.loads(row["sketch"])}
+            )
+        await con.executemany(
+            UPSERT_SQL,
+            [
+                upsert_args(period_name, (*key, TOTAL), partial)
+                for key, rows in months.items()
+                for partial in merge_partials(rows).values()
+            ],
+        )
+
+
+trend_refresher = TrendRefresher(settings.API_TREND_PROFILE_REFRESH)
+
+
+if __name__ == "__main__":
+    # refresh once, e.g. from a scheduled task, backfilling on the first run
+    logging.basicConfig(level=logging.DEBUG)
+    asyncio.run(TrendRefresher().run(backfill=True))
@@ -4,10 +4,12 @@ import logging
 import operator
 import types
 import weakref
+from collections.abc import Callable
 from datetime import date, datetime
 from enum import Enum
+from functools import lru_cache
 from types import FunctionType
-from typing import Annotated, Any
+from typing import Annotated, Any, ClassVar, NamedTuple
 
 import fastapi
 import humps
@@ -26,6 +28,8 @@ from pydantic import (
 )
 from pydantic_core import CoreSchema, core_schema
 
+from openaq_api.cursor import CURSOR_START, cursor_params
+
 logger = logging.getLogger("queries")
 
 maxint = 2147483647
@@ -177,6 +181,52 @@ class CommaSeparatedList(list, metaclass=TypeParametersMemoizer):
         raise NotImplementedError("should be overridden in metaclass")
 
 
+class CompiledQuery(NamedTuple):
+    """The clause producers of a query class, in a stable order"""
+
+    bases: tuple[type, ...]
+    fields: tuple[Callable, ...]
+    where: tuple[Callable, ...]
+    pagination: tuple[Callable, ...]
+
+
+@lru_cache(maxsize=None)
+def compile_query(query: type) -> CompiledQuery:
+    """Collects the `fields`, `where` and `pagination` methods of a query class
+
+    Runs once per class. Bases sorted by name inherit methods from each
+    other, every method is kept once in the order of the first base it
+    resolves on.
+
+    Args:
+        query: a class which inherits from one or more QueryBaseModel classes
+    """
+    # removes object primitives <class '__main__.QueryBaseModel'>,
+    # <class 'pydantic.main.BaseModel'>, <class 'object'> and sorts to ensure
+    # consistent order for reliability in testing
+    bases = tuple(
+        sorted(inspect.getmro(query)[:-3], key=operator.attrgetter("__name__"))
+    )
+
+    def producers(name: str) -> tuple[Callable, ...]:
+        methods = [getattr(base, name, None) for base in bases]
+        return tuple(dict.fromkeys(m for m in methods if callable(m)))
+
+    return CompiledQuery(
+        bases=bases,
+        fields=producers("fields"),
+        where=producers("where"),
+        pagination=producers("pagination"),
+    )
+
+
+def _join_clauses(prefix: str, separator: str, clauses: tuple[str, ...]) -> str:
+    """SQL text of a set of clauses, empty without clauses"""
+    if not clauses:
+        return ""
+    return prefix + separator.join(clauses)
+
+
 class QueryBuilder(object):
     """A utility class to wrap multiple QueryBaseModel classes"""
 
@@ -187,9 +237,10 @@ class QueryBuilder(object):
              models, QueryBaseModel.
         """
         self.query = query
+        self.compiled = compile_query(query.__class__)
 
     def _bases(self) -> list[type]:
-        """inspects the object and returns base classes
+        """returns the base classes of the query
 
         Removes primitive objects in ancestry to only include Pydantic Query
         and Path models
@@ -197,47 +248,24 @@ class QueryBuilder(object):
         Returns:
             a sorted list of base classes
         """
-        bases = list(inspect.getmro(self.query.__class__))[
-            :-3
-        ]  # removes object primitives <class '__main__.QueryBaseModel'>, <class 'pydantic.main.BaseModel'>, <class 'object'>
-        bases_sorted = sorted(
-            bases, key=operator.attrgetter("__name__")
-        )  # sort to ensure consistent order for reliability in testing
-        return bases_sorted
+        return list(self.compiled.bases)
+
+    def _clauses(self, producers: tuple[Callable, ...]) -> tuple[str, ...]:
+        """calls each producer once and dedupes the clauses in order"""
+        return tuple(dict.fromkeys(c for p in producers if (c := p(self.query))))
 
     def fields(self) -> str:
         """
-        loops through all ancestor classes and calls
-        their respective fields() methods to concatenate
+        calls the fields() methods of all ancestor classes to concatenate
         into additional fields for select
 
         Returns:
 
         """
-        fields = []
-        bases = self._bases()
-        for base in bases:
-            if callable(getattr(base, "fields", None)):
-                if base.fields(self.query):
-                    fields.append(base.fields(self.query))
-        if len(fields):
-            fields = list(set(fields))
-            return "\n," + ("\n,").join(fields)
-        else:
-            return ""
+        return _join_clauses("\n,", "\n,", self._clauses(self.compiled.fields))
 
     def pagination(self) -> str:
-        pagination = []
-        bases = self._bases()
-        for base in bases:
-            if callable(getattr(base, "pagination", None)):
-                if base.pagination(self.query):
-                    pagination.append(base.pagination(self.query))
-        if len(pagination):
-            pagination = list(set(pagination))
-            return "\n" + ("\n,").join(pagination)
-        else:
-            return ""
+        return _join_clauses("\n", "\n,", self._clauses(self.compiled.pagination))
 
     def params(self) -> dict:
         return self.query.model_dump(exclude_unset=True, by_alias=True)
@@ -252,23 +280,14 @@ class QueryBuilder(object):
         return ", COUNT(1) OVER() as found"
 
     def where(self) -> str:
-        """Introspects object ancestors and calls respective where() methods.
+        """Calls the where() methods of all ancestor classes.
 
         Returns:
             SQL string of all ancestor WHERE clauses.
         """
-        where = []
-        bases = self._bases()
-        for base in bases:
-            if callable(getattr(base, "where", None)):
-                if base.where(self.query):
-                    where.append(base.where(self.query))
-        if len(where):
-            where = list(set(where))
-            where.sort()  # ensure the order is consistent for testing
-            return "WHERE " + ("\nAND ").join(where)
-        else:
-            return ""
+        # sorted to ensure the order is consistent for testing
+        where = tuple(sorted(self._clauses(self.compiled.where)))
+        return _join_clauses("WHERE ", "\nAND ", where)
 
 
 class QueryBaseModel(BaseModel):
@@ -350,6 +369,57 @@ class Paging(QueryBaseModel):
         return "LIMIT :limit OFFSET :offset"
 
 
+class CursorQuery(QueryBaseModel):
+    """Pydantic query model for the `cursor` query parameter
+
+    Inherits from QueryBaseModel
+
+    Keyset pagination as an alternative to `page`. Each page is selected by
+    filtering on the ordering key of the last row of the previous page so
+    deep pages cost the same as the first. Subclasses set `cursor_columns`
+    to the datetime and id columns the query is ordered by.
+
+    Attributes:
+        cursor: `*` for the first page or the cursor from `meta.next`
+    """
+
+    cursor: str | None = Query(
+        None,
+        description="""Paginate through results with a cursor rather than a
+        page number. Pass cursor=* for the first page and follow `meta.next`
+        for the following pages""",
+        examples=["*"],
+    )
+
+    cursor_columns: ClassVar[tuple[str, str]] = ("datetime", "id")
+
+    @field_validator("cursor")
+    def validate_cursor(cls, v):
+        """Validates that `cursor` can be decoded
+
+        Raises:
+            ValueError: if `cursor` is not `*` or a valid cursor token
+        """
+        cursor_params(v)
+        return v
+
+    def fields(self) -> str | None:
+        """Selects the ordering key used to build the next cursor"""
+        if self.has("cursor"):
+            dt, id = self.cursor_columns
+            return f"{dt} as cursor_datetime, {id} as cursor_id"
+
+    def where(self) -> str | None:
+        """Generates SQL condition for rows after the cursor
+
+        Returns:
+            string of WHERE clause if `cursor` is set past the first page
+        """
+        if self.has("cursor") and self.cursor != CURSOR_START:
+            dt, id = self.cursor_columns
+            return f"({dt}, {id}) > (:cursor_datetime, :cursor_id)"
+
+
 class ParametersQuery(QueryBaseModel):
     """Pydantic query model for the parameters query parameter
 
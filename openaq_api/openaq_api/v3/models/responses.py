@@ -1,8 +1,11 @@
 from datetime import datetime
-from typing import Any
+from functools import lru_cache
+from typing import Any, get_args, get_origin
 
+import orjson
 from humps import camelize
 from pydantic import BaseModel, ConfigDict, Field
+from starlette.responses import Response
 
 
 class JsonBase(BaseModel):
@@ -15,6 +18,7 @@ class Meta(JsonBase):
     page: int = 1
     limit: int = 100
     found: int | str | None = None
+    next: str | None = None
 
 
 class OpenAQResult(JsonBase):
@@ -22,6 +26,96 @@ class OpenAQResult(JsonBase):
     results: list[Any] = []
 
 
+def _nested_model(annotation) -> tuple[type[BaseModel], bool] | None:
+    """The model of a field holding a model or a list of models, and whether
+    it is a list"""
+    types = [annotation]
+    while types:
+        t = types.pop()
+        if get_origin(t) is list:
+            [item] = get_args(t) or [Any]
+            if isinstance(item, type) and issubclass(item, BaseModel):
+                return item, True
+        elif get_origin(t) is not None:
+            types.extend(get_args(t))
+        elif isinstance(t, type) and issubclass(t, BaseModel):
+            return t, False
+    return None
+
+
+@lru_cache(maxsize=None)
+def _renamed(model: type[BaseModel]) -> bool:
+    """Whether a model or one of its nested models has a field whose alias
+    differs from its name"""
+    for name, field in model.model_fields.items():
+        if (field.alias or name) != name:
+            return True
+        nested = _nested_model(field.annotation)
+        if nested is not None and _renamed(nested[0]):
+            return True
+    return False
+
+
+def _aliased_value(annotation, expr: str) -> str:
+    nested = _nested_model(annotation)
+    if nested is None or not _renamed(nested[0]):
+        return expr
+    model, many = nested
+    if not many:
+        return (
+            f"CASE WHEN jsonb_typeof({expr}) = 'object' "
+            f"THEN {aliased_jsonb(model, expr)} ELSE {expr} END"
+        )
+    item = aliased_jsonb(model, "i.value")
+    return (
+        f"CASE WHEN jsonb_typeof({expr}) = 'array' THEN (SELECT "
+        f"COALESCE(jsonb_agg({item} ORDER BY i.n), '[]') FROM "
+        f"jsonb_array_elements({expr}) WITH ORDINALITY i(value, n)) "
+        f"ELSE {expr} END"
+    )
+
+
+@lru_cache(maxsize=None)
+def aliased_jsonb(model: type[BaseModel], expr: str) -> str:
+    """SQL building the serialized output of a JsonBase model from a jsonb
+    expression with the field names of the model as keys
+
+    Keys are the aliases of the fields, and of the fields of nested models,
+    fields missing from `expr` are null as the model would serialize them.
+
+    Args:
+        model: the model the jsonb represents
+        expr: SQL jsonb expression of an object
+    """
+    fields = ", ".join(
+        f"'{field.alias or name}', "
+        f"{_aliased_value(field.annotation, f'{expr}->{name!r}')}"
+        for name, field in model.model_fields.items()
+    )
+    return f"jsonb_build_object({fields})"
+
+
+def raw_json_response(meta: BaseModel, results: bytes) -> Response:
+    """Builds an OpenAQResult response from a JSON array of results
+
+    Args:
+        meta: page meta
+        results: JSON array of serialized results, as built by
+            `DB.fetchRawPage`
+    """
+    meta = Meta.model_validate(meta.model_dump())
+    content = b"".join(
+        [
+            b'{"meta":',
+            orjson.dumps(meta.model_dump(by_alias=True)),
+            b',"results":',
+            results,
+            b"}",
+        ]
+    )
+    return Response(content=content, media_type="application/json")
+
+
 #
 
 
@@ -3,7 +3,9 @@ from typing import Annotated
 
 from fastapi import APIRouter, Depends, Path
 
+from openaq_api.catalog import LocationCatalog
 from openaq_api.db import DB
+from openaq_api.settings import settings
 from openaq_api.v3.models.queries import (
     BboxQuery,
     CountryIdQuery,
@@ -17,10 +19,35 @@ from openaq_api.v3.models.queries import (
     QueryBuilder,
     RadiusQuery,
 )
-from openaq_api.v3.models.responses import LocationsResponse
+from openaq_api.v3.models.responses import (
+    Location,
+    LocationsResponse,
+    raw_json_response,
+)
 
 logger = logging.getLogger("locations")
 
+# the fields of a Location, also the rows of the location catalog
+LOCATION_FIELDS = """id
+    , name
+    , ismobile as is_mobile
+    , ismonitor as is_monitor
+    , city as locality
+    , country
+    , owner
+    , provider
+    , coordinates
+    , instruments
+    , sensors
+    , timezone
+    , bbox(geom) as bounds
+    , datetime_first
+    , datetime_last"""
+
+location_catalog = LocationCatalog(
+    LOCATION_FIELDS, Location, refresh_interval=settings.API_LOCATION_CATALOG_REFRESH
+)
+
 router = APIRouter(
     prefix="/v3",
     tags=["v3-alpha"],
@@ -96,27 +123,26 @@ async def locations_get(
 
 async def fetch_locations(query, db):
     query_builder = QueryBuilder(query)
+    if settings.API_LOCATION_CATALOG:
+        snapshot = await location_catalog.get(db)
+        if snapshot is not None and snapshot.supports(query):
+            meta, results = snapshot.page(query, query_builder.params())
+            return raw_json_response(meta, results)
     sql = f"""
-    SELECT id
-    , name
-    , ismobile as is_mobile
-    , ismonitor as is_monitor
-    , city as locality
-    , country
-    , owner
-    , provider
-    , coordinates
-    , instruments
-    , sensors
-    , timezone
-    , bbox(geom) as bounds
-    , datetime_first
-    , datetime_last
-    {query_builder.fields() or ''} 
+    SELECT {LOCATION_FIELDS}
+    {query_builder.fields() or ''}
     {query_builder.total()}
     FROM locations_view_cached
     {query_builder.where()}
+    ORDER BY id
     {query_builder.pagination()}
     """
-    response = await db.fetchPage(sql, query_builder.params())
-    return response
+    if not settings.API_RAW_JSON:
+        response = await db.fetchPage(
+            sql, query_builder.params(), statement="v3_locations"
+        )
+        return response
+    meta, results = await db.fetchRawPage(
+        sql, query_builder.params(), Location, statement="v3_locations"
+    )
+    return raw_json_response(meta, results)
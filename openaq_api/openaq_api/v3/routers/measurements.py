@@ -1,18 +1,45 @@
 from typing import Annotated
 
 from fastapi import APIRouter, Depends, Path, Query
+from pydantic import model_validator
 
 from openaq_api.db import DB
+from openaq_api.rollups import (
+    ROLLUP_PERIODS,
+    AGGREGATE_COLUMNS,
+    aggregates_sql,
+    rollup_refresher,
+)
+from openaq_api.settings import settings
+from openaq_api.streaming import (
+    StreamFormat,
+    csv_chunks,
+    ndjson_chunks,
+    stream_response,
+)
 from openaq_api.v3.models.queries import (
     CommaSeparatedList,
+    CursorQuery,
     DateFromQuery,
     DateToQuery,
     Paging,
     PeriodNameQuery,
+    PeriodNames,
     QueryBaseModel,
     QueryBuilder,
 )
-from openaq_api.v3.models.responses import MeasurementsResponse
+from openaq_api.v3.models.responses import (
+    Measurement,
+    MeasurementsResponse,
+    raw_json_response,
+)
+
+# the interval of an aggregate period in the responses, other periods are
+# reported as hours
+PERIOD_INTERVALS = {
+    PeriodNames.day: "24:00:00",
+    PeriodNames.month: "1 month",
+}
 
 router = APIRouter(
     prefix="/v3",
@@ -38,15 +65,51 @@ class MeasurementsParametersQuery(QueryBaseModel):
             return "m.measurands_id = ANY (:parameters_id)"
 
 
+class MeasurementsCursorQuery(CursorQuery):
+    cursor_columns = ("h.datetime", "h.sensors_id")
+
+
+class MeasurementsFormatQuery(QueryBaseModel):
+    format: StreamFormat | None = Query(
+        None,
+        description="""Stream the results as a file, csv or ndjson (newline
+        delimited JSON). Streamed results allow a limit up to the server row
+        cap""",
+        examples=["csv"],
+    )
+
+
 class LocationMeasurementsQueries(
     Paging,
+    MeasurementsCursorQuery,
+    MeasurementsFormatQuery,
     LocationPathQuery,
     DateFromQuery,
     DateToQuery,
     MeasurementsParametersQuery,
     PeriodNameQuery,
 ):
-    ...
+    limit: int = Query(
+        100,
+        gt=0,
+        le=settings.API_STREAM_MAX_ROWS,
+        description="""Change the number of results returned.
+        e.g. limit=100 will return up to 100 results. Up to 1000 or up to
+        the server row cap when a format is given""",
+        examples=["100"],
+    )
+
+    @model_validator(mode="after")
+    def check_limit(self):
+        if self.format is None and self.limit > 1000:
+            raise ValueError("limit must be less than or equal to 1000")
+        return self
+
+    @model_validator(mode="after")
+    def check_cursor_period(self):
+        if self.cursor is not None and self.period_name not in [None, "hour"]:
+            raise ValueError("cursor pagination is only available for hourly data")
+        return self
 
 
 @router.get(
@@ -67,10 +130,12 @@ async def measurements_get(
 
 async def fetch_measurements(q, db):
     query = QueryBuilder(q)
-    dur = "01:00:00"
-    expected_hours = 1
+    params = query.params()
+    pool = "interactive"
 
     if q.period_name in [None, "hour"]:
+        statement = "v3_measurements_hourly"
+        params["expected_hours"] = 1
         # Query for hourly data
         sql = f"""
         SELECT sn.id
@@ -100,7 +165,7 @@ async def fetch_measurements(q, db):
           h.value_count
         , s.data_averaging_period_seconds
         , s.data_logging_period_seconds
-        , {expected_hours} * 3600
+        , :expected_hours::int * 3600
         )||jsonb_build_object(
           'datetime_from', get_datetime_object(h.first_datetime, sn.timezone)
         , 'datetime_to', get_datetime_object(h.last_datetime, sn.timezone)
@@ -112,54 +177,36 @@ async def fetch_measurements(q, db):
         JOIN locations_view_cached sn ON (sy.sensor_nodes_id = sn.id)
         JOIN measurands m ON (m.measurands_id = h.measurands_id)
         {query.where()}
-        ORDER BY datetime
+        ORDER BY h.datetime, h.sensors_id
         {query.pagination()}
         """
     else:
         # Query for the aggregate data
-        if q.period_name == "hour":
-            dur = "01:00:00"
-        elif q.period_name == "day":
-            dur = "24:00:00"
-        elif q.period_name == "month":
-            dur = "1 month"
+        pool = "analytical"
+        params["period_interval"] = PERIOD_INTERVALS.get(
+            PeriodNames(q.period_name), "01:00:00"
+        )
 
-        sql = f"""
-            WITH meas AS (
-            SELECT
-            sy.sensor_nodes_id
-            , s.measurands_id
-            , ts.tzid
-            , truncate_timestamp(datetime, :period_name, ts.tzid) as datetime
-            , AVG(s.data_averaging_period_seconds) as avg_seconds
-            , AVG(s.data_logging_period_seconds) as log_seconds
-            , MAX(truncate_timestamp(datetime, :period_name, ts.tzid, '1{q.period_name}'::interval)) as last_period
-            , MIN(timezone(ts.tzid, datetime - '1sec'::interval)) as first_datetime
-            , MAX(timezone(ts.tzid, datetime - '1sec'::interval)) as last_datetime
-            , COUNT(1) as value_count
-            , AVG(value_avg) as value_avg
-            , STDDEV(value_avg) as value_sd
-            , MIN(value_avg) as value_min
-            , MAX(value_avg) as value_max
-            , PERCENTILE_CONT(0.02) WITHIN GROUP(ORDER BY value_avg) as value_p02
-            , PERCENTILE_CONT(0.25) WITHIN GROUP(ORDER BY value_avg) as value_p25
-            , PERCENTILE_CONT(0.5) WITHIN GROUP(ORDER BY value_avg) as value_p50
-            , PERCENTILE_CONT(0.75) WITHIN GROUP(ORDER BY value_avg) as value_p75
-            , PERCENTILE_CONT(0.98) WITHIN GROUP(ORDER BY value_avg) as value_p98
-            , current_timestamp as calculated_on
-            FROM hourly_data m
-            JOIN sensors s ON (m.sensors_id = s.sensors_id)
-            JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
-            JOIN sensor_nodes sn ON (sy.sensor_nodes_id = sn.sensor_nodes_id)
-            JOIN timezones ts ON (sn.timezones_id = ts.gid)
+        if settings.API_ROLLUPS and q.period_name in ROLLUP_PERIODS:
+            statement = "v3_measurements_rollup"
+            rollup_refresher.schedule()
+            meas = aggregates_sql(q, query.where())
+        else:
+            statement = "v3_measurements_aggregate"
+            meas = f"""
+            meas AS (
+            SELECT {AGGREGATE_COLUMNS}
             {query.where()}
-            GROUP BY 1, 2, 3, 4)
+            GROUP BY 1, 2, 3, 4)"""
+
+        sql = f"""
+            WITH {meas}
             SELECT t.sensor_nodes_id
             , json_build_object(
-                'label', '1{q.period_name}'
+                'label', '1' || :period_name::text
                 , 'datetime_from', get_datetime_object(datetime, t.tzid)
                 , 'datetime_to', get_datetime_object(last_period, t.tzid)
-                , 'interval',  '{dur}'
+                , 'interval', :period_interval::text
                 ) as period
             , sig_digits(value_avg, 2) as value
             , json_build_object(
@@ -191,7 +238,62 @@ async def fetch_measurements(q, db):
             --JOIN sensor_nodes sn ON (t.sensor_nodes_id = sn.sensor_nodes_id)
             --JOIN timezones ts ON (sn.timezones_id = ts.gid)
             JOIN measurands m ON (t.measurands_id = m.measurands_id)
+            ORDER BY t.datetime, t.measurands_id
             {query.pagination()}
     """
-    response = await db.fetchPage(sql, query.params())
-    return response
+    if getattr(q, "format", None) is not None:
+        return await stream_measurements(sql, params, q.format, db)
+    # cursor pages need the ordering key of their last row
+    if getattr(q, "cursor", None) is not None or not settings.API_RAW_JSON:
+        response = await db.fetchPage(sql, params, statement=statement, pool=pool)
+        return response
+    meta, results = await db.fetchRawPage(
+        sql,
+        params,
+        Measurement,
+        statement=statement,
+        pool=pool,
+    )
+    return raw_json_response(meta, results)
+
+
+MEASUREMENTS_CSV_HEADER = [
+    "location_id",
+    "parameter_id",
+    "parameter",
+    "units",
+    "datetime_from_utc",
+    "datetime_from_local",
+    "datetime_to_utc",
+    "datetime_to_local",
+    "value",
+]
+
+
+def measurement_csv_row(r) -> list:
+    period = r["period"]
+    parameter = r["parameter"]
+    return [
+        r[0],
+        parameter["id"],
+        parameter["name"],
+        parameter["units"],
+        period["datetime_from"]["utc"],
+        period["datetime_from"]["local"],
+        period["datetime_to"]["utc"],
+        period["datetime_to"]["local"],
+        r["value"],
+    ]
+
+
+def measurement_json(r) -> dict:
+    return Measurement.model_validate(dict(r)).model_dump(by_alias=True)
+
+
+async def stream_measurements(sql: str, params: dict, format: StreamFormat, db: DB):
+    rows = db.stream(sql, params, pool="analytical")
+    if format == StreamFormat.csv:
+        chunks = csv_chunks(rows, MEASUREMENTS_CSV_HEADER, measurement_csv_row)
+    else:
+        chunks = ndjson_chunks(rows, measurement_json)
+    return await stream_response(chunks, format, "measurements")
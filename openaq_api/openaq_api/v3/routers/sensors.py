@@ -1,9 +1,11 @@
 import logging
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, Path
+from fastapi import APIRouter, Depends, Path, Query
 
 from openaq_api.db import DB
+from openaq_api.settings import settings
+from openaq_api.sketches import sketch_refresher, summary
 from openaq_api.v3.models.queries import QueryBaseModel, QueryBuilder
 from openaq_api.v3.models.responses import SensorsResponse
 from openaq_api.v3.routers.measurements import fetch_measurements
@@ -21,6 +23,10 @@ class SensorQuery(QueryBaseModel):
     sensors_id: int = Path(
         ..., description="Limit the results to a specific sensors id", ge=1
     )
+    exact: bool = Query(
+        False,
+        description="Calculate the summary exactly instead of from the sensor sketch",
+    )
 
     def where(self):
         return "m.sensors_id = :sensors_id"
@@ -58,11 +64,8 @@ async def sensor_get(
     return response
 
 
-async def fetch_sensors(q, db):
-    query = QueryBuilder(q)
-
-    sql = f"""
-        WITH sensor AS (
+# the summary of a sensor calculated from all of its hourly values
+EXACT_SUMMARY = """
         SELECT
         m.sensors_id
         , MIN(datetime - '1sec'::interval) as datetime_first
@@ -79,8 +82,47 @@ async def fetch_sensors(q, db):
         , PERCENTILE_CONT(0.98) WITHIN GROUP(ORDER BY value_avg) as value_p98
         , current_timestamp as calculated_on
         FROM hourly_data m
-        {query.where()}
-        GROUP BY 1)
+        {where}
+        GROUP BY 1"""
+
+# the summary of a sensor from its merged sketch, the percentiles are read
+# from the sketch after the query
+SKETCH_SUMMARY = """
+        SELECT
+        k.sensors_id
+        , k.datetime_first
+        , k.datetime_last
+        , k.value_count
+        , k.value_avg
+        , CASE WHEN (k.sketch->>'count')::bigint > 1
+          THEN sqrt(greatest(k.value_m2, 0) / ((k.sketch->>'count')::bigint - 1))
+          END as value_sd
+        , k.value_min
+        , k.value_max
+        , NULL::float as value_p02
+        , NULL::float as value_p25
+        , NULL::float as value_p50
+        , NULL::float as value_p75
+        , NULL::float as value_p98
+        , k.calculated_on
+        , k.sketch
+        FROM sensor_sketches k
+        WHERE k.sensors_id = :sensors_id
+        AND k.bucket = '-infinity'"""
+
+
+async def fetch_sensors(q, db, sketched: bool | None = None):
+    query = QueryBuilder(q)
+    if sketched is None:
+        sketched = settings.API_SENSOR_SKETCHES and not q.exact
+    if sketched:
+        sketch_refresher.schedule()
+        summary_sql = SKETCH_SUMMARY
+    else:
+        summary_sql = EXACT_SUMMARY.format(where=query.where())
+
+    sql = f"""
+        WITH sensor AS ({summary_sql})
         SELECT c.sensors_id as id
         , 'sensor' as name
         , c.value_avg as value
@@ -116,6 +158,7 @@ async def fetch_sensors(q, db):
         , s.data_logging_period_seconds
         , EXTRACT(EPOCH FROM c.datetime_last - c.datetime_first)
         ) as coverage
+        {", c.sketch" if sketched else ""}
         FROM sensors s
         JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
         JOIN sensor_nodes sn ON (sy.sensor_nodes_id = sn.sensor_nodes_id)
@@ -125,5 +168,12 @@ async def fetch_sensors(q, db):
         LEFT JOIN sensor c ON (c.sensors_id = s.sensors_id)
         WHERE s.sensors_id = :sensors_id;
     """
-    response = await db.fetchPage(sql, query.params())
+    response = await db.fetchPage(sql, query.params(), pool="analytical")
+    if sketched:
+        for row in response.results:
+            sketch = row.pop("sketch")
+            if sketch is None:
+                # not sketched yet, summarized from hourly_data instead
+                return await fetch_sensors(q, db, sketched=False)
+            row["summary"] = summary(sketch, row["summary"]["sd"])
     return response
@@ -6,6 +6,8 @@ from fastapi import APIRouter, Depends, HTTPException, Path, Query, Request, Res
 from pydantic import BaseModel, Field
 
 from openaq_api.db import DB
+from openaq_api.settings import settings
+from openaq_api.tile_cache import tile_cache, tile_response
 from openaq_api.v3.models.queries import (
     CommaSeparatedList,
     MobileQuery,
@@ -120,9 +122,17 @@ class MobileTile(TileBase):
     response_class=Response,
 )
 async def get_tile(
+    request: Request,
     tile: Annotated[Tile, Depends(Tile.depends())],
     db: DB = Depends(),
 ):
+    if settings.API_TILE_CACHE:
+        entry = await tile_cache.fetch(
+            "locations", tile, lambda: fetch_tiles(tile, db, cached=False)
+        )
+        if entry.data is None:
+            raise HTTPException(status_code=204, detail="no data found for this tile")
+        return tile_response(request, entry)
     vt = await fetch_tiles(tile, db)
     if vt is None:
         raise HTTPException(status_code=204, detail="no data found for this tile")
@@ -136,9 +146,19 @@ async def get_tile(
     response_class=Response,
 )
 async def get_threshold_tile(
+    request: Request,
     threshold_tile: Annotated[ThresholdTile, Depends(ThresholdTile.depends())],
     db: DB = Depends(),
 ):
+    if settings.API_TILE_CACHE:
+        entry = await tile_cache.fetch(
+            "thresholds",
+            threshold_tile,
+            lambda: fetch_threshold_tiles(threshold_tile, db, cached=False),
+        )
+        if entry.data is None:
+            raise HTTPException(status_code=204, detail="no data found for this tile")
+        return tile_response(request, entry)
     vt = await fetch_threshold_tiles(threshold_tile, db)
     if vt is None:
         raise HTTPException(status_code=204, detail="no data found for this tile")
@@ -146,7 +166,7 @@ async def get_threshold_tile(
     return Response(content=vt, status_code=200, media_type="application/x-protobuf")
 
 
-async def fetch_tiles(query, db):
+async def fetch_tiles(query, db, cached: bool = True):
     query_builder = QueryBuilder(query)
     sql = f"""
     WITH
@@ -198,11 +218,13 @@ async def fetch_tiles(query, db):
         )
         SELECT ST_AsMVT(t, 'default') FROM t;
     """
-    response = await db.fetchval(sql, query_builder.params())
+    response = await db.fetchval(
+        sql, query_builder.params(), statement="v3_tiles", cached=cached
+    )
     return response
 
 
-async def fetch_threshold_tiles(query, db):
+async def fetch_threshold_tiles(query, db, cached: bool = True):
     query_builder = QueryBuilder(query)
     sql = f"""
     WITH
@@ -272,7 +294,9 @@ async def fetch_threshold_tiles(query, db):
         )
         SELECT ST_AsMVT(t, 'default') FROM t;
     """
-    response = await db.fetchval(sql, query_builder.params())
+    response = await db.fetchval(
+        sql, query_builder.params(), statement="v3_threshold_tiles", cached=cached
+    )
     return response
 
 
@@ -1,9 +1,18 @@
 import logging
 from typing import Annotated
 
+import orjson
 from fastapi import APIRouter, Depends, Path
 
 from openaq_api.db import DB
+from openaq_api.settings import settings
+from openaq_api.trend_profiles import (
+    TREND_PERIODS,
+    TRENDS_CTE,
+    profile_sql,
+    trend_refresher,
+    trend_rows,
+)
 from openaq_api.v3.models.responses import TrendsResponse
 
 logger = logging.getLogger("trends")
@@ -13,6 +22,7 @@ from openaq_api.v3.models.queries import (
     DateToQuery,
     Paging,
     PeriodNameQuery,
+    PeriodNames,
     QueryBaseModel,
     QueryBuilder,
 )
@@ -66,6 +76,8 @@ async def trends_get(
 
 
 async def fetch_trends(q, db):
+    # the value, a str enum formats as its name in an f-string
+    period_name = PeriodNames(q.period_name).value
     fmt = ""
     if q.period_name == "hour":
         fmt = "HH24"
@@ -78,8 +90,21 @@ async def fetch_trends(q, db):
         dur = "1 month"
 
     query = QueryBuilder(q)
-    sql = f"""
-WITH trends AS (
+    params = query.params()
+    trends = None
+    if settings.API_TREND_PROFILES and period_name in TREND_PERIODS:
+        trend_refresher.schedule()
+        partials = await db.fetch(
+            profile_sql(q, query.where()), params, pool="analytical"
+        )
+        # locations not profiled yet are aggregated from hourly_data, with
+        # date filters only the stored months have a sketch
+        if any(p["sketch"] is not None for p in partials):
+            params["trends"] = orjson.dumps(trend_rows(partials)).decode()
+            trends = TRENDS_CTE
+    if trends is None:
+        trends = f"""
+trends AS (
 SELECT
   sn.id
  , s.measurands_id
@@ -105,7 +130,10 @@ SELECT
  JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
  JOIN locations_view_cached sn ON (sy.sensor_nodes_id = sn.id)
  {query.where()}
- GROUP BY 1, 2, 3, 4)
+ GROUP BY 1, 2, 3, 4)"""
+
+    sql = f"""
+WITH {trends}
  SELECT t.id
  , jsonb_build_object(
     'label', factor
@@ -132,19 +160,20 @@ SELECT
      t.value_count::int
    , t.avg_seconds
    , t.log_seconds
-  , expected_hours(datetime_from, datetime_to, '{q.period_name}', factor) * 3600.0
+  , expected_hours(datetime_from, datetime_to, '{period_name}', factor) * 3600.0
 )||jsonb_build_object(
           'datetime_from', get_datetime_object(datetime_from, t.timezone)
         , 'datetime_to', get_datetime_object(datetime_to, t.timezone)
  ) as coverage
  FROM trends t
  JOIN measurands m ON (t.measurands_id = m.measurands_id)
+ ORDER BY t.factor
  {query.pagination()}
     """
 
     logger.debug(
-        f"expected_hours(datetime_from, datetime_to, '{q.period_name}', factor) * 3600.0"
+        f"expected_hours(datetime_from, datetime_to, '{period_name}', factor) * 3600.0"
     )
 
-    response = await db.fetchPage(sql, query.params())
+    response = await db.fetchPage(sql, params, pool="analytical")
     return response
@@ -0,0 +1,231 @@
+"""Overhead of the middleware stack on a trivial route
+
+Sends requests to `/ping` through the ASGI interface, without a server or an
+HTTP client, and compares the previous BaseHTTPMiddleware implementations
+of the cache control, logging and rate limiting middlewares with the pure
+ASGI ones. Redis is replaced by an in memory stand in so only middleware
+overhead is measured.
+
+    python -m tests.bench_middleware
+"""
+import asyncio
+import datetime
+import logging
+import statistics
+import time
+
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from openaq_api.middleware import (
+    CacheControlMiddleware,
+    LoggingMiddleware,
+    RateLimiterMiddleWare,
+)
+from openaq_api.models.logging import HTTPLog, LogType
+
+# the log payloads are still built, only the output is dropped
+logging.getLogger("middleware").addHandler(logging.NullHandler())
+logging.getLogger("middleware").propagate = False
+
+RATE_TIME = datetime.timedelta(minutes=1)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def setnx(self, key, value):
+        return self.data.setdefault(key, value) is value
+
+    def expire(self, key, seconds):
+        return True
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def decrby(self, key, amount):
+        self.data[key] = int(self.data[key]) - amount
+        return self.data[key]
+
+    def sismember(self, key, value):
+        return False
+
+
+class AsyncFakeRedis:
+    def __init__(self):
+        self.counts = {}
+
+    def register_script(self, script):
+        async def run(keys, args):
+            self.counts[keys[0]] = self.counts.get(keys[0], 0) + 1
+            return [self.counts[keys[0]], args[0]]
+
+        return run
+
+    async def sismember(self, key, value):
+        return False
+
+
+class BaseCacheControlMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, cachecontrol=None):
+        super().__init__(app)
+        self.cachecontrol = cachecontrol
+
+    async def dispatch(self, request, call_next):
+        response = await call_next(request)
+        if (
+            not response.headers.get("Cache-Control")
+            and self.cachecontrol
+            and request.method in ["HEAD", "GET"]
+            and response.status_code < 500
+        ):
+            response.headers["Cache-Control"] = self.cachecontrol
+        return response
+
+
+class BaseLoggingMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        start_time = time.time()
+        response = await call_next(request)
+        timing = round((time.time() - start_time) * 1000, 2)
+        logging.getLogger("middleware").info(
+            HTTPLog(
+                request=request,
+                type=LogType.SUCCESS,
+                http_code=response.status_code,
+                timing=timing,
+                rate_limiter=getattr(request.app.state, "rate_limiter", None),
+                api_key=request.headers.get("x-api-key", None),
+            ).model_dump_json()
+        )
+        return response
+
+
+class BaseRateLimiterMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, redis_client, rate_amount, rate_amount_key, rate_time):
+        super().__init__(app)
+        self.redis_client = redis_client
+        self.rate_amount = rate_amount
+        self.rate_time = rate_time
+        self.counter = 0
+
+    def request_is_limited(self, key: str, limit: int):
+        if self.redis_client.setnx(key, limit):
+            self.redis_client.expire(key, int(self.rate_time.total_seconds()))
+        count = self.redis_client.get(key)
+        if count and int(count) > 0:
+            self.counter = self.redis_client.decrby(key, 1)
+            return False
+        return True
+
+    async def dispatch(self, request, call_next):
+        key = request.client.host
+        if RateLimiterMiddleWare.limited_path(request.url.path) and (
+            self.request_is_limited(key, self.rate_amount)
+        ):
+            return JSONResponse(status_code=429, content={})
+        request.app.state.rate_limiter = f"{key}/{self.counter}"
+        return await call_next(request)
+
+
+def build_app(cache_control, logging_middleware, rate_limiter, redis_client):
+    app = FastAPI()
+
+    @app.get("/ping")
+    def ping():
+        return {"ping": "pong!"}
+
+    app.add_middleware(
+        rate_limiter,
+        redis_client=redis_client,
+        rate_amount=10**9,
+        rate_amount_key=10**9,
+        rate_time=RATE_TIME,
+    )
+    app.add_middleware(cache_control, cachecontrol="public, max-age=900")
+    app.add_middleware(logging_middleware)
+    return app
+
+
+async def request(app, path: str = "/ping"):
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"host", b"bench")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("bench", 80),
+    }
+    sent = False
+    disconnected = asyncio.Event()
+    status = None
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body" and not message.get(
+            "more_body", False
+        ):
+            disconnected.set()
+
+    await app(scope, receive, send)
+    assert status == 200, status
+
+
+async def bench(name: str, app, requests: int = 5000) -> float:
+    for _ in range(100):
+        await request(app)
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(requests):
+        t = time.perf_counter()
+        await request(app)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    p99 = statistics.quantiles(latencies, n=100)[98]
+    print(
+        f"{name:<20} {requests / elapsed:8.0f} req/s"
+        f"   p50 {statistics.median(latencies) * 1e6:6.0f}us"
+        f"   p99 {p99 * 1e6:6.0f}us"
+    )
+    return requests / elapsed
+
+
+async def main():
+    before = build_app(
+        BaseCacheControlMiddleware,
+        BaseLoggingMiddleware,
+        BaseRateLimiterMiddleware,
+        FakeRedis(),
+    )
+    after = build_app(
+        CacheControlMiddleware,
+        LoggingMiddleware,
+        RateLimiterMiddleWare,
+        AsyncFakeRedis(),
+    )
+    print("GET /ping")
+    rps_before = await bench("BaseHTTPMiddleware", before)
+    rps_after = await bench("pure ASGI", after)
+    print(f"{rps_after / rps_before:.2f}x requests/sec")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+"""Time saved by running hot queries as prepared statements
+
+Takes the SQL and parameters /v2/latest and /v3/locations/{id} send to the
+database and compares, per request:
+
+* client: buildpg `render` of the query text against the parameter list of
+  a registered Statement
+* database (needs the database at DATABASE_READ_URL): the query text sent
+  on a connection without a statement cache, so it is parsed and planned
+  every time as when the text differs from the cached statements, against
+  the statement prepared once on the connection. The planning time of the
+  query is read from EXPLAIN ANALYZE.
+
+    python -m tests.bench_prepared_statements
+"""
+import asyncio
+import statistics
+import time
+
+import asyncpg
+import orjson
+from buildpg import render
+
+from openaq_api.db import DB
+from openaq_api.routers.locations import Locations, latest_get
+from openaq_api.settings import settings
+from openaq_api.statements import Statement, StatementConnection
+from openaq_api.v3.routers.locations import LocationPathQuery, location_get
+
+
+class CaptureDB(DB):
+    """Records the query a route runs instead of running it"""
+
+    def __init__(self):
+        self.captured = None
+
+    async def fetch(self, query, kwargs, statement=None, pool="interactive"):
+        self.captured = (query, dict(kwargs), statement)
+        return [{"found": None, "returned": 0, "results": "[]"}]
+
+
+async def route_queries() -> dict[str, tuple[str, dict, str]]:
+    db = CaptureDB()
+    queries = {}
+    await latest_get(Locations(limit=100, page=1), db)
+    queries["/v2/latest"] = db.captured
+    await location_get(LocationPathQuery(locations_id=2178), db)
+    queries["/v3/locations/{id}"] = db.captured
+    return queries
+
+
+def bench_client(name, query, kwargs, statement, iterations=20000):
+    prepared = Statement(statement, query)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        render(query, **kwargs)
+    rendered = (time.perf_counter() - start) / iterations
+    start = time.perf_counter()
+    for _ in range(iterations):
+        prepared.args(kwargs)
+    args = (time.perf_counter() - start) / iterations
+    print(f"{name:<20} render {rendered * 1e6:6.1f}us   statement {args * 1e6:6.1f}us")
+
+
+async def timed(fn, iterations):
+    for _ in range(5):
+        await fn()
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await fn()
+        latencies.append(time.perf_counter() - start)
+    return statistics.median(latencies)
+
+
+async def bench_database(name, query, kwargs, statement, iterations=200):
+    rquery, args = render(query, **kwargs)
+    text_con = await asyncpg.connect(settings.DATABASE_READ_URL, statement_cache_size=0)
+    con = await asyncpg.connect(
+        settings.DATABASE_READ_URL, connection_class=StatementConnection
+    )
+    try:
+        plan = await text_con.fetchval(
+            f"EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) {rquery}", *args
+        )
+        planning = orjson.loads(plan)[0]["Planning Time"]
+        text = await timed(lambda: text_con.fetch(rquery, *args), iterations)
+        prepared = Statement(statement, query)
+        statement_args = prepared.args(kwargs)
+        executed = await timed(
+            lambda: con.fetch_statement(prepared, statement_args), iterations
+        )
+    finally:
+        await text_con.close()
+        await con.close()
+    print(
+        f"{name:<20} planning {planning:6.2f}ms   text {text * 1e3:6.2f}ms"
+        f"   prepared {executed * 1e3:6.2f}ms"
+        f"   saved {(text - executed) * 1e3:6.2f}ms per request"
+    )
+
+
+async def main():
+    queries = await route_queries()
+    print("client CPU per request")
+    for name, (query, kwargs, statement) in queries.items():
+        bench_client(name, query, kwargs, statement)
+    print("\ndatabase, median per request")
+    try:
+        for name, (query, kwargs, statement) in queries.items():
+            await bench_database(name, query, kwargs, statement)
+    except (OSError, asyncpg.PostgresError) as e:
+        print(f"database at DATABASE_READ_URL not available: {e}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
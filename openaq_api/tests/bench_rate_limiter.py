@@ -0,0 +1,129 @@
+"""Per request overhead of the rate limiter
+
+Compares the previous limiter, four blocking commands on the synchronous
+redis client, with the single atomic script on the asyncio client and with
+batches of the limit claimed by the script and counted down in process. Redis is
+replaced by in memory stand ins that add a fixed round trip time to every
+command so the cost of blocking the event loop shows up the way it does in
+production.
+
+    python -m tests.bench_rate_limiter
+"""
+import asyncio
+import datetime
+import statistics
+import time
+
+from openaq_api.middleware import RateLimiterMiddleWare
+
+RTT = 0.0005  # seconds, a round trip to an in-region ElastiCache node
+RATE_TIME = datetime.timedelta(minutes=1)
+
+
+class SyncRedis:
+    def __init__(self):
+        self.data = {}
+
+    def setnx(self, key, value):
+        time.sleep(RTT)
+        return self.data.setdefault(key, value) is value
+
+    def expire(self, key, seconds):
+        time.sleep(RTT)
+        return True
+
+    def get(self, key):
+        time.sleep(RTT)
+        return self.data.get(key)
+
+    def decrby(self, key, amount):
+        time.sleep(RTT)
+        self.data[key] = int(self.data[key]) - amount
+        return self.data[key]
+
+
+class AsyncRedis:
+    def __init__(self):
+        self.tats = {}
+
+    def register_script(self, script):
+        async def run(keys, args):
+            await asyncio.sleep(RTT)
+            now = time.time() * 1000
+            window, limit, requested = (int(a) for a in args)
+            interval = window / limit
+            tat = max(self.tats.get(keys[0], now), now)
+            granted = max(min(requested, int((now + window - tat) / interval)), 0)
+            tat += granted * interval
+            self.tats[keys[0]] = tat
+            remaining = int((now + window - tat) / interval)
+            return [granted, remaining, tat - now, interval]
+
+        return run
+
+
+class SyncLimiter:
+    """The previous RateLimiterMiddleWare.request_is_limited"""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.counter = 0
+
+    def request_is_limited(self, key: str, limit: int):
+        if self.redis_client.setnx(key, limit):
+            self.redis_client.expire(key, int(RATE_TIME.total_seconds()))
+        count = self.redis_client.get(key)
+        if count and int(count) > 0:
+            self.counter = self.redis_client.decrby(key, 1)
+            return False
+        return True
+
+
+async def bench(name: str, check, requests: int = 2000, concurrency: int = 50):
+    latencies = []
+
+    async def worker(n):
+        for i in range(n):
+            t = time.perf_counter()
+            await check(f"10.0.0.{i % 20}")
+            latencies.append(time.perf_counter() - t)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(requests // concurrency) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    p99 = statistics.quantiles(latencies, n=100)[98]
+    print(
+        f"{name:<24} {len(latencies) / elapsed:8.0f} checks/s"
+        f"   p50 {statistics.median(latencies) * 1e3:7.2f}ms"
+        f"   p99 {p99 * 1e3:7.2f}ms"
+    )
+
+
+async def main():
+    sync_limiter = SyncLimiter(SyncRedis())
+    async_limiter = RateLimiterMiddleWare(
+        None, AsyncRedis(), 10**9, 10**9, RATE_TIME
+    )
+
+    async def sync_check(key):
+        sync_limiter.request_is_limited(key, 10**9)
+
+    async def async_check(key):
+        await async_limiter.request_is_limited(key, 10**9)
+
+    local_limiter = RateLimiterMiddleWare(
+        None, AsyncRedis(), 10**9, 10**9, RATE_TIME, local_batch=0.1
+    )
+
+    async def local_check(key):
+        await local_limiter.request_is_limited(key, 2000)
+
+    print(f"{RTT * 1000}ms redis round trip, 50 concurrent requests")
+    await bench("sync, 3-4 round trips", sync_check)
+    await bench("async script", async_check)
+    # long enough for the first claim of each key not to dominate
+    await bench("local batches of 10%", local_check, requests=20000)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,156 @@
+"""Serialization CPU of the raw JSON pass-through against the response model path
+
+Compares, per page of results, the work the API does after Postgres has
+returned the rows:
+
+* model: the json codec decodes each json column, FastAPI validates the
+  page against the response model and ORJSONResponse encodes it again
+* raw: Postgres returns the page as one JSON text with the keys of the
+  response model, spliced into the response envelope
+
+Postgres output is simulated from representative rows of
+/v3/locations and /v3/locations/{id}/measurements.
+
+    python -m tests.bench_raw_json
+"""
+import asyncio
+import time
+
+import orjson
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from openaq_api.v3.models.responses import (
+    Location,
+    LocationsResponse,
+    Measurement,
+    MeasurementsResponse,
+    Meta,
+    raw_json_response,
+)
+
+DATETIME = {"utc": "2023-01-01T00:00:00Z", "local": "2023-01-01T00:00:00+00:00"}
+
+LOCATION = {
+    "id": 2178,
+    "name": "Del Norte",
+    "is_mobile": False,
+    "is_monitor": True,
+    "locality": "Albuquerque",
+    "country": {"id": 13, "code": "US", "name": "United States"},
+    "owner": {"id": 4, "name": "Unknown Governmental Organization"},
+    "provider": {"id": 119, "name": "AirNow"},
+    "coordinates": {"latitude": 35.1353, "longitude": -106.584702},
+    "instruments": [{"id": 2, "name": "Government Monitor"}],
+    "sensors": [
+        {
+            "id": 3917 + i,
+            "name": f"{p} ppm",
+            "parameter": {"id": i, "name": p, "units": "ppm", "display_name": p},
+        }
+        for i, p in enumerate(["co", "no2", "o3", "pm25", "pm10"])
+    ],
+    "timezone": "America/Denver",
+    "bounds": [-106.584702, 35.1353, -106.584702, 35.1353],
+    "datetime_first": DATETIME,
+    "datetime_last": DATETIME,
+}
+LOCATION_JSON_COLUMNS = [
+    "country",
+    "owner",
+    "provider",
+    "coordinates",
+    "instruments",
+    "sensors",
+    "datetime_first",
+    "datetime_last",
+]
+
+MEASUREMENT = {
+    "id": 2178,
+    "period": {
+        "label": "1hour",
+        "datetime_from": DATETIME,
+        "datetime_to": DATETIME,
+        "interval": "01:00:00",
+    },
+    "parameter": {"id": 2, "units": "µg/m³", "name": "pm25"},
+    "summary": {
+        "sd": 1.2,
+        "min": 1.0,
+        "q02": 1.0,
+        "q25": 2.0,
+        "median": 3.0,
+        "q75": 4.0,
+        "q98": 5.0,
+        "max": 5.0,
+    },
+    "value": 3.1,
+    "coverage": {
+        "expected_count": 1,
+        "expected_interval": "01:00:00",
+        "observed_count": 1,
+        "observed_interval": "01:00:00",
+        "percent_complete": 100.0,
+        "percent_coverage": 100.0,
+        "datetime_from": DATETIME,
+        "datetime_to": DATETIME,
+    },
+}
+MEASUREMENT_JSON_COLUMNS = ["period", "parameter", "summary", "coverage"]
+
+
+def model_path(field, rows, json_columns):
+    # asyncpg hands the json columns to the orjson codec one value at a time
+    results = [
+        {k: orjson.loads(v) if k in json_columns else v for k, v in r.items()}
+        for r in rows
+    ]
+    content = {"meta": Meta(found=len(results)).model_dump(), "results": results}
+    response = asyncio.run(
+        serialize_response(field=field, response_content=content, is_coroutine=True)
+    )
+    return orjson.dumps(response)
+
+
+def raw_path(page):
+    return raw_json_response(Meta(found=1000), page).body
+
+
+def bench(name, fn, iterations):
+    fn()
+    start = time.process_time()
+    for _ in range(iterations):
+        fn()
+    elapsed = (time.process_time() - start) / iterations
+    print(f"{name:<32} {elapsed * 1000:8.3f} ms/page")
+    return elapsed
+
+
+def run(name, response_model, model, row, json_columns, rows=1000, iterations=20):
+    field = create_response_field(name="response", type_=response_model)
+    # rows as returned by asyncpg before the json codec runs
+    db_rows = [
+        {k: orjson.dumps(v) if k in json_columns else v for k, v in row.items()}
+    ] * rows
+    # as Postgres builds it, with the aliases of the model as keys
+    page = orjson.dumps([model.model_validate(row).model_dump(by_alias=True)] * rows)
+    print(f"{name} ({rows} rows)")
+    validated = bench(
+        "  decode + validate + encode",
+        lambda: model_path(field, db_rows, json_columns),
+        iterations,
+    )
+    raw = bench("  raw pass-through", lambda: raw_path(page), iterations)
+    print(f"  {validated / raw:.1f}x less CPU per page\n")
+
+
+if __name__ == "__main__":
+    run("/v3/locations", LocationsResponse, Location, LOCATION, LOCATION_JSON_COLUMNS)
+    run(
+        "/v3/locations/{id}/measurements",
+        MeasurementsResponse,
+        Measurement,
+        MEASUREMENT,
+        MEASUREMENT_JSON_COLUMNS,
+    )
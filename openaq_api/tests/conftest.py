@@ -0,0 +1,41 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from openaq_api.db import DB, db_pool
+
+
+class Request:
+    """The parts of a request that `DB` uses"""
+
+    scope = {}
+
+    def __init__(self, pool, path: str) -> None:
+        self.url = SimpleNamespace(path=path)
+        self.app = SimpleNamespace(state=SimpleNamespace(pool=pool))
+
+
+@pytest.fixture
+def database():
+    """Runs a test coroutine against the database of the settings
+
+    Returns a function that calls `test(db, pool)` with a pool of the read
+    database and a `DB` for a request to `path`, and closes the pool after.
+    The test is skipped when the database is unavailable.
+    """
+
+    def run(test, path: str = "/"):
+        async def main():
+            try:
+                pool = await db_pool(None)
+            except OSError as e:
+                pytest.skip(f"database unavailable: {e}")
+            try:
+                return await test(DB(Request(pool, path)), pool)
+            finally:
+                await pool.close()
+
+        return asyncio.run(main())
+
+    return run
@@ -0,0 +1,54 @@
+import orjson
+import pytest
+
+from openaq_api.catalog import LocationCatalog
+from openaq_api.settings import settings
+from openaq_api.v3.routers import locations
+from openaq_api.v3.models.responses import Location
+from openaq_api.v3.routers.locations import LocationsQueries, fetch_locations
+
+QUERIES = [
+    {},
+    {"providers_id": "1,2"},
+    {"countries_id": "13", "monitor": True},
+    {"iso": "US", "mobile": False, "limit": 10, "page": 4},
+    {"bbox": "-77.1,38.8,-76.9,39.0"},
+    {"bbox": "-180,-90,180,90", "limit": 1000},
+    {"providers_id": "1", "page": 10000},
+    {"coordinates": "38.9072,-77.0369", "radius": 25000},
+    {"coordinates": "28.6139,77.209", "radius": 10000, "limit": 1000},
+]
+
+
+@pytest.fixture
+def pairs(database, monkeypatch):
+    catalog = LocationCatalog(locations.LOCATION_FIELDS, Location)
+    monkeypatch.setattr(locations, "location_catalog", catalog)
+    # compared with the raw pages, as the catalog builds them
+    monkeypatch.setattr(settings, "API_RAW_JSON", True)
+
+    async def compare(db, pool) -> list[tuple]:
+        assert await catalog.load(pool) is not None
+        pairs = []
+        for p in QUERIES:
+            query = LocationsQueries(**{"limit": 100, "page": 1, **p})
+            monkeypatch.setattr(settings, "API_LOCATION_CATALOG", False)
+            from_sql = await fetch_locations(query, db)
+            monkeypatch.setattr(settings, "API_LOCATION_CATALOG", True)
+            from_catalog = await fetch_locations(query, db)
+            pairs.append((from_sql, from_catalog))
+        return pairs
+
+    return database(compare, "/v3/locations")
+
+
+def test_catalog_matches_database(pairs):
+    for from_sql, from_catalog in pairs:
+        sql, cat = orjson.loads(from_sql.body), orjson.loads(from_catalog.body)
+        assert cat["meta"] == sql["meta"]
+        assert [r["id"] for r in cat["results"]] == [r["id"] for r in sql["results"]]
+        # distances are computed with Vincenty's formula in the catalog
+        for c, s in zip(cat["results"], sql["results"]):
+            if s["distance"] is not None:
+                assert c.pop("distance") == pytest.approx(s.pop("distance"), abs=1e-4)
+        assert cat["results"] == sql["results"]
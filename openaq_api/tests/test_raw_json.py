@@ -0,0 +1,45 @@
+import orjson
+
+from openaq_api.db import DB
+from openaq_api.settings import settings
+from openaq_api.v3.models.responses import Location
+from openaq_api.v3.routers.locations import LocationsQueries, fetch_locations
+
+QUERIES = [
+    {},
+    {"providers_id": "1,2", "limit": 1000},
+    {"coordinates": "38.9072,-77.0369", "radius": 25000},
+]
+
+
+def test_raw_pages_match_response_model(database, monkeypatch):
+    monkeypatch.setattr(settings, "API_LOCATION_CATALOG", False)
+    monkeypatch.setattr(settings, "API_RAW_JSON", True)
+    pages = []
+    fetch_raw_page = DB.fetchRawPage
+
+    async def fetchRawPage(self, sql, kwargs, model, **options):
+        pages.append((sql, dict(kwargs)))
+        return await fetch_raw_page(self, sql, kwargs, model, **options)
+
+    monkeypatch.setattr(DB, "fetchRawPage", fetchRawPage)
+
+    async def compare(db, pool) -> list[tuple]:
+        pairs = []
+        for params in QUERIES:
+            q = LocationsQueries(**{"limit": 100, "page": 1, **params})
+            raw = await fetch_locations(q, db)
+            sql, kwargs = pages[-1]
+            page = await db.fetchPage(sql, kwargs)
+            pairs.append((raw, page))
+        return pairs
+
+    for raw, page in database(compare, "/v3/locations"):
+        body = orjson.loads(raw.body)
+        expected = [
+            orjson.loads(Location.model_validate(r).model_dump_json(by_alias=True))
+            for r in page.results
+        ]
+        assert body["meta"]["found"] == page.meta.found
+        # the same keys, nulls included, in the same order
+        assert body["results"] == expected
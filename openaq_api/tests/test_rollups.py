@@ -0,0 +1,46 @@
+import orjson
+import pytest
+
+from openaq_api.settings import settings
+from openaq_api.v3.routers import measurements
+from openaq_api.v3.routers.measurements import (
+    LocationMeasurementsQueries,
+    fetch_measurements,
+)
+
+# compared for the first location with rollups, e.g. a multi year monthly query
+QUERIES = [
+    {"period_name": "month", "limit": 1000},
+    {"period_name": "day", "limit": 1000},
+    {"period_name": "day", "date_from": "2022-01-01", "date_to": "2022-03-15"},
+    {"period_name": "month", "date_from": "2021-06-15T12:00:00Z"},
+]
+
+
+def test_rollups_match_hourly_aggregates(database, monkeypatch):
+    monkeypatch.setattr(measurements.rollup_refresher, "interval", None)
+
+    async def compare(db, pool) -> list[tuple]:
+        async with pool.acquire() as con:
+            locations_id = await con.fetchval(
+                "SELECT sensor_nodes_id FROM measurements_rollup LIMIT 1"
+            )
+        if locations_id is None:
+            pytest.skip("rollups have not been refreshed")
+        pairs = []
+        for params in QUERIES:
+            q = LocationMeasurementsQueries(
+                locations_id=locations_id, **{"limit": 100, "page": 1, **params}
+            )
+            monkeypatch.setattr(settings, "API_ROLLUPS", False)
+            hourly = await fetch_measurements(q, db)
+            monkeypatch.setattr(settings, "API_ROLLUPS", True)
+            rollups = await fetch_measurements(q, db)
+            pairs.append((hourly, rollups))
+        return pairs
+
+    pairs = database(compare, "/v3/locations/{locations_id}/measurements")
+    for hourly, rollups in pairs:
+        expected, actual = orjson.loads(hourly.body), orjson.loads(rollups.body)
+        assert actual["meta"] == expected["meta"]
+        assert actual["results"] == expected["results"]
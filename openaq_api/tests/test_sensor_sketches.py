@@ -0,0 +1,46 @@
+import pytest
+
+from openaq_api.settings import settings
+from openaq_api.sketches import RELATIVE_ACCURACY
+from openaq_api.v3.routers import sensors
+from openaq_api.v3.routers.sensors import SensorQuery, fetch_sensors
+
+
+def test_sketches_match_exact_summary(database, monkeypatch):
+    monkeypatch.setattr(settings, "API_SENSOR_SKETCHES", True)
+    monkeypatch.setattr(sensors.sketch_refresher, "interval", None)
+
+    async def compare(db, pool) -> list[tuple]:
+        async with pool.acquire() as con:
+            # sensors refreshed since their last hourly row was calculated
+            sensors_ids = await con.fetch(
+                """
+                SELECT k.sensors_id FROM sensor_sketches k
+                WHERE k.bucket = '-infinity'
+                AND k.calculated_on > (SELECT MAX(calculated_on)
+                  FROM hourly_data m WHERE m.sensors_id = k.sensors_id)
+                LIMIT 10
+                """
+            )
+        if not sensors_ids:
+            pytest.skip("sketches have not been refreshed")
+        pairs = []
+        for row in sensors_ids:
+            q = SensorQuery(sensors_id=row["sensors_id"])
+            exact = await fetch_sensors(q, db, sketched=False)
+            sketched = await fetch_sensors(q, db)
+            pairs.append((exact.results[0], sketched.results[0]))
+        return pairs
+
+    for exact, sketched in database(compare, "/v3/sensors/{sensors_id}"):
+        expected, actual = exact.pop("summary"), sketched.pop("summary")
+        # the mean of the merged months may differ in the last digits
+        assert sketched.pop("value") == pytest.approx(exact.pop("value"), rel=1e-9)
+        assert sketched == exact
+        for key in ("min", "max"):
+            assert actual[key] == expected[key]
+        assert actual["sd"] == pytest.approx(expected["sd"], rel=1e-9)
+        for key in ("q02", "q25", "median", "q75", "q98"):
+            assert actual[key] == pytest.approx(
+                expected[key], rel=RELATIVE_ACCURACY, abs=1e-9
+            )
@@ -0,0 +1,72 @@
+import asyncio
+import math
+
+import asyncpg
+import pytest
+
+from openaq_api.settings import settings
+from openaq_api.spatial import GridIndex, distance
+from tests.unit.test_spatial import points
+
+SEARCHES = [
+    (-77.0, 38.9, 25000),
+    (-77.3, 39.2, 1000),
+    (179.99, -16.55, 25000),
+    (-179.99, -16.55, 5000),
+    (10.0, 89.9, 25000),
+]
+
+
+async def postgis(xs, ys) -> list[tuple[list[int], dict[int, float]]]:
+    """The positions ST_DWithin selects and their ST_Distance, per search"""
+    try:
+        con = await asyncpg.connect(settings.DATABASE_READ_URL)
+    except OSError as e:
+        pytest.skip(f"database unavailable: {e}")
+    results = []
+    try:
+        for lon, lat, radius in SEARCHES:
+            rows = await con.fetch(
+                """
+                WITH points AS (
+                SELECT position - 1 as position
+                , ST_MakePoint(x, y)::geography as geog
+                FROM unnest($1::float8[], $2::float8[])
+                WITH ORDINALITY AS p(x, y, position)
+                WHERE x <> 'NaN'
+                )
+                SELECT position
+                , ST_Distance(geog, ST_MakePoint($3, $4)::geography) as distance
+                FROM points
+                WHERE ST_DWithin(ST_MakePoint($3, $4)::geography, geog, $5)
+                ORDER BY position
+                """,
+                list(xs),
+                list(ys),
+                lon,
+                lat,
+                radius,
+            )
+            results.append(
+                (
+                    [r["position"] for r in rows],
+                    {r["position"]: r["distance"] for r in rows},
+                )
+            )
+    finally:
+        await con.close()
+    return results
+
+
+def test_grid_index_matches_postgis():
+    xs, ys = points(2000)
+    index = GridIndex(xs, ys)
+    for (lon, lat, radius), (positions, distances) in zip(
+        SEARCHES, asyncio.run(postgis(xs, ys))
+    ):
+        assert index.within(lon, lat, radius) == positions
+        for position, expected in distances.items():
+            assert distance(lon, lat, xs[position], ys[position]) == pytest.approx(
+                expected, abs=1e-4
+            )
+            assert not math.isnan(expected)
@@ -0,0 +1,71 @@
+import orjson
+import pytest
+
+from openaq_api.settings import settings
+from openaq_api.sketches import RELATIVE_ACCURACY
+from openaq_api.v3.routers import trends
+from openaq_api.v3.routers.trends import LocationTrendsQueries, fetch_trends
+
+# compared for the first location and parameter with a profile
+QUERIES = [
+    {"period_name": "hour"},
+    {"period_name": "day"},
+    {"period_name": "month"},
+    {"period_name": "hour", "date_from": "2022-01-15", "date_to": "2022-06-01"},
+    {"period_name": "day", "date_from": "2021-06-15T12:00:00Z"},
+]
+
+
+def test_profiles_match_hourly_trends(database, monkeypatch):
+    monkeypatch.setattr(trends.trend_refresher, "interval", None)
+
+    async def compare(db, pool) -> list[tuple]:
+        async with pool.acquire() as con:
+            # profiles refreshed since their last hourly row was calculated
+            profile = await con.fetchrow(
+                """
+                SELECT p.sensor_nodes_id, p.measurands_id FROM trend_profiles p
+                WHERE p.bucket = '-infinity'
+                AND p.calculated_on > (SELECT MAX(calculated_on) FROM hourly_data)
+                LIMIT 1
+                """
+            )
+        if profile is None:
+            pytest.skip("trend profiles have not been refreshed")
+        pairs = []
+        for params in QUERIES:
+            q = LocationTrendsQueries(
+                locations_id=profile["sensor_nodes_id"],
+                measurands_id=profile["measurands_id"],
+                **{
+                    "limit": 100,
+                    "page": 1,
+                    "date_from": None,
+                    "date_to": None,
+                    **params,
+                },
+            )
+            monkeypatch.setattr(settings, "API_TREND_PROFILES", False)
+            exact = await fetch_trends(q, db)
+            monkeypatch.setattr(settings, "API_TREND_PROFILES", True)
+            profiled = await fetch_trends(q, db)
+            pairs.append((exact, profiled))
+        return pairs
+
+    pairs = database(compare, "/v3/locations/{locations_id}/trends/{measurands_id}")
+    for exact, profiled in pairs:
+        expected = orjson.loads(exact.model_dump_json())
+        actual = orjson.loads(profiled.model_dump_json())
+        assert actual["meta"] == expected["meta"]
+        assert len(actual["results"]) == len(expected["results"])
+        for a, e in zip(actual["results"], expected["results"]):
+            summary, expected_summary = a.pop("summary"), e.pop("summary")
+            assert a.pop("value") == pytest.approx(e.pop("value"), rel=1e-9)
+            assert a == e
+            for key in ("min", "max"):
+                assert summary[key] == expected_summary[key]
+            assert summary["sd"] == pytest.approx(expected_summary["sd"], rel=1e-9)
+            for key in ("q02", "q25", "median", "q75", "q98"):
+                assert summary[key] == pytest.approx(
+                    expected_summary[key], rel=RELATIVE_ACCURACY, abs=1e-9
+                )
@@ -0,0 +1,96 @@
+import asyncio
+from types import SimpleNamespace
+
+
+class FakeTransaction:
+    """Counts the open transactions of its connection"""
+
+    def __init__(self, con):
+        self.con = con
+
+    async def __aenter__(self):
+        self.con.transactions += 1
+        return self
+
+    async def __aexit__(self, *args):
+        self.con.transactions -= 1
+        return False
+
+
+class FakeConnection:
+    """Answers every fetch with `rows` after `delay` seconds, recording the
+    statements it runs"""
+
+    def __init__(self, rows=({"id": 1},), delay: float = 0):
+        self.rows = list(rows)
+        self.delay = delay
+        self.statements = []
+        self.transactions = 0
+
+    def transaction(self, readonly=False):
+        return FakeTransaction(self)
+
+    async def execute(self, sql, *args):
+        self.statements.append(sql)
+
+    async def fetch(self, sql, *args):
+        self.statements.append(sql)
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return self.rows
+
+
+class Acquire:
+    """The connection of a FakePool, held by one caller at a time"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def __aenter__(self):
+        await self.pool.lock.acquire()
+        self.pool.acquired += 1
+        return self.pool.con
+
+    async def __aexit__(self, *args):
+        self.pool.acquired -= 1
+        self.pool.lock.release()
+        return False
+
+
+class FakePool:
+    """A pool of one connection, with the sizes asyncpg pools report"""
+
+    def __init__(self, con=None, size=1, idle=1, max_size=1):
+        self.con = FakeConnection() if con is None else con
+        self.size = size
+        self.idle = idle
+        self.max_size = max_size
+        self.lock = asyncio.Lock()
+        self.acquired = 0
+
+    def acquire(self, timeout=None):
+        return Acquire(self)
+
+    def get_size(self):
+        return self.size
+
+    def get_idle_size(self):
+        return self.idle
+
+    def get_max_size(self):
+        return self.max_size
+
+
+class FakeRequest:
+    """The parts of a request that `DB` uses
+
+    Args:
+        pool: the interactive pool, created by `DB` when None
+        path: the request path
+        route: the path template of the route, when the request was routed
+    """
+
+    def __init__(self, pool=None, path: str = "/test", route: str | None = None):
+        self.url = SimpleNamespace(path=path)
+        self.scope = {} if route is None else {"route": SimpleNamespace(path=route)}
+        self.app = SimpleNamespace(state=SimpleNamespace(pool=pool))
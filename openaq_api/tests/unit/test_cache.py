@@ -0,0 +1,485 @@
+import asyncio
+import datetime
+import decimal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from openaq_api import cache as cache_module
+from openaq_api.cache import (
+    ROUTE_CACHE_POLICIES,
+    CachedRecord,
+    CacheEntry,
+    CachePolicy,
+    LRUMemoryCache,
+    QueryCache,
+    RedisQueryCache,
+    SingleFlight,
+    dumps_entry,
+    estimate_size,
+    loads_entry,
+    normalize_sql,
+    query_key,
+    route_policy,
+)
+from openaq_api.settings import settings
+
+
+class FakeRoute:
+    def __init__(self, path):
+        self.path = path
+
+
+class FakeRequest:
+    def __init__(self, path):
+        self.scope = {"route": FakeRoute(path)}
+
+
+class FakeRedis:
+    """Minimal asyncio redis stand in"""
+
+    def __init__(self, fail: bool = False):
+        self.data = {}
+        self.fail = fail
+        self.calls = 0
+
+    async def get(self, key):
+        self.calls += 1
+        if self.fail:
+            raise ConnectionError("redis is down")
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        self.calls += 1
+        if self.fail:
+            raise ConnectionError("redis is down")
+        self.data[key] = value
+        return True
+
+    async def delete(self, *keys):
+        self.calls += 1
+        if self.fail:
+            raise ConnectionError("redis is down")
+        for key in keys:
+            self.data.pop(key, None)
+
+
+def record(**kwargs):
+    return CachedRecord(tuple(kwargs.values()), {k: i for i, k in enumerate(kwargs)})
+
+
+class TestEstimateSize:
+    def test_scales_with_rows(self):
+        rows = [(1, "location", {"id": 1, "name": "pm25"})] * 10
+        assert estimate_size(rows * 10) > estimate_size(rows) * 9
+
+    def test_empty(self):
+        assert estimate_size([]) > 0
+
+
+class TestLRUMemoryCache:
+    @pytest.fixture(autouse=True)
+    def set_cache(self):
+        self.row = [(1, "x" * 100)]
+        self.row_size = estimate_size(self.row)
+        self.cache = LRUMemoryCache(max_bytes=self.row_size * 3, timeout=None)
+
+    def test_get_set(self):
+        asyncio.run(self.cache.set("a", self.row))
+        assert asyncio.run(self.cache.get("a")) == self.row
+        assert self.cache.stats["hits"] == 1
+        assert self.cache.stats["resident_bytes"] == self.row_size
+
+    def test_miss(self):
+        assert asyncio.run(self.cache.get("a")) is None
+        assert self.cache.stats["misses"] == 1
+
+    def test_evicts_least_recently_used(self):
+        async def run():
+            await self.cache.set("a", self.row)
+            await self.cache.set("b", self.row)
+            await self.cache.set("c", self.row)
+            await self.cache.get("a")
+            await self.cache.set("d", self.row)
+            return [await self.cache.exists(k) for k in "abcd"]
+
+        assert asyncio.run(run()) == [True, False, True, True]
+        assert self.cache.stats["evictions"] == 1
+        assert self.cache.stats["resident_bytes"] == self.row_size * 3
+
+    def test_max_entries(self):
+        cache = LRUMemoryCache(max_entries=1, timeout=None)
+
+        async def run():
+            await cache.set("a", self.row)
+            await cache.set("b", self.row)
+            return await cache.exists("a"), await cache.exists("b")
+
+        assert asyncio.run(run()) == (False, True)
+
+    def test_skips_values_over_budget(self):
+        asyncio.run(self.cache.set("a", self.row * 100))
+        assert asyncio.run(self.cache.get("a")) is None
+        assert self.cache.stats["resident_bytes"] == 0
+
+    def test_expires(self, monkeypatch):
+        asyncio.run(self.cache.set("a", self.row, ttl=10))
+        now = time.monotonic()
+        monkeypatch.setattr(time, "monotonic", lambda: now + 11)
+        assert asyncio.run(self.cache.get("a")) is None
+        assert self.cache.stats["expirations"] == 1
+        assert self.cache.stats["resident_bytes"] == 0
+
+    def test_zero_ttl(self):
+        asyncio.run(self.cache.set("a", self.row, ttl=0))
+        assert asyncio.run(self.cache.get("a")) is None
+        assert self.cache.stats["resident_bytes"] == 0
+
+    def test_expire(self):
+        asyncio.run(self.cache.set("a", self.row, ttl=10))
+        asyncio.run(self.cache.expire("a", None))
+        assert self.cache._cache["a"][1] is None
+        asyncio.run(self.cache.expire("a", 0))
+        assert asyncio.run(self.cache.get("a")) is None
+        assert self.cache.stats["resident_bytes"] == 0
+
+
+class TestRoutePolicy:
+    def test_default(self):
+        policy = route_policy(FakeRequest("/v2/latest"))
+        assert policy == CachePolicy(ttl=settings.API_CACHE_TIMEOUT)
+
+    def test_no_request(self):
+        assert route_policy(None).ttl == settings.API_CACHE_TIMEOUT
+
+    def test_route_default(self):
+        policy = route_policy(FakeRequest("/v3/parameters"))
+        assert policy == ROUTE_CACHE_POLICIES["/v3/parameters"]
+
+    def test_settings_override(self, monkeypatch):
+        path = "/v3/sensors/{sensors_id}"
+        monkeypatch.setattr(settings, "API_CACHE_TIMEOUTS", {path: 5})
+        monkeypatch.setattr(settings, "API_CACHE_STALE_TIMEOUTS", {path: 0})
+        policy = route_policy(FakeRequest(path))
+        assert policy.ttl == 5
+        assert policy.stale_ttl == 0
+        assert policy.early_refresh == ROUTE_CACHE_POLICIES[path].early_refresh
+        # the code defaults are not modified
+        assert ROUTE_CACHE_POLICIES[path].ttl != 5
+
+
+class TestNormalizeSql:
+    def test_whitespace(self):
+        a = "SELECT id\n    , name\n    FROM locations_view_cached\n    WHERE id = :id\n"
+        b = "SELECT id, name FROM locations_view_cached WHERE id = :id"
+        assert normalize_sql(a) == normalize_sql(b)
+
+    def test_comments(self):
+        a = "SELECT id --comment\n, name /* block\n comment */ FROM t"
+        assert normalize_sql(a) == "SELECT id,name FROM t"
+
+    def test_keeps_literals(self):
+        a = "SELECT '1  hour' as label, 'a -- b' as c"
+        assert normalize_sql(a) == "SELECT '1  hour' as label,'a -- b' as c"
+
+
+class TestQueryKey:
+    def test_param_order(self):
+        assert query_key("SELECT 1", {"a": 1, "b": 2}) == query_key(
+            "SELECT 1", {"b": 2, "a": 1}
+        )
+
+    def test_param_values(self):
+        assert query_key("SELECT 1", {"a": 1}) != query_key("SELECT 1", {"a": 2})
+
+    def test_formatting(self):
+        assert query_key("SELECT  1\n", {"a": 1}) == query_key("SELECT 1", {"a": 1})
+
+    def test_datetimes(self):
+        d = datetime.datetime(2022, 10, 1, 14, 47, 27, 100)
+        assert query_key("SELECT 1", {"d": d}) != query_key(
+            "SELECT 1", {"d": d.replace(microsecond=0)}
+        )
+
+    def test_stable_across_processes(self):
+        code = (
+            "from openaq_api.cache import query_key;"
+            "print(query_key('SELECT 1', {'a': [1, 2]}))"
+        )
+        keys = {
+            subprocess.run(
+                [sys.executable, "-c", code], capture_output=True, text=True
+            ).stdout.strip()
+            for _ in range(2)
+        }
+        assert keys == {query_key("SELECT 1", {"a": [1, 2]})}
+
+
+class TestRecordSerialization:
+    def test_roundtrip(self):
+        rows = [
+            record(
+                id=1,
+                name="location",
+                country={"code": "US", "id": 13},
+                value=decimal.Decimal("1.50"),
+                datetime_last=datetime.datetime(
+                    2023, 1, 1, tzinfo=datetime.timezone.utc
+                ),
+                day=datetime.date(2023, 1, 1),
+                interval=datetime.timedelta(hours=1),
+                empty=None,
+            )
+        ]
+        entry = loads_entry(dumps_entry(CacheEntry(rows, 5.0, 10.0, 0.5)))
+        assert (entry.stale_at, entry.expires_at, entry.delta) == (5.0, 10.0, 0.5)
+        loaded = entry.value
+        assert loaded == rows
+        assert dict(loaded[0]) == dict(rows[0])
+        assert loaded[0]["country"]["code"] == "US"
+        assert loaded[0][0] == 1
+        assert "name" in loaded[0].keys()
+
+    def test_empty(self):
+        assert loads_entry(dumps_entry(CacheEntry([], 10.0, 10.0))).value == []
+
+    def test_unknown_type(self):
+        with pytest.raises(TypeError):
+            dumps_entry(CacheEntry([record(id=1, point=object())], 10.0, 10.0))
+
+
+class TestQueryCache:
+    @pytest.fixture(autouse=True)
+    def set_cache(self):
+        self.rows = [record(id=1, name="a"), record(id=2, name="b")]
+        self.redis = FakeRedis()
+        self.l1 = LRUMemoryCache(timeout=None)
+        self.cache = QueryCache(self.l1, RedisQueryCache(self.redis))
+
+    def test_l2_shared_between_instances(self):
+        other = QueryCache(LRUMemoryCache(timeout=None), RedisQueryCache(self.redis))
+
+        async def run():
+            await self.cache.set("k", self.rows, ttl=60)
+            await asyncio.sleep(0)
+            return await other.get("k")
+
+        assert asyncio.run(run()) == self.rows
+        assert other.stats["l1"]["misses"] == 1
+        assert other.stats["l2"]["hits"] == 1
+
+    def test_l2_hit_fills_l1(self):
+        other = QueryCache(LRUMemoryCache(timeout=None), RedisQueryCache(self.redis))
+
+        async def run():
+            await self.cache.set("k", self.rows, ttl=60)
+            await asyncio.sleep(0)
+            await other.get("k")
+            await other.get("k")
+
+        asyncio.run(run())
+        assert other.stats["l1"]["hits"] == 1
+        assert other.stats["l2"]["hits"] == 1
+
+    def test_fallback_to_l1(self):
+        self.redis.fail = True
+
+        async def run():
+            await self.cache.set("k", self.rows, ttl=60)
+            await asyncio.sleep(0)
+            return await self.cache.get("k"), await self.cache.get("missing")
+
+        assert asyncio.run(run()) == (self.rows, None)
+        assert self.cache.stats["l2"]["errors"] == 1
+        assert self.cache.stats["l2"]["available"] is False
+        # redis is not retried while marked unavailable
+        assert self.redis.calls == 1
+
+    def test_unserializable_kept_local(self):
+        rows = [record(id=1, point=object())]
+
+        async def run():
+            await self.cache.set("k", rows, ttl=60)
+            await asyncio.sleep(0)
+            return await self.cache.get("k")
+
+        assert asyncio.run(run()) == rows
+        assert self.redis.data == {}
+        assert self.cache.stats["l2"]["available"] is True
+
+    def test_unreadable_entry_is_a_miss(self, caplog):
+        l2 = RedisQueryCache(self.redis)
+        self.redis.data[f"{l2.namespace}k"] = b"not msgpack"
+        assert asyncio.run(l2.get("k")) is None
+        assert self.redis.data == {}
+        assert l2.stats["misses"] == 1 and l2.stats["hits"] == 0
+        assert l2.stats["available"] is True
+        assert "dropping unreadable shared cache entry k" in caplog.text
+
+
+class TestSingleFlight:
+    def test_concurrent_calls_share_one_call(self):
+        cache = QueryCache(LRUMemoryCache(timeout=None))
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return [record(id=1)]
+
+        async def run():
+            return await asyncio.gather(
+                *[cache.fetch("k", loader, CachePolicy(ttl=60)) for _ in range(10)]
+            )
+
+        results = asyncio.run(run())
+        assert len(calls) == 1
+        assert all(r == [record(id=1)] for r in results)
+        assert cache.stats["single_flight"]["shared"] == 9
+        assert cache.stats["single_flight"]["in_flight"] == 0
+
+    def test_errors_propagate(self):
+        flights = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("bad query")
+
+        async def run():
+            return await asyncio.gather(
+                *[flights.do("k", fail) for _ in range(3)], return_exceptions=True
+            )
+
+        results = asyncio.run(run())
+        assert all(isinstance(r, ValueError) for r in results)
+        assert flights.in_flight == 0
+
+    def test_cancelled_caller_does_not_cancel_others(self):
+        flights = SingleFlight()
+
+        async def slow():
+            await asyncio.sleep(0.02)
+            return "done"
+
+        async def run():
+            first = asyncio.ensure_future(flights.do("k", slow))
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(flights.do("k", slow))
+            await asyncio.sleep(0)
+            first.cancel()
+            return await second, first.cancelled()
+
+        assert asyncio.run(run()) == ("done", True)
+        assert flights.calls == 1
+
+
+class TestStaleWhileRevalidate:
+    @pytest.fixture(autouse=True)
+    def set_cache(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr(time, "time", lambda: self.now)
+        self.cache = QueryCache(LRUMemoryCache(timeout=None))
+        self.calls = 0
+
+    async def loader(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return [record(version=self.calls)]
+
+    def test_serves_stale_and_refreshes_once(self):
+        policy = CachePolicy(ttl=60, stale_ttl=600)
+
+        async def run():
+            await self.cache.fetch("k", self.loader, policy)
+            self.now += 120
+            stale = await asyncio.gather(
+                *[self.cache.fetch("k", self.loader, policy) for _ in range(5)]
+            )
+            await asyncio.sleep(0.05)
+            return stale, await self.cache.fetch("k", self.loader, policy)
+
+        stale, fresh = asyncio.run(run())
+        assert all(r == [record(version=1)] for r in stale)
+        assert fresh == [record(version=2)]
+        assert self.calls == 2
+        assert self.cache.stats["stale_served"] == 5
+        assert self.cache.stats["background_refreshes"] == 1
+
+    def test_expired_past_stale_window(self):
+        policy = CachePolicy(ttl=60, stale_ttl=600)
+
+        async def run():
+            await self.cache.fetch("k", self.loader, policy)
+            self.now += 700
+            return await self.cache.fetch("k", self.loader, policy)
+
+        assert asyncio.run(run()) == [record(version=2)]
+        assert self.cache.stats["stale_served"] == 0
+
+    def test_no_stale_window(self):
+        policy = CachePolicy(ttl=60)
+
+        async def run():
+            await self.cache.fetch("k", self.loader, policy)
+            self.now += 61
+            return await self.cache.fetch("k", self.loader, policy)
+
+        assert asyncio.run(run()) == [record(version=2)]
+
+    def test_refresh_errors_keep_stale_value(self):
+        policy = CachePolicy(ttl=60, stale_ttl=600)
+
+        async def fail():
+            raise ValueError("bad query")
+
+        async def run():
+            await self.cache.fetch("k", self.loader, policy)
+            self.now += 120
+            first = await self.cache.fetch("k", fail, policy)
+            await asyncio.sleep(0.01)
+            return first, await self.cache.fetch("k", self.loader, policy)
+
+        assert asyncio.run(run()) == ([record(version=1)], [record(version=1)])
+        assert self.cache.stats["background_errors"] == 1
+
+
+class TestEarlyRefresh:
+    @pytest.fixture(autouse=True)
+    def set_cache(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr(time, "time", lambda: self.now)
+        self.cache = QueryCache(LRUMemoryCache(timeout=None))
+
+    def fetch_with(self, monkeypatch, rand):
+        monkeypatch.setattr(cache_module.random, "random", lambda: rand)
+        calls = []
+
+        async def loader():
+            calls.append(1)
+            # a query that took 2 seconds
+            self.now += 2
+            return [record(id=1)]
+
+        policy = CachePolicy(ttl=60, early_refresh=1)
+
+        async def run():
+            await self.cache.fetch("k", loader, policy)
+            # 5 seconds before the entry goes stale
+            self.now += 55
+            await self.cache.fetch("k", loader, policy)
+            await asyncio.sleep(0)
+
+        asyncio.run(run())
+        return len(calls)
+
+    def test_refreshes_near_expiry(self, monkeypatch):
+        # -2 * ln(0.01) ~ 9.2s of lookahead
+        assert self.fetch_with(monkeypatch, 0.01) == 2
+        assert self.cache.stats["early_refreshes"] == 1
+
+    def test_skips_refresh_well_before_expiry(self, monkeypatch):
+        # -2 * ln(0.9) ~ 0.2s of lookahead
+        assert self.fetch_with(monkeypatch, 0.9) == 1
+        assert self.cache.stats["early_refreshes"] == 0
@@ -0,0 +1,374 @@
+import asyncio
+import random
+import struct
+
+import orjson
+import pytest
+
+from openaq_api.catalog import (
+    CatalogSnapshot,
+    LocationCatalog,
+    bitmask,
+    float_down,
+    float_up,
+    jsonb_float,
+    mask_positions,
+)
+from openaq_api.models.responses import Meta, OpenAQResult
+from openaq_api.routers import locations as v2_locations
+from openaq_api.settings import settings
+from openaq_api.spatial import distance
+from openaq_api.v3.routers import locations
+from openaq_api.v3.routers.locations import (
+    LocationPathQuery,
+    LocationsQueries,
+    fetch_locations,
+)
+from openaq_api.v3.models.queries import QueryBuilder
+from openaq_api.v3.models.responses import Location
+
+ISOS = {1: "US", 2: "GB", 3: "IN", 4: "CL"}
+
+
+def catalog_rows(n: int = 400, seed: int = 7) -> list[dict]:
+    rng = random.Random(seed)
+    rows = []
+    for i, id in enumerate(rng.sample(range(1, 10 * n), n)):
+        country = rng.choice([1, 2, 3, 4, None])
+        point = rng.random() > 0.05
+        # a tenth of the points around 5, 10 for radius searches
+        spread = 0.03 if i % 10 == 0 else 1
+        rows.append(
+            {
+                "id": id,
+                "providers_id": rng.choice([1, 2, 3, 4, 5, None]),
+                "owner_contacts_id": rng.choice([10, 11, 12]),
+                "countries_id": country,
+                "iso": ISOS.get(country),
+                "is_mobile": rng.choice([True, False, False, None]),
+                "is_monitor": rng.choice([True, False]),
+                "x": round(10 + rng.uniform(-20, 20) * spread, 6) if point else None,
+                "y": round(5 + rng.uniform(-10, 10) * spread, 6) if point else None,
+                # as the catalog query prints it, with a distance entry
+                "json": (
+                    f'{{"id": {id}, "name": "location {id}", "distance": null,'
+                    f' "timezone": "UTC"}}'
+                ),
+            }
+        )
+    return sorted(rows, key=lambda r: r["id"])
+
+
+def row_json(row) -> bytes:
+    return row["json"].encode()
+
+
+def without_distance(rows) -> list[dict]:
+    return [{**r, "json": r["json"].replace('"distance": null, ', "")} for r in rows]
+
+
+def reference_page(rows, query) -> tuple[int, list[int]]:
+    """The rows the SQL of fetch_locations selects, evaluated row by row"""
+
+    def matches(row) -> bool:
+        if query.has("locations_id") and row["id"] != query.locations_id:
+            return False
+        for field, column in (
+            ("providers_id", "providers_id"),
+            ("owner_contacts_id", "owner_contacts_id"),
+            ("countries_id", "countries_id"),
+        ):
+            if query.has(field) and row[column] not in getattr(query, field):
+                return False
+        if query.has("iso") and row["iso"] != query.iso:
+            return False
+        if query.has("mobile") and row["is_mobile"] is not query.mobile:
+            return False
+        if query.has("monitor") and row["is_monitor"] is not query.monitor:
+            return False
+        if query.has("bbox"):
+            if row["x"] is None:
+                return False
+            return (
+                float_down(row["x"]) <= float_up(query.maxx)
+                and float_up(row["x"]) >= float_down(query.minx)
+                and float_down(row["y"]) <= float_up(query.maxy)
+                and float_up(row["y"]) >= float_down(query.miny)
+            )
+        if query.has("radius"):
+            if row["x"] is None:
+                return False
+            return distance(query.lon, query.lat, row["x"], row["y"]) <= query.radius
+        return True
+
+    ids = [row["id"] for row in rows if matches(row)]
+    offset = (query.page - 1) * query.limit
+    return len(ids), ids[offset : offset + query.limit]
+
+
+QUERIES = [
+    {},
+    {"providers_id": "1"},
+    {"providers_id": "1,3,99"},
+    {"owner_contacts_id": "11", "mobile": True},
+    {"countries_id": "2,3", "monitor": False},
+    {"iso": "CL", "limit": 5, "page": 3},
+    {"mobile": False, "monitor": True, "limit": 7, "page": 2},
+    {"bbox": "-5,-5,5,5"},
+    {"bbox": "-20,-10,0,0", "providers_id": "2", "limit": 3},
+    {"bbox": "10.1234,1.5,10.1235,1.6"},
+    {"providers_id": "4", "page": 100},
+    {"coordinates": "5,10", "radius": 25000},
+    {"coordinates": "5.1,9.9", "radius": 15000, "providers_id": "1,2"},
+    {"coordinates": "-4.99,-9.99", "radius": 1000},
+]
+
+
+class TestFloat4:
+    def test_rounds_outward(self):
+        for value in (0.1, -0.1, 38.9074, -77.0373, 179.99999):
+            down, up = float_down(value), float_up(value)
+            assert down < value < up
+            for f in (down, up):
+                assert struct.unpack("<f", struct.pack("<f", f))[0] == f
+
+    def test_exact(self):
+        for value in (0.0, 0.5, -2.25, 180.0):
+            assert float_down(value) == float_up(value) == value
+
+
+class TestBitmask:
+    def test_positions(self):
+        mask = bitmask([0, 9, 3, 30])
+        assert mask == (1 << 0) | (1 << 3) | (1 << 9) | (1 << 30)
+        assert mask_positions(mask, 0, 10) == [0, 3, 9, 30]
+        assert mask_positions(mask, 1, 2) == [3, 9]
+        assert mask_positions(mask, 4, 10) == []
+        assert mask_positions(0, 0, 10) == []
+
+
+class TestCatalogSnapshot:
+    @pytest.fixture(autouse=True)
+    def set_snapshot(self):
+        self.rows = catalog_rows()
+        self.snapshot = CatalogSnapshot(self.rows)
+
+    @pytest.mark.parametrize("params", QUERIES)
+    def test_matches_reference(self, params):
+        # FastAPI sets every field of the query, defaults included
+        query = LocationsQueries(**{"limit": 100, "page": 1, **params})
+        found, ids = reference_page(self.rows, query)
+        meta, results = self.snapshot.page(query, QueryBuilder(query).params())
+        rows = orjson.loads(results)
+        assert [r["id"] for r in rows] == ids
+        if query.radius:
+            assert all(r["distance"] <= query.radius for r in rows)
+        assert meta.found == (found if ids else 0)
+        assert meta.limit == query.limit
+        assert meta.page == query.page
+
+    def test_location(self):
+        id = self.rows[10]["id"]
+        query = LocationPathQuery(locations_id=id)
+        meta, results = self.snapshot.page(query, QueryBuilder(query).params())
+        assert results == row_json(self.rows[10]).join([b"[", b"]"])
+        assert meta.found == 1
+        query = LocationPathQuery(locations_id=10**6)
+        assert self.snapshot.page(query, QueryBuilder(query).params())[1] == b"[]"
+
+    def test_results_text(self):
+        query = LocationsQueries(limit=2)
+        _, results = self.snapshot.page(query, QueryBuilder(query).params())
+        # as jsonb_agg prints the rows
+        assert results == b"[" + b", ".join(row_json(r) for r in self.rows[:2]) + b"]"
+
+    def test_distance(self):
+        # the first location by id within the radius
+        row = next(
+            r
+            for r in self.rows
+            if r["x"] is not None and distance(10, 5, r["x"], r["y"]) <= 25000
+        )
+        query = LocationsQueries(coordinates="5,10", radius=25000, limit=1)
+        _, results = self.snapshot.page(query, QueryBuilder(query).params())
+        value = jsonb_float(distance(10, 5, row["x"], row["y"])).decode()
+        assert (
+            results
+            == (
+                f'[{{"id": {row["id"]}, "name": "location {row["id"]}",'
+                f' "distance": {value}, "timezone": "UTC"}}]'
+            ).encode()
+        )
+
+    def test_supports(self):
+        radius = LocationsQueries(coordinates="38.9,-77.0", radius=1000)
+        assert self.snapshot.supports(LocationsQueries(providers_id="1", bbox=None))
+        assert self.snapshot.supports(radius)
+        # without a distance entry radius pages cannot be built
+        assert not CatalogSnapshot(without_distance(self.rows)).supports(radius)
+
+    def test_within(self):
+        ids = self.snapshot.within(10, 5, 25000)
+        assert ids == [
+            r["id"]
+            for r in self.rows
+            if r["x"] is not None and distance(10, 5, r["x"], r["y"]) <= 25000
+        ]
+        assert ids
+
+
+class TestJsonbFloat:
+    def test_format(self):
+        assert jsonb_float(0.0) == b"0"
+        assert jsonb_float(1234.0) == b"1234"
+        assert jsonb_float(1234.5678) == b"1234.5678"
+        assert jsonb_float(0.1 + 0.2) == b"0.30000000000000004"
+        assert jsonb_float(1e-05) == b"0.00001"
+        assert jsonb_float(1.5e20) == b"150000000000000000000"
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.rows = rows
+
+    async def fetch(self, query):
+        if isinstance(self.rows, Exception):
+            raise self.rows
+        return self.rows
+
+
+class FakePool:
+    def __init__(self, rows):
+        self.con = FakeConnection(rows)
+
+    def acquire(self, timeout=None):
+        pool = self
+
+        class Acquire:
+            async def __aenter__(self):
+                return pool.con
+
+            async def __aexit__(self, *args):
+                return False
+
+        return Acquire()
+
+
+class TestLocationCatalog:
+    def test_query(self):
+        sql = LocationCatalog(locations.LOCATION_FIELDS, Location).query()
+        assert "ORDER BY id" in sql
+        # rows are stored as the model serializes them, distance is null
+        assert "FROM page, to_jsonb(page) as j" in sql
+        assert "'isMobile', j->'is_mobile'" in sql
+        assert "'distance', j->'distance'" in sql
+
+    def test_load(self, caplog):
+        catalog = LocationCatalog("id", Location)
+        snapshot = asyncio.run(catalog.load(FakePool(catalog_rows(20))))
+        assert len(snapshot) == 20
+        assert catalog.snapshot is snapshot
+        # a failed reload keeps the loaded snapshot
+        failed = asyncio.run(catalog.load(FakePool(OSError("connection refused"))))
+        assert failed is snapshot
+        assert catalog.errors == 1
+        assert "could not load location catalog" in caplog.text
+
+    def test_get_schedules_load(self):
+        catalog = LocationCatalog("id", Location, refresh_interval=60)
+        pool = FakePool(catalog_rows(20))
+
+        class FakeDB:
+            async def pool(self, name):
+                assert name == "analytical"
+                return pool
+
+        async def run():
+            first = await catalog.get(FakeDB())
+            await catalog._task
+            return first, await catalog.get(FakeDB())
+
+        first, second = asyncio.run(run())
+        assert first is None
+        assert len(second) == 20
+        assert catalog.loads == 1
+
+
+class FakeDB:
+    def __init__(self):
+        self.queries = []
+
+    async def fetchPage(self, sql, kwargs, statement=None):
+        self.queries.append(sql)
+        return OpenAQResult(meta=Meta.model_validate(kwargs))
+
+
+class TestFetchLocations:
+    @pytest.fixture(autouse=True)
+    def set_catalog(self, monkeypatch):
+        monkeypatch.setattr(settings, "API_LOCATION_CATALOG", True)
+        catalog = LocationCatalog("id", Location)
+        catalog.snapshot = CatalogSnapshot(catalog_rows())
+        monkeypatch.setattr(locations, "location_catalog", catalog)
+
+    def test_served_from_catalog(self):
+        db = FakeDB()
+        response = asyncio.run(fetch_locations(LocationsQueries(limit=3), db))
+        assert db.queries == []
+        body = orjson.loads(response.body)
+        assert body["meta"]["found"] == 400
+        assert len(body["results"]) == 3
+
+    def test_radius_served_from_catalog(self):
+        db = FakeDB()
+        query = LocationsQueries(coordinates="5,10", radius=25000, limit=100)
+        response = asyncio.run(fetch_locations(query, db))
+        assert db.queries == []
+        assert orjson.loads(response.body)["results"]
+
+    def test_without_distance_queries_database(self, monkeypatch):
+        snapshot = CatalogSnapshot(without_distance(catalog_rows()))
+        monkeypatch.setattr(locations.location_catalog, "snapshot", snapshot)
+        db = FakeDB()
+        query = LocationsQueries(coordinates="38.9,-77.0", radius=1000)
+        asyncio.run(fetch_locations(query, db))
+        assert len(db.queries) == 1
+        assert "ST_DWithin" in db.queries[0]
+
+
+class RouteDB:
+    """A DB outside of a request, with the default cache policy"""
+
+    request = None
+
+
+class TestV2Radius:
+    @pytest.fixture(autouse=True)
+    def set_catalog(self, monkeypatch):
+        monkeypatch.setattr(settings, "API_LOCATION_CATALOG", True)
+        catalog = LocationCatalog("id", Location)
+        catalog.snapshot = CatalogSnapshot(catalog_rows())
+        monkeypatch.setattr(v2_locations, "location_catalog", catalog)
+
+    def test_ids(self):
+        query = v2_locations.Locations(coordinates="5,10", radius=25000)
+        asyncio.run(v2_locations.catalog_geo(query, RouteDB()))
+        ids = query.params()["geo_ids"]
+        assert ids == v2_locations.location_catalog.snapshot.within(10, 5, 25000)
+        assert ids
+        assert "l.id = ANY(:geo_ids)" in query.where()
+        assert "st_dwithin" not in query.where()
+
+    def test_without_coordinates(self):
+        query = v2_locations.Locations()
+        asyncio.run(v2_locations.catalog_geo(query, RouteDB()))
+        assert "geo_ids" not in query.params()
+
+    def test_stale_snapshot_queries_database(self, monkeypatch):
+        monkeypatch.setattr(settings, "API_CACHE_TIMEOUT", 900)
+        snapshot = v2_locations.location_catalog.snapshot
+        monkeypatch.setattr(snapshot, "loaded_at", snapshot.loaded_at - 901)
+        query = v2_locations.Locations(coordinates="5,10", radius=25000)
+        asyncio.run(v2_locations.catalog_geo(query, RouteDB()))
+        assert "geo_ids" not in query.params()
+        assert "st_dwithin" in query.where()
@@ -0,0 +1,82 @@
+import asyncio
+import datetime
+
+import pytest
+from starlette.datastructures import URL
+
+from openaq_api.cursor import cursor_params, decode_cursor, encode_cursor
+from openaq_api.db import DB
+
+
+class FakeRequest:
+    def __init__(self, url):
+        self.url = URL(url)
+        self.app = None
+
+
+class FakeDB(DB):
+    def __init__(self, request, rows):
+        self.request = request
+        self.rows = rows
+        self.queries = []
+
+    async def fetch(self, query, kwargs, statement=None, pool="interactive"):
+        self.queries.append(dict(kwargs))
+        return self.rows
+
+
+DT = datetime.datetime(2023, 1, 1, 12, tzinfo=datetime.timezone.utc)
+
+
+class TestCursor:
+    def test_roundtrip(self):
+        assert decode_cursor(encode_cursor(DT, 42)) == (DT, 42)
+
+    def test_url_safe(self):
+        token = encode_cursor(DT, 42)
+        assert token.replace("-", "").replace("_", "").isalnum()
+
+    def test_invalid(self):
+        for token in ["abc", "", encode_cursor(DT, 1)[:-3]]:
+            with pytest.raises(ValueError):
+                decode_cursor(token)
+
+    def test_params(self):
+        assert cursor_params(None) == {}
+        assert cursor_params("*") == {}
+        assert cursor_params(encode_cursor(DT, 42)) == {
+            "cursor_datetime": DT,
+            "cursor_id": 42,
+        }
+
+
+class TestFetchPage:
+    def rows(self, n):
+        return [{"value": i, "cursor_datetime": DT, "cursor_id": i} for i in range(n)]
+
+    def test_next_link_on_full_page(self):
+        db = FakeDB(
+            FakeRequest("http://test/v2/measurements?cursor=*&limit=2"), self.rows(2)
+        )
+        result = asyncio.run(db.fetchPage("", {"cursor": "*", "limit": 2}))
+        assert result.results == [{"value": 0}, {"value": 1}]
+        assert result.meta.found == ">2"
+        next = URL(result.meta.next)
+        assert next.path == "/v2/measurements"
+        assert decode_cursor(next.query.split("cursor=")[1].split("&")[0]) == (DT, 1)
+
+    def test_no_next_link_on_last_page(self):
+        token = encode_cursor(DT, 1)
+        db = FakeDB(
+            FakeRequest(f"http://test/v2/measurements?cursor={token}"), self.rows(1)
+        )
+        result = asyncio.run(db.fetchPage("", {"cursor": token, "limit": 2}))
+        assert result.meta.next is None
+        assert db.queries[0]["offset"] == 0
+        assert db.queries[0]["cursor_id"] == 1
+
+    def test_page_without_cursor(self):
+        db = FakeDB(FakeRequest("http://test/v2/measurements"), [{"value": 1}])
+        result = asyncio.run(db.fetchPage("", {"page": 3, "limit": 2}))
+        assert result.meta.next is None
+        assert db.queries[0]["offset"] == 4
@@ -0,0 +1,102 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from openaq_api import metrics
+from openaq_api.db import DB, collect_pool_metrics
+from openaq_api.metrics import MetricsRegistry
+
+from .conftest import FakeConnection, FakePool, FakeRequest
+
+
+class TestRegistry:
+    def test_counter(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("requests_total", "Requests", ("limiter",))
+        counter.inc(("ip",))
+        counter.inc(("ip",), 2)
+        assert registry.render().splitlines() == [
+            "# HELP requests_total Requests",
+            "# TYPE requests_total counter",
+            'requests_total{limiter="ip"} 3',
+        ]
+
+    def test_labels(self):
+        registry = MetricsRegistry()
+        counter = registry.counter("requests_total", "Requests", ("limiter",))
+        with pytest.raises(ValueError):
+            counter.inc()
+        with pytest.raises(ValueError):
+            registry.gauge("requests_total", "Requests")
+
+    def test_escapes_label_values(self):
+        registry = MetricsRegistry()
+        registry.gauge("g", "Gauge", ("route",)).set(1, ('a"b\\c',))
+        assert 'g{route="a\\"b\\\\c"} 1' in registry.render()
+
+    def test_histogram(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram("seconds", "Seconds", ("pool",), (0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, ("analytical",))
+        assert histogram.count(("analytical",)) == 4
+        assert registry.render().splitlines()[2:] == [
+            'seconds_bucket{pool="analytical",le="0.1"} 2',
+            'seconds_bucket{pool="analytical",le="1"} 3',
+            'seconds_bucket{pool="analytical",le="+Inf"} 4',
+            'seconds_sum{pool="analytical"} 2.65',
+            'seconds_count{pool="analytical"} 4',
+        ]
+
+    def test_collectors(self):
+        registry = MetricsRegistry()
+        gauge = registry.gauge("size", "Size")
+
+        @registry.collector
+        def collect(state):
+            gauge.set(state["size"])
+
+        assert "size 4" in registry.render({"size": 4})
+
+
+class TestDBMetrics:
+    def test_fetch(self):
+        request = FakeRequest(route="/v3/locations/{locations_id}")
+        request.app.state.analytical_pool = FakePool(FakeConnection(delay=0.01))
+        db = DB(request)
+        labels = ("analytical", "/v3/locations/{locations_id}", "other")
+        acquired = metrics.db_pool_acquire_seconds.count(labels)
+        queries = metrics.db_query_seconds.count(labels)
+        waits = []
+
+        async def run():
+            fetch = asyncio.gather(
+                db._fetch("SELECT 1", {}, pool="analytical"),
+                db._fetch("SELECT 2", {}, pool="analytical"),
+            )
+            await asyncio.sleep(0.005)
+            # the second query waits for the connection held by the first
+            waits.append(metrics.db_pool_waiting.get(("analytical",)))
+            await fetch
+
+        asyncio.run(run())
+        assert waits == [1]
+        assert metrics.db_pool_waiting.get(("analytical",)) == 0
+        assert metrics.db_pool_acquire_seconds.count(labels) == acquired + 2
+        assert metrics.db_query_seconds.count(labels) == queries + 2
+        # the slowest wait lasted as long as a query
+        assert metrics.db_pool_acquire_seconds.sums[labels] >= 0.01
+
+    def test_pool_connections(self):
+        state = SimpleNamespace(pool=FakePool(size=3, idle=1, max_size=10))
+        collect_pool_metrics(state)
+        assert metrics.db_pool_connections.get(("interactive", "in_use")) == 2
+        assert metrics.db_pool_connections.get(("interactive", "idle")) == 1
+        assert metrics.db_pool_max_connections.get(("interactive",)) == 10
+
+    def test_render(self):
+        text = metrics.registry.render(SimpleNamespace())
+        assert "# TYPE openaq_db_query_seconds histogram" in text
+        assert "# TYPE openaq_query_cache_hit_ratio gauge" in text
+        assert 'openaq_query_cache_requests_total{tier="memory",result="hit"}' in text
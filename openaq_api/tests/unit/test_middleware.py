@@ -0,0 +1,546 @@
+import asyncio
+import datetime
+import math
+import random
+import time
+import logging
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, StreamingResponse
+
+from openaq_api import metrics
+from openaq_api.access_log import AccessLog, AccessLogRecord, http_log_json
+from openaq_api.middleware import (
+    APIKeyCache,
+    CacheControlMiddleware,
+    LoggingMiddleware,
+    RateLimiterMiddleWare,
+)
+from openaq_api.models.logging import HTTPLog, LogType
+from openaq_api.settings import settings
+
+
+class FakeRedis:
+    """Minimal asyncio redis stand in, runs the rate limit script in python"""
+
+    def __init__(self):
+        self.tats = {}
+        self.sets = {}
+        self.calls = 0
+        self.fail = False
+        self.latency = 0
+        # milliseconds, the redis clock when set
+        self.now = None
+
+    def register_script(self, script):
+        async def run(keys, args):
+            self.calls += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if self.fail:
+                raise ConnectionError("redis is down")
+            now = time.time() * 1000 if self.now is None else self.now
+            window, limit, requested = (int(a) for a in args)
+            interval = window / limit
+            tat = max(self.tats.get(keys[0], now), now)
+            granted = min(requested, math.floor((now + window - tat) / interval + 1e-9))
+            if granted > 0:
+                tat += granted * interval
+                self.tats[keys[0]] = tat
+            else:
+                granted = 0
+            return [
+                granted,
+                math.floor((now + window - tat) / interval + 1e-9),
+                math.ceil(tat - now),
+                max(math.ceil(tat + interval - now - window), 0),
+            ]
+
+        return run
+
+    async def sismember(self, key, value):
+        self.calls += 1
+        if self.fail:
+            raise ConnectionError("redis is down")
+        return value in self.sets.get(key, set())
+
+    async def smembers(self, key):
+        self.calls += 1
+        if self.fail:
+            raise ConnectionError("redis is down")
+        return set(self.sets.get(key, set()))
+
+
+def build_app():
+    app = FastAPI()
+
+    @app.get("/ping")
+    def ping():
+        return {"ping": "pong!"}
+
+    @app.post("/ping")
+    def ping_post():
+        return {"ping": "pong!"}
+
+    @app.get("/cached")
+    def cached():
+        return PlainTextResponse("ok", headers={"Cache-Control": "no-cache"})
+
+    @app.get("/stream")
+    def stream():
+        return StreamingResponse(iter([b"a", b"b"]))
+
+    return app
+
+
+class TestCacheControlMiddleware:
+    @pytest.fixture(autouse=True)
+    def set_client(self):
+        app = build_app()
+        app.add_middleware(CacheControlMiddleware, cachecontrol="public, max-age=900")
+        self.client = TestClient(app)
+
+    def test_get(self):
+        response = self.client.get("/ping")
+        assert response.headers["cache-control"] == "public, max-age=900"
+        assert response.json() == {"ping": "pong!"}
+
+    def test_post(self):
+        assert "cache-control" not in self.client.post("/ping").headers
+
+    def test_keeps_route_header(self):
+        assert self.client.get("/cached").headers["cache-control"] == "no-cache"
+
+    def test_streaming(self):
+        response = self.client.get("/stream")
+        assert response.content == b"ab"
+        assert response.headers["cache-control"] == "public, max-age=900"
+
+
+class TestLoggingMiddleware:
+    def test_logs_status(self, caplog):
+        access_log = AccessLog(logging.getLogger("middleware"), flush_interval=60)
+        app = build_app()
+        app.add_middleware(LoggingMiddleware, access_log=access_log)
+        client = TestClient(app)
+        with caplog.at_level(logging.INFO, logger="middleware"):
+            client.get("/ping?limit=1")
+            client.get("/missing")
+            # nothing is logged on the request path
+            assert caplog.records == []
+            assert access_log.flush() == 2
+            access_log.close()
+        assert '"type":"SUCCESS"' in caplog.records[0].message
+        assert '"path":"/ping"' in caplog.records[0].message
+        assert '"httpCode":404' in caplog.records[1].message
+        assert '"type":"WARNING"' in caplog.records[1].message
+
+    def test_requests_in_flight(self):
+        app = FastAPI()
+        in_flight = []
+
+        @app.get("/flight")
+        def flight():
+            in_flight.append(metrics.http_requests_in_flight.get())
+            return {}
+
+        access_log = AccessLog(logging.getLogger("middleware"), flush_interval=60)
+        app.add_middleware(LoggingMiddleware, access_log=access_log)
+        before = metrics.http_requests_in_flight.get()
+        TestClient(app).get("/flight")
+        access_log.close()
+        assert in_flight == [before + 1]
+        assert metrics.http_requests_in_flight.get() == before
+
+
+def access_log_record(**kwargs) -> AccessLogRecord:
+    fields = dict(
+        type=LogType.SUCCESS,
+        http_code=200,
+        timing=1.5,
+        rate_limiter="127.0.0.1/60/59",
+        counter=3,
+        ip="127.0.0.1",
+        api_key="key",
+        user_agent="python",
+        path="/v3/locations",
+        params="limit=1&page=2&coordinates=1,2",
+        server_timing={"sql": 1.25, "total": 1.5},
+    )
+    fields.update(kwargs)
+    return AccessLogRecord(**fields)
+
+
+class TestAccessLog:
+    def test_matches_http_log(self):
+        record = access_log_record()
+        request = Request(
+            {
+                "type": "http",
+                "method": "GET",
+                "path": record.path,
+                "query_string": record.params.encode(),
+                "headers": [
+                    (b"x-api-key", b"key"),
+                    (b"user-agent", b"python"),
+                    (b"host", b"api.openaq.org"),
+                ],
+                "client": ("127.0.0.1", 50000),
+            }
+        )
+        log = HTTPLog(
+            request=request,
+            type=LogType.SUCCESS,
+            http_code=200,
+            timing=1.5,
+            rate_limiter="127.0.0.1/60/59",
+            counter=3,
+            server_timing={"sql": 1.25, "total": 1.5},
+        )
+        assert http_log_json(record) == log.model_dump_json()
+        assert http_log_json(record._replace(server_timing=None)) == (
+            log.model_copy(update={"server_timing": None}).model_dump_json()
+        )
+
+    def test_drops_when_full(self, caplog):
+        access_log = AccessLog(
+            logging.getLogger("middleware"), max_size=2, flush_interval=60
+        )
+        with caplog.at_level(logging.INFO, logger="middleware"):
+            assert [access_log.put(access_log_record()) for _ in range(3)] == [
+                True,
+                True,
+                False,
+            ]
+            assert access_log.dropped == 1
+            access_log.close()
+        assert len(caplog.records) == 3
+        assert "dropped 1 records" in caplog.records[2].message
+        assert access_log.emitted == 2
+
+    def test_background_flush(self, caplog):
+        access_log = AccessLog(
+            logging.getLogger("middleware"), batch_size=2, flush_interval=60
+        )
+        with caplog.at_level(logging.INFO, logger="middleware"):
+            access_log.put(access_log_record())
+            access_log.put(access_log_record())
+            # a full batch wakes the thread before the flush interval
+            for _ in range(100):
+                if access_log.emitted == 2:
+                    break
+                time.sleep(0.01)
+            access_log.close()
+        assert access_log.emitted == 2
+        assert len(caplog.records) == 2
+
+
+class TestRateLimiterMiddleware:
+    @pytest.fixture(autouse=True)
+    def set_client(self, monkeypatch):
+        monkeypatch.setattr(settings, "ORIGIN", "https://explore.openaq.org")
+        self.redis = FakeRedis()
+        self.redis.now = 0
+        self.redis.sets["keys"] = {"valid-key"}
+        app = build_app()
+        app.add_middleware(
+            RateLimiterMiddleWare,
+            redis_client=self.redis,
+            rate_amount=2,
+            rate_amount_key=5,
+            rate_time=datetime.timedelta(minutes=1),
+        )
+        self.client = TestClient(app)
+
+    def test_limits_requests(self):
+        rejected = metrics.rate_limit_rejections.get(("ip",))
+        codes = [self.client.get("/ping").status_code for _ in range(3)]
+        assert codes == [200, 200, 429]
+        assert metrics.rate_limit_rejections.get(("ip",)) == rejected + 1
+        assert self.client.get("/ping").json() == {"message": "Too many requests"}
+
+    def test_headers(self):
+        response = self.client.get("/ping")
+        assert response.headers["x-ratelimit-limit"] == "2"
+        assert response.headers["x-ratelimit-remaining"] == "1"
+        # one request back every 30 seconds
+        assert response.headers["x-ratelimit-reset"] == "30"
+        self.client.get("/ping")
+        response = self.client.get("/ping")
+        assert response.headers["x-ratelimit-remaining"] == "0"
+        assert response.headers["x-ratelimit-reset"] == "60"
+        assert response.headers["retry-after"] == "30"
+
+    def test_window_boundary(self):
+        # the whole limit used at the end of a minute
+        self.redis.now = 59_000
+        codes = [self.client.get("/ping").status_code for _ in range(3)]
+        assert codes == [200, 200, 429]
+        # not available again at the start of the next one
+        self.redis.now = 61_000
+        response = self.client.get("/ping")
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "28"
+        self.redis.now = 89_000
+        codes = [self.client.get("/ping").status_code for _ in range(2)]
+        assert codes == [200, 429]
+
+    def test_refills(self):
+        codes = [self.client.get("/ping").status_code for _ in range(3)]
+        assert codes == [200, 200, 429]
+        self.redis.now = 60_000
+        codes = [self.client.get("/ping").status_code for _ in range(3)]
+        assert codes == [200, 200, 429]
+
+    def test_redis_unavailable(self):
+        self.redis.fail = True
+        codes = [self.client.get("/ping").status_code for _ in range(3)]
+        assert codes == [200, 200, 200]
+        assert "x-ratelimit-limit" not in self.client.get("/ping").headers
+        # redis is not retried while marked unavailable
+        assert self.redis.calls == 1
+
+    def test_invalid_key(self):
+        response = self.client.get("/ping", headers={"X-API-Key": "bad"})
+        assert response.status_code == 401
+        assert response.json() == {"message": "invalid credentials"}
+
+    def test_valid_key_limit(self):
+        headers = {"X-API-Key": "valid-key"}
+        codes = [
+            self.client.get("/ping", headers=headers).status_code for _ in range(6)
+        ]
+        assert codes == [200] * 5 + [429]
+
+    def test_valid_key_cached(self):
+        headers = {"X-API-Key": "valid-key"}
+        self.client.get("/ping", headers=headers)
+        calls = self.redis.calls
+        self.redis.fail = True
+        assert self.client.get("/ping", headers=headers).status_code == 200
+        # only the rate limit script was called
+        assert self.redis.calls == calls + 1
+
+    def test_made_up_key_redis_unavailable(self):
+        self.redis.fail = True
+        response = self.client.get("/docs", headers={"X-API-Key": "made-up"})
+        assert response.status_code == 200
+        # not treated as a valid key, the request has the anonymous limit
+        assert self.client.app.state.rate_limiter == "testclient/2/None"
+
+    def test_valid_key_cached_redis_unavailable(self):
+        headers = {"X-API-Key": "valid-key"}
+        self.client.get("/docs", headers=headers)
+        self.redis.fail = True
+        self.client.get("/docs", headers=headers)
+        assert self.client.app.state.rate_limiter == "valid-key/5/None"
+
+    def test_unlimited_path(self):
+        codes = [self.client.get("/docs").status_code for _ in range(3)]
+        assert codes == [200] * 3
+        assert self.redis.calls == 0
+
+    def test_unlimited_path_state(self):
+        self.client.get("/ping")
+        assert self.client.app.state.rate_limiter == "testclient/2/1"
+        # not left over from the previous request
+        self.client.get("/docs")
+        assert self.client.app.state.rate_limiter == "testclient/2/None"
+
+
+class TestLocalRateLimiter:
+    def limiter(self, redis, batch=0.1, overdraft=0):
+        return RateLimiterMiddleWare(
+            build_app(),
+            redis_client=redis,
+            rate_amount=100,
+            rate_amount_key=1000,
+            rate_time=datetime.timedelta(minutes=1),
+            local_batch=batch,
+            local_overdraft=overdraft,
+        )
+
+    def run_workers(self, workers, requests, limit, concurrency=8):
+        """Sends requests for one key to the workers in random order"""
+        rng = random.Random(1)
+        admitted = 0
+
+        async def client(n):
+            nonlocal admitted
+            for _ in range(n):
+                worker = rng.choice(workers)
+                rate_limit = await worker.request_is_limited("key", limit)
+                if rate_limit is None or not rate_limit.limited:
+                    admitted += 1
+
+        async def run():
+            await asyncio.gather(
+                *[client(requests // concurrency) for _ in range(concurrency)]
+            )
+
+        asyncio.run(run())
+        return admitted
+
+    def test_single_worker(self):
+        redis = FakeRedis()
+        redis.now = 0
+        admitted = self.run_workers([self.limiter(redis)], 200, 100)
+        assert admitted == 100
+        # one claim per batch of 10, the last one finds the limit used up
+        assert redis.calls == 11
+
+    def test_refills(self):
+        redis = FakeRedis()
+        redis.now = 0
+        limiter = self.limiter(redis)
+        assert self.run_workers([limiter], 200, 100) == 100
+        # a request is back every 600ms, the lease waits until retry_at to
+        # call redis again, cleared as if that time had passed
+        redis.now = 3_000
+        limiter.leases["key"].retry_at = 0
+        assert self.run_workers([limiter], 200, 100) == 5
+
+    def test_headers(self, monkeypatch):
+        monkeypatch.setattr(settings, "ORIGIN", "https://explore.openaq.org")
+        redis = FakeRedis()
+        redis.now = 0
+        app = build_app()
+        app.add_middleware(
+            RateLimiterMiddleWare,
+            redis_client=redis,
+            rate_amount=100,
+            rate_amount_key=1000,
+            rate_time=datetime.timedelta(minutes=1),
+            local_batch=0.1,
+        )
+        client = TestClient(app)
+        response = client.get("/ping")
+        assert response.headers["x-ratelimit-limit"] == "100"
+        assert response.headers["x-ratelimit-remaining"] == "99"
+        # the claimed batch of 10 is back after 6 seconds
+        assert response.headers["x-ratelimit-reset"] == "6"
+        for _ in range(99):
+            client.get("/ping")
+        response = client.get("/ping")
+        assert response.status_code == 429
+        assert response.headers["x-ratelimit-remaining"] == "0"
+        assert response.headers["retry-after"] == "1"
+        assert redis.calls == 11
+
+    @pytest.mark.parametrize("workers", [4, 16, 64])
+    def test_workers_share_limit(self, workers):
+        redis = FakeRedis()
+        redis.now = 0
+        redis.latency = 0.0001
+        limiters = [self.limiter(redis) for _ in range(workers)]
+        admitted = self.run_workers(limiters, 4000, 1000)
+        assert admitted <= 1000
+        # tokens claimed by a worker that did not use them are lost
+        assert admitted >= 1000 - workers * 100
+        # the whole limit was claimed
+        assert redis.tats["ratelimit:key"] == 60_000
+
+    @pytest.mark.parametrize("workers", [4, 16, 64])
+    def test_overdraft_is_bounded(self, workers):
+        redis = FakeRedis()
+        redis.now = 0
+        redis.latency = 0.0001
+        limiters = [self.limiter(redis, overdraft=0.5) for _ in range(workers)]
+        admitted = self.run_workers(limiters, 4000, 1000)
+        # each worker admits at most half a batch over the limit
+        assert admitted <= 1000 + workers * 50
+
+    def test_overdraft_does_not_wait(self):
+        redis = FakeRedis()
+        redis.latency = 0.01
+        limiter = self.limiter(redis, overdraft=0.5)
+
+        async def run():
+            first = await limiter.request_is_limited("key", 100)
+            # admitted on credit while the first claim is in flight
+            assert limiter.leases["key"].claim is not None
+            assert limiter.leases["key"].tokens == -1
+            await asyncio.sleep(0.02)
+            return first
+
+        assert not asyncio.run(run()).limited
+
+    def test_redis_unavailable(self):
+        redis = FakeRedis()
+        redis.fail = True
+        admitted = self.run_workers([self.limiter(redis)], 200, 100)
+        assert admitted == 200
+        assert redis.calls == 1
+
+
+class TestAPIKeyCache:
+    @pytest.fixture(autouse=True)
+    def set_cache(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr("openaq_api.middleware.time.monotonic", lambda: self.now)
+        self.redis = FakeRedis()
+        self.redis.sets["keys"] = {"valid-key"}
+        self.cache = APIKeyCache(
+            self.redis, refresh_interval=300, ttl=120, negative_ttl=60, max_entries=2
+        )
+
+    def get(self, key):
+        async def run():
+            value = self.cache.get(key)
+            if self.cache._refresh_task is not None:
+                await self.cache._refresh_task
+            return value
+
+        return asyncio.run(run())
+
+    def test_snapshot(self):
+        assert self.get("valid-key") is None
+        assert self.get("valid-key") is True
+        assert self.cache.snapshot == {"valid-key"}
+        assert self.redis.calls == 1
+
+    def test_refresh_interval(self):
+        self.get("valid-key")
+        self.redis.sets["keys"] = {"new-key"}
+        self.now += 299
+        assert self.get("new-key") is None
+        self.now += 1
+        self.get("new-key")
+        assert self.get("new-key") is True
+        assert self.get("valid-key") is None
+
+    def test_negative_ttl(self):
+        self.get("valid-key")
+        self.cache.set("bad", False)
+        assert self.get("bad") is False
+        self.now += 60
+        assert self.get("bad") is None
+
+    def test_ttl(self):
+        self.get("valid-key")
+        self.cache.add("added")
+        assert self.get("added") is True
+        self.now += 120
+        assert self.get("added") is None
+
+    def test_redis_unavailable(self, caplog):
+        self.get("valid-key")
+        self.redis.fail = True
+        self.now += 300
+        assert self.get("valid-key") is True
+        assert self.cache.errors == 1
+        assert "api key cache refresh failed" in caplog.text
+        # the refresh is retried after retry_after rather than every request
+        assert self.get("valid-key") is True
+        assert self.cache.errors == 1
+        self.now += 30
+        self.get("valid-key")
+        assert self.cache.errors == 2
+
+    def test_max_entries(self):
+        for key in ["a", "b", "c"]:
+            self.cache.set(key, True)
+        assert list(self.cache.entries) == ["b", "c"]
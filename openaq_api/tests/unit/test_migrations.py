@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from openaq_api import rollups
+from openaq_api.migrations import MIGRATIONS, Migration, migrate
+
+from .conftest import FakeConnection
+
+
+class MigratedConnection(FakeConnection):
+    def __init__(self, applied=(), fail=None):
+        super().__init__()
+        self.applied = list(applied)
+        self.fail = fail
+        self.executed = []
+
+    async def fetch(self, sql):
+        return [{"name": name} for name in self.applied]
+
+    async def execute(self, sql, *args):
+        if sql == self.fail:
+            raise OSError("connection reset")
+        self.executed.append((sql, self.transactions > 0))
+        if "INSERT INTO api_migrations" in sql:
+            self.applied.append(args[0])
+
+
+MIGRATED = (
+    Migration("0001_a", "CREATE TABLE a ()"),
+    Migration("0002_b", "CREATE INDEX CONCURRENTLY b ON a ()", transaction=False),
+    Migration("0003_c", "CREATE TABLE c ()"),
+)
+
+
+class TestMigrate:
+    def test_names(self):
+        names = [m.name for m in MIGRATIONS]
+        assert names == sorted(set(names))
+        # the index is built concurrently, outside of the table migration
+        assert "calculated_on_idx" not in rollups.SCHEMA
+        [index] = [m for m in MIGRATIONS if "calculated_on_idx" in m.sql]
+        assert "CONCURRENTLY" in index.sql and not index.transaction
+
+    def test_migrate(self):
+        con = MigratedConnection()
+        assert asyncio.run(migrate(con, MIGRATED)) == ["0001_a", "0002_b", "0003_c"]
+        assert con.applied == ["0001_a", "0002_b", "0003_c"]
+        executed = dict(con.executed)
+        assert executed["CREATE TABLE a ()"]
+        assert not executed["CREATE INDEX CONCURRENTLY b ON a ()"]
+        assert "pg_advisory_lock" in con.executed[0][0]
+        assert "pg_advisory_unlock" in con.executed[-1][0]
+
+    def test_pending(self):
+        con = MigratedConnection(applied=["0001_a", "0002_b"])
+        assert asyncio.run(migrate(con, MIGRATED)) == ["0003_c"]
+        assert "CREATE TABLE a ()" not in dict(con.executed)
+
+    def test_failed(self):
+        con = MigratedConnection(fail="CREATE INDEX CONCURRENTLY b ON a ()")
+        with pytest.raises(OSError):
+            asyncio.run(migrate(con, MIGRATED))
+        assert con.applied == ["0001_a"]
+        assert "pg_advisory_unlock" in con.executed[-1][0]
@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from openaq_api import db as db_module
+from openaq_api.db import DB, POOLS, pool_attribute, pool_options
+from openaq_api.settings import settings
+
+from .conftest import FakeConnection, FakePool, FakeRequest
+
+
+def test_pool_options_default(monkeypatch):
+    monkeypatch.setattr(settings, "DATABASE_ANALYTICAL_URL", None)
+    options = pool_options("analytical")
+    assert options == {
+        "dsn": settings.DATABASE_READ_URL,
+        "command_timeout": settings.DATABASE_ANALYTICAL_TIMEOUT,
+        "max_size": settings.DATABASE_ANALYTICAL_POOL_SIZE,
+    }
+
+
+def test_pool_options_url(monkeypatch):
+    monkeypatch.setattr(settings, "DATABASE_ANALYTICAL_URL", "postgres://replica")
+    monkeypatch.setattr(settings, "DATABASE_INTERACTIVE_URL", None)
+    assert pool_options("analytical")["dsn"] == "postgres://replica"
+    assert pool_options("interactive")["dsn"] == settings.DATABASE_READ_URL
+
+
+def test_pool_options_unknown():
+    with pytest.raises(ValueError):
+        pool_options("reporting")
+
+
+def test_pool_attribute():
+    assert [pool_attribute(name) for name in POOLS] == ["pool", "analytical_pool"]
+
+
+def test_query_runs_on_named_pool(monkeypatch):
+    created = []
+
+    async def create_pool(dsn, **kwargs):
+        created.append(kwargs["max_size"])
+        return FakePool(FakeConnection(rows=[{"pool": len(created)}]))
+
+    monkeypatch.setattr(db_module.asyncpg, "create_pool", create_pool)
+    request = FakeRequest()
+    db = DB(request)
+
+    async def run():
+        return (
+            await db._fetch("SELECT 1", {}),
+            await db._fetch("SELECT 1", {}, pool="analytical"),
+            await db._fetch("SELECT 2", {}, pool="analytical"),
+        )
+
+    interactive, analytical, again = asyncio.run(run())
+    assert interactive == [{"pool": 1}]
+    assert analytical == again == [{"pool": 2}]
+    assert created == [
+        settings.DATABASE_INTERACTIVE_POOL_SIZE,
+        settings.DATABASE_ANALYTICAL_POOL_SIZE,
+    ]
+    assert request.app.state.pool.con.rows == [{"pool": 1}]
+    assert request.app.state.analytical_pool.con.rows == [{"pool": 2}]
@@ -0,0 +1,293 @@
+import asyncio
+from datetime import date, datetime, timedelta, timezone
+
+from buildpg import render
+
+from openaq_api.models.responses import Meta, OpenAQResult
+from openaq_api.rollups import (
+    ADVISORY_LOCK,
+    NODES_SQL,
+    ROLLUP_PERIODS,
+    RollupRefresher,
+    aggregates_sql,
+    covered,
+    date_bound,
+    refresh_sql,
+)
+from openaq_api.settings import settings
+from openaq_api.v3.routers import measurements
+from openaq_api.v3.routers.measurements import (
+    LocationMeasurementsQueries,
+    fetch_measurements,
+)
+
+
+def queries(**params) -> LocationMeasurementsQueries:
+    return LocationMeasurementsQueries(
+        **{"locations_id": 1, "limit": 100, "page": 1, **params}
+    )
+
+
+class TestCovered:
+    def test_date_bound(self):
+        assert date_bound(None, "date_from", "ts.tzid") is None
+        assert (
+            date_bound(date(2022, 1, 1), "date_from", "ts.tzid")
+            == "(:date_from::timestamp AT TIME ZONE ts.tzid)"
+        )
+        assert (
+            date_bound(datetime(2022, 1, 1), "date_to", "r.tzid")
+            == "(:date_to::timestamp AT TIME ZONE r.tzid)"
+        )
+        aware = datetime(2022, 1, 1, tzinfo=timezone.utc)
+        assert date_bound(aware, "date_to", "r.tzid") == ":date_to"
+
+    def test_refreshed_periods(self):
+        q = queries(period_name="month")
+        assert covered(q, "s", "e", "tz") == "e <= (SELECT until FROM refreshed)"
+
+    def test_whole_periods(self):
+        q = queries(period_name="day", date_from="2022-01-01", date_to="2022-02-01")
+        assert covered(q, "s", "e", "tz") == (
+            "e <= (SELECT until FROM refreshed)"
+            " AND s > (:date_from::timestamp AT TIME ZONE tz)"
+            " AND e <= (:date_to::timestamp AT TIME ZONE tz)"
+        )
+
+
+class TestAggregatesSql:
+    def test_union(self):
+        q = queries(period_name="month", parameters_id="2,3")
+        sql = aggregates_sql(q, "WHERE sy.sensor_nodes_id = :locations_id")
+        rollups, hourly = sql.split("UNION ALL")
+        assert "FROM measurements_rollup r" in rollups
+        assert "r.measurands_id = ANY (:parameters_id)" in rollups
+        assert "FROM hourly_data m" in hourly
+        # the hourly rows of the periods the rollups do not answer
+        assert "AND NOT (truncate_timestamp(" in hourly
+        assert "'1 month 2 days'::interval" in hourly
+        # the period is bound, not written into the query
+        assert "('1' || :period_name)::interval" in hourly
+        assert "'1month'" not in hourly
+
+    def test_renders(self):
+        q = queries(period_name="day", date_from="2022-01-01")
+        params = {**q.model_dump(), "offset": 0}
+        sql, args = render(
+            f"WITH {aggregates_sql(q, 'WHERE TRUE')} SELECT * FROM meas", **params
+        )
+        assert "$1" in sql and args[0] == "day"
+
+    def test_refresh_sql(self):
+        for period_name in ROLLUP_PERIODS:
+            sql = refresh_sql(period_name)
+            assert "ON CONFLICT (period_name, sensor_nodes_id, measurands_id" in sql
+            assert "value_p98 = EXCLUDED.value_p98" in sql
+            # the key is not updated
+            assert ", datetime = EXCLUDED" not in sql
+            assert "sensor_nodes_id = EXCLUDED" not in sql
+            # a batch of locations
+            assert sql.count("sy.sensor_nodes_id = ANY(:sensor_nodes_ids)") == 2
+            # the rows of the last periods only when one may have closed
+            assert "date_trunc(:period_name" in sql
+            # hourly_data is read in the range of the changed periods
+            assert "m.datetime >= (SELECT MIN(datetime) FROM changed)" in sql
+            assert "m.datetime < (SELECT MAX(datetime) FROM changed)" in sql
+
+
+class FakeDB:
+    def __init__(self):
+        self.calls = []
+
+    async def fetchPage(self, sql, kwargs, statement=None, pool=None):
+        self.calls.append((sql, pool, statement, kwargs))
+        return OpenAQResult(meta=Meta.model_validate(kwargs))
+
+
+class TestFetchMeasurements:
+    def run(self, monkeypatch, enabled: bool, **params):
+        monkeypatch.setattr(settings, "API_ROLLUPS", enabled)
+        monkeypatch.setattr(measurements.rollup_refresher, "interval", None)
+        db = FakeDB()
+        asyncio.run(fetch_measurements(queries(**params), db))
+        return db.calls[0]
+
+    def test_rollups(self, monkeypatch):
+        sql, pool, statement, kwargs = self.run(monkeypatch, True, period_name="month")
+        assert "FROM measurements_rollup r" in sql
+        assert "'label', '1' || :period_name::text" in sql
+        assert kwargs["period_interval"] == "1 month"
+        assert pool == "analytical"
+        assert statement == "v3_measurements_rollup"
+
+    def test_disabled(self, monkeypatch):
+        sql, _, statement, kwargs = self.run(monkeypatch, False, period_name="day")
+        assert "measurements_rollup" not in sql
+        assert kwargs["period_interval"] == "24:00:00"
+        assert statement == "v3_measurements_aggregate"
+        # the periods share one query
+        month = self.run(monkeypatch, False, period_name="month")
+        assert month[0] == sql and month[2] == statement
+
+    def test_hourly(self, monkeypatch):
+        sql, _, statement, kwargs = self.run(monkeypatch, True, period_name="hour")
+        assert "measurements_rollup" not in sql
+        assert ":expected_hours::int * 3600" in sql
+        assert kwargs["expected_hours"] == 1
+        assert statement == "v3_measurements_hourly"
+
+
+class FakeTransaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class FakeConnection:
+    def __init__(self, nodes=(1, 2, 3, 4, 5), locked=False, fail=None):
+        self.nodes = nodes
+        self.locked = locked
+        self.fail = fail
+        self.states = {}
+        self.refreshed = []
+        self.listed = []
+        self.executed = []
+        self.closed = False
+
+    def transaction(self):
+        return FakeTransaction()
+
+    async def fetchval(self, sql, *args):
+        if "COUNT(1) FROM measurements_rollup_refresh" in sql:
+            return sum(1 for s in self.states.values() if s[1] != datetime.min)
+        assert "pg_try_advisory_xact_lock" in sql
+        assert args == (ADVISORY_LOCK,)
+        return not self.locked
+
+    async def fetchrow(self, sql, period_name, overlap):
+        refreshed_until, calculated_until, until, after = self.states.get(
+            period_name, (datetime.min, datetime.min, None, None)
+        )
+        until = until or datetime(2024, 1, 1, tzinfo=timezone.utc)
+        return {
+            "refreshed_until": refreshed_until,
+            "calculated_until": calculated_until,
+            "first": refreshed_until == datetime.min,
+            "until": until,
+            "calculated": until - timedelta(minutes=15),
+            "nodes_after": after or 0,
+        }
+
+    async def fetch(self, sql, *args):
+        self.listed.append("first" if sql == NODES_SQL else "changed")
+        after, limit = args[0], args[-1]
+        return [{"sensor_nodes_id": n} for n in self.nodes if n > after][:limit]
+
+    async def execute(self, sql, *args):
+        if "INSERT INTO measurements_rollup " in sql:
+            [ids] = [a for a in args if isinstance(a, list)]
+            if self.fail in ids:
+                self.fail = None
+                raise OSError("connection reset")
+            self.refreshed.append(ids)
+        elif "measurements_rollup_refresh" in sql:
+            self.states[args[0]] = args[1:]
+        self.executed.append((sql, args))
+        return "INSERT 0 1"
+
+    async def close(self):
+        self.closed = True
+
+
+def refresh(refresher, con, backfill=True):
+    async def connect():
+        return con
+
+    return asyncio.run(refresher.run(connect, backfill))
+
+
+class TestRollupRefresher:
+    def test_refresh(self):
+        refresher = RollupRefresher(nodes=2)
+        con = FakeConnection()
+        assert refresh(refresher, con)
+        # batches of locations for every period
+        assert con.refreshed == [[1, 2], [3, 4], [5]] * len(ROLLUP_PERIODS)
+        assert set(con.listed) == {"first"}
+        states = [args for sql, args in con.executed if "_refresh" in sql]
+        assert [args[0] for args in states] == [
+            p for p in ROLLUP_PERIODS for _ in range(4)
+        ]
+        assert [args[4] for args in states[:4]] == [2, 4, 5, None]
+        until = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        assert con.states["day"] == (until, until - timedelta(minutes=15), None, None)
+        assert "idle_in_transaction_session_timeout" in con.executed[0][0]
+        assert con.closed
+        assert refresher.refreshes == 1
+
+    def test_incremental(self):
+        refresher = RollupRefresher(nodes=10)
+        con = FakeConnection()
+        assert refresh(refresher, con)
+        assert refresh(refresher, con, backfill=False)
+        # the changed locations once the first refresh is complete
+        assert con.listed[-1] == "changed"
+        assert refresher.refreshes == 2
+
+    def test_not_backfilled(self, caplog):
+        refresher = RollupRefresher()
+        con = FakeConnection()
+        assert not refresh(refresher, con, backfill=False)
+        assert con.refreshed == []
+        assert "rollups are not backfilled" in caplog.text
+        assert refresher.errors == 0
+
+    def test_locked(self):
+        refresher = RollupRefresher()
+        con = FakeConnection(locked=True)
+        assert not refresh(refresher, con)
+        assert len(con.executed) == 1
+        assert con.closed
+        assert refresher.errors == 0
+
+    def test_error(self, caplog):
+        refresher = RollupRefresher()
+        con = FakeConnection(fail=1)
+        assert not refresh(refresher, con)
+        assert con.closed
+        assert refresher.errors == 1
+        assert "could not refresh rollups" in caplog.text
+
+    def test_resume(self):
+        refresher = RollupRefresher(nodes=2)
+        con = FakeConnection(fail=3)
+        assert not refresh(refresher, con)
+        # the first batch is kept and the next refresh continues after it
+        assert con.states["day"][3] == 2 and con.refreshed == [[1, 2]]
+        assert refresh(refresher, con)
+        assert con.refreshed[:3] == [[1, 2], [3, 4], [5]]
+
+    def test_schedule(self, monkeypatch):
+        refresher = RollupRefresher(interval=60)
+        runs = []
+
+        async def run():
+            runs.append(1)
+
+        monkeypatch.setattr(refresher, "run", run)
+
+        async def schedule():
+            refresher.schedule()
+            await refresher._task
+            refresher.schedule()
+
+        asyncio.run(schedule())
+        assert runs == [1]
+        assert refresher._task.done()
+
+    def test_schedule_off(self):
+        refresher = RollupRefresher(interval=None)
+        refresher.schedule()
+        assert refresher._task is None
@@ -0,0 +1,368 @@
+import asyncio
+import math
+import random
+import statistics
+from datetime import datetime, timedelta, timezone
+
+import orjson
+import pytest
+
+from openaq_api import sketches
+from openaq_api.models.responses import Meta, OpenAQResult
+from openaq_api.settings import settings
+from openaq_api.sketches import (
+    ADVISORY_LOCK,
+    CHANGED_SENSORS_SQL,
+    RELATIVE_ACCURACY,
+    SENSORS_SQL,
+    TOTAL,
+    Moments,
+    QuantileSketch,
+    SketchRefresher,
+    merge_buckets,
+    summary,
+)
+from openaq_api.v3.models.responses import Summary
+from openaq_api.v3.routers import sensors
+from openaq_api.v3.routers.sensors import SensorQuery, fetch_sensors
+
+
+def percentile_cont(values: list[float], q: float) -> float:
+    values = sorted(values)
+    rank = q * (len(values) - 1)
+    low = math.floor(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (rank - low) * (values[high] - values[low])
+
+
+def samples(seed: int = 7) -> dict[str, list[float]]:
+    rng = random.Random(seed)
+    return {
+        "lognormal": [rng.lognormvariate(2, 1.5) for _ in range(5000)],
+        "temperature": [rng.gauss(4, 9) for _ in range(5000)],
+        "counts": [float(rng.randint(0, 20)) for _ in range(3000)],
+        "constant": [12.5] * 100,
+        "single": [-3.0],
+    }
+
+
+QS = (0.0, 0.02, 0.25, 0.5, 0.75, 0.98, 1.0)
+
+
+class TestQuantileSketch:
+    @pytest.mark.parametrize("name", list(samples()))
+    def test_error_bound(self, name):
+        values = samples()[name]
+        sketch = QuantileSketch().extend(values)
+        for q, approx in zip(QS, sketch.quantiles(QS)):
+            exact = percentile_cont(values, q)
+            # relative to the values the exact percentile is interpolated
+            # between, which matters only when they differ in sign
+            rank = q * (len(values) - 1)
+            ordered = sorted(values)
+            scale = max(
+                abs(ordered[math.floor(rank)]),
+                abs(ordered[min(math.ceil(rank), len(values) - 1)]),
+            )
+            assert abs(approx - exact) <= RELATIVE_ACCURACY * scale * (1 + 1e-9)
+
+    def test_extremes(self):
+        values = samples()["lognormal"]
+        sketch = QuantileSketch().extend(values)
+        assert sketch.quantiles([0, 1]) == [min(values), max(values)]
+
+    def test_empty(self):
+        sketch = QuantileSketch().extend([None])
+        assert sketch.count == 0
+        assert sketch.quantiles([0.5]) == [None]
+
+    def test_merge(self):
+        values = samples()["temperature"]
+        chunks = [values[i : i + 700] for i in range(0, len(values), 700)]
+        whole = QuantileSketch().extend(values).to_dict()
+        merged = QuantileSketch()
+        for chunk in reversed(chunks):
+            merged.merge(QuantileSketch().extend(chunk))
+        # bins add up exactly, the merge is the sketch of all the values
+        assert merged.to_dict() == whole
+
+    def test_merge_accuracy(self):
+        with pytest.raises(ValueError):
+            QuantileSketch(0.01).merge(QuantileSketch(0.02))
+
+    def test_serialize(self):
+        sketch = QuantileSketch().extend(samples()["temperature"])
+        data = orjson.loads(orjson.dumps(sketch.to_dict()))
+        restored = QuantileSketch.from_dict(data)
+        assert restored.to_dict() == sketch.to_dict()
+        assert restored.quantiles(QS) == sketch.quantiles(QS)
+
+    def test_collapse(self, monkeypatch):
+        monkeypatch.setattr(sketches, "MAX_BINS", 10)
+        values = [10**e for e in range(-5, 15)]
+        sketch = QuantileSketch().extend(values)
+        assert len(sketch.positive) == 10
+        assert sum(sketch.positive.values()) == len(values)
+        # the large values keep their accuracy
+        assert sketch.quantile(1) == 1e14
+        assert sketch.quantile(17 / 19) == pytest.approx(1e12, rel=RELATIVE_ACCURACY)
+
+
+class TestMoments:
+    def test_merge(self):
+        values = samples()["temperature"]
+        moments = Moments()
+        for i in range(0, len(values), 300):
+            chunk = values[i : i + 300]
+            mean = statistics.fmean(chunk)
+            m2 = sum((v - mean) ** 2 for v in chunk)
+            moments.merge(Moments(len(chunk), mean, m2))
+        assert moments.count == len(values)
+        assert moments.mean == pytest.approx(statistics.fmean(values))
+        assert moments.sd == pytest.approx(statistics.stdev(values))
+
+    def test_large_values(self):
+        # a sum of squares would lose the spread of these
+        values = [1e9 + v for v in (0.1, 0.2, 0.3, 0.4)]
+        moments = Moments()
+        for v in values:
+            moments.merge(Moments(1, v, 0))
+        assert moments.sd == pytest.approx(statistics.stdev(values), rel=1e-6)
+
+    def test_sd(self):
+        assert Moments().sd is None
+        assert Moments(1, 3.0, 0).sd is None
+
+
+def test_summary():
+    values = samples()["lognormal"]
+    result = summary(QuantileSketch().extend(values).to_dict(), 1.5)
+    Summary.model_validate(result)
+    assert result["sd"] == 1.5
+    assert result["min"] == min(values)
+    assert result["median"] == pytest.approx(
+        statistics.median(values), rel=RELATIVE_ACCURACY
+    )
+
+
+def bucket_row(sensors_id: int, month: int, values: list[float]) -> dict:
+    start = datetime(2024, month, 1, tzinfo=timezone.utc)
+    mean = statistics.fmean(values)
+    return {
+        "sensors_id": sensors_id,
+        "bucket": start.replace(tzinfo=None),
+        "datetime_first": start,
+        "datetime_last": start + timedelta(hours=len(values)),
+        "value_count": len(values),
+        "value_avg": mean,
+        "value_m2": sum((v - mean) ** 2 for v in values),
+        "value_min": min(values),
+        "value_max": max(values),
+        "values": values,
+    }
+
+
+def test_merge_buckets():
+    values = samples()["temperature"]
+    rows = [bucket_row(5, m + 1, values[m * 500 : (m + 1) * 500]) for m in range(10)]
+    for row in rows:
+        row["sketch"] = QuantileSketch().extend(row["values"]).to_dict()
+    total = merge_buckets(rows)
+    assert total[:2] == (5, TOTAL)
+    assert total[2] == rows[0]["datetime_first"]
+    assert total[3] == rows[-1]["datetime_last"]
+    assert total[4] == len(values)
+    assert total[5] == pytest.approx(statistics.fmean(values))
+    assert total[6] == pytest.approx(statistics.pvariance(values) * len(values))
+    assert (total[7], total[8]) == (min(values), max(values))
+    assert orjson.loads(total[9]) == QuantileSketch().extend(values).to_dict()
+
+
+class FakeTransaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class FakeConnection:
+    def __init__(self, buckets, fail=None):
+        self.buckets = buckets
+        self.fail = fail
+        self.state = None
+        self.table = {}
+        self.sketched = []
+        self.listed = []
+        self.executed = []
+        self.closed = False
+
+    def transaction(self):
+        return FakeTransaction()
+
+    async def fetchval(self, sql, *args):
+        assert "pg_try_advisory_xact_lock" in sql
+        assert args == (ADVISORY_LOCK,)
+        return True
+
+    async def fetchrow(self, sql, *args):
+        calculated_until, pass_until, after = self.state or (None, None, None)
+        return {
+            "first": calculated_until in (None, datetime.min),
+            "calculated_until": calculated_until or datetime.min,
+            "pass_until": pass_until or datetime(2024, 1, 1, tzinfo=timezone.utc),
+            "sensors_after": after or 0,
+        }
+
+    async def cursor(self, sql, calculated_until, sensors_ids):
+        if self.fail in sensors_ids:
+            self.fail = None
+            raise OSError("connection reset")
+        self.sketched.extend(sensors_ids)
+        for row in self.buckets:
+            if row["sensors_id"] in sensors_ids:
+                yield row
+
+    async def executemany(self, sql, rows):
+        for row in rows:
+            self.table[row[:2]] = row
+
+    async def fetch(self, sql, *args):
+        if sql in (SENSORS_SQL, CHANGED_SENSORS_SQL):
+            self.listed.append(sql)
+            after, limit = args[-2:]
+            ids = sorted(
+                {r["sensors_id"] for r in self.buckets if r["sensors_id"] > after}
+            )
+            return [{"sensors_id": i} for i in ids[:limit]]
+        [sensors_ids] = args
+        keys = sorted(k for k in self.table if k[0] in sensors_ids and k[1] != TOTAL)
+        columns = ("datetime_first", "datetime_last", "value_count", "value_avg")
+        return [
+            {
+                "sensors_id": k[0],
+                **dict(zip(columns, self.table[k][2:6])),
+                "value_m2": self.table[k][6],
+                "sketch": self.table[k][9],
+            }
+            for k in keys
+        ]
+
+    async def execute(self, sql, *args):
+        self.executed.append((sql, args))
+        if "sensor_sketches_refresh" in sql:
+            self.state = args
+
+    async def close(self):
+        self.closed = True
+
+
+def sensor_buckets(sensors: int) -> list[dict]:
+    values = samples()["lognormal"]
+    return [
+        bucket_row(s, m + 1, values[(s * 3 + m) * 200 : (s * 3 + m + 1) * 200])
+        for s in range(1, sensors + 1)
+        for m in range(3)
+    ]
+
+
+def refresh(refresher, con) -> bool:
+    async def connect():
+        return con
+
+    return asyncio.run(refresher.run(connect, backfill=True))
+
+
+class TestSketchRefresher:
+    def test_refresh(self):
+        buckets = sensor_buckets(2)
+        con = FakeConnection(buckets)
+        refresher = SketchRefresher(batch=4)
+        assert refresh(refresher, con)
+        assert len(con.table) == 8
+        for sensors_id in (1, 2):
+            total = con.table[(sensors_id, TOTAL)]
+            sensor_values = [
+                v
+                for row in buckets
+                if row["sensors_id"] == sensors_id
+                for v in row["values"]
+            ]
+            assert total[4] == len(sensor_values) == 600
+            sketch = QuantileSketch.from_dict(orjson.loads(total[9]))
+            assert sketch.quantile(0.5) == pytest.approx(
+                statistics.median(sensor_values), rel=RELATIVE_ACCURACY
+            )
+        assert "sensor_sketches_refresh" in con.executed[-1][0]
+        assert con.closed and refresher.refreshes == 1
+
+    def test_batches(self):
+        con = FakeConnection(sensor_buckets(5))
+        refresher = SketchRefresher(sensors=2)
+        assert refresh(refresher, con)
+        states = [args for sql, args in con.executed if "_refresh" in sql]
+        # the last sensor of each batch then the end of the pass
+        assert [state[2] for state in states] == [2, 4, 5, None]
+        assert states[0][0] == datetime.min
+        assert states[-1][0] == datetime(2024, 1, 1, tzinfo=timezone.utc)
+        assert len({k[0] for k in con.table if k[1] == TOTAL}) == 5
+        # the first pass lists every sensor, later ones the changed sensors
+        assert set(con.listed) == {SENSORS_SQL}
+        assert refresh(refresher, con)
+        assert con.listed[-1] == CHANGED_SENSORS_SQL
+
+    def test_resume(self):
+        con = FakeConnection(sensor_buckets(5), fail=3)
+        refresher = SketchRefresher(sensors=2)
+        assert not refresh(refresher, con)
+        # the first batch is kept and the next refresh continues after it
+        assert con.state[2] == 2 and con.sketched == [1, 2]
+        assert refresh(refresher, con)
+        assert con.sketched == [1, 2, 3, 4, 5]
+        assert con.state[1:] == (None, None)
+
+
+class FakeDB:
+    def __init__(self, sketch):
+        self.sketch = sketch
+        self.calls = []
+
+    async def fetchPage(self, sql, kwargs, statement=None, pool=None):
+        self.calls.append(sql)
+        row = {"id": 1, "summary": {"sd": 2.0, "q02": None, "median": None}}
+        if "FROM sensor_sketches" in sql:
+            row["sketch"] = self.sketch
+        return OpenAQResult(meta=Meta.model_validate(kwargs), results=[row])
+
+
+class TestFetchSensors:
+    def run(self, monkeypatch, sketch, **params):
+        monkeypatch.setattr(settings, "API_SENSOR_SKETCHES", True)
+        monkeypatch.setattr(sensors.sketch_refresher, "interval", None)
+        db = FakeDB(sketch)
+        q = SensorQuery(**{"sensors_id": 1, **params})
+        response = asyncio.run(fetch_sensors(q, db))
+        return db.calls, response.results[0]
+
+    def test_sketch(self, monkeypatch):
+        values = samples()["lognormal"]
+        sketch = QuantileSketch().extend(values).to_dict()
+        calls, row = self.run(monkeypatch, sketch)
+        assert len(calls) == 1 and "PERCENTILE_CONT" not in calls[0]
+        assert "sketch" not in row
+        assert row["summary"]["sd"] == 2.0
+        assert row["summary"]["max"] == max(values)
+        assert row["summary"]["q98"] == pytest.approx(
+            percentile_cont(values, 0.98), rel=RELATIVE_ACCURACY
+        )
+
+    def test_exact(self, monkeypatch):
+        calls, row = self.run(monkeypatch, None, exact=True)
+        assert len(calls) == 1 and "PERCENTILE_CONT" in calls[0]
+        assert "sensor_sketches" not in calls[0]
+
+    def test_not_sketched(self, monkeypatch):
+        calls, row = self.run(monkeypatch, None)
+        assert "FROM sensor_sketches" in calls[0]
+        assert "PERCENTILE_CONT" in calls[1]
+        assert "sketch" not in row
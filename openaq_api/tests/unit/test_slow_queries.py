@@ -0,0 +1,175 @@
+import asyncio
+
+import asyncpg
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from openaq_api.db import DB
+from openaq_api.routers.admin import router
+from openaq_api.settings import settings
+from openaq_api.slow_queries import SlowQueryLog, fingerprint, slow_queries
+
+from .conftest import FakeConnection, FakePool, FakeRequest
+
+SQL = "SELECT id FROM locations WHERE id = $1"
+
+
+class ExplainConnection(FakeConnection):
+    def __init__(self, fail=False):
+        super().__init__()
+        self.fail = fail
+
+    def transaction(self, readonly=False):
+        assert readonly
+        return super().transaction()
+
+    async def fetchval(self, sql, *args):
+        self.statements.append((sql, args))
+        if self.fail:
+            raise asyncpg.exceptions.PostgresSyntaxError("syntax error")
+        return '[{"Plan": {"Node Type": "Index Scan"}}]'
+
+
+def observe(log, seconds, con, sql=SQL):
+    pool = FakePool(con)
+
+    async def explain_pool():
+        return pool
+
+    async def run():
+        entry = log.observe(
+            sql, [42], seconds, "/v3/locations", "interactive", None, explain_pool
+        )
+        await asyncio.gather(*log._tasks)
+        return entry
+
+    return asyncio.run(run())
+
+
+class TestSlowQueryLog:
+    def test_threshold(self):
+        log = SlowQueryLog(threshold=1.0, sample_rate=0)
+        assert observe(log, 0.5, ExplainConnection()) is None
+        entry = observe(log, 1.5, ExplainConnection())
+        assert entry.fingerprint == fingerprint(SQL)
+        assert list(log.entries) == [entry]
+
+    def test_off(self):
+        log = SlowQueryLog(threshold=None)
+        assert observe(log, 100, ExplainConnection()) is None
+
+    def test_not_explained_by_default(self):
+        log = SlowQueryLog(threshold=0)
+        con = ExplainConnection()
+        assert observe(log, 1, con).plan is None
+        assert con.statements == []
+
+    def test_fingerprint(self):
+        assert fingerprint(SQL) == fingerprint(SQL.replace(" ", "\n  "))
+        assert fingerprint(SQL) != fingerprint(SQL.replace("id = ", "id > "))
+
+    def test_ring(self):
+        log = SlowQueryLog(threshold=0, sample_rate=0, max_entries=2)
+        for seconds in (1, 2, 3):
+            observe(log, seconds, ExplainConnection())
+        assert [e.seconds for e in log.entries] == [2, 3]
+        report = log.report()
+        assert [q["seconds"] for q in report["queries"]] == [3, 2]
+        assert report["fingerprints"] == [
+            {
+                "fingerprint": fingerprint(SQL),
+                "count": 3,
+                "totalSeconds": 6,
+                "maxSeconds": 3,
+                "sql": SQL,
+            }
+        ]
+
+    def test_max_fingerprints(self):
+        log = SlowQueryLog(threshold=0, sample_rate=0, max_fingerprints=2)
+        for n in range(3):
+            observe(log, 1, ExplainConnection(), sql=f"SELECT {n}")
+        assert list(log.fingerprints) == [
+            fingerprint("SELECT 1"),
+            fingerprint("SELECT 2"),
+        ]
+
+    def test_explain(self):
+        log = SlowQueryLog(threshold=0, sample_rate=1)
+        con = ExplainConnection()
+        entry = observe(log, 1, con)
+        assert entry.plan == [{"Plan": {"Node Type": "Index Scan"}}]
+        assert con.statements[1] == (f"EXPLAIN (FORMAT JSON) {SQL}", (42,))
+        assert log.explains == 1
+
+    def test_explain_analyze(self):
+        log = SlowQueryLog(threshold=0, sample_rate=1, analyze=True)
+        con = ExplainConnection()
+        observe(log, 1, con)
+        assert con.statements[0] == "SET LOCAL statement_timeout = 30000"
+        assert con.statements[1][0].startswith(
+            "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)"
+        )
+
+    def test_explain_interval(self):
+        log = SlowQueryLog(threshold=0, sample_rate=1, explain_interval=300)
+        first = observe(log, 1, ExplainConnection())
+        second = observe(log, 1, ExplainConnection())
+        assert first.plan is not None
+        assert second.plan is None
+        assert log.explains == 1
+
+    def test_explain_error(self, caplog):
+        log = SlowQueryLog(threshold=0, sample_rate=1)
+        con = ExplainConnection(fail=True)
+        entry = observe(log, 1, con)
+        assert entry.plan is None
+        assert entry.explain_error == "syntax error"
+        assert log.explain_errors == 1
+        assert "could not explain slow query" in caplog.text
+
+
+def test_db_records_slow_queries(monkeypatch):
+    monkeypatch.setattr(slow_queries, "threshold", 0.005)
+    monkeypatch.setattr(slow_queries, "sample_rate", 0)
+    monkeypatch.setattr(slow_queries, "entries", slow_queries.entries.copy())
+    con = FakeConnection([{"id": 42}], delay=0.01)
+    db = DB(FakeRequest(FakePool(con), path="/v3/locations/42"))
+    query = "SELECT id FROM locations WHERE id = :id"
+    asyncio.run(db._fetch(query, {"id": 42}))
+    entry = slow_queries.entries[-1]
+    assert entry.sql == "SELECT id FROM locations WHERE id = $1"
+    assert entry.args == [42]
+    assert entry.route == "/v3/locations/42"
+    assert entry.pool == "interactive"
+
+
+class TestAdminEndpoint:
+    def client(self):
+        app = FastAPI()
+        app.include_router(router)
+        return TestClient(app)
+
+    def test_disabled(self, monkeypatch):
+        monkeypatch.setattr(settings, "API_ADMIN_KEY", None)
+        response = self.client().get(
+            "/admin/slow-queries", headers={"X-Admin-Key": "secret"}
+        )
+        assert response.status_code == 404
+
+    def test_key(self, monkeypatch):
+        monkeypatch.setattr(settings, "API_ADMIN_KEY", "secret")
+        client = self.client()
+        assert client.get("/admin/slow-queries").status_code == 401
+        response = client.get("/admin/slow-queries", headers={"X-Admin-Key": "wrong"})
+        assert response.status_code == 401
+        response = client.get("/admin/slow-queries", headers={"X-Admin-Key": "secret"})
+        assert response.status_code == 200
+        assert response.headers["cache-control"] == "no-store"
+        assert set(response.json()) == {
+            "threshold",
+            "explains",
+            "explainErrors",
+            "fingerprints",
+            "queries",
+        }
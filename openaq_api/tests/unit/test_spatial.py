@@ -0,0 +1,109 @@
+import math
+import random
+from array import array
+
+import pytest
+
+from openaq_api.spatial import (
+    GridIndex,
+    distance,
+    radius_boxes,
+    sphere_distance,
+)
+
+
+class TestDistance:
+    def test_known(self):
+        # a degree along the equator and along a meridian of WGS 84
+        assert distance(0, 0, 1, 0) == pytest.approx(111319.490793, abs=1e-6)
+        assert distance(0, 0, 0, 1) == pytest.approx(110574.388558, abs=1e-6)
+        assert distance(-77.0373, 38.9074, -77.0373, 38.9074) == 0
+
+    def test_symmetric(self):
+        a, b = (-77.0373, 38.9074), (-76.9, 39.0)
+        assert distance(*a, *b) == pytest.approx(distance(*b, *a), abs=1e-9)
+
+    def test_antimeridian(self):
+        assert distance(179.99, 0, -179.99, 0) == pytest.approx(
+            distance(-0.01, 0, 0.01, 0), abs=1e-6
+        )
+
+    def test_antipodal(self):
+        # Vincenty does not converge, measured on the sphere instead
+        assert distance(0, 0, 179.9, 0.1) == pytest.approx(
+            sphere_distance(0, 0, 179.9, 0.1)
+        )
+
+
+class TestRadiusBoxes:
+    def test_box(self):
+        [(minx, miny, maxx, maxy)] = radius_boxes(-77, 38.9, 25000)
+        assert minx < -77 < maxx and miny < 38.9 < maxy
+        assert distance(-77, 38.9, minx, 38.9) > 25000
+        assert distance(-77, 38.9, -77, maxy) > 25000
+
+    def test_antimeridian(self):
+        east, west = radius_boxes(179.99, 10, 25000)
+        assert east[2] == 180 and west[0] == -180
+        assert distance(179.99, 10, east[0], 10) > 25000
+        assert distance(179.99, 10, west[2], 10) > 25000
+
+    def test_pole(self):
+        [(minx, _, maxx, maxy)] = radius_boxes(0, 89.9, 25000)
+        assert (minx, maxx, maxy) == (-180, 180, 90)
+
+
+def points(n: int, seed: int = 3):
+    rng = random.Random(seed)
+    xs, ys = array("d"), array("d")
+    centers = [(-77.0, 38.9), (179.95, -16.5), (-179.95, -16.6), (10.0, 89.8)]
+    for i in range(n):
+        if i % 50 == 0:
+            xs.append(math.nan)
+            ys.append(math.nan)
+            continue
+        cx, cy = centers[i % len(centers)]
+        x = cx + rng.uniform(-0.5, 0.5)
+        xs.append(x - 360 if x > 180 else x + 360 if x < -180 else x)
+        ys.append(min(90, cy + rng.uniform(-0.5, 0.5)))
+    return xs, ys
+
+
+class TestGridIndex:
+    @pytest.fixture(autouse=True)
+    def set_index(self):
+        self.xs, self.ys = points(2000)
+        self.index = GridIndex(self.xs, self.ys)
+
+    @pytest.mark.parametrize(
+        "lon,lat,radius",
+        [
+            (-77.0, 38.9, 25000),
+            (-77.3, 39.2, 1000),
+            (179.99, -16.55, 25000),
+            (-179.99, -16.55, 5000),
+            (10.0, 89.9, 25000),
+            (-170.0, 89.95, 20000),
+            (0, 0, 25000),
+        ],
+    )
+    def test_within(self, lon, lat, radius):
+        expected = [
+            p
+            for p, (x, y) in enumerate(zip(self.xs, self.ys))
+            if not math.isnan(x) and distance(lon, lat, x, y) <= radius
+        ]
+        assert self.index.within(lon, lat, radius) == expected
+
+    def test_bbox(self):
+        candidates = set(self.index.bbox(-77.2, 38.7, -76.8, 39.1))
+        for p, (x, y) in enumerate(zip(self.xs, self.ys)):
+            if -77.2 <= x <= -76.8 and 38.7 <= y <= 39.1:
+                assert p in candidates
+
+    def test_bbox_world(self):
+        # filters the cells instead of visiting every cell of the world
+        positions = self.index.bbox(-180, -90, 180, 90)
+        assert sorted(positions) == [
+            p for p, x in enumerate(self.xs) if not math.isnan(x)
+        ]
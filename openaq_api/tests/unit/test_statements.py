@@ -0,0 +1,141 @@
+import asyncio
+import asyncpg
+import pytest
+
+from openaq_api.db import DB
+from openaq_api.statements import (
+    Statement,
+    StatementConnection,
+    StatementRegistry,
+    statements,
+)
+
+from .conftest import FakeConnection, FakePool, FakeRequest
+
+QUERY = """
+SELECT id
+FROM locations
+WHERE id = :locations_id
+AND (provider->'id')::int = ANY (:providers_id)
+AND id > :locations_id
+LIMIT :limit
+"""
+
+
+class FakePrepared:
+    def __init__(self, sql, fail=0):
+        self.sql = sql
+        self.fail = fail
+        self.calls = []
+
+    async def fetch(self, *args):
+        self.calls.append(args)
+        if self.fail:
+            self.fail -= 1
+            raise asyncpg.exceptions.InvalidCachedStatementError("cached plan changed")
+        return [{"id": args[0]}]
+
+
+class PreparingConnection(FakeConnection):
+    """Runs the StatementConnection methods without a database"""
+
+    prepare_statement = StatementConnection.prepare_statement
+    fetch_statement = StatementConnection.fetch_statement
+
+    def __init__(self, fail=0):
+        super().__init__()
+        self.prepared = {}
+        self.prepares = []
+        self.fail = fail
+
+    async def prepare(self, sql):
+        self.prepares.append(sql)
+        if sql.startswith("broken"):
+            raise asyncpg.exceptions.PostgresSyntaxError("syntax error")
+        prepared = FakePrepared(sql, fail=self.fail)
+        self.fail = 0
+        return prepared
+
+    async def fetch(self, sql, *args):
+        raise AssertionError("registered statements are not run as text")
+
+
+class TestStatement:
+    def test_render(self):
+        statement = Statement("locations", QUERY)
+        assert "WHERE id = $1" in statement.sql
+        assert "ANY ($2)" in statement.sql
+        assert "AND id > $1" in statement.sql
+        assert "::int" in statement.sql
+        assert statement.params == ("locations_id", "providers_id", "limit")
+
+    def test_args(self):
+        statement = Statement("locations", QUERY)
+        kwargs = {"limit": 10, "providers_id": [1, 2], "locations_id": 42, "page": 1}
+        assert statement.args(kwargs) == [42, [1, 2], 10]
+
+    def test_missing_param(self):
+        statement = Statement("locations", QUERY)
+        with pytest.raises(KeyError):
+            statement.args({"locations_id": 42})
+
+
+class TestStatementRegistry:
+    def test_shapes(self):
+        registry = StatementRegistry(max_shapes=2)
+        first = registry.get("locations", "SELECT :a")
+        assert registry.get("locations", "SELECT :a") is first
+        assert registry.get("locations", "SELECT :b") is not None
+        # further shapes run as plain queries
+        assert registry.get("locations", "SELECT :c") is None
+        assert registry.get("latest", "SELECT :c") is not None
+        assert [len(shapes) for shapes in registry.statements.values()] == [2, 1]
+
+
+class TestStatementConnection:
+    def test_prepares_once(self):
+        con = PreparingConnection()
+        statement = Statement("locations", "SELECT :a")
+
+        async def run():
+            await con.fetch_statement(statement, [1])
+            return await con.fetch_statement(statement, [2])
+
+        assert asyncio.run(run()) == [{"id": 2}]
+        assert con.prepares == ["SELECT $1"]
+        assert con.prepared["SELECT $1"].calls == [(1,), (2,)]
+
+    def test_prepares_on_each_connection(self):
+        statement = Statement("locations", "SELECT :a")
+        first, second = PreparingConnection(), PreparingConnection()
+        asyncio.run(first.fetch_statement(statement, [1]))
+        # a connection prepares a statement the first time it runs on it
+        assert second.prepares == []
+        asyncio.run(second.fetch_statement(statement, [2]))
+        assert first.prepares == second.prepares == ["SELECT $1"]
+
+    def test_prepare_error(self):
+        con = PreparingConnection()
+        statement = Statement("broken", "broken :a")
+        with pytest.raises(asyncpg.exceptions.PostgresSyntaxError):
+            asyncio.run(con.fetch_statement(statement, [1]))
+        assert con.prepared == {}
+
+    def test_reprepares_invalid_statement(self):
+        con = PreparingConnection(fail=1)
+        statement = Statement("locations", "SELECT :a")
+        assert asyncio.run(con.fetch_statement(statement, [1])) == [{"id": 1}]
+        assert con.prepares == ["SELECT $1", "SELECT $1"]
+
+
+class TestDBStatements:
+    def test_fetch_statement(self):
+        con = PreparingConnection()
+        db = DB(FakeRequest(FakePool(con)))
+        query = "SELECT id FROM locations WHERE id = :locations_id"
+        rows = asyncio.run(
+            db._fetch(query, {"locations_id": 7}, statement="test_statement")
+        )
+        assert rows == [{"id": 7}]
+        assert statements.get("test_statement", query).sql in con.prepared
+        statements.statements.pop("test_statement")
@@ -0,0 +1,182 @@
+import asyncio
+import decimal
+
+import orjson
+import pytest
+from fastapi import HTTPException
+
+from openaq_api import db as db_module
+from openaq_api.db import DB
+from openaq_api.settings import settings
+from openaq_api.streaming import (
+    StreamFormat,
+    csv_chunks,
+    ndjson_chunks,
+    stream_response,
+)
+
+
+async def chunks(*chunks):
+    for c in chunks:
+        yield c
+
+
+async def collect(it):
+    return [c async for c in it]
+
+
+class TestNdjson:
+    def test_rows(self):
+        rows = [{"id": 1, "value": decimal.Decimal("1.5")}, {"id": 2, "value": None}]
+        body = b"".join(asyncio.run(collect(ndjson_chunks(chunks(rows[:1], rows[1:])))))
+        lines = body.splitlines()
+        assert [orjson.loads(line) for line in lines] == [
+            {"id": 1, "value": 1.5},
+            {"id": 2, "value": None},
+        ]
+
+    def test_transform(self):
+        out = asyncio.run(
+            collect(ndjson_chunks(chunks([{"id": 1}]), lambda r: {"x": r["id"]}))
+        )
+        assert out == [b'{"x":1}\n']
+
+
+class TestCsv:
+    def test_one_chunk_per_chunk(self):
+        out = asyncio.run(
+            collect(csv_chunks(chunks([(1, "a")], [(2, "b,c")]), ["id", "name"], list))
+        )
+        assert out == [b"id,name\r\n1,a\r\n", b'2,"b,c"\r\n']
+
+    def test_empty(self):
+        out = asyncio.run(collect(csv_chunks(chunks(), ["id"], list)))
+        assert out == [b"id\r\n"]
+
+
+class TestStreamResponse:
+    def test_errors_before_response(self):
+        async def fail():
+            raise ValueError("bad query")
+            yield b""
+
+        with pytest.raises(ValueError):
+            asyncio.run(stream_response(fail(), StreamFormat.csv, "measurements"))
+
+    def test_body(self):
+        async def run():
+            response = await stream_response(
+                chunks(b"a", b"b"), StreamFormat.ndjson, "measurements"
+            )
+            return response, await collect(response.body_iterator)
+
+        response, body = asyncio.run(run())
+        assert body == [b"a", b"b"]
+        assert response.media_type == "application/x-ndjson"
+        assert "measurements.ndjson" in response.headers["content-disposition"]
+
+
+class FakeContext:
+    def __init__(self, value=None):
+        self.value = value
+
+    async def __aenter__(self):
+        return self.value
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.fetches = []
+
+    async def fetch(self, n, timeout=None):
+        self.fetches.append(n)
+        rows, self.rows = self.rows[:n], self.rows[n:]
+        return rows
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.cur = FakeCursor(rows)
+        self.statements = []
+
+    def transaction(self, readonly=False):
+        return FakeContext()
+
+    async def execute(self, sql):
+        self.statements.append(sql)
+
+    async def cursor(self, query, *args, timeout=None):
+        self.statements.append(query)
+        return self.cur
+
+
+class FakePool:
+    def __init__(self, con, busy=False):
+        self.con = con
+        self.busy = busy
+        self.timeouts = []
+
+    def acquire(self, timeout=None):
+        self.timeouts.append(timeout)
+        if self.busy:
+            raise asyncio.TimeoutError()
+        return FakeContext(self.con)
+
+
+class StreamDB(DB):
+    def __init__(self, con, busy=False):
+        self.con = con
+        self.request = None
+        self.fake_pool = FakePool(con, busy)
+
+    async def pool(self, name="interactive"):
+        return self.fake_pool
+
+
+class TestDBStream:
+    @pytest.fixture(autouse=True)
+    def set_settings(self, monkeypatch):
+        monkeypatch.setattr(settings, "API_STREAM_CHUNK_SIZE", 2)
+        monkeypatch.setattr(settings, "API_STREAM_MAX_ROWS", 5)
+        monkeypatch.setattr(settings, "API_STREAM_CONCURRENCY", 1)
+        monkeypatch.setattr(settings, "API_STREAM_ACQUIRE_TIMEOUT", 0.01)
+        monkeypatch.setattr(db_module, "_stream_slots", None)
+
+    def test_chunks(self):
+        db = StreamDB(FakeConnection(list(range(3))))
+        out = asyncio.run(collect(db.stream("SELECT 1", {"limit": 10})))
+        assert out == [[0, 1], [2]]
+        assert db.con.statements[0].startswith("SET LOCAL statement_timeout")
+
+    def test_row_cap(self):
+        db = StreamDB(FakeConnection(list(range(100))))
+        out = asyncio.run(collect(db.stream("SELECT 1", {"limit": 100})))
+        assert out == [[0, 1], [2, 3], [4]]
+        assert db.con.cur.fetches == [2, 2, 1]
+
+    def test_concurrency(self):
+        async def run():
+            first = StreamDB(FakeConnection(list(range(3)))).stream("SELECT 1", {})
+            await anext(first)
+            try:
+                with pytest.raises(HTTPException) as e:
+                    await collect(StreamDB(FakeConnection([1])).stream("SELECT 1", {}))
+            finally:
+                await first.aclose()
+            # the slot is released when the first stream is closed
+            assert await collect(StreamDB(FakeConnection([1])).stream("SELECT 1", {}))
+            return e.value
+
+        assert asyncio.run(run()).status_code == 503
+
+    def test_acquire_timeout(self):
+        db = StreamDB(FakeConnection([1]), busy=True)
+        with pytest.raises(HTTPException) as e:
+            asyncio.run(collect(db.stream("SELECT 1", {})))
+        assert e.value.status_code == 503
+        assert db.fake_pool.timeouts == [0.01]
+        assert db_module.stream_slots()._value == 1
@@ -0,0 +1,432 @@
+import asyncio
+import gzip
+import time
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+from openaq_api.routers import admin
+
+from openaq_api.settings import settings
+from openaq_api.tile_cache import (
+    DiskTileStore,
+    RedisTileStore,
+    TileCache,
+    TileEntry,
+    accepts_gzip,
+    dumps_tile,
+    filters_digest,
+    tile_key,
+    tile_response,
+    tile_ttl,
+)
+from openaq_api.v3.routers import tiles
+from openaq_api.v3.routers.tiles import (
+    ThresholdTile,
+    Tile,
+    fetch_threshold_tiles,
+    fetch_tiles,
+    get_tile,
+)
+
+MVT = b"\x1a\x07default" * 20
+
+
+def request(**headers) -> Request:
+    return Request(
+        {
+            "type": "http",
+            "method": "GET",
+            "path": "/v3/locations/tiles/3/1/2.pbf",
+            "headers": [
+                (k.replace("_", "-").encode(), v.encode()) for k, v in headers.items()
+            ],
+        }
+    )
+
+
+def entry(data: bytes | None = MVT, ttl: float = 60) -> TileEntry:
+    return TileEntry(
+        'W/"abc"', None if data is None else gzip.compress(data), time.time() + ttl
+    )
+
+
+class TestKeys:
+    def test_ttl(self, monkeypatch):
+        monkeypatch.setattr(settings, "API_TILE_CACHE_TTLS", {5: 3600, 9: 1800})
+        monkeypatch.setattr(settings, "API_TILE_CACHE_TTL", 300)
+        assert [tile_ttl(z) for z in (0, 5, 6, 9, 10, 22)] == [
+            3600,
+            3600,
+            1800,
+            1800,
+            300,
+            300,
+        ]
+
+    def test_filters(self):
+        a = Tile(z=3, x=1, y=2, parameters_id="2,1")
+        b = Tile(z=9, x=100, y=200, parameters_id="1,2,2")
+        c = Tile(z=3, x=1, y=2, parameters_id="2")
+        # the same filters on any tile
+        assert filters_digest(a) == filters_digest(b)
+        assert filters_digest(a) != filters_digest(c)
+        assert filters_digest(Tile(z=3, x=1, y=2)) != filters_digest(c)
+        assert tile_key("locations", a) == f"locations:{filters_digest(a)}:3/1/2"
+
+    def test_layers(self):
+        tile = ThresholdTile(z=3, x=1, y=2, period=1, threshold=5)
+        other = ThresholdTile(z=3, x=1, y=2, period=30, threshold=5)
+        assert tile_key("thresholds", tile) != tile_key("thresholds", other)
+
+
+class TestTileResponse:
+    def test_gzip(self):
+        response = tile_response(request(accept_encoding="gzip, br"), entry())
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        assert gzip.decompress(response.body) == MVT
+        assert response.headers["etag"] == 'W/"abc"'
+        assert response.headers["cache-control"] in (
+            "public, max-age=59",
+            "public, max-age=60",
+        )
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert response.media_type == "application/x-protobuf"
+
+    def test_identity(self):
+        response = tile_response(request(), entry())
+        assert "content-encoding" not in response.headers
+        assert response.body == MVT
+
+    @pytest.mark.parametrize(
+        "header,accepted",
+        [
+            ("gzip", True),
+            ("br, GZIP;q=0.5", True),
+            ("*", True),
+            ("", False),
+            ("identity", False),
+            ("gzip;q=0", False),
+            ("gzip; q=0.000, br", False),
+            ("*;q=0", False),
+            ("*, gzip;q=0", False),
+            ("identity, *;q=0.1", True),
+        ],
+    )
+    def test_accepts_gzip(self, header, accepted):
+        assert accepts_gzip(header) is accepted
+
+    def test_refused_gzip(self):
+        response = tile_response(request(accept_encoding="gzip;q=0"), entry())
+        assert "content-encoding" not in response.headers
+        assert response.body == MVT
+
+    @pytest.mark.parametrize("tag", ['W/"abc"', '"abc"', '"x", W/"abc"', "*"])
+    def test_not_modified(self, tag):
+        response = tile_response(request(if_none_match=tag), entry())
+        assert response.status_code == 304
+        assert response.body == b""
+        assert response.headers["etag"] == 'W/"abc"'
+
+    def test_modified(self):
+        response = tile_response(request(if_none_match='W/"old"'), entry())
+        assert response.status_code == 200
+
+
+class FakeStore:
+    def __init__(self):
+        self.entries = {}
+        self.invalidated = []
+
+    async def get(self, key):
+        return self.entries.get(key)
+
+    async def set(self, key, entry):
+        self.entries[key] = entry
+
+    async def invalidate(self, prefix):
+        self.invalidated.append(prefix)
+
+
+class TestTileCache:
+    def test_miss_then_hit(self):
+        cache = TileCache(1024 * 1024)
+        loads = []
+
+        async def loader():
+            loads.append(1)
+            await asyncio.sleep(0.01)
+            return MVT
+
+        async def run():
+            tile = Tile(z=3, x=1, y=2)
+            # concurrent misses share one query
+            entries = await asyncio.gather(
+                *(cache.fetch("locations", tile, loader) for _ in range(5))
+            )
+            entries.append(await cache.fetch("locations", tile, loader))
+            return entries
+
+        entries = asyncio.run(run())
+        assert loads == [1]
+        assert len({e.etag for e in entries}) == 1
+        assert gzip.decompress(entries[0].data) == MVT
+        assert entries[0].etag.startswith('W/"')
+
+    def test_empty(self):
+        cache = TileCache(1024 * 1024)
+
+        async def loader():
+            return None
+
+        tile = Tile(z=3, x=1, y=2)
+        result = asyncio.run(cache.fetch("locations", tile, loader))
+        assert result.data is None
+        assert asyncio.run(cache.l1.get(tile_key("locations", tile))) == result
+
+    def test_zoom_ttl(self, monkeypatch):
+        monkeypatch.setattr(settings, "API_TILE_CACHE_TTLS", {5: 3600})
+        monkeypatch.setattr(settings, "API_TILE_CACHE_TTL", 300)
+        cache = TileCache(1024 * 1024)
+
+        async def loader():
+            return MVT
+
+        low = asyncio.run(cache.fetch("locations", Tile(z=2, x=1, y=1), loader))
+        high = asyncio.run(cache.fetch("locations", Tile(z=14, x=1, y=1), loader))
+        assert low.ttl > 3000 and high.ttl <= 300
+
+    def test_store(self):
+        store = FakeStore()
+        cache = TileCache(1024 * 1024, store)
+        tile = Tile(z=3, x=1, y=2)
+        key = tile_key("locations", tile)
+
+        async def loader():
+            raise AssertionError("served from the store")
+
+        store.entries[key] = entry()
+        result = asyncio.run(cache.fetch("locations", tile, loader))
+        assert result == store.entries[key]
+        # copied into the process cache
+        assert asyncio.run(cache.l1.get(key)) == result
+
+    def test_writes_store(self):
+        store = FakeStore()
+        cache = TileCache(1024 * 1024, store)
+        tile = Tile(z=3, x=1, y=2)
+
+        async def loader():
+            return MVT
+
+        async def run():
+            result = await cache.fetch("locations", tile, loader)
+            await asyncio.gather(*cache._tasks)
+            return result
+
+        result = asyncio.run(run())
+        assert store.entries[tile_key("locations", tile)] == result
+
+    def test_invalidate(self):
+        store = FakeStore()
+        cache = TileCache(1024 * 1024, store)
+        o3 = Tile(z=3, x=1, y=2, parameters_id="3")
+        o2 = Tile(z=3, x=1, y=2, parameters_id="2")
+
+        async def loader():
+            return MVT
+
+        async def run():
+            for tile in (o3, o2):
+                await cache.fetch("locations", tile, loader)
+            await cache.fetch("thresholds", o3, loader)
+            await cache.invalidate("locations", o3)
+            first = [await cache.l1.get(tile_key("locations", t)) for t in (o3, o2)]
+            await cache.invalidate("locations")
+            second = await cache.l1.get(tile_key("locations", o2))
+            thresholds = await cache.l1.get(tile_key("thresholds", o3))
+            return first, second, thresholds
+
+        (o3_entry, o2_entry), second, thresholds = asyncio.run(run())
+        assert o3_entry is None and o2_entry is not None
+        assert second is None and thresholds is not None
+        assert store.invalidated == [f"locations:{filters_digest(o3)}:", "locations:"]
+
+
+class TestDiskTileStore:
+    def test_round_trip(self, tmp_path):
+        store = DiskTileStore(str(tmp_path))
+        tile = Tile(z=3, x=1, y=2)
+        key = tile_key("locations", tile)
+        asyncio.run(store.set(key, entry()))
+        assert (tmp_path / "locations" / filters_digest(tile) / "3/1/2.tile").exists()
+        assert asyncio.run(store.get(key)) == entry()._replace(
+            expires_at=asyncio.run(store.get(key)).expires_at
+        )
+        assert store.hits == 2
+
+    def test_expired(self, tmp_path):
+        store = DiskTileStore(str(tmp_path))
+        asyncio.run(store.set("locations:f:3/1/2", entry(ttl=-1)))
+        assert asyncio.run(store.get("locations:f:3/1/2")) is None
+        assert not (tmp_path / "locations/f/3/1/2.tile").exists()
+
+    def test_invalidate(self, tmp_path):
+        store = DiskTileStore(str(tmp_path))
+        asyncio.run(store.set("locations:a:3/1/2", entry()))
+        asyncio.run(store.set("locations:b:3/1/2", entry()))
+        asyncio.run(store.invalidate("locations:a:"))
+        assert asyncio.run(store.get("locations:a:3/1/2")) is None
+        assert asyncio.run(store.get("locations:b:3/1/2")) is not None
+
+    def test_sweep(self, tmp_path):
+        size = len(dumps_tile(entry()))
+        store = DiskTileStore(str(tmp_path), max_bytes=size * 2)
+
+        async def run():
+            await store.set("locations:a:3/1/1", entry(ttl=-1))
+            await store.set("locations:a:3/1/2", entry(ttl=30))
+            await store.set("locations:a:3/1/3", entry(ttl=90))
+            await store.set("locations:a:3/1/4", entry(ttl=60))
+            await store._sweep
+
+        asyncio.run(run())
+        # the expired tile, then the tile closest to expiring
+        tiles = sorted(p.name for p in (tmp_path / "locations/a/3/1").iterdir())
+        assert tiles == ["3.tile", "4.tile"]
+
+    def test_sweep_leftovers(self, tmp_path, monkeypatch):
+        store = DiskTileStore(str(tmp_path))
+        (tmp_path / "other").write_bytes(b"x")
+        (tmp_path / "a.tile.1.tmp").write_bytes(b"x")
+        store._sweep_files()
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["a.tile.1.tmp", "other"]
+        # a write interrupted over a minute ago
+        now = time.time()
+        monkeypatch.setattr(time, "time", lambda: now + 120)
+        store._sweep_files()
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["other"]
+
+
+class FakeRedis:
+    def __init__(self, fail=False):
+        self.data = {}
+        self.fail = fail
+
+    async def get(self, key):
+        if self.fail:
+            raise ConnectionError("redis down")
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None):
+        assert ex > 0
+        self.data[key] = value
+
+    async def scan_iter(self, match):
+        for key in list(self.data):
+            if key.startswith(match.rstrip("*")):
+                yield key
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+
+class TestRedisTileStore:
+    def test_round_trip(self):
+        store = RedisTileStore(FakeRedis())
+        asyncio.run(store.set("locations:a:3/1/2", entry()))
+        assert asyncio.run(store.get("locations:a:3/1/2")).data == entry().data
+        asyncio.run(store.invalidate("locations:"))
+        assert asyncio.run(store.get("locations:a:3/1/2")) is None
+
+    def test_unavailable(self, caplog):
+        store = RedisTileStore(FakeRedis(fail=True))
+        assert asyncio.run(store.get("locations:a:3/1/2")) is None
+        assert not store.available
+        assert "tile cache redis unavailable" in caplog.text
+
+
+class FakeDB:
+    def __init__(self, tile):
+        self.tile = tile
+        self.calls = []
+        self.statements = []
+
+    async def fetchval(self, sql, params, statement=None, pool=None, cached=True):
+        self.calls.append(cached)
+        self.statements.append(statement)
+        return self.tile
+
+
+class TestGetTile:
+    def run(self, monkeypatch, vt, enabled=True, **headers):
+        monkeypatch.setattr(settings, "API_TILE_CACHE", enabled)
+        monkeypatch.setattr(tiles, "tile_cache", TileCache(1024 * 1024))
+        db = FakeDB(vt)
+        tile = Tile(z=3, x=1, y=2)
+        response = asyncio.run(get_tile(request(**headers), tile, db))
+        return response, db.calls
+
+    def test_cached(self, monkeypatch):
+        response, calls = self.run(monkeypatch, MVT, accept_encoding="gzip")
+        assert calls == [False]
+        assert gzip.decompress(response.body) == MVT
+        assert "etag" in response.headers
+
+    def test_empty(self, monkeypatch):
+        with pytest.raises(HTTPException) as e:
+            self.run(monkeypatch, None)
+        assert e.value.status_code == 204
+
+    def test_disabled(self, monkeypatch):
+        response, calls = self.run(monkeypatch, MVT, enabled=False)
+        assert calls == [True]
+        assert response.body == MVT
+        assert "etag" not in response.headers
+
+
+class TestInvalidateEndpoint:
+    def client(self, monkeypatch, cache):
+        monkeypatch.setattr(settings, "API_ADMIN_KEY", "secret")
+        monkeypatch.setattr(admin, "tile_cache", cache)
+        app = FastAPI()
+        app.include_router(admin.router)
+        return TestClient(app)
+
+    def test_invalidate(self, monkeypatch):
+        cache = TileCache(1024 * 1024)
+        tile = Tile(z=3, x=1, y=2)
+
+        async def loader():
+            return MVT
+
+        for layer in ("locations", "thresholds"):
+            asyncio.run(cache.fetch(layer, tile, loader))
+        client = self.client(monkeypatch, cache)
+        assert client.delete("/admin/tile-cache/locations").status_code == 401
+        response = client.delete(
+            "/admin/tile-cache/locations", headers={"X-Admin-Key": "secret"}
+        )
+        assert response.status_code == 204
+        assert asyncio.run(cache.l1.get(tile_key("locations", tile))) is None
+        assert asyncio.run(cache.l1.get(tile_key("thresholds", tile))) is not None
+
+    def test_unknown_layer(self, monkeypatch):
+        client = self.client(monkeypatch, TileCache(1024 * 1024))
+        response = client.delete(
+            "/admin/tile-cache/sensors", headers={"X-Admin-Key": "secret"}
+        )
+        assert response.status_code == 422
+
+
+def test_statements():
+    db = FakeDB(MVT)
+    asyncio.run(fetch_tiles(Tile(z=3, x=1, y=2), db))
+    asyncio.run(
+        fetch_threshold_tiles(ThresholdTile(z=3, x=1, y=2, period=1, threshold=5), db)
+    )
+    assert db.statements == ["v3_tiles", "v3_threshold_tiles"]
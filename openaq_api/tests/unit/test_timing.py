@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import time
+
+import orjson
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from openaq_api.access_log import AccessLog
+from openaq_api.db import DB
+from openaq_api.middleware import LoggingMiddleware
+from openaq_api.timing import ServerTiming, current_timing, time_endpoints
+
+from .conftest import FakeConnection, FakePool, FakeRequest
+
+ROWS = [{"id": 1, "found": 1}]
+
+
+def timed_request() -> FakeRequest:
+    return FakeRequest(FakePool(FakeConnection(ROWS, delay=0.01)))
+
+
+def server_timing(header: str) -> dict[str, float]:
+    phases = {}
+    for metric in header.split(", "):
+        name, duration = metric.split(";dur=")
+        phases[name] = float(duration)
+    return phases
+
+
+class TestServerTiming:
+    def test_header(self):
+        timing = ServerTiming()
+        timing.add("sql", 0.002)
+        timing.add("sql", 0.001)
+        timing.add("cache", 0.0005)
+        durations = timing.milliseconds()
+        assert list(durations) == ["cache", "sql", "total"]
+        assert durations["sql"] == 3.0
+        assert timing.header(durations) == (
+            f"cache;dur=0.5, sql;dur=3.0, total;dur={durations['total']}"
+        )
+
+    def test_phases(self):
+        timing = ServerTiming()
+        timing.add("ratelimit", 0.001)
+        timing.endpoint_started()
+        time.sleep(0.02)
+        timing.add("sql", 0.015)
+        timing.endpoint_returned()
+        timing.response_started()
+        assert timing.phases["validate"] < 0.01
+        # time recorded by the database phases is not the handler's
+        assert 0.005 <= timing.phases["handler"] < 0.015
+        assert timing.phases["serialize"] >= 0
+
+
+class TestDBTiming:
+    def test_fetch_page(self):
+        db = DB(timed_request())
+        timing = ServerTiming()
+
+        async def run():
+            current_timing.set(timing)
+            return await db.fetchPage("SELECT 'timing'", {"page": 1, "limit": 10})
+
+        result = asyncio.run(run())
+        assert result.meta.found == 1
+        assert set(timing.phases) == {"cache", "acquire", "sql", "rows"}
+        assert timing.phases["sql"] >= 0.01
+        assert timing.phases["cache"] < timing.phases["sql"]
+
+    def test_off(self):
+        db = DB(timed_request())
+        assert current_timing.get() is None
+        assert asyncio.run(db.fetch("SELECT 2", {})) == [{"id": 1, "found": 1}]
+
+
+def build_app(server_timing: bool) -> tuple[FastAPI, AccessLog]:
+    app = FastAPI()
+
+    async def slow_dependency():
+        await asyncio.sleep(0.01)
+        return 1
+
+    @app.get("/async")
+    async def async_endpoint(value: int = Depends(slow_dependency)):
+        return {"value": value}
+
+    @app.get("/sync")
+    def sync_endpoint():
+        return {"value": 2}
+
+    if server_timing:
+        time_endpoints(app.routes)
+    access_log = AccessLog(logging.getLogger("middleware"), flush_interval=60)
+    app.add_middleware(
+        LoggingMiddleware, access_log=access_log, server_timing=server_timing
+    )
+    return app, access_log
+
+
+class TestServerTimingHeader:
+    def test_header(self):
+        app, access_log = build_app(True)
+        response = TestClient(app).get("/async")
+        access_log.close()
+        phases = server_timing(response.headers["server-timing"])
+        assert list(phases) == ["validate", "handler", "serialize", "total"]
+        assert phases["validate"] >= 10
+        assert phases["total"] >= phases["validate"]
+
+    def test_sync_endpoint(self):
+        app, access_log = build_app(True)
+        response = TestClient(app).get("/sync")
+        access_log.close()
+        assert "handler" in server_timing(response.headers["server-timing"])
+
+    def test_logged(self, caplog):
+        app, access_log = build_app(True)
+        with caplog.at_level(logging.INFO, logger="middleware"):
+            response = TestClient(app).get("/async")
+            access_log.close()
+        log = orjson.loads(caplog.records[0].message)
+        assert log["serverTiming"] == server_timing(response.headers["server-timing"])
+
+    def test_off(self, caplog):
+        app, access_log = build_app(False)
+        with caplog.at_level(logging.INFO, logger="middleware"):
+            response = TestClient(app).get("/async")
+            access_log.close()
+        assert "server-timing" not in response.headers
+        assert orjson.loads(caplog.records[0].message)["serverTiming"] is None
@@ -0,0 +1,349 @@
+import asyncio
+import random
+import re
+import statistics
+from datetime import datetime, timedelta, timezone
+
+import orjson
+import pytest
+from buildpg import render
+
+from openaq_api.models.responses import Meta
+from openaq_api.settings import settings
+from openaq_api.sketches import RELATIVE_ACCURACY, TOTAL, QuantileSketch
+from openaq_api.trend_profiles import (
+    ADVISORY_LOCK,
+    CHANGED_NODES_SQL,
+    NODES_SQL,
+    PROFILE_COLUMNS,
+    TREND_PERIODS,
+    TRENDS_CTE,
+    TrendRefresher,
+    merge_partials,
+    months_covered,
+    profile_sql,
+    trend_rows,
+)
+from openaq_api.v3.routers import trends
+from openaq_api.v3.routers.trends import LocationTrendsQueries, fetch_trends
+
+
+def queries(**params) -> LocationTrendsQueries:
+    return LocationTrendsQueries(
+        **{
+            "locations_id": 1,
+            "measurands_id": 2,
+            "limit": 100,
+            "page": 1,
+            "period_name": "hour",
+            **params,
+        }
+    )
+
+
+class TestProfileSql:
+    def test_months_covered(self):
+        q = queries(date_from="2022-01-01", date_to="2022-03-15T00:00:00Z")
+        assert months_covered(q, "b", "tz") == (
+            "((b + '1 month'::interval) AT TIME ZONE tz) <= (SELECT until FROM refreshed)"
+            " AND (b AT TIME ZONE tz) >= (:date_from::timestamp AT TIME ZONE tz)"
+            " AND ((b + '1 month'::interval) AT TIME ZONE tz) <= :date_to"
+        )
+
+    def test_profile(self):
+        sql = profile_sql(queries(), "WHERE TRUE")
+        assert "FROM trend_profiles" in sql
+        assert "bucket = '-infinity'" in sql
+        assert "hourly_data" not in sql
+
+    def test_months(self):
+        q = queries(period_name="day", date_from="2022-01-01")
+        sql = profile_sql(q, "WHERE TRUE")
+        stored, hourly = sql.split("UNION ALL")
+        assert "FROM trend_profiles_refresh" in stored
+        assert "bucket > '-infinity'" in stored
+        assert "FROM hourly_data m" in hourly
+        assert "'ID'" in hourly
+        # the hourly rows of the partial month and of the months since the
+        # last refresh
+        assert (
+            "AND (m.datetime > (SELECT until FROM refreshed) - '1 month 2 days'::interval"
+            " OR m.datetime <= (:date_from::timestamp AT TIME ZONE 'UTC')"
+            " + '1 month 2 days'::interval)"
+        ) in hourly
+        assert "AND NOT (((date_trunc('month'" in hourly
+        # months are only read from profiles refreshed after they ended
+        for side in (stored, hourly):
+            assert "<= (SELECT until FROM refreshed)" in side
+
+    def test_renders(self):
+        q = queries(date_from="2022-01-01", date_to="2022-02-10")
+        sql, args = render(profile_sql(q, "WHERE TRUE"), **q.model_dump())
+        assert "$1" in sql and args[0] == "hour"
+
+
+def hourly_rows(n: int, seed: int = 5) -> list[dict]:
+    rng = random.Random(seed)
+    start = datetime(2023, 11, 20, tzinfo=timezone.utc)
+    return [
+        {
+            "datetime": start + timedelta(hours=i),
+            "value": rng.lognormvariate(2, 1),
+            "seconds": 3600 if i % 3 else 600,
+        }
+        for i in range(n)
+    ]
+
+
+def partial(rows: list[dict], factor: str, bucket=None) -> dict:
+    values = [r["value"] for r in rows]
+    mean = statistics.fmean(values)
+    return {
+        "sensor_nodes_id": 1,
+        "measurands_id": 2,
+        "bucket": bucket,
+        "factor": factor,
+        "avg_seconds": statistics.fmean(r["seconds"] for r in rows),
+        "log_seconds": 3600.0,
+        "datetime_from": min(r["datetime"] for r in rows),
+        "datetime_to": max(r["datetime"] for r in rows),
+        "value_count": len(rows),
+        "value_avg": mean,
+        "value_m2": sum((v - mean) ** 2 for v in values),
+        "value_min": min(values),
+        "value_max": max(values),
+        "values": values,
+        "sketch": None,
+    }
+
+
+def partials(rows: list[dict]) -> list[dict]:
+    # the hour of day factors of each month
+    groups: dict[tuple, list] = {}
+    for r in rows:
+        key = (r["datetime"].strftime("%Y-%m"), r["datetime"].strftime("%H"))
+        groups.setdefault(key, []).append(r)
+    return [partial(g, factor, month) for (month, factor), g in groups.items()]
+
+
+def stored(rows: list[dict]) -> list[dict]:
+    """The partial aggregates as read back from the profile store"""
+    return [
+        {**r, "values": None, "sketch": QuantileSketch().extend(r["values"]).to_dict()}
+        for r in rows
+    ]
+
+
+class TestMerge:
+    def test_merge_partials(self):
+        rows = hourly_rows(2000)
+        merged = merge_partials(partials(rows))
+        assert sorted(merged) == [f"{h:02}" for h in range(24)]
+        hour = [r for r in rows if r["datetime"].hour == 7]
+        total = merged["07"]
+        assert total["value_count"] == len(hour)
+        assert total["avg_seconds"] == pytest.approx(
+            statistics.fmean(r["seconds"] for r in hour)
+        )
+        assert total["datetime_from"] == hour[0]["datetime"]
+        assert total["datetime_to"] == hour[-1]["datetime"]
+        values = [r["value"] for r in hour]
+        assert total["moments"].mean == pytest.approx(statistics.fmean(values))
+        assert total["moments"].sd == pytest.approx(statistics.stdev(values))
+        assert total["sketch"].to_dict() == QuantileSketch().extend(values).to_dict()
+
+    def test_stored(self):
+        # the months read back from the profile store merge the same
+        rows = partials(hourly_rows(2000))
+        assert trend_rows(stored(rows)) == trend_rows(rows)
+
+    def test_trend_rows(self):
+        rows = hourly_rows(2000)
+        result = trend_rows(partials(rows))
+        columns = re.findall(
+            r"^ [ ,] (\w+) (?:text|float8|timestamptz|bigint)$", TRENDS_CTE, re.M
+        )
+        assert [r["factor"] for r in result] == [f"{h:02}" for h in range(24)]
+        assert sorted(result[0]) == sorted(columns)
+        values = sorted(r["value"] for r in rows if r["datetime"].hour == 0)
+        assert result[0]["value_min"] == values[0]
+        assert result[0]["value_p50"] == pytest.approx(
+            statistics.median(values), rel=RELATIVE_ACCURACY
+        )
+        # serializable as the trends parameter
+        orjson.dumps(result)
+
+
+class FakeTransaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.rows = rows
+        self.states = {}
+        self.table = {}
+        self.aggregated = []
+        self.executed = []
+        self.closed = False
+
+    def transaction(self):
+        return FakeTransaction()
+
+    async def fetchval(self, sql, *args):
+        assert "pg_try_advisory_xact_lock" in sql
+        assert args == (ADVISORY_LOCK,)
+        return True
+
+    async def fetchrow(self, sql, period_name, overlap):
+        calculated_until, pass_until, after = self.states.get(
+            period_name, (None, None, None)
+        )
+        return {
+            "first": calculated_until in (None, datetime.min),
+            "calculated_until": calculated_until or datetime.min,
+            "pass_until": pass_until or datetime(2024, 1, 1, tzinfo=timezone.utc),
+            "nodes_after": after or 0,
+        }
+
+    async def cursor(self, sql, *args):
+        [ids] = [a for a in args if isinstance(a, list)]
+        self.aggregated.append(ids)
+        for row in self.rows:
+            if row["sensor_nodes_id"] in ids:
+                yield row
+
+    async def executemany(self, sql, rows):
+        for row in rows:
+            self.table[row[:5]] = row
+
+    async def fetch(self, sql, *args):
+        if sql in (NODES_SQL, CHANGED_NODES_SQL):
+            after, limit = args[-2:]
+            ids = sorted(
+                {
+                    r["sensor_nodes_id"]
+                    for r in self.rows
+                    if r["sensor_nodes_id"] > after
+                }
+            )
+            return [{"sensor_nodes_id": i} for i in ids[:limit]]
+        period_name, nodes, measurands = args
+        keys = list(zip(nodes, measurands))
+        return [
+            {
+                **dict(zip(PROFILE_COLUMNS[1:-1], row[1:-1])),
+                "sketch": row[-1],
+            }
+            for k, row in self.table.items()
+            if k[0] == period_name and k[1:3] in keys and k[3] != TOTAL
+        ]
+
+    async def execute(self, sql, *args):
+        self.executed.append((sql, args))
+        if "trend_profiles_refresh" in sql:
+            self.states[args[0]] = args[1:]
+
+    async def close(self):
+        self.closed = True
+
+
+def refresh(refresher, con) -> bool:
+    async def connect():
+        return con
+
+    return asyncio.run(refresher.run(connect, backfill=True))
+
+
+class TestTrendRefresher:
+    def test_refresh(self):
+        rows = hourly_rows(1500)
+        con = FakeConnection(partials(rows))
+        refresher = TrendRefresher(batch=10)
+        assert refresh(refresher, con)
+        states = [args for sql, args in con.executed if "trend_profiles_refresh" in sql]
+        # a batch with the location then the end of the pass, per period
+        assert [args[0] for args in states] == [
+            p for p in TREND_PERIODS for _ in range(2)
+        ]
+        totals = {k[4]: row for k, row in con.table.items() if k[3] == TOTAL}
+        # a bounded number of factor rows per location and parameter
+        assert len(totals) == 24
+        sketch = QuantileSketch.from_dict(orjson.loads(totals["13"][-1]))
+        assert sketch.count == len([r for r in rows if r["datetime"].hour == 13])
+        assert con.closed and refresher.refreshes == 1
+
+    def test_batches(self):
+        rows = partials(hourly_rows(100))
+        con = FakeConnection(
+            [{**r, "sensor_nodes_id": n} for n in (1, 2, 3, 4, 5) for r in rows]
+        )
+        refresher = TrendRefresher(nodes=2)
+        assert refresh(refresher, con)
+        assert con.aggregated == [[1, 2], [3, 4], [5]] * len(TREND_PERIODS)
+        states = [args for sql, args in con.executed if "_refresh" in sql]
+        assert [args[3] for args in states[:4]] == [2, 4, 5, None]
+        assert con.states["hour"][0] == datetime(2024, 1, 1, tzinfo=timezone.utc)
+        assert len({k[1] for k in con.table if k[3] == TOTAL}) == 5
+
+
+class FakeDB:
+    def __init__(self, partials):
+        self.partials = partials
+        self.calls = []
+
+    async def fetch(self, sql, kwargs, statement=None, pool=None):
+        self.calls.append((sql, dict(kwargs)))
+        return self.partials
+
+    async def fetchPage(self, sql, kwargs, statement=None, pool=None):
+        self.calls.append((sql, dict(kwargs)))
+        return Meta.model_validate(kwargs)
+
+
+class TestFetchTrends:
+    def run(self, monkeypatch, enabled, partials, **params):
+        monkeypatch.setattr(settings, "API_TREND_PROFILES", enabled)
+        monkeypatch.setattr(trends.trend_refresher, "interval", None)
+        db = FakeDB(partials)
+        asyncio.run(fetch_trends(queries(**params), db))
+        return db.calls
+
+    def test_profiles(self, monkeypatch):
+        calls = self.run(monkeypatch, True, stored(partials(hourly_rows(500))))
+        (profile, _), (sql, params) = calls
+        assert "FROM trend_profiles" in profile
+        assert "jsonb_to_recordset(:trends::text::jsonb)" in sql
+        assert "PERCENTILE_CONT" not in sql
+        assert len(orjson.loads(params["trends"])) == 24
+        assert "expected_hours(datetime_from, datetime_to, 'hour', factor)" in sql
+
+    def test_not_profiled(self, monkeypatch):
+        calls = self.run(monkeypatch, True, [])
+        assert "PERCENTILE_CONT" in calls[1][0]
+
+    def test_not_profiled_with_dates(self, monkeypatch):
+        # only the hourly rows of the partial months, the months the dates
+        # include are not profiled
+        rows = partials(hourly_rows(500))
+        calls = self.run(monkeypatch, True, rows, date_from="2023-11-25")
+        (profile, _), (sql, params) = calls
+        assert "UNION ALL" in profile
+        assert "PERCENTILE_CONT" in sql
+        assert "trends" not in params
+
+    def test_profiled_with_dates(self, monkeypatch):
+        rows = partials(hourly_rows(1500))
+        calls = self.run(
+            monkeypatch, True, stored(rows[:-24]) + rows[-24:], date_from="2023-11-25"
+        )
+        assert "jsonb_to_recordset(:trends::text::jsonb)" in calls[1][0]
+
+    def test_disabled(self, monkeypatch):
+        [(sql, params)] = self.run(monkeypatch, False, [], period_name="month")
+        assert "PERCENTILE_CONT" in sql and "'MM'" in sql
+        assert "trends" not in params
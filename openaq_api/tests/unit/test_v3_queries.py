@@ -12,6 +12,7 @@ from openaq_api.v3.models.queries import (
     CommaSeparatedList,
     CountryIdQuery,
     CountryIsoQuery,
+    CursorQuery,
     DateFromQuery,
     DateToQuery,
     MobileQuery,
@@ -22,9 +23,12 @@ from openaq_api.v3.models.queries import (
     ProviderQuery,
     QueryBuilder,
     RadiusQuery,
+    compile_query,
     truncate_float,
 )
+from openaq_api.cursor import encode_cursor
 from openaq_api.v3.routers.locations import LocationPathQuery, LocationsQueries
+from openaq_api.v3.routers.measurements import LocationMeasurementsQueries
 
 
 class TestTruncateFloat:
@@ -438,6 +442,46 @@ class TestQueryBuilder:
         query_builder = QueryBuilder(query)
         assert query_builder.pagination() == "\nLIMIT :limit OFFSET :offset"
 
+    def test_compiled_once(self):
+        query_builder = QueryBuilder(QueryContainer(iso="us"))
+        assert query_builder.compiled is compile_query(QueryContainer)
+        assert QueryBuilder(QueryContainer(monitor=True)).compiled is (
+            query_builder.compiled
+        )
+
+    def test_producers_called_once(self):
+        calls = []
+
+        class CountedQuery(MonitorQuery):
+            def where(self):
+                calls.append(1)
+                return super().where()
+
+        class CountedContainer(CountedQuery, CountryIsoQuery):
+            ...
+
+        query_builder = QueryBuilder(CountedContainer(iso="us", monitor=True))
+        assert query_builder.where() == (
+            "WHERE country->>'code' = :iso\nAND ismonitor = :monitor"
+        )
+        # CountedContainer and CountedQuery resolve to the same method
+        assert len(calls) == 1
+
+    def test_fields_order(self):
+        class FieldsContainer(CursorQuery, RadiusQuery):
+            ...
+
+        query = FieldsContainer(coordinates="38.9072,-77.0369", radius=1000, cursor="*")
+        assert QueryBuilder(query).fields() == (
+            "\n,datetime as cursor_datetime, id as cursor_id"
+            "\n,ST_Distance(geog, ST_MakePoint(:lon, :lat)::geography) as distance"
+        )
+
+    def test_same_shape_same_sql(self):
+        first = QueryBuilder(QueryContainer(iso="us", monitor=True)).where()
+        second = QueryBuilder(QueryContainer(iso="ca", monitor=False)).where()
+        assert first == second
+
 
 class TestLocationPathQuery:
     def test_location_path_query(self):
@@ -462,3 +506,34 @@ class TestLocationsQueries:
                 coordinates=f"{latitude},{longitude}",
                 radius=radius,
             )
+
+
+class TestCursorQuery:
+    def test_no_value(self):
+        cursor_query = CursorQuery()
+        assert cursor_query.where() is None
+        assert cursor_query.fields() is None
+
+    def test_first_page(self):
+        cursor_query = CursorQuery(cursor="*")
+        assert cursor_query.where() is None
+        assert cursor_query.fields() == "datetime as cursor_datetime, id as cursor_id"
+
+    def test_next_page(self):
+        token = encode_cursor(datetime.datetime(2023, 1, 1), 1)
+        cursor_query = CursorQuery(cursor=token)
+        assert cursor_query.where() == "(datetime, id) > (:cursor_datetime, :cursor_id)"
+
+    def test_invalid(self):
+        with pytest.raises(fastapi.exceptions.HTTPException):
+            CursorQuery(cursor="abc")
+
+    def test_measurements_aggregates(self):
+        with pytest.raises(fastapi.exceptions.HTTPException):
+            LocationMeasurementsQueries(locations_id=1, cursor="*", period_name="day")
+
+    def test_measurements_limit(self):
+        with pytest.raises(fastapi.exceptions.HTTPException):
+            LocationMeasurementsQueries(locations_id=1, limit=5000)
+        query = LocationMeasurementsQueries(locations_id=1, limit=5000, format="csv")
+        assert query.limit == 5000
@@ -0,0 +1,150 @@
+import asyncio
+
+import orjson
+
+from openaq_api.db import DB
+from openaq_api.v3.models.responses import (
+    Location,
+    Measurement,
+    Meta,
+    aliased_jsonb,
+    raw_json_response,
+)
+
+LOCATION = {
+    "id": 1,
+    "name": "site_a",
+    "locality": None,
+    "timezone": "UTC",
+    "country": {"id": 1, "code": "US", "name": "United States"},
+    "owner": {"id": 1, "name": "owner"},
+    "provider": {"id": 1, "name": "provider"},
+    "is_mobile": False,
+    "is_monitor": True,
+    "instruments": [{"id": 1, "name": "instrument"}],
+    "sensors": [
+        {
+            "id": 1,
+            "name": "pm25 µg/m³",
+            "parameter": {
+                "id": 2,
+                "name": "pm25",
+                "units": "µg/m³",
+                "display_name": "PM2.5",
+            },
+        }
+    ],
+    "coordinates": {"latitude": 1.5, "longitude": 2.5},
+    "bounds": [2.5, 1.5, 2.5, 1.5],
+    "distance": None,
+    "datetime_first": {"utc": "2023-01-01T00:00:00Z", "local": "2023-01-01"},
+    "datetime_last": {"utc": "2023-01-02T00:00:00Z", "local": "2023-01-02"},
+}
+
+DATETIME = {"utc": "2023-01-01T00:00:00Z", "local": "2023-01-01"}
+
+MEASUREMENT = {
+    "period": {
+        "label": "1hour",
+        "interval": "01:00:00",
+        "datetime_from": DATETIME,
+        "datetime_to": DATETIME,
+    },
+    "value": 1.5,
+    "parameter": {"id": 2, "name": "pm25", "units": "µg/m³", "display_name": None},
+    "coordinates": None,
+    "summary": None,
+    "coverage": {
+        "expected_count": 1,
+        "expected_interval": "01:00:00",
+        "observed_count": 1,
+        "observed_interval": "01:00:00",
+        "percent_complete": 100.0,
+        "percent_coverage": 100.0,
+        "datetime_from": DATETIME,
+        "datetime_to": DATETIME,
+    },
+}
+
+
+class FakeDB(DB):
+    def __init__(self, row):
+        self.row = row
+        self.queries = []
+
+    async def fetchrow(self, query, kwargs, statement=None, pool="interactive"):
+        self.queries.append(query)
+        return self.row
+
+
+class TestAliasedJsonb:
+    def test_aliases(self):
+        sql = aliased_jsonb(Location, "row")
+        assert sql.startswith("jsonb_build_object('id', row->'id',")
+        assert "'isMobile', row->'is_mobile'" in sql
+        assert "'datetimeFirst', row->'datetime_first'" in sql
+        # every field of the model, in its order
+        aliases = [f.alias for f in Location.model_fields.values()]
+        positions = [sql.index(f"'{alias}', ") for alias in aliases]
+        assert positions == sorted(positions)
+
+    def test_nested_models(self):
+        sql = aliased_jsonb(Measurement, "row")
+        assert (
+            "CASE WHEN jsonb_typeof(row->'period') = 'object' THEN jsonb_build_object("
+            "'label', row->'period'->'label'"
+        ) in sql
+        assert "'datetimeFrom', row->'coverage'->'datetime_from'" in sql
+        assert "'percentComplete', row->'coverage'->'percent_complete'" in sql
+        # null nested objects are kept as they are
+        assert "ELSE row->'coverage' END" in sql
+
+    def test_nested_lists(self):
+        sql = aliased_jsonb(Location, "row")
+        assert "jsonb_array_elements(row->'sensors') WITH ORDINALITY i(value, n)" in sql
+        assert "ORDER BY i.n), '[]')" in sql
+        assert "'displayName', i.value->'parameter'->'display_name'" in sql
+
+    def test_unrenamed_models_unchanged(self):
+        sql = aliased_jsonb(Location, "row")
+        assert "'country', row->'country'," in sql
+        assert "'datetimeLast', row->'datetime_last')" in sql
+
+
+class TestRawJsonResponse:
+    def test_envelope(self):
+        location = Location.model_validate(LOCATION).model_dump(by_alias=True)
+        response = raw_json_response(Meta(found=1), orjson.dumps([location]))
+        body = orjson.loads(response.body)
+        assert response.media_type == "application/json"
+        assert body["meta"]["found"] == 1
+        assert body["results"] == [location]
+
+
+class TestFetchRawPage:
+    def test_found(self):
+        db = FakeDB({"results": "[]", "returned": 0, "found": 42})
+        meta, results = asyncio.run(
+            db.fetchRawPage("SELECT 1", {"limit": 10}, Location)
+        )
+        assert meta.found == 42
+        assert results == b"[]"
+
+    def test_full_page_without_count(self):
+        db = FakeDB({"results": "[{}, {}]", "returned": 2, "found": None})
+        meta, _ = asyncio.run(
+            db.fetchRawPage("SELECT 1", {"limit": 2, "page": 2}, Location)
+        )
+        assert meta.found == ">2"
+        assert meta.page == 2
+
+    def test_model_fields(self):
+        db = FakeDB({"results": "[]", "returned": 0, "found": None})
+        asyncio.run(db.fetchRawPage("SELECT 1", {"limit": 10}, Measurement))
+        # the fields of the model by their aliases
+        assert f"jsonb_agg({aliased_jsonb(Measurement, 'row')} ORDER BY n)" in (
+            db.queries[0]
+        )
+        # in the order of the page query
+        assert "row_number() OVER () as n" in db.queries[0]
+        assert ") ORDER BY n)" in db.queries[0]